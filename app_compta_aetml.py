@@ -1,38 +1,642 @@
 import customtkinter as ctk
 from tkinter import ttk, messagebox, filedialog
 import sqlite3
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from fpdf import FPDF
 from fpdf.enums import XPos, YPos
+try:
+    from pypdf import PdfReader, PdfWriter
+    from pypdf.errors import PyPdfError
+except ImportError:  # pypdf absent : dossier de clôture sans annexes fusionnées, justificatifs non indexés
+    PdfReader = PdfWriter = None
 import os
 import shutil
+import stat
 import webbrowser
 import sys
 import requests
 from packaging.version import parse as parse_version
 import calendar
 import locale ### NOUVEAU ###
+import time
+import re
+import threading
+import logging
+import functools
+import traceback
+import hashlib
+import uuid
+import zipfile
+import io
+import queue
+import csv
+import unicodedata
+import xml.etree.ElementTree as ET
+import difflib
+from bisect import bisect_left, bisect_right
+from array import array
+from collections import OrderedDict
+import json
+import pathlib
+import socket
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
+import ctypes
+import ctypes.util
+import select
+from collections import defaultdict, deque, Counter
+from contextlib import contextmanager
 
 # --- CONFIGURATION ---
 APP_VERSION = "1.1.1"  # Version incrémentée
 DB_FILE = "aetml_compta.db"
+SCHEMA_VERSION = 1  # PRAGMA user_version ; une sauvegarde d'un schéma plus récent est refusée
 APP_TITLE = "AETML - Gestion Comptable"
 ATTACHMENT_DIR = "attachments"
 REPORTS_DIR = "reports"
 SAVE_DIR = "save"
 
 # ... (Le reste de la configuration et la section DB restent identiques)
+# Catégories créées dans une nouvelle base ; ensuite gérées dans la table categories (vue Budget)
 CATEGORIES = {
     "recette": ["Recettes babyfoot", "Dons", "Sponsoring", "Cotisations", "Autre Recette"],
     "depense": ["Frais de production", "Frais de communication", "Frais de représentation", "Charges financières", "Taxe bancaire", "Prix et sponsoring", "Achats matériel", "Autre Dépense"]
 }
 DENOMINATIONS = [100, 50, 20, 10, 5, 2, 1, 0.5, 0.2, 0.1, 0.05]
+# Comptes créés dans une nouvelle base : (code enregistré dans entries.journal, nom, nature)
+ACCOUNTS = [("poste", "Poste", "banque"), ("caisse", "Caisse", "caisse")]
+# Soldes initiaux aussi tenus dans accounting_years (colonnes synchronisées entre postes)
+LEGACY_BALANCE_COLUMNS = {"poste": "initial_balance_poste", "caisse": "initial_balance_caisse"}
+
+# Réglages SQLite appliqués à chaque connexion (voir db_connect)
+SQLITE_PRAGMAS = {
+    "auto_vacuum": "INCREMENTAL",  # effectif pour une nouvelle base ; une base existante est convertie au premier VACUUM
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -20000,       # ~20 Mo de cache de pages
+    "mmap_size": 64 * 1024 * 1024,
+    "temp_store": "MEMORY",
+    "foreign_keys": "ON",
+    "busy_timeout": 5000,       # attente (ms) lorsqu'un autre poste écrit
+}
+# Base sur un partage réseau (chemin UNC, lecteur réseau, montage NFS/SMB) : le mode WAL exige une
+# mémoire partagée (-shm) que ces systèmes de fichiers ne garantissent pas entre postes
+NETWORK_SQLITE_PRAGMAS = {
+    "journal_mode": "DELETE",
+    "mmap_size": 0,
+    "busy_timeout": 15000,      # verrous plus lents à obtenir à travers le réseau
+}
+NETWORK_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afpfs", "fuse.sshfs", "davfs"}
+SQLITE_CACHED_STATEMENTS = 256
+# Plusieurs postes peuvent ouvrir la même base (dossier partagé)
+WRITE_RETRIES = 5               # nouvelles tentatives si la base reste verrouillée au-delà de busy_timeout
+DATA_VERSION_POLL_MS = 2000     # intervalle de détection des modifications faites par un autre poste
+
+# Contrôle d'intégrité (base + pièces jointes), lancé en arrière-plan au démarrage
+INTEGRITY_HASH_CACHE = "aetml_integrity.json"   # empreintes des pièces jointes déjà vérifiées
+INTEGRITY_WORKERS = 4
+ORPHAN_ATTACHMENT_DIR = "_orphelins"             # quarantaine des fichiers sans écriture (sous ATTACHMENT_DIR)
+
+# Maintenance de la base (ANALYZE, optimize, vacuum incrémental, checkpoint) quand l'application est inactive
+MAINTENANCE_IDLE_MS = 60000         # inactivité clavier/souris avant de lancer la maintenance
+MAINTENANCE_CHECK_MS = 15000
+MAINTENANCE_INTERVAL_S = 6 * 3600   # au plus une maintenance « inactive » toutes les 6 heures
+MAINTENANCE_BUDGET_S = 2.0          # temps maximal d'une maintenance en arrière-plan
+MAINTENANCE_EXIT_BUDGET_S = 1.0     # temps maximal à la fermeture
+VACUUM_PAGES_PER_STEP = 200         # pages libérées par transaction de vacuum incrémental
+VACUUM_BYTES_PER_S = 20 * 1024 * 1024  # débit prudent d'un VACUUM complet, pour estimer sa durée
+ANALYSIS_LIMIT = 1000               # lignes échantillonnées par index lors d'ANALYZE
+
+# Synchronisation entre postes par paquets de modifications (voir export_sync_package)
+SYNC_PACKAGE_EXT = ".aetmlsync"
+SYNC_FORMAT = 1
+# Tables synchronisées et colonnes dont la modification est journalisée
+SYNC_TABLES = {
+    "accounting_years": "name, start_date, end_date, initial_balance_poste, initial_balance_caisse",
+    "budgets": "year_id, category, amount",
+    "entries": "date, journal, libelle, category, type, amount, attachment_path, year_id",
+    "accounts": "code, name, kind",
+    "account_balances": "opening_balance",
+}
+# Tables sans colonne uid : un solde initial est désigné par « uid de l'exercice:code du compte »
+# (ceux du compte postal et de la caisse voyagent avec l'exercice, voir LEGACY_BALANCE_COLUMNS)
+SYNC_NATURAL_KEY_TABLES = {"account_balances"}
+
+# Nombre d'exercices gardés en mémoire (cache LRU des instantanés d'exercice)
+YEAR_CACHE_SIZE = 4
+
+# Courbes du tableau de bord, tracées sur un canevas Tk à partir des totaux mensuels pré-agrégés
+DASHBOARD_CHART_RANGES = {"Exercice": 1, "5 exercices": 5, "Tout l'historique": None}  # nombre d'exercices tracés
+DASHBOARD_CHART_MAX_POINTS = 60     # au-delà, les mois sont regroupés par trimestre, semestre ou année
+DASHBOARD_CHART_HEIGHT = 200
+DASHBOARD_CHART_GRIDLINES = 4
+DASHBOARD_SERIES_CACHE_SIZE = 8     # séries calculées gardées par empreinte des données
+CHART_ACCOUNT_COLORS = ("#4aa3df", "#f0ad4e", "#b07cd8", "#1abc9c", "#e67e22", "#95a5a6")
+CHART_RECETTES_COLOR = "#2ecc71"
+CHART_DEPENSES_COLOR = "#e74c3c"
+
+# Archivage des exercices clôturés : une base en lecture seule par exercice, attachée à la demande
+ARCHIVE_DIR = "archives"
+ARCHIVE_MAX_ATTACHED = 8    # SQLite limite le nombre de bases attachées (10 par défaut)
+
+# Pré-génération des rapports périodiques (mois terminés, exercices clôturés) au démarrage et en inactivité
+REPORT_PREGEN_DELAY_MS = 5000       # premier passage après le démarrage
+REPORT_PREGEN_IDLE_MS = 30000
+REPORT_PREGEN_INTERVAL_S = 15 * 60
+REPORT_PREGEN_WORKERS = 2           # processus de rendu PDF
+REPORT_PREGEN_TYPES = ("resultat", "budget")  # rapports d'un exercice clôturé, en plus du journal de chaque compte
+REPORT_LABELS = {"resultat": "Compte de résultat", "budget": "Budget annuel", "monthly_summary": "Résumé mensuel"}
+
+# Index plein texte des justificatifs PDF (FTS5), alimenté en arrière-plan
+ATTACHMENT_INDEX_DELAY_MS = 15000   # premier passage après le démarrage
+ATTACHMENT_INDEX_INTERVAL_S = 5 * 60
+ATTACHMENT_INDEX_WORKERS = 2        # processus d'extraction du texte
+ATTACHMENT_INDEX_BATCH = 50         # textes écrits par transaction
+ATTACHMENT_INDEX_MAX_PAGES = 20
+ATTACHMENT_INDEX_MAX_CHARS = 100000
+ATTACHMENT_SEARCH_LIMIT = 200
+
+# Rapprochement bancaire (relevé PostFinance / journal d'un compte bancaire)
+RECONCILE_DATE_WINDOW_DAYS = 5      # écart maximal entre la date du relevé et celle de l'écriture
+RECONCILE_AMBIGUITY_MARGIN = 0.2    # écart de similarité des libellés en dessous duquel deux candidats sont ex aequo
+
+# Détection des doublons (même journal, même montant, dates proches, ou même justificatif)
+DUPLICATE_DATE_WINDOW_DAYS = 3
+DUPLICATE_MIN_SCORE = 0.8           # similarité minimale (libellé pondéré par l'écart de dates) signalée
+
+# Classement automatique : règles (libellé, journal, fourchette de montant) et suggestions tirées de l'historique
+AUTO_CATEGORY_FALLBACKS = ("Autre Recette", "Autre Dépense")  # catégories « fourre-tout » reclassées par défaut
+AUTO_CATEGORY_MIN_COUNT = 3         # occurrences d'un libellé avant d'en apprendre la catégorie
+AUTO_CATEGORY_MIN_SHARE = 0.8       # part minimale de la catégorie majoritaire de ce libellé
+
+# Boîte de réception des justificatifs : dossier surveillé où sont déposés les PDF scannés
+INBOX_DIR = "inbox"
+INBOX_PENDING_DIR = "_a_attribuer"   # sous INBOX_DIR : pièces sans écriture correspondante
+INBOX_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png")
+INBOX_SETTLE_S = 2.0                # un fichier est traité quand sa taille n'a pas bougé depuis ce délai (scanner en cours d'écriture)
+INBOX_POLL_S = 10.0                 # scrutation du dossier quand inotify est indisponible
+INBOX_IDLE_WAKE_S = 60.0            # réveil de sécurité de la surveillance inotify
+INBOX_DATE_WINDOW_DAYS = 3          # écart toléré entre la date du nom de fichier et celle de l'écriture
+
+# Dossier de clôture (rapports, justificatifs et index dans un seul ZIP)
+DOSSIER_REPORT_TYPES = ("resultat", "budget")  # en plus du journal de chaque compte
+DOSSIER_APPENDIX_VOLUME_RECEIPTS = 100  # justificatifs par volume d'annexe fusionnée (borne la mémoire)
+
+# Tâches d'arrière-plan (base de données, fichiers, PDF) hors de la boucle Tk
+TASK_POLL_MS = 50                   # relève des tâches terminées par la boucle Tk
+BACKUP_PAGES_PER_STEP = 1024        # pages copiées entre deux vérifications d'annulation d'une sauvegarde
+
+# API JSON locale en lecture seule (activée avec AETML_API=1 ou l'option --api)
+API_ENV_VAR = "AETML_API"
+API_HOST = "127.0.0.1"
+API_PORT = 8765
+API_WORKERS = 8
+
+# Diagnostics (activés avec la variable d'environnement AETML_PROFILE=1 ou l'option --profile)
+PROFILE_ENV_VAR = "AETML_PROFILE"
+DIAGNOSTICS_LOG = "aetml_diagnostics.log"
+SLOW_QUERY_MS = 50
+N_PLUS_ONE_THRESHOLD = 20
+
+# Détection des blocages de la boucle Tk (AETML_WATCHDOG=1, --watchdog, ou avec le profilage)
+WATCHDOG_ENV_VAR = "AETML_WATCHDOG"
+WATCHDOG_TICK_MS = 100          # battement posé sur la boucle Tk
+WATCHDOG_STALL_MS = 500         # retard du battement au-delà duquel la boucle est considérée bloquée
+WATCHDOG_SAMPLE_MS = 50         # intervalle d'échantillonnage de la pile pendant un blocage
+WATCHDOG_MAX_STACKS = 3         # piles distinctes journalisées par blocage
+WATCHDOG_STACK_DEPTH = 12       # cadres conservés par pile (les plus profonds)
+
+# --- DIAGNOSTICS ET PROFILAGE ---
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+def normalize_sql(sql):
+    """Remplace les valeurs littérales d'une requête par '?' pour regrouper les requêtes identiques."""
+    return " ".join(_SQL_LITERALS.sub("?", sql).split())
+
+def diagnostics_logger(log_file=DIAGNOSTICS_LOG):
+    """Logger du journal de diagnostic, relié au fichier au premier appel."""
+    logger = logging.getLogger("aetml.diagnostics")
+    if not logger.handlers:
+        logger.setLevel(logging.INFO)
+        handler = logging.FileHandler(log_file, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        logger.addHandler(handler)
+    return logger
+
+def percentile(sorted_values, pct):
+    """Percentile (rang le plus proche) d'une liste déjà triée."""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+_PROFILER_INTERNALS = {'execute', 'executemany', 'fetchone', 'fetchmany', 'fetchall', '__next__', 'cursor', 'wrapper'}
+
+class QueryRecord:
+    __slots__ = ('sql', 'caller', 'action', 'duration_ms', 'rows', 'timestamp')
+
+    def __init__(self, sql, caller, action):
+        self.sql = sql
+        self.caller = caller
+        self.action = action
+        self.duration_ms = 0.0
+        self.rows = 0
+        self.timestamp = time.time()
+
+class Profiler:
+    """Instrumentation optionnelle : trace SQL, durées des opérations de l'App et détection des motifs N+1.
+
+    Les requêtes et les durées sont conservées dans des tampons circulaires (deque) de taille fixe.
+    Tant que `enabled` est faux, rien n'est enregistré et le surcoût se limite à un test booléen.
+    """
+    def __init__(self, history=500):
+        self.enabled = False
+        self.queries = deque(maxlen=history * 4)
+        self.timings = defaultdict(lambda: deque(maxlen=history))
+        self.action_query_counts = defaultdict(lambda: deque(maxlen=history))
+        self.n_plus_one = deque(maxlen=50)
+        self._state = threading.local()
+        self._logger = None
+
+    def enable(self, log_file=DIAGNOSTICS_LOG):
+        self.enabled = True
+        self._logger = diagnostics_logger(log_file)
+        self._logger.info("Profilage activé (v%s, SQLite %s)", APP_VERSION, sqlite3.sqlite_version)
+
+    def attach(self, conn):
+        """Branche la trace SQL sur une connexion."""
+        conn.set_trace_callback(self._trace)
+
+    def _find_caller(self):
+        frame = sys._getframe(2)
+        while frame is not None:
+            code = frame.f_code
+            if code.co_filename == __file__ and code.co_name not in _PROFILER_INTERNALS:
+                return f"{code.co_name}:{frame.f_lineno}"
+            frame = frame.f_back
+        return "?"
+
+    def _trace(self, sql):
+        if not self.enabled:
+            return
+        state = self._state
+        if getattr(state, 'bulk', False) and getattr(state, 'last_record', None) is not None:
+            return  # executemany : une seule entrée pour tout le lot
+        record = QueryRecord(sql, self._find_caller(), getattr(state, 'action', None))
+        state.last_record = record
+        self.queries.append(record)
+        counts = getattr(state, 'statement_counts', None)
+        if counts is not None:
+            counts[normalize_sql(sql)] += 1
+
+    def _begin_statement(self, bulk=False):
+        self._state.last_record = None
+        self._state.bulk = bulk
+
+    def _end_statement(self, started, rowcount):
+        state = self._state
+        state.bulk = False
+        record = getattr(state, 'last_record', None)
+        if record is not None:
+            record.duration_ms += (time.perf_counter() - started) * 1000
+            if rowcount > 0:
+                record.rows += rowcount
+            if self._logger and record.duration_ms > SLOW_QUERY_MS:
+                self._logger.warning("Requête lente %.1f ms (%s, %s) : %s", record.duration_ms, record.caller, record.action, record.sql)
+        return record
+
+    @contextmanager
+    def action(self, name):
+        """Chronomètre une opération ; l'opération la plus externe compte aussi ses requêtes SQL."""
+        state = self._state
+        outermost = getattr(state, 'action', None) is None
+        if outermost:
+            state.action = name
+            state.statement_counts = Counter()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            self.timings[name].append(duration_ms)
+            if outermost:
+                counts = state.statement_counts
+                state.action = None
+                state.statement_counts = None
+                total = sum(counts.values())
+                self.action_query_counts[name].append(total)
+                for sql, count in counts.items():
+                    if count >= N_PLUS_ONE_THRESHOLD:
+                        self.n_plus_one.append((name, sql, count))
+                        if self._logger:
+                            self._logger.warning("Motif N+1 dans '%s' : %d x %s", name, count, sql)
+                if self._logger:
+                    self._logger.info("%s : %.1f ms, %d requêtes", name, duration_ms, total)
+
+    def record(self, name, duration_ms):
+        """Durée d'une opération chronométrée hors de action() (tâche exécutée dans un processus de rendu)."""
+        self.timings[name].append(duration_ms)
+        if self._logger:
+            self._logger.info("%s : %.1f ms", name, duration_ms)
+
+    def timing_stats(self):
+        stats = {}
+        for name, values in self.timings.items():
+            ordered = sorted(values)
+            stats[name] = {'count': len(ordered), 'p50': percentile(ordered, 50), 'p90': percentile(ordered, 90),
+                           'p99': percentile(ordered, 99), 'max': ordered[-1] if ordered else 0.0}
+        return stats
+
+    def slowest_queries(self, limit=15):
+        return sorted(self.queries, key=lambda r: r.duration_ms, reverse=True)[:limit]
+
+    def report(self):
+        """Résumé texte affiché dans le panneau de diagnostic."""
+        lines = [f"Profilage {'actif' if self.enabled else 'inactif'} - {len(self.queries)} requêtes en mémoire", ""]
+        lines.append("Opérations (ms)            n      p50      p90      p99      max")
+        for name, st in sorted(self.timing_stats().items()):
+            lines.append(f"{name:<24}{st['count']:>5}{st['p50']:>9.1f}{st['p90']:>9.1f}{st['p99']:>9.1f}{st['max']:>9.1f}")
+        lines += ["", "Requêtes par action         moy.     max"]
+        for name, counts in sorted(self.action_query_counts.items()):
+            if counts:
+                lines.append(f"{name:<24}{sum(counts) / len(counts):>9.1f}{max(counts):>9}")
+        lines += ["", "Requêtes les plus lentes"]
+        for record in self.slowest_queries():
+            lines.append(f"{record.duration_ms:>9.2f} ms {record.rows:>7} lignes  {record.caller:<28} {record.sql[:120]}")
+        lines += ["", "Motifs N+1 détectés"]
+        seen = set()
+        for name, sql, count in reversed(self.n_plus_one):
+            if (name, sql) in seen:
+                continue
+            seen.add((name, sql))
+            lines.append(f"{name}: {count} x {sql}")
+        if not seen:
+            lines.append("(aucun)")
+        return "\n".join(lines)
+
+PROFILER = Profiler()
+
+_MODAL_DIALOG_FILES = ("messagebox.py", "filedialog.py", "simpledialog.py", "commondialog.py")
+
+class StallWatchdog:
+    """Détecte les blocages de la boucle Tk et échantillonne la pile du thread principal pendant qu'ils durent.
+
+    Un battement after() note l'heure de chaque passage dans la boucle ; tant que ce battement est
+    en retard, un thread échantillonneur relève la pile du thread principal (sys._current_frames).
+    À la reprise, le blocage est journalisé avec sa durée, l'action de l'App en cours et les piles
+    les plus fréquentes. Inactif, il n'y a ni battement ni thread.
+    """
+    def __init__(self, tick_ms=WATCHDOG_TICK_MS, stall_ms=WATCHDOG_STALL_MS, sample_ms=WATCHDOG_SAMPLE_MS, history=50):
+        self.enabled = False
+        self.tick_ms = tick_ms
+        self.stall_ms = stall_ms
+        self.sample_ms = sample_ms
+        self.stalls = deque(maxlen=history)     # (horodatage, durée ms, action, origine, [(n, pile)])
+        self._actions = []                      # actions @profiled en cours sur le thread principal
+        self._samples = Counter()
+        self._stall_action = None
+        self._last_tick = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._widget = None
+        self._main_thread_id = threading.main_thread().ident
+        self._logger = None
+
+    def start(self, widget):
+        """Pose le battement sur la boucle Tk de `widget` et démarre l'échantillonneur."""
+        if self.enabled:
+            return
+        self.enabled = True
+        self._widget = widget
+        self._logger = diagnostics_logger()
+        # Un événement par démarrage : un ancien battement ou échantillonneur ne survit pas à un redémarrage
+        self._stop = threading.Event()
+        self._last_tick = time.perf_counter()
+        widget.after(self.tick_ms, self._tick, self._stop)
+        self._thread = threading.Thread(target=self._sample_loop, args=(self._stop,), name="aetml-watchdog", daemon=True)
+        self._thread.start()
+        self._logger.info("Surveillance de la boucle Tk activée (seuil %d ms)", self.stall_ms)
+
+    def stop(self):
+        self.enabled = False
+        self._stop.set()
+
+    @contextmanager
+    def action(self, name):
+        """Marque l'action de l'App en cours, pour l'attribuer aux blocages qu'elle provoque."""
+        if threading.get_ident() != self._main_thread_id:
+            yield
+            return
+        self._actions.append(name)
+        try:
+            yield
+        finally:
+            self._actions.pop()
+
+    def _tick(self, stop):
+        if stop.is_set():
+            return
+        now = time.perf_counter()
+        late_ms = (now - self._last_tick) * 1000 - self.tick_ms
+        self._last_tick = now
+        if late_ms > self.stall_ms:
+            self._report_stall(late_ms)
+        self._widget.after(self.tick_ms, self._tick, stop)
+
+    def _sample_loop(self, stop):
+        threshold = (self.tick_ms + self.stall_ms) / 1000
+        while not stop.wait(self.sample_ms / 1000):
+            if time.perf_counter() - self._last_tick < threshold:
+                continue
+            frame = sys._current_frames().get(self._main_thread_id)
+            if frame is None:
+                continue
+            stack = tuple(traceback.extract_stack(frame))
+            del frame
+            key = tuple((os.path.basename(fs.filename), fs.lineno, fs.name) for fs in stack)
+            with self._lock:
+                self._samples[key] += 1
+                if self._stall_action is None and self._actions:
+                    self._stall_action = " > ".join(self._actions)
+
+    @staticmethod
+    def stack_origin(stack):
+        """Premier cadre de l'application appelé depuis la boucle Tk (la fonction de rappel fautive)."""
+        app_file = os.path.basename(__file__)
+        left_app = False
+        for filename, lineno, name in stack:
+            if filename != app_file:
+                left_app = True
+            elif left_app and name != "wrapper":   # décorateur @profiled
+                return f"{name}:{lineno}"
+        return "?"
+
+    def _report_stall(self, late_ms):
+        with self._lock:
+            samples, self._samples = self._samples, Counter()
+            action, self._stall_action = self._stall_action, None
+        stacks = [(count, stack) for stack, count in samples.most_common(WATCHDOG_MAX_STACKS)]
+        origin = self.stack_origin(stacks[0][1]) if stacks else "?"
+        self.stalls.append((time.time(), late_ms, action, origin, stacks))
+        # Une boîte de dialogue modale suspend aussi le battement : attente de l'utilisateur, pas un blocage
+        modal = bool(stacks) and any(frame[0] in _MODAL_DIALOG_FILES for frame in stacks[0][1])
+        log = self._logger.info if modal else self._logger.warning
+        log("Boucle Tk %s %.0f ms (action : %s, origine : %s, %d échantillons)",
+            "en attente d'un dialogue" if modal else "bloquée", late_ms, action or "-", origin, sum(samples.values()))
+        for count, stack in stacks:
+            log("  %d x\n%s", count, "\n".join(f"    {filename}:{lineno} {name}" for filename, lineno, name in stack[-WATCHDOG_STACK_DEPTH:]))
+
+    def report(self):
+        """Résumé texte des derniers blocages, affiché dans le panneau de diagnostic."""
+        lines = [f"Surveillance de la boucle Tk {'active' if self.enabled else 'inactive'} - seuil {self.stall_ms} ms"]
+        if not self.stalls:
+            lines.append("(aucun blocage)")
+        for timestamp, late_ms, action, origin, stacks in reversed(self.stalls):
+            deepest = stacks[0][1][-1] if stacks else None
+            where = f"{deepest[0]}:{deepest[1]} {deepest[2]}" if deepest else "?"
+            lines.append(f"{datetime.fromtimestamp(timestamp):%d.%m %H:%M:%S} {late_ms:>8.0f} ms  {action or '-':<24} {origin:<32} {where}")
+        return "\n".join(lines)
+
+WATCHDOG = StallWatchdog()
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Curseur mesurant la durée d'exécution et le nombre de lignes de chaque requête tracée."""
+    _record = None
+
+    def execute(self, sql, parameters=()):
+        PROFILER._begin_statement()
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record = PROFILER._end_statement(started, self.rowcount)
+
+    def executemany(self, sql, seq_of_parameters):
+        PROFILER._begin_statement(bulk=True)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._record = PROFILER._end_statement(started, self.rowcount)
+
+    def _account(self, started, rows):
+        if self._record is not None:
+            self._record.duration_ms += (time.perf_counter() - started) * 1000
+            self._record.rows += rows
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._account(started, 1 if row is not None else 0)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._account(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._account(started, len(rows))
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        row = super().__next__()
+        self._account(started, 1)
+        return row
+
+class ProfiledConnection(sqlite3.Connection):
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def profiled(action_name):
+    """Décorateur chronométrant une méthode de l'App lorsque le profilage ou la surveillance est actif."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled and not WATCHDOG.enabled:
+                return func(*args, **kwargs)
+            with WATCHDOG.action(action_name):
+                if not PROFILER.enabled:
+                    return func(*args, **kwargs)
+                with PROFILER.action(action_name):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 # --- GESTION DE LA BASE DE DONNÉES (SQLite) ---
-def db_connect():
+def is_network_path(path):
+    """Indique si le fichier se trouve sur un partage réseau (UNC, lecteur réseau Windows, montage NFS/SMB)."""
+    path = os.path.abspath(path)
+    if path.startswith(("\\\\", "//")):
+        return True
+    if sys.platform == "win32":
+        drive = os.path.splitdrive(path)[0]
+        if not drive:
+            return False
+        try:
+            import ctypes
+            return ctypes.windll.kernel32.GetDriveTypeW(drive + "\\") == 4  # DRIVE_REMOTE
+        except (ImportError, AttributeError, OSError):
+            return False
+    try:
+        with open("/proc/mounts", encoding="utf-8") as f:
+            mounts = [line.split()[1:3] for line in f if len(line.split()) >= 3]
+    except OSError:
+        return False
+    # Point de montage le plus long contenant le fichier
+    best, best_type = "", None
+    for mount_point, fs_type in mounts:
+        mount_point = mount_point.replace("\\040", " ")
+        if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) > len(best):
+            best, best_type = mount_point, fs_type
+    return best_type in NETWORK_FILESYSTEMS
+
+def sqlite_pragmas(db_file):
+    """Réglages SQLite pour ce fichier : SQLITE_PRAGMAS, sans WAL ni mmap sur un partage réseau."""
+    if db_file == ":memory:" or not is_network_path(db_file):
+        return SQLITE_PRAGMAS
+    return {**SQLITE_PRAGMAS, **NETWORK_SQLITE_PRAGMAS}
+
+def _set_journal_mode(conn, mode):
+    """Change le mode de journal ; quitter WAL demande que les autres connexions soient fermées."""
+    for attempt in range(WRITE_RETRIES + 1):
+        try:
+            conn.execute(f"PRAGMA journal_mode = {mode}")
+            return
+        except sqlite3.OperationalError as e:
+            if not is_locked_error(e):
+                raise
+            if attempt == WRITE_RETRIES:
+                print(f"Mode de journal {mode} non appliqué, base utilisée par un autre poste : {e}")
+                return
+            time.sleep(0.05 * 2 ** attempt)
+
+def db_connect(db_file=DB_FILE):
     """Initialise la connexion à la base de données et crée les tables si elles n'existent pas."""
-    conn = sqlite3.connect(DB_FILE)
+    if PROFILER.enabled:
+        conn = sqlite3.connect(db_file, factory=ProfiledConnection, cached_statements=SQLITE_CACHED_STATEMENTS)
+        PROFILER.attach(conn)
+    else:
+        conn = sqlite3.connect(db_file, cached_statements=SQLITE_CACHED_STATEMENTS)
     conn.row_factory = sqlite3.Row
+    for pragma, value in sqlite_pragmas(db_file).items():
+        if pragma == "journal_mode":
+            _set_journal_mode(conn, value)
+        else:
+            conn.execute(f"PRAGMA {pragma} = {value}")
     cursor = conn.cursor()
     cursor.execute("CREATE TABLE IF NOT EXISTS accounting_years (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, start_date TEXT, end_date TEXT, initial_balance_poste REAL NOT NULL DEFAULT 0, initial_balance_caisse REAL NOT NULL DEFAULT 0)")
     cursor.execute("""
@@ -58,6 +662,14 @@ def db_connect():
         cursor.execute("ALTER TABLE entries ADD COLUMN year_id INTEGER REFERENCES accounting_years(id)")
     if 'attachment_path' not in columns_entries:
         cursor.execute("ALTER TABLE entries ADD COLUMN attachment_path TEXT")
+    if 'version' not in columns_entries:
+        cursor.execute("ALTER TABLE entries ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+    if 'reconciled_on' not in columns_entries:
+        # Date du mouvement bancaire correspondant (NULL : écriture non pointée)
+        cursor.execute("ALTER TABLE entries ADD COLUMN reconciled_on TEXT")
+    if 'attachment_sha256' not in columns_entries:
+        # Empreinte du justificatif (détection des doublons) ; NULL : pas encore calculée
+        cursor.execute("ALTER TABLE entries ADD COLUMN attachment_sha256 TEXT")
 
     cursor.execute("PRAGMA table_info(accounting_years)")
     columns_years = [info[1] for info in cursor.fetchall()]
@@ -65,10 +677,3099 @@ def db_connect():
         cursor.execute("ALTER TABLE accounting_years ADD COLUMN initial_balance_poste REAL NOT NULL DEFAULT 0")
     if 'initial_balance_caisse' not in columns_years:
         cursor.execute("ALTER TABLE accounting_years ADD COLUMN initial_balance_caisse REAL NOT NULL DEFAULT 0")
+    if 'archive_file' not in columns_years:
+        # Exercice archivé : ses écritures, détails de caisse et budgets sont dans ce fichier
+        cursor.execute("ALTER TABLE accounting_years ADD COLUMN archive_file TEXT")
+
+    # --- Comptes (un journal par compte) et soldes initiaux par exercice ---
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS accounts (
+            id INTEGER PRIMARY KEY, code TEXT NOT NULL UNIQUE, name TEXT NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'banque', position INTEGER NOT NULL DEFAULT 0)
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS account_balances (
+            year_id INTEGER NOT NULL REFERENCES accounting_years(id) ON DELETE CASCADE,
+            account_id INTEGER NOT NULL REFERENCES accounts(id) ON DELETE CASCADE,
+            opening_balance REAL NOT NULL DEFAULT 0, PRIMARY KEY (year_id, account_id)) WITHOUT ROWID
+    """)
+    if cursor.execute("SELECT COUNT(*) FROM accounts").fetchone()[0] == 0:
+        cursor.executemany("INSERT INTO accounts (code, name, kind, position) VALUES (?, ?, ?, ?)",
+                           [(code, name, kind, position) for position, (code, name, kind) in enumerate(ACCOUNTS)])
+        cursor.execute("INSERT OR IGNORE INTO accounts (code, name, position) "
+                       "SELECT journal, journal, 1000 FROM entries WHERE journal IS NOT NULL GROUP BY journal")
+        for code, column in LEGACY_BALANCE_COLUMNS.items():
+            cursor.execute(f"INSERT OR IGNORE INTO account_balances (year_id, account_id, opening_balance) "
+                           f"SELECT y.id, a.id, y.{column} FROM accounting_years y JOIN accounts a ON a.code = ?", (code,))
+    legacy_case = " ".join(f"WHEN '{code}' THEN NEW.{column}" for code, column in LEGACY_BALANCE_COLUMNS.items())
+    for event in ("INSERT", f"UPDATE OF {', '.join(LEGACY_BALANCE_COLUMNS.values())}"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_accounting_years_{event.split()[0].lower()[:3]}_balances AFTER {event} ON accounting_years BEGIN
+                INSERT OR REPLACE INTO account_balances (year_id, account_id, opening_balance)
+                    SELECT NEW.id, id, CASE code {legacy_case} END FROM accounts
+                    WHERE code IN ({', '.join(f"'{code}'" for code in LEGACY_BALANCE_COLUMNS)});
+            END
+        """)
+    # Un journal inconnu (écriture reçue d'un autre poste, sauvegarde) crée son compte
+    for event in ("INSERT", "UPDATE OF journal"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_entries_{event.split()[0].lower()[:3]}_account AFTER {event} ON entries
+            WHEN NEW.journal IS NOT NULL BEGIN
+                INSERT OR IGNORE INTO accounts (code, name, position) VALUES (NEW.journal, NEW.journal, 1000);
+            END
+        """)
+
+    # --- Catégories hiérarchiques (parent_id) et table de fermeture (tous les couples ancêtre/descendant) ---
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, type TEXT NOT NULL DEFAULT 'depense',
+            parent_id INTEGER REFERENCES categories(id), position INTEGER NOT NULL DEFAULT 0)
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS category_closure (
+            ancestor_id INTEGER NOT NULL, descendant_id INTEGER NOT NULL, depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id)) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_category_closure_descendant ON category_closure (descendant_id, ancestor_id)")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_categories_ins_closure AFTER INSERT ON categories BEGIN
+            INSERT INTO category_closure (ancestor_id, descendant_id, depth) VALUES (NEW.id, NEW.id, 0);
+            INSERT INTO category_closure (ancestor_id, descendant_id, depth)
+                SELECT ancestor_id, NEW.id, depth + 1 FROM category_closure WHERE descendant_id = NEW.parent_id;
+        END
+    """)
+    # Déplacement : le sous-arbre perd ses anciens ancêtres et reçoit ceux du nouveau parent
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_categories_upd_closure AFTER UPDATE OF parent_id ON categories
+        WHEN OLD.parent_id IS NOT NEW.parent_id BEGIN
+            DELETE FROM category_closure
+                WHERE descendant_id IN (SELECT descendant_id FROM category_closure WHERE ancestor_id = NEW.id)
+                  AND ancestor_id NOT IN (SELECT descendant_id FROM category_closure WHERE ancestor_id = NEW.id);
+            INSERT INTO category_closure (ancestor_id, descendant_id, depth)
+                SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+                FROM category_closure a, category_closure d WHERE a.descendant_id = NEW.parent_id AND d.ancestor_id = NEW.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_categories_del_closure AFTER DELETE ON categories BEGIN
+            DELETE FROM category_closure WHERE descendant_id = OLD.id OR ancestor_id = OLD.id;
+        END
+    """)
+    if cursor.execute("SELECT COUNT(*) FROM categories").fetchone()[0] == 0:
+        cursor.executemany("INSERT INTO categories (name, type, position) VALUES (?, ?, ?)",
+                           [(name, type_op, position) for type_op, names in CATEGORIES.items() for position, name in enumerate(names)])
+    # Les écritures et budgets gardent le nom (paquets de synchronisation, sauvegardes, archives)
+    # et y ajoutent la clé de la catégorie, tenue à jour par les déclencheurs ci-dessous
+    for table in ("entries", "budgets"):
+        cursor.execute(f"PRAGMA table_info({table})")
+        if 'category_id' not in [info[1] for info in cursor.fetchall()]:
+            type_expr = "MIN(type)" if table == "entries" else "'depense'"
+            cursor.execute(f"INSERT OR IGNORE INTO categories (name, type, position) "
+                           f"SELECT category, {type_expr}, 1000 FROM {table} WHERE category IS NOT NULL GROUP BY category")
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN category_id INTEGER REFERENCES categories(id)")
+            cursor.execute(f"UPDATE {table} SET category_id = (SELECT id FROM categories WHERE name = {table}.category)")
+        type_expr = "NEW.type" if table == "entries" else "'depense'"
+        for event in ("INSERT", "UPDATE OF category"):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.split()[0].lower()[:3]}_category AFTER {event} ON {table}
+                WHEN NEW.category IS NOT NULL BEGIN
+                    INSERT OR IGNORE INTO categories (name, type, position) VALUES (NEW.category, {type_expr}, 1000);
+                    UPDATE {table} SET category_id = (SELECT id FROM categories WHERE name = NEW.category)
+                        WHERE id = NEW.id AND category_id IS NOT (SELECT id FROM categories WHERE name = NEW.category);
+                END
+            """)
+    # Renommer une catégorie renomme ses écritures et budgets (et les propage aux autres postes)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_categories_upd_name AFTER UPDATE OF name ON categories
+        WHEN OLD.name IS NOT NEW.name BEGIN
+            UPDATE entries SET category = NEW.name WHERE category_id = NEW.id;
+            UPDATE budgets SET category = NEW.name WHERE category_id = NEW.id;
+        END
+    """)
+
+    # --- Règles de classement automatique, propres au poste comme la hiérarchie des catégories ---
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS category_rules (
+            id INTEGER PRIMARY KEY, position INTEGER NOT NULL DEFAULT 0, pattern TEXT NOT NULL DEFAULT '',
+            journal TEXT, min_amount REAL, max_amount REAL,
+            category_id INTEGER NOT NULL REFERENCES categories(id) ON DELETE CASCADE)
+    """)
+
+    # --- Justificatifs reçus dans la boîte de réception sans écriture correspondante ---
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS inbox_pending (
+            id INTEGER PRIMARY KEY, path TEXT NOT NULL, original_name TEXT NOT NULL, sha256 TEXT NOT NULL,
+            received_at TEXT NOT NULL, file_date TEXT, amount REAL, note TEXT)
+    """)
+
+    # --- Index utilisés par les journaux, le tableau de bord et les détails de caisse ---
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_entries_year_journal_date ON entries (year_id, journal, date, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cash_details_entry ON cash_details (entry_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_entries_year_category ON entries (year_id, category_id, amount)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_entries_journal_date ON entries (journal, date)")
+    # Blocage des doublons : une recherche par (journal, montant, fenêtre de dates) ou par justificatif
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_entries_duplicates ON entries (journal, amount, date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_entries_attachment_sha256 ON entries (attachment_sha256) WHERE attachment_sha256 IS NOT NULL")
+    # Rapprochement d'un justificatif reçu par montant et date, tous journaux confondus
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_entries_amount_date ON entries (amount, date)")
+
+    # --- Inventaire de caisse : instantanés mensuels et comptages physiques ---
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cash_snapshots (
+            snapshot_date TEXT NOT NULL, denomination REAL NOT NULL, count INTEGER NOT NULL,
+            PRIMARY KEY (snapshot_date, denomination))
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cash_counts (
+            id INTEGER PRIMARY KEY, count_date TEXT NOT NULL, created_at TEXT NOT NULL, book_balance REAL)
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cash_count_lines (
+            count_id INTEGER NOT NULL, denomination REAL NOT NULL, expected INTEGER NOT NULL, counted INTEGER NOT NULL,
+            PRIMARY KEY (count_id, denomination), FOREIGN KEY (count_id) REFERENCES cash_counts(id) ON DELETE CASCADE)
+    """)
+    # Inventaire de la caisse à la fin de chaque exercice archivé (point de départ des instantanés suivants)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS archive_cash_balances (
+            year_id INTEGER NOT NULL, snapshot_date TEXT NOT NULL, denomination REAL NOT NULL, count INTEGER NOT NULL,
+            PRIMARY KEY (year_id, denomination))
+    """)
+    # Toute modification d'un mouvement de caisse invalide les instantanés postérieurs à sa date
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_cash_details_ins_snapshots AFTER INSERT ON cash_details BEGIN
+            DELETE FROM cash_snapshots WHERE snapshot_date >= (SELECT date FROM entries WHERE id = NEW.entry_id);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_cash_details_del_snapshots AFTER DELETE ON cash_details BEGIN
+            DELETE FROM cash_snapshots WHERE snapshot_date >= COALESCE((SELECT date FROM entries WHERE id = OLD.entry_id), '');
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_entries_upd_snapshots AFTER UPDATE OF date, amount, journal ON entries
+        WHEN (OLD.journal = 'caisse' OR NEW.journal = 'caisse')
+             AND (OLD.date IS NOT NEW.date OR OLD.amount IS NOT NEW.amount OR OLD.journal IS NOT NEW.journal) BEGIN
+            DELETE FROM cash_snapshots WHERE snapshot_date >= MIN(OLD.date, NEW.date);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_entries_upd_attachment_hash AFTER UPDATE OF attachment_path ON entries
+        WHEN NEW.attachment_sha256 IS NOT NULL AND OLD.attachment_path IS NOT NEW.attachment_path BEGIN
+            UPDATE entries SET attachment_sha256 = NULL WHERE id = NEW.id;
+        END
+    """)
+    # Une écriture pointée dont le montant ou la date change doit être rapprochée à nouveau
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_entries_upd_reconciled AFTER UPDATE OF date, amount ON entries
+        WHEN NEW.reconciled_on IS NOT NULL AND (OLD.date IS NOT NEW.date OR OLD.amount IS NOT NEW.amount) BEGIN
+            UPDATE entries SET reconciled_on = NULL WHERE id = NEW.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_entries_del_snapshots AFTER DELETE ON entries
+        WHEN OLD.journal = 'caisse' BEGIN
+            DELETE FROM cash_snapshots WHERE snapshot_date >= OLD.date;
+        END
+    """)
+    # --- Historique de la maintenance (taille du fichier, pages libres, durée) ---
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS maintenance_runs (
+            id INTEGER PRIMARY KEY, run_at TEXT NOT NULL, trigger TEXT NOT NULL, tasks TEXT NOT NULL, duration_ms REAL NOT NULL,
+            file_size_before INTEGER, file_size_after INTEGER, free_pages_before INTEGER, free_pages_after INTEGER)
+    """)
+    # --- Index des rapports pré-générés (empreinte des données utilisées pour le rendu) ---
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS report_index (
+            year_id INTEGER NOT NULL, report_type TEXT NOT NULL, period TEXT NOT NULL, path TEXT NOT NULL,
+            fingerprint TEXT NOT NULL, generated_at TEXT NOT NULL, PRIMARY KEY (year_id, report_type, period))
+    """)
+    # Jeton aléatoire renouvelé à chaque transaction qui touche l'exercice (voir LedgerRepository.transaction)
+    cursor.execute("CREATE TABLE IF NOT EXISTS year_versions (year_id INTEGER PRIMARY KEY, token TEXT NOT NULL)")
+    # --- Texte des justificatifs (FTS5, rowid = id de l'écriture) ; taille et date du fichier pour ne relire que les pièces modifiées ---
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS attachment_index (
+            entry_id INTEGER PRIMARY KEY, attachment_path TEXT NOT NULL, size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL, indexed_at TEXT NOT NULL)
+    """)
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS attachment_fts USING fts5(content, tokenize = 'unicode61 remove_diacritics 2')")
+    except sqlite3.OperationalError:
+        pass  # SQLite sans FTS5 : la recherche dans les justificatifs est indisponible
+    else:
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_entries_del_attachment_index AFTER DELETE ON entries BEGIN
+                DELETE FROM attachment_fts WHERE rowid = OLD.id;
+                DELETE FROM attachment_index WHERE entry_id = OLD.id;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_entries_upd_attachment_index AFTER UPDATE OF attachment_path ON entries
+            WHEN OLD.attachment_path IS NOT NEW.attachment_path BEGIN
+                DELETE FROM attachment_fts WHERE rowid = OLD.id;
+                DELETE FROM attachment_index WHERE entry_id = OLD.id;
+            END
+        """)
+
+    # --- Synchronisation : identifiants globaux et journal des modifications ---
+    new_uid_tables = set()
+    for table in SYNC_TABLES:
+        if table in SYNC_NATURAL_KEY_TABLES:
+            continue
+        cursor.execute(f"PRAGMA table_info({table})")
+        if 'uid' not in [info[1] for info in cursor.fetchall()]:
+            new_uid_tables.add(table)
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN uid TEXT")
+            cursor.execute(f"UPDATE {table} SET uid = lower(hex(randomblob(16))) WHERE uid IS NULL")
+        cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_uid ON {table} (uid)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT NOT NULL, row_uid TEXT NOT NULL, op TEXT NOT NULL)
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sync_peers (
+            site_id TEXT PRIMARY KEY, last_applied_seq INTEGER NOT NULL DEFAULT 0,
+            acked_seq INTEGER NOT NULL DEFAULT 0, last_sync_at TEXT)
+    """)
+    cursor.execute("CREATE TABLE IF NOT EXISTS sync_files (path TEXT PRIMARY KEY, sha256 TEXT NOT NULL, sent_seq INTEGER NOT NULL DEFAULT 0)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sync_conflicts (
+            id INTEGER PRIMARY KEY, site_id TEXT NOT NULL, table_name TEXT NOT NULL, row_uid TEXT NOT NULL,
+            remote_payload TEXT, received_at TEXT NOT NULL)
+    """)
+    # Les modifications appliquées par un import (ligne 'applying' présente) ne sont pas journalisées
+    not_applying = "NOT EXISTS (SELECT 1 FROM sync_state WHERE key = 'applying')"
+    legacy_codes = ", ".join(f"'{code}'" for code in LEGACY_BALANCE_COLUMNS)
+    if 'accounts' in new_uid_tables:
+        # Comptes et soldes initiaux jusqu'ici propres à ce poste : envoyés avec le prochain paquet
+        cursor.execute("INSERT INTO change_log (table_name, row_uid, op) SELECT 'accounts', uid, 'U' FROM accounts")
+        cursor.execute(f"""
+            INSERT INTO change_log (table_name, row_uid, op)
+                SELECT 'account_balances', y.uid || ':' || a.code, 'U' FROM account_balances b
+                JOIN accounting_years y ON y.id = b.year_id JOIN accounts a ON a.id = b.account_id
+                WHERE a.code NOT IN ({legacy_codes})
+        """)
+    for table, columns in SYNC_TABLES.items():
+        if table in SYNC_NATURAL_KEY_TABLES:
+            continue
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_sync_{table}_ins AFTER INSERT ON {table} BEGIN
+                UPDATE {table} SET uid = lower(hex(randomblob(16))) WHERE id = NEW.id AND uid IS NULL;
+                INSERT INTO change_log (table_name, row_uid, op)
+                    SELECT '{table}', uid, 'U' FROM {table} WHERE id = NEW.id AND {not_applying};
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_sync_{table}_upd AFTER UPDATE OF {columns} ON {table} WHEN {not_applying} BEGIN
+                INSERT INTO change_log (table_name, row_uid, op) VALUES ('{table}', NEW.uid, 'U');
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_sync_{table}_del AFTER DELETE ON {table} WHEN {not_applying} BEGIN
+                INSERT INTO change_log (table_name, row_uid, op) VALUES ('{table}', OLD.uid, 'D');
+            END
+        """)
+    for event, row, op in (("INSERT", "NEW", "U"), (f"UPDATE OF {SYNC_TABLES['account_balances']}", "NEW", "U"), ("DELETE", "OLD", "D")):
+        # Exercice ou compte déjà supprimé (cascade) : sa suppression suffit à l'autre poste
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_sync_account_balances_{event.split()[0].lower()[:3]} AFTER {event} ON account_balances
+            WHEN {not_applying} BEGIN
+                INSERT INTO change_log (table_name, row_uid, op)
+                    SELECT 'account_balances', y.uid || ':' || a.code, '{op}' FROM accounting_years y JOIN accounts a ON a.id = {row}.account_id
+                    WHERE y.id = {row}.year_id AND y.uid IS NOT NULL AND a.code NOT IN ({legacy_codes});
+            END
+        """)
+    # Le détail de caisse fait partie de l'écriture
+    for event, row in (("INSERT", "NEW"), ("DELETE", "OLD")):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_sync_cash_details_{event.lower()[:3]} AFTER {event} ON cash_details WHEN {not_applying} BEGIN
+                INSERT INTO change_log (table_name, row_uid, op)
+                    SELECT 'entries', uid, 'U' FROM entries WHERE id = {row}.entry_id;
+            END
+        """)
+
+    if cursor.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
     conn.commit()
     return conn
 
+def db_connect_read_only(db_file=DB_FILE):
+    """Connexion en lecture seule (mode=ro) : ne crée ni ne modifie rien dans la base."""
+    uri = pathlib.Path(os.path.abspath(db_file)).as_uri() + "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, cached_statements=SQLITE_CACHED_STATEMENTS)
+    conn.row_factory = sqlite3.Row
+    pragmas = sqlite_pragmas(db_file)
+    for pragma in ("cache_size", "mmap_size", "temp_store", "busy_timeout"):
+        conn.execute(f"PRAGMA {pragma} = {pragmas[pragma]}")
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+class ConflictError(Exception):
+    """L'écriture a été modifiée ou supprimée par un autre poste depuis sa lecture."""
+
+def is_locked_error(error):
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error))
+
+class LedgerRepository:
+    """Couche d'accès aux données : possède l'unique connexion et regroupe toutes les requêtes SQL.
+
+    La connexion est en mode autocommit ; les écritures passent par transaction(), qui ouvre
+    une transaction explicite (BEGIN IMMEDIATE) et peut être imbriquée. Les requêtes sont des
+    chaînes constantes afin de profiter du cache de requêtes préparées de sqlite3.
+    """
+    SQL_YEARS = "SELECT * FROM accounting_years ORDER BY start_date DESC"
+    SQL_INSERT_YEAR = "INSERT INTO accounting_years (name, start_date, end_date) VALUES (?, ?, ?)"
+    SQL_ENTRIES_FOR_YEAR = "SELECT * FROM entries WHERE year_id = ? ORDER BY date ASC, id ASC"
+    SQL_JOURNAL_ENTRIES = "SELECT * FROM entries WHERE journal = ? AND year_id = ? ORDER BY date ASC, id ASC"
+    SQL_ENTRIES_BETWEEN = "SELECT * FROM entries WHERE year_id = ? AND date BETWEEN ? AND ?"
+    SQL_ENTRY = "SELECT * FROM entries WHERE id = ?"
+    SQL_DUPLICATE_CANDIDATES = ("SELECT id, date, journal, libelle, amount, attachment_sha256 FROM entries "
+                                "WHERE journal = ? AND amount = ? AND date BETWEEN ? AND ? AND id IS NOT ?")
+    SQL_SAME_ATTACHMENT = ("SELECT id, date, journal, libelle, amount, attachment_sha256 FROM entries "
+                           "WHERE attachment_sha256 = ? AND id IS NOT ?")
+    SQL_DUPLICATE_SCAN = ("SELECT id, date, journal, libelle, amount, attachment_sha256 FROM entries "
+                          "WHERE year_id = ? ORDER BY journal, amount, date, id")
+    SQL_RECONCILIATION_ENTRIES = ("SELECT id, date, libelle, amount, reconciled_on FROM entries "
+                                  "WHERE journal = ? AND year_id = ? ORDER BY date ASC, id ASC")
+    SQL_YEAR_SNAPSHOT = ("SELECT id, date, journal, libelle, category, type, amount, attachment_path "
+                         "FROM entries WHERE year_id = ? ORDER BY date ASC, id ASC")
+    SQL_INSERT_ENTRY = ("INSERT INTO entries (date, journal, libelle, category, type, amount, year_id, attachment_path) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+    SQL_UPDATE_ENTRY = ("UPDATE entries SET date = ?, libelle = ?, category = ?, type = ?, amount = ?, attachment_path = ?, "
+                        "version = version + 1 WHERE id = ? AND version = ?")
+    SQL_DELETE_ENTRY = "DELETE FROM entries WHERE id = ? AND version = ?"
+    SQL_LIBELLE_HISTORY = ("SELECT libelle, category, type FROM entries WHERE journal = ? AND libelle != '' "
+                           "GROUP BY libelle, category, type ORDER BY MAX(date) DESC, COUNT(*) DESC LIMIT ?")
+    SQL_CASH_DETAILS = "SELECT denomination, count FROM cash_details WHERE entry_id = ? ORDER BY denomination DESC"
+    SQL_CASH_DETAIL_ENTRY_IDS = ("SELECT DISTINCT d.entry_id FROM cash_details d JOIN entries e ON e.id = d.entry_id "
+                                 "WHERE e.year_id = ? AND e.journal = ?")
+    SQL_DELETE_CASH_DETAILS = "DELETE FROM cash_details WHERE entry_id = ?"
+    SQL_INSERT_CASH_DETAIL = "INSERT INTO cash_details (entry_id, denomination, count) VALUES (?, ?, ?)"
+    SQL_BUDGETS = "SELECT category, amount FROM budgets WHERE year_id = ?"
+    SQL_UPSERT_BUDGET = ("INSERT INTO budgets (year_id, category, amount) VALUES (?, ?, ?) "
+                         "ON CONFLICT(year_id, category) DO UPDATE SET amount = excluded.amount")
+    SQL_ACTUAL_BY_CATEGORY = "SELECT category, SUM(amount) FROM entries WHERE year_id = ? GROUP BY category"
+    # Totaux cumulés de chaque catégorie (ses sous-catégories comprises) en une requête indexée
+    SQL_CATEGORY_ROLLUP = ("SELECT cc.ancestor_id, SUM(e.amount) FROM entries e "
+                           "JOIN category_closure cc ON cc.descendant_id = e.category_id WHERE e.year_id = ? GROUP BY cc.ancestor_id")
+    SQL_BUDGET_ROLLUP = ("SELECT cc.ancestor_id, SUM(b.amount) FROM budgets b "
+                         "JOIN category_closure cc ON cc.descendant_id = b.category_id WHERE b.year_id = ? GROUP BY cc.ancestor_id")
+    # Catégories dans l'ordre d'affichage : recettes puis dépenses, chaque parent suivi de ses enfants
+    SQL_CATEGORY_TREE = """
+        WITH RECURSIVE tree(id, name, type, parent_id, depth, path) AS (
+            SELECT id, name, type, parent_id, 0, printf('%06d.%08d', position, id) FROM categories WHERE parent_id IS NULL
+            UNION ALL
+            SELECT c.id, c.name, c.type, c.parent_id, t.depth + 1, t.path || '/' || printf('%06d.%08d', c.position, c.id)
+            FROM categories c JOIN tree t ON c.parent_id = t.id)
+        SELECT id, name, type, parent_id, depth FROM tree ORDER BY type DESC, path
+    """
+    SQL_CATEGORY_RULES = ("SELECT r.id, r.position, r.pattern, r.journal, r.min_amount, r.max_amount, r.category_id, "
+                          "c.name AS category, c.type FROM category_rules r JOIN categories c ON c.id = r.category_id ORDER BY r.position, r.id")
+    SQL_CATEGORIZATION_ENTRIES = ("SELECT id, version, date, journal, libelle, category, type, amount FROM entries "
+                                  "WHERE year_id = ? ORDER BY date ASC, id ASC")
+    SQL_CATEGORY_HISTORY = ("SELECT libelle, type, category, journal, COUNT(*) AS count FROM entries "
+                            "WHERE libelle != '' AND category IS NOT NULL GROUP BY libelle, type, category, journal")
+    SQL_SET_ENTRY_CATEGORY = "UPDATE entries SET category = ?, version = version + 1 WHERE id = ? AND version = ? AND year_id = ?"
+    SQL_ACCOUNTS = "SELECT * FROM accounts ORDER BY position, id"
+    # Solde de chaque compte pour un exercice (solde initial + mouvements) en une requête groupée
+    SQL_ACCOUNT_BALANCES = """
+        SELECT a.id, a.code, a.name, a.kind, COALESCE(b.opening_balance, 0) AS opening_balance,
+               COALESCE(m.movements, 0) AS movements, COALESCE(b.opening_balance, 0) + COALESCE(m.movements, 0) AS balance
+        FROM accounts a
+        LEFT JOIN account_balances b ON b.account_id = a.id AND b.year_id = :year
+        LEFT JOIN (SELECT journal, SUM(amount) AS movements FROM entries WHERE year_id = :year GROUP BY journal) m ON m.journal = a.code
+        ORDER BY a.position, a.id
+    """
+    SQL_OPENING_BALANCES = ("SELECT b.year_id, a.code, a.name, b.opening_balance FROM account_balances b "
+                            "JOIN accounts a ON a.id = b.account_id ORDER BY b.year_id, a.position, a.id")
+    SQL_CATEGORY_MONTH_PIVOT = ("SELECT category, type, substr(date, 1, 7) AS month, SUM(amount) AS total, COUNT(*) AS count "
+                                "FROM entries WHERE year_id = ? GROUP BY category, type, month ORDER BY category, month")
+    # Totaux mensuels d'un exercice par journal : base des courbes du tableau de bord
+    SQL_MONTHLY_TOTALS = """
+        SELECT substr(date, 1, 7) AS month, journal, TOTAL(amount) AS movements,
+               TOTAL(CASE WHEN type = 'recette' THEN amount END) AS recettes,
+               TOTAL(CASE WHEN type = 'depense' THEN ABS(amount) END) AS depenses
+        FROM entries WHERE year_id = ? GROUP BY month, journal ORDER BY month, journal
+    """
+    SQL_DASHBOARD_TOTALS = """
+        SELECT COALESCE(SUM(CASE WHEN type = 'recette' THEN amount END), 0) AS total_recettes,
+               COALESCE(SUM(CASE WHEN type = 'depense' THEN ABS(amount) END), 0) AS total_depenses
+        FROM entries WHERE year_id = ?
+    """
+
+    # Lignes orphelines : (libellé, requête des id, table à nettoyer)
+    ORPHAN_CHECKS = [
+        ("Écritures sans exercice", "SELECT e.id FROM entries e LEFT JOIN accounting_years y ON y.id = e.year_id WHERE y.id IS NULL", "entries"),
+        ("Détails de caisse sans écriture", "SELECT d.id FROM cash_details d LEFT JOIN entries e ON e.id = d.entry_id WHERE e.id IS NULL", "cash_details"),
+        ("Budgets sans exercice", "SELECT b.id FROM budgets b LEFT JOIN accounting_years y ON y.id = b.year_id WHERE y.id IS NULL", "budgets"),
+        ("Lignes de comptage sans comptage", "SELECT l.rowid FROM cash_count_lines l LEFT JOIN cash_counts c ON c.id = l.count_id WHERE c.id IS NULL", "cash_count_lines"),
+    ]
+    # État synchronisable d'une ligne, les clés étrangères étant exprimées en uid
+    SQL_SYNC_PAYLOAD = {
+        "accounting_years": ("SELECT uid, name, start_date, end_date, initial_balance_poste, initial_balance_caisse "
+                             "FROM accounting_years WHERE uid = ?"),
+        "budgets": "SELECT b.uid, y.uid AS year, b.category, b.amount FROM budgets b JOIN accounting_years y ON y.id = b.year_id WHERE b.uid = ?",
+        "entries": ("SELECT e.id, e.uid, y.uid AS year, e.date, e.journal, e.libelle, e.category, e.type, e.amount, e.attachment_path "
+                    "FROM entries e JOIN accounting_years y ON y.id = e.year_id WHERE e.uid = ?"),
+        "accounts": "SELECT uid, code, name, kind FROM accounts WHERE uid = ?",
+        "account_balances": ("SELECT y.uid || ':' || a.code AS uid, y.uid AS year, a.code AS account, b.opening_balance "
+                             "FROM account_balances b JOIN accounting_years y ON y.id = b.year_id JOIN accounts a ON a.id = b.account_id "
+                             "WHERE y.uid = substr(?1, 1, instr(?1, ':') - 1) AND a.code = substr(?1, instr(?1, ':') + 1)"),
+    }
+    SQL_SYNC_BALANCE_KEYS = ("SELECT y.uid || ':' || a.code FROM account_balances b JOIN accounting_years y ON y.id = b.year_id "
+                             f"JOIN accounts a ON a.id = b.account_id WHERE a.code NOT IN ({', '.join('?' * len(LEGACY_BALANCE_COLUMNS))}) "
+                             "ORDER BY y.id, a.position")
+    SQL_SYNC_CHANGES = ("SELECT table_name, row_uid, op, seq FROM change_log WHERE seq IN "
+                        "(SELECT MAX(seq) FROM change_log WHERE seq > ? GROUP BY table_name, row_uid) ORDER BY seq")
+    SQL_BUMP_YEAR_VERSION = "INSERT OR REPLACE INTO year_versions (year_id, token) VALUES (?, lower(hex(randomblob(8))))"
+    SQL_BUMP_ALL_YEAR_VERSIONS = "INSERT OR REPLACE INTO year_versions (year_id, token) SELECT id, lower(hex(randomblob(8))) FROM accounting_years"
+    SQL_ATTACHMENT_REFERENCES = "SELECT id, attachment_path FROM entries WHERE attachment_path IS NOT NULL AND attachment_path != ''"
+    # Tables d'un exercice déplacées dans sa partition d'archive
+    ARCHIVE_TABLES = ("accounting_years", "categories", "entries", "cash_details", "budgets")
+    ARCHIVED_TABLE_RE = re.compile(r"\b(FROM|JOIN)\s+(entries|budgets|cash_details)\b")
+
+    def __init__(self, db_file=DB_FILE, read_only=False):
+        self.db_file = db_file
+        self.read_only = read_only
+        self.conn = None
+        self._tx_depth = 0
+        self._data_version = None
+        self._touched_years = set()
+        self._write_listeners = []
+        self._attached_archives = OrderedDict()
+        self.connect()
+
+    def connect(self):
+        self.conn = db_connect_read_only(self.db_file) if self.read_only else db_connect(self.db_file)
+        self.conn.isolation_level = None  # transactions explicites via transaction()
+        self._tx_depth = 0
+        self._attached_archives = OrderedDict()
+        self._data_version = self.data_version()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def reconnect(self):
+        self.close()
+        self.connect()
+
+    def add_write_listener(self, callback):
+        """callback(year_ids) est appelé après chaque transaction validée ; None dans year_ids signifie « tous »."""
+        self._write_listeners.append(callback)
+
+    def _touch(self, year_id):
+        self._touched_years.add(year_id)
+
+    def _notify_writes(self):
+        touched, self._touched_years = self._touched_years, set()
+        if touched:
+            for callback in self._write_listeners:
+                callback(touched)
+
+    @contextmanager
+    def transaction(self):
+        """Ouvre une transaction d'écriture ; validée à la sortie du bloc, annulée en cas d'exception."""
+        if self._tx_depth:
+            self._tx_depth += 1
+            try:
+                yield self.conn
+            finally:
+                self._tx_depth -= 1
+            return
+        self._begin_immediate()
+        self._tx_depth = 1
+        self._touched_years = set()
+        try:
+            yield self.conn
+            self._bump_year_versions()
+            self.conn.execute("COMMIT")
+        except BaseException:
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+            self._touched_years = set()
+            raise
+        finally:
+            self._tx_depth = 0
+        self._notify_writes()
+
+    def _bump_year_versions(self):
+        """Renouvelle, dans la transaction, le jeton des exercices touchés (tous si None en fait partie).
+
+        Un jeton aléatoire plutôt qu'un compteur : après la restauration d'une sauvegarde, un ancien
+        jeton ne peut pas être confondu avec celui d'un état plus récent.
+        """
+        if not self._touched_years:
+            return
+        if None in self._touched_years:
+            self.conn.execute(self.SQL_BUMP_ALL_YEAR_VERSIONS)
+        else:
+            self.conn.executemany(self.SQL_BUMP_YEAR_VERSION, [(year_id,) for year_id in self._touched_years])
+
+    def year_versions(self):
+        """Jeton de modification de chaque exercice (absent si l'exercice n'a jamais été modifié depuis sa création)."""
+        return {row[0]: row[1] for row in self._all("SELECT year_id, token FROM year_versions")}
+
+    def _begin_immediate(self):
+        """Prend le verrou d'écriture ; réessaie avec un délai croissant si un autre poste le garde trop longtemps."""
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as e:
+                if not is_locked_error(e) or attempt == WRITE_RETRIES:
+                    raise
+                time.sleep(0.05 * 2 ** attempt)
+
+    def data_version(self):
+        """PRAGMA data_version : change uniquement lorsqu'une autre connexion a validé une écriture."""
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def has_external_changes(self):
+        """Indique si un autre processus a écrit dans la base depuis le dernier appel."""
+        version = self.data_version()
+        changed = version != self._data_version
+        self._data_version = version
+        return changed
+
+    def _all(self, sql, params=()):
+        return self.conn.execute(sql, params).fetchall()
+
+    def _one(self, sql, params=()):
+        return self.conn.execute(sql, params).fetchone()
+
+    # --- Exercices ---
+    def list_years(self):
+        return self._all(self.SQL_YEARS)
+
+    def insert_year(self, name, start_date, end_date, opening_balances=None):
+        """Crée un exercice ; opening_balances : {code du compte : solde initial}."""
+        with self.transaction():
+            year_id = self.conn.execute(self.SQL_INSERT_YEAR, (name, start_date, end_date)).lastrowid
+            if opening_balances:
+                self.set_opening_balances(year_id, opening_balances)
+            self._touch(year_id)
+        return year_id
+
+    def delete_year(self, year_id):
+        """Supprime un exercice avec ses budgets, écritures et détails de caisse."""
+        with self.transaction():
+            # Les instantanés de caisse à partir de l'exercice sont recalculés (voir refresh_cash_snapshots)
+            self.conn.execute("DELETE FROM cash_snapshots WHERE snapshot_date >= (SELECT start_date FROM accounting_years WHERE id = ?)", (year_id,))
+            self.conn.execute("DELETE FROM archive_cash_balances WHERE year_id = ?", (year_id,))
+            self.conn.execute("DELETE FROM budgets WHERE year_id = ?", (year_id,))
+            self.conn.execute("DELETE FROM cash_details WHERE entry_id IN (SELECT id FROM entries WHERE year_id = ?)", (year_id,))
+            self.conn.execute("DELETE FROM entries WHERE year_id = ?", (year_id,))
+            self.conn.execute("DELETE FROM accounting_years WHERE id = ?", (year_id,))
+            self._touch(year_id)
+
+    # --- Partitions d'archive ---
+    def archive_file(self, year_id):
+        """Fichier d'archive de l'exercice, ou None s'il est dans la base principale."""
+        row = self._one("SELECT archive_file FROM accounting_years WHERE id = ?", (year_id,))
+        return row[0] if row else None
+
+    def _year_sql(self, sql, year_id):
+        """Requête portant sur un exercice, dirigée vers sa partition d'archive (attachée à la demande) s'il est archivé."""
+        archive_file = self.archive_file(year_id) if year_id is not None else None
+        if not archive_file:
+            return sql
+        schema = self._attach_archive(year_id, archive_file)
+        return self.ARCHIVED_TABLE_RE.sub(rf"\1 {schema}.\2", sql)
+
+    def _attach_archive(self, year_id, archive_file):
+        schema = self._attached_archives.get(year_id)
+        if schema is not None:
+            self._attached_archives.move_to_end(year_id)
+            return schema
+        if not os.path.exists(archive_file):
+            # ATTACH créerait une base vide à la place de l'archive manquante
+            raise sqlite3.OperationalError(f"Archive introuvable : {archive_file}")
+        # Au-delà de la limite, la partition utilisée le moins récemment est détachée
+        while len(self._attached_archives) >= ARCHIVE_MAX_ATTACHED:
+            _, old_schema = self._attached_archives.popitem(last=False)
+            self.conn.execute(f"DETACH DATABASE {old_schema}")
+        schema = f"archive_{int(year_id)}"
+        self.conn.execute(f"ATTACH DATABASE ? AS {schema}", (archive_file,))
+        self._attached_archives[year_id] = schema
+        return schema
+
+    def detach_archives(self):
+        while self._attached_archives:
+            _, schema = self._attached_archives.popitem()
+            self.conn.execute(f"DETACH DATABASE {schema}")
+
+    def copy_year_to_archive(self, year_id, archive_path):
+        """Première étape de l'archivage : copie l'exercice dans une nouvelle base archive_path.
+
+        Le schéma des tables est repris de la base principale (colonnes ajoutées par migration
+        comprises, sans les triggers de synchronisation). Les catégories sont copiées telles quelles
+        pour que l'archive reste lisible seule. La base principale n'est pas modifiée.
+        """
+        if os.path.exists(archive_path):
+            os.remove(archive_path)  # reste d'un archivage interrompu
+        schemas = self._all(f"SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name IN ({', '.join('?' * len(self.ARCHIVE_TABLES))})",
+                            self.ARCHIVE_TABLES)
+        self.conn.execute("ATTACH DATABASE ? AS arc", (archive_path,))
+        try:
+            with self.transaction():
+                for row in schemas:
+                    self.conn.execute(row['sql'].replace("CREATE TABLE ", "CREATE TABLE arc.", 1))
+                self.conn.execute("CREATE INDEX arc.idx_entries_year_journal_date ON entries (year_id, journal, date, id)")
+                self.conn.execute("CREATE INDEX arc.idx_cash_details_entry ON cash_details (entry_id)")
+                self.conn.execute("INSERT INTO arc.accounting_years SELECT * FROM main.accounting_years WHERE id = ?", (year_id,))
+                self.conn.execute("PRAGMA defer_foreign_keys = ON")  # parents et enfants dans un ordre quelconque
+                self.conn.execute("INSERT INTO arc.categories SELECT * FROM main.categories")
+                self.conn.execute("INSERT INTO arc.entries SELECT * FROM main.entries WHERE year_id = ?", (year_id,))
+                self.conn.execute("INSERT INTO arc.cash_details SELECT d.* FROM main.cash_details d "
+                                  "JOIN main.entries e ON e.id = d.entry_id WHERE e.year_id = ?", (year_id,))
+                self.conn.execute("INSERT INTO arc.budgets SELECT * FROM main.budgets WHERE year_id = ?", (year_id,))
+            copied = self._one("SELECT COUNT(*) FROM arc.entries")[0]
+        finally:
+            self.conn.execute("DETACH DATABASE arc")
+        return copied
+
+    def drop_archived_year(self, year_id, archive_path):
+        """Seconde étape : retire l'exercice de la base principale et l'inscrit comme archivé.
+
+        Les deux étapes sont séparées car une transaction sur plusieurs bases n'est pas atomique
+        en mode WAL : l'archive est complète avant que rien ne soit supprimé. L'inventaire de
+        caisse à la fin de l'exercice est conservé pour les instantanés suivants. La suppression
+        n'est pas journalisée pour la synchronisation : les autres postes gardent leurs écritures.
+        """
+        with self.transaction():
+            self._restore_cash_anchors()
+            end_date = self._one("SELECT end_date FROM accounting_years WHERE id = ?", (year_id,))[0]
+            inventory = self.cash_inventory(end_date)
+            self.set_applying(True)
+            self.conn.execute("DELETE FROM cash_details WHERE entry_id IN (SELECT id FROM entries WHERE year_id = ?)", (year_id,))
+            self.conn.execute("DELETE FROM entries WHERE year_id = ?", (year_id,))
+            self.conn.execute("DELETE FROM budgets WHERE year_id = ?", (year_id,))
+            self.set_applying(False)
+            self.conn.execute("UPDATE accounting_years SET archive_file = ? WHERE id = ?", (archive_path, year_id))
+            self.conn.executemany("INSERT OR REPLACE INTO archive_cash_balances (year_id, snapshot_date, denomination, count) VALUES (?, ?, ?, ?)",
+                                  [(year_id, end_date, denom, count) for denom, count in inventory.items()])
+            self._restore_cash_anchors()
+            self._touch(year_id)
+
+    def _restore_cash_anchors(self):
+        """Recrée les instantanés de fin d'exercice archivé effacés par une modification antérieure."""
+        self.conn.execute("INSERT OR IGNORE INTO cash_snapshots (snapshot_date, denomination, count) "
+                          "SELECT snapshot_date, denomination, count FROM archive_cash_balances")
+
+    def yearly_totals(self):
+        """Totaux de chaque exercice, archivés compris (analyse pluriannuelle)."""
+        return [(year, self.dashboard_totals(year['id'])) for year in self.list_years()]
+
+    # --- Écritures ---
+    def entries_for_year(self, year_id):
+        return self._all(self._year_sql(self.SQL_ENTRIES_FOR_YEAR, year_id), (year_id,))
+
+    def journal_entries(self, year_id, journal_type):
+        return self._all(self._year_sql(self.SQL_JOURNAL_ENTRIES, year_id), (journal_type, year_id))
+
+    def entries_between(self, year_id, start_date, end_date):
+        return self._all(self._year_sql(self.SQL_ENTRIES_BETWEEN, year_id), (year_id, start_date, end_date))
+
+    def get_entry(self, entry_id, year_id=None):
+        """Écriture par id ; avec year_id, cherchée dans la partition de l'exercice s'il est archivé."""
+        return self._one(self._year_sql(self.SQL_ENTRY, year_id), (entry_id,))
+
+    def insert_entry(self, year_id, date_str, journal_type, libelle, category, type_op, amount, attachment_path=None, cash_details=None):
+        with self.transaction():
+            entry_id = self.conn.execute(self.SQL_INSERT_ENTRY, (date_str, journal_type, libelle, category, type_op, amount, year_id, attachment_path)).lastrowid
+            self._touch(year_id)
+            if cash_details:
+                self.replace_cash_details(entry_id, cash_details)
+        return entry_id
+
+    def insert_entries(self, year_id, journal_type, rows):
+        """Insère un lot d'écritures (saisie en lot) en une seule transaction et retourne leurs id.
+
+        rows : (date, libellé, catégorie, type, montant, détail de caisse {valeur: nombre} ou None).
+        """
+        with self.transaction():
+            first_id = self._one("SELECT COALESCE(MAX(id), 0) FROM entries")[0] + 1
+            self.conn.executemany(self.SQL_INSERT_ENTRY, [(date_str, journal_type, libelle, category, type_op, amount, year_id, None)
+                                                          for date_str, libelle, category, type_op, amount, _ in rows])
+            # Sous BEGIN IMMEDIATE personne d'autre n'écrit : SQLite attribue MAX(id) + 1, + 2, ...
+            entry_ids = list(range(first_id, first_id + len(rows)))
+            self.conn.executemany(self.SQL_INSERT_CASH_DETAIL, [(entry_id, denom, count)
+                                                                for entry_id, row in zip(entry_ids, rows) if row[5]
+                                                                for denom, count in row[5].items()])
+            self._touch(year_id)
+        return entry_ids
+
+    def libelle_history(self, journal_type, limit=500):
+        """Libellés déjà saisis dans un journal, du plus récent au plus ancien, avec leur catégorie et leur type."""
+        return self._all(self.SQL_LIBELLE_HISTORY, (journal_type, limit))
+
+    def update_entry(self, entry_id, date_str, libelle, category, type_op, amount, attachment_path, cash_details=None, replace_cash_details=False, expected_version=None):
+        """Met à jour une écriture. Avec expected_version, lève ConflictError si elle a changé entre-temps."""
+        with self.transaction():
+            current_version = self._current_version(entry_id)
+            if expected_version is None:
+                expected_version = current_version
+            cursor = self.conn.execute(self.SQL_UPDATE_ENTRY, (date_str, libelle, category, type_op, amount, attachment_path, entry_id, expected_version))
+            if cursor.rowcount == 0:
+                raise ConflictError(f"L'écriture {entry_id} a été modifiée ou supprimée par un autre poste.")
+            if replace_cash_details:
+                self.replace_cash_details(entry_id, cash_details)
+
+    def delete_entry(self, entry_id, expected_version=None):
+        # Les détails de caisse suivent grâce au ON DELETE CASCADE (foreign_keys activé)
+        with self.transaction():
+            current_version = self._current_version(entry_id)
+            if expected_version is None:
+                expected_version = current_version
+            if self.conn.execute(self.SQL_DELETE_ENTRY, (entry_id, expected_version)).rowcount == 0:
+                raise ConflictError(f"L'écriture {entry_id} a été modifiée ou supprimée par un autre poste.")
+
+    def _current_version(self, entry_id):
+        """Version actuelle de l'écriture ; note aussi son exercice comme modifié."""
+        row = self._one("SELECT version, year_id FROM entries WHERE id = ?", (entry_id,))
+        if row is None:
+            return None
+        self._touch(row['year_id'])
+        return row['version']
+
+    # --- Doublons ---
+    def duplicate_candidates(self, journal_type, amount, start_date, end_date, attachment_sha256=None, exclude_id=None):
+        """Écritures de même journal et même montant entre deux dates, ou de même justificatif (deux recherches indexées)."""
+        rows = {row['id']: row for row in self._all(self.SQL_DUPLICATE_CANDIDATES, (journal_type, amount, start_date, end_date, exclude_id))}
+        if attachment_sha256:
+            rows.update((row['id'], row) for row in self._all(self.SQL_SAME_ATTACHMENT, (attachment_sha256, exclude_id)))
+        return list(rows.values())
+
+    def duplicate_scan_rows(self, year_id):
+        return self._all(self._year_sql(self.SQL_DUPLICATE_SCAN, year_id), (year_id,))
+
+    def entries_without_attachment_hash(self, year_id):
+        return self._all("SELECT id, attachment_path FROM entries WHERE year_id = ? AND attachment_path IS NOT NULL "
+                         "AND attachment_sha256 IS NULL", (year_id,))
+
+    def set_attachment_hashes(self, hashes):
+        """hashes : liste de (id d'écriture, empreinte sha256 du justificatif)."""
+        with self.transaction():
+            self.conn.executemany("UPDATE entries SET attachment_sha256 = ? WHERE id = ?", [(digest, entry_id) for entry_id, digest in hashes])
+
+    # --- Index plein texte des justificatifs ---
+    SQL_ATTACHMENTS_FOR_INDEXING = """
+        SELECT e.id, e.attachment_path, i.size, i.mtime_ns
+        FROM entries e LEFT JOIN attachment_index i ON i.entry_id = e.id AND i.attachment_path = e.attachment_path
+        WHERE e.attachment_path IS NOT NULL
+    """
+    SQL_SEARCH_ATTACHMENTS = """
+        SELECT e.id, e.year_id, y.name AS year_name, e.journal, e.date, e.libelle, e.amount,
+               snippet(attachment_fts, 0, '[', ']', '...', 12) AS excerpt
+        FROM attachment_fts
+        JOIN entries e ON e.id = attachment_fts.rowid
+        JOIN accounting_years y ON y.id = e.year_id
+        WHERE attachment_fts MATCH ?
+        ORDER BY rank LIMIT ?
+    """
+
+    def attachment_index_available(self):
+        return self._one("SELECT 1 FROM sqlite_master WHERE name = 'attachment_fts'") is not None
+
+    def attachments_for_indexing(self):
+        """Écritures des exercices ouverts avec justificatif ; size/mtime_ns sont NULL si la pièce n'est pas encore indexée."""
+        return self._all(self.SQL_ATTACHMENTS_FOR_INDEXING)
+
+    def store_attachment_texts(self, texts):
+        """texts : liste de (id d'écriture, chemin, taille, mtime_ns, texte).
+
+        Une écriture supprimée ou dont la pièce a changé pendant l'extraction est ignorée.
+        """
+        indexed_at = datetime.now().isoformat(timespec="seconds")
+        stored = 0
+        with self.transaction():
+            for entry_id, path, size, mtime_ns, text in texts:
+                cursor = self.conn.execute(
+                    "INSERT OR REPLACE INTO attachment_index (entry_id, attachment_path, size, mtime_ns, indexed_at) "
+                    "SELECT id, attachment_path, ?, ?, ? FROM entries WHERE id = ? AND attachment_path = ?",
+                    (size, mtime_ns, indexed_at, entry_id, path))
+                if not cursor.rowcount:
+                    continue
+                self.conn.execute("DELETE FROM attachment_fts WHERE rowid = ?", (entry_id,))
+                if text:
+                    self.conn.execute("INSERT INTO attachment_fts (rowid, content) VALUES (?, ?)", (entry_id, text))
+                stored += 1
+        return stored
+
+    def attachment_index_status(self):
+        """(pièces indexées, pièces contenant du texte, pièces en attente)."""
+        indexed = self._one("SELECT COUNT(*) FROM attachment_index")[0]
+        with_text = self._one("SELECT COUNT(*) FROM attachment_fts")[0]
+        pending = self._one("SELECT COUNT(*) FROM entries e WHERE e.attachment_path IS NOT NULL AND NOT EXISTS "
+                            "(SELECT 1 FROM attachment_index i WHERE i.entry_id = e.id AND i.attachment_path = e.attachment_path)")[0]
+        return indexed, with_text, pending
+
+    def search_attachments(self, match_query, limit=ATTACHMENT_SEARCH_LIMIT):
+        return self._all(self.SQL_SEARCH_ATTACHMENTS, (match_query, limit))
+
+    # --- Rapprochement bancaire ---
+    def reconciliation_entries(self, year_id, journal_type='poste'):
+        return self._all(self._year_sql(self.SQL_RECONCILIATION_ENTRIES, year_id), (journal_type, year_id))
+
+    def mark_reconciled(self, matches):
+        """Pointe les écritures : matches est une liste de (id d'écriture, date du mouvement bancaire)."""
+        with self.transaction():
+            self.conn.executemany("UPDATE entries SET reconciled_on = ? WHERE id = ?",
+                                  [(statement_date, entry_id) for entry_id, statement_date in matches])
+
+    # --- Boîte de réception des justificatifs ---
+    SQL_INBOX_CANDIDATES = ("SELECT id, year_id, date, journal, libelle, amount FROM entries "
+                            "WHERE amount IN (?, ?) AND date BETWEEN ? AND ? AND (attachment_path IS NULL OR attachment_path = '') "
+                            "ORDER BY date, id")
+    SQL_ENTRIES_WITHOUT_ATTACHMENT = ("SELECT id, date, journal, libelle, amount FROM entries "
+                                      "WHERE year_id = ? AND (attachment_path IS NULL OR attachment_path = '') ORDER BY date, id")
+
+    def inbox_candidates(self, amount, start_date, end_date):
+        """Écritures sans justificatif d'un montant donné (dépense ou recette) entre deux dates."""
+        return self._all(self.SQL_INBOX_CANDIDATES, (abs(amount), -abs(amount), start_date, end_date))
+
+    def entries_without_attachment(self, year_id):
+        return self._all(self.SQL_ENTRIES_WITHOUT_ATTACHMENT, (year_id,))
+
+    def entry_with_attachment_sha(self, sha256):
+        return self._one("SELECT id, date, libelle FROM entries WHERE attachment_sha256 = ? LIMIT 1", (sha256,))
+
+    def attach_receipt(self, entry_id, attachment_path, sha256, pending_id=None):
+        """Joint un justificatif reçu à une écriture qui n'en a pas ; lève ConflictError sinon.
+
+        La file d'attente (pending_id) est vidée dans la même transaction.
+        """
+        with self.transaction():
+            row = self._one("SELECT year_id FROM entries WHERE id = ?", (entry_id,))
+            updated = self.conn.execute("UPDATE entries SET attachment_path = ?, version = version + 1 "
+                                        "WHERE id = ? AND (attachment_path IS NULL OR attachment_path = '')",
+                                        (attachment_path, entry_id)).rowcount
+            if row is None or not updated:
+                raise ConflictError("L'écriture a été supprimée ou a déjà un justificatif.")
+            # Après la mise à jour du chemin, qui efface l'empreinte (trg_entries_upd_attachment_hash)
+            self.conn.execute("UPDATE entries SET attachment_sha256 = ? WHERE id = ?", (sha256, entry_id))
+            if pending_id is not None:
+                self.conn.execute("DELETE FROM inbox_pending WHERE id = ?", (pending_id,))
+            self._touch(row['year_id'])
+
+    def add_inbox_pending(self, path, original_name, sha256, file_date=None, amount=None, note=None):
+        with self.transaction():
+            return self.conn.execute("INSERT INTO inbox_pending (path, original_name, sha256, received_at, file_date, amount, note) "
+                                     "VALUES (?, ?, ?, ?, ?, ?, ?)", (path, original_name, sha256, datetime.now().isoformat(timespec="seconds"),
+                                                                      file_date, amount, note)).lastrowid
+
+    def inbox_pending(self):
+        return self._all("SELECT * FROM inbox_pending ORDER BY received_at, id")
+
+    def inbox_pending_count(self):
+        return self._one("SELECT COUNT(*) FROM inbox_pending")[0]
+
+    def delete_inbox_pending(self, pending_id):
+        with self.transaction():
+            self.conn.execute("DELETE FROM inbox_pending WHERE id = ?", (pending_id,))
+
+    # --- Détails de caisse ---
+    def cash_details(self, entry_id, year_id=None):
+        return self._all(self._year_sql(self.SQL_CASH_DETAILS, year_id), (entry_id,))
+
+    def cash_detail_entry_ids(self, year_id, journal_type='caisse'):
+        return {row[0] for row in self._all(self._year_sql(self.SQL_CASH_DETAIL_ENTRY_IDS, year_id), (year_id, journal_type))}
+
+    def replace_cash_details(self, entry_id, cash_details):
+        with self.transaction():
+            self._current_version(entry_id)
+            self.conn.execute(self.SQL_DELETE_CASH_DETAILS, (entry_id,))
+            if cash_details:
+                self.conn.executemany(self.SQL_INSERT_CASH_DETAIL, [(entry_id, denom, count) for denom, count in cash_details.items()])
+
+    # --- Budgets et agrégats ---
+    def budgets(self, year_id):
+        return {row['category']: row['amount'] for row in self._all(self._year_sql(self.SQL_BUDGETS, year_id), (year_id,))}
+
+    def save_budgets(self, year_id, amounts):
+        with self.transaction():
+            self.conn.executemany(self.SQL_UPSERT_BUDGET, [(year_id, category, amount) for category, amount in amounts.items()])
+            self._touch(year_id)
+
+    def actual_by_category(self, year_id):
+        return {row['category']: row[1] for row in self._all(self._year_sql(self.SQL_ACTUAL_BY_CATEGORY, year_id), (year_id,))}
+
+    def dashboard_totals(self, year_id):
+        return self._one(self._year_sql(self.SQL_DASHBOARD_TOTALS, year_id), (year_id,))
+
+    def monthly_totals(self, year_id):
+        """Lignes (mois AAAA-MM, journal, mouvements, recettes, dépenses) de l'exercice, archivé compris."""
+        return self._all(self._year_sql(self.SQL_MONTHLY_TOTALS, year_id), (year_id,))
+
+    # --- Comptes ---
+    def accounts(self):
+        return self._all(self.SQL_ACCOUNTS)
+
+    def account_balances(self, year_id):
+        """Comptes avec solde initial, mouvements et solde de l'exercice."""
+        return self._all(self._year_sql(self.SQL_ACCOUNT_BALANCES, year_id), {"year": year_id})
+
+    def opening_balances(self):
+        """{id d'exercice : [(code, nom, solde initial), ...]}."""
+        balances = defaultdict(list)
+        for row in self._all(self.SQL_OPENING_BALANCES):
+            balances[row['year_id']].append((row['code'], row['name'], row['opening_balance']))
+        return balances
+
+    def set_opening_balances(self, year_id, balances):
+        """Soldes initiaux d'un exercice, balances : {code du compte : montant}."""
+        with self.transaction():
+            for code, amount in balances.items():
+                column = LEGACY_BALANCE_COLUMNS.get(code)
+                if column:
+                    # Le déclencheur reporte la valeur dans account_balances
+                    self.conn.execute(f"UPDATE accounting_years SET {column} = ? WHERE id = ?", (amount, year_id))
+                else:
+                    self.conn.execute("INSERT OR REPLACE INTO account_balances (year_id, account_id, opening_balance) "
+                                      "SELECT ?, id, ? FROM accounts WHERE code = ?", (year_id, amount, code))
+            self._touch(year_id)
+
+    def _check_account_name(self, name, account_id=None):
+        if self._one("SELECT 1 FROM accounts WHERE name = ? AND id IS NOT ?", (name, account_id)):
+            raise ValueError(f"Un compte nommé '{name}' existe déjà.")
+
+    def add_account(self, name, kind='banque'):
+        """Crée un compte ; son code (valeur de entries.journal) est tiré du nom. Retourne le code."""
+        with self.transaction():
+            self._check_account_name(name)
+            existing = {row['code'] for row in self._all("SELECT code FROM accounts")} | RESERVED_ACCOUNT_CODES
+            base = code = account_code(name)
+            suffix = 2
+            while code in existing:
+                code, suffix = f"{base}_{suffix}", suffix + 1
+            position = self._one("SELECT COALESCE(MAX(position), -1) + 1 FROM accounts WHERE position < 1000")[0]
+            self.conn.execute("INSERT INTO accounts (code, name, kind, position) VALUES (?, ?, ?, ?)", (code, name, kind, position))
+            self._touch(None)
+        return code
+
+    def rename_account(self, account_id, name):
+        """Change le nom affiché ; le code, enregistré dans les écritures, ne change pas."""
+        with self.transaction():
+            self._check_account_name(name, account_id)
+            self.conn.execute("UPDATE accounts SET name = ? WHERE id = ?", (name, account_id))
+            self._touch(None)
+
+    def account_in_use(self, code):
+        """Vrai si une écriture (exercices archivés compris) est passée sur le compte."""
+        if self._one("SELECT 1 FROM entries WHERE journal = ? LIMIT 1", (code,)):
+            return True
+        return any(self._one(self._year_sql("SELECT 1 FROM entries WHERE journal = ? LIMIT 1", year['id']), (code,))
+                   for year in self.list_years() if year['archive_file'])
+
+    def delete_account(self, account_id):
+        with self.transaction():
+            code = self._one("SELECT code FROM accounts WHERE id = ?", (account_id,))['code']
+            if code in LEGACY_BALANCE_COLUMNS:
+                raise ValueError("Le compte postal et la caisse ne peuvent pas être supprimés.")
+            if self.account_in_use(code):
+                raise ValueError("Ce compte a des écritures.")
+            self.conn.execute("DELETE FROM accounts WHERE id = ?", (account_id,))
+            self._touch(None)
+
+    # --- Catégories ---
+    def category_rows(self):
+        return self._all(self.SQL_CATEGORY_TREE)
+
+    def category_rollup(self, year_id):
+        """{id de catégorie : total de l'exercice, sous-catégories comprises}."""
+        return dict(self._all(self._year_sql(self.SQL_CATEGORY_ROLLUP, year_id), (year_id,)))
+
+    def budget_rollup(self, year_id):
+        return dict(self._all(self._year_sql(self.SQL_BUDGET_ROLLUP, year_id), (year_id,)))
+
+    def add_category(self, name, type_op, parent_id=None):
+        with self.transaction():
+            if parent_id is not None:
+                type_op = self._one("SELECT type FROM categories WHERE id = ?", (parent_id,))['type']
+            position = self._one("SELECT COALESCE(MAX(position), -1) + 1 FROM categories WHERE parent_id IS ? AND type = ?",
+                                 (parent_id, type_op))[0]
+            category_id = self.conn.execute("INSERT INTO categories (name, type, parent_id, position) VALUES (?, ?, ?, ?)",
+                                            (name, type_op, parent_id, position)).lastrowid
+            self._touch(None)
+        return category_id
+
+    def rename_category(self, category_id, name):
+        with self.transaction():
+            self.conn.execute("UPDATE categories SET name = ? WHERE id = ?", (name, category_id))
+            self._touch(None)
+
+    def move_category(self, category_id, parent_id):
+        """Rattache une catégorie (et ses sous-catégories) à parent_id, ou à la racine avec None."""
+        with self.transaction():
+            if parent_id is not None:
+                if self._one("SELECT 1 FROM category_closure WHERE ancestor_id = ? AND descendant_id = ?", (category_id, parent_id)):
+                    raise ValueError("Une catégorie ne peut pas être rangée sous l'une de ses sous-catégories.")
+                parent_type = self._one("SELECT type FROM categories WHERE id = ?", (parent_id,))['type']
+                if parent_type != self._one("SELECT type FROM categories WHERE id = ?", (category_id,))['type']:
+                    raise ValueError("Une catégorie de recettes ne peut pas être rangée sous une catégorie de dépenses (et inversement).")
+            self.conn.execute("UPDATE categories SET parent_id = ? WHERE id = ?", (parent_id, category_id))
+            self._touch(None)
+
+    def category_in_use(self, category_id):
+        """Vrai si une écriture ou un budget (exercices archivés compris) utilise la catégorie ou une sous-catégorie."""
+        sql = ("SELECT 1 FROM {table} WHERE category_id IN "
+               "(SELECT descendant_id FROM category_closure WHERE ancestor_id = ?) LIMIT 1")
+        for table in ("entries", "budgets"):
+            if self._one(sql.format(table=table), (category_id,)):
+                return True
+            for year in self.list_years():
+                if year['archive_file'] and self._one(self._year_sql(f"SELECT 1 FROM {table} WHERE category_id = ? LIMIT 1", year['id']), (category_id,)):
+                    return True
+        return False
+
+    def delete_category(self, category_id):
+        with self.transaction():
+            if self._one("SELECT 1 FROM categories WHERE parent_id = ?", (category_id,)):
+                raise ValueError("Supprimez ou déplacez d'abord ses sous-catégories.")
+            if self.category_in_use(category_id):
+                raise ValueError("Cette catégorie est utilisée par des écritures ou des budgets.")
+            self.conn.execute("DELETE FROM categories WHERE id = ?", (category_id,))
+            self._touch(None)
+
+    # --- Règles de classement ---
+    def category_rules(self):
+        """Règles dans leur ordre d'application, avec le nom et le type de leur catégorie."""
+        return self._all(self.SQL_CATEGORY_RULES)
+
+    def add_category_rule(self, pattern, category_id, journal=None, min_amount=None, max_amount=None):
+        pattern = pattern.strip()
+        if not pattern and journal is None and min_amount is None and max_amount is None:
+            raise ValueError("Une règle doit porter sur le libellé, le journal ou le montant.")
+        if min_amount is not None and max_amount is not None and min_amount > max_amount:
+            raise ValueError("Le montant minimum dépasse le montant maximum.")
+        with self.transaction():
+            position = self._one("SELECT COALESCE(MAX(position), -1) + 1 FROM category_rules")[0]
+            return self.conn.execute("INSERT INTO category_rules (position, pattern, journal, min_amount, max_amount, category_id) "
+                                     "VALUES (?, ?, ?, ?, ?, ?)", (position, pattern, journal, min_amount, max_amount, category_id)).lastrowid
+
+    def delete_category_rule(self, rule_id):
+        with self.transaction():
+            self.conn.execute("DELETE FROM category_rules WHERE id = ?", (rule_id,))
+
+    def move_category_rule(self, rule_id, offset):
+        """Avance (offset < 0) ou recule une règle d'un rang : la première règle qui convient l'emporte."""
+        with self.transaction():
+            ids = [row['id'] for row in self._all(self.SQL_CATEGORY_RULES)]
+            index = ids.index(rule_id)
+            target = index + offset
+            if not 0 <= target < len(ids):
+                return
+            ids[index], ids[target] = ids[target], ids[index]
+            self.conn.executemany("UPDATE category_rules SET position = ? WHERE id = ?", list(enumerate(ids)))
+
+    def categorization_entries(self, year_id):
+        return self._all(self.SQL_CATEGORIZATION_ENTRIES, (year_id,))
+
+    def category_history(self):
+        """Libellé, type, catégorie et journal avec leur nombre d'écritures, exercices archivés exclus."""
+        return self._all(self.SQL_CATEGORY_HISTORY)
+
+    def set_entry_categories(self, year_id, changes):
+        """Reclasse les écritures en une seule requête : changes est une liste de (catégorie, id, version lue).
+
+        Une écriture modifiée entre-temps par un autre poste n'est pas touchée. Retourne le nombre d'écritures reclassées.
+        """
+        with self.transaction():
+            updated = self.conn.executemany(self.SQL_SET_ENTRY_CATEGORY,
+                                            [(category, entry_id, version, year_id) for category, entry_id, version in changes]).rowcount
+            self._touch(year_id)
+        return updated
+
+    def iter_year_entries(self, year_id):
+        """Curseur sur les écritures d'un exercice (colonnes utiles aux instantanés), sans tout charger en liste."""
+        return self.conn.execute(self._year_sql(self.SQL_YEAR_SNAPSHOT, year_id), (year_id,))
+
+    def category_month_pivot(self, year_id):
+        return self._all(self._year_sql(self.SQL_CATEGORY_MONTH_PIVOT, year_id), (year_id,))
+
+    # --- Inventaire de caisse ---
+    # Pièces et billets entrent en caisse avec une recette et en sortent avec une dépense.
+    SQL_CASH_INVENTORY = """
+        WITH snap AS (SELECT MAX(snapshot_date) AS snapshot_date FROM cash_snapshots WHERE snapshot_date <= :date)
+        SELECT denomination, SUM(n) AS count FROM (
+            SELECT denomination, count AS n FROM cash_snapshots WHERE snapshot_date = (SELECT snapshot_date FROM snap)
+            UNION ALL
+            SELECT d.denomination, CASE WHEN e.amount < 0 THEN -d.count ELSE d.count END
+            FROM entries e JOIN cash_details d ON d.entry_id = e.id
+            WHERE e.journal = 'caisse' AND e.date <= :date AND e.date > COALESCE((SELECT snapshot_date FROM snap), '')
+        ) GROUP BY denomination
+    """
+
+    def cash_inventory(self, date_str):
+        """Nombre de pièces/billets de chaque valeur que la caisse devrait contenir au soir de date_str."""
+        inventory = {denom: 0 for denom in DENOMINATIONS}
+        for row in self._all(self.SQL_CASH_INVENTORY, {"date": date_str}):
+            inventory[round(row['denomination'], 2)] = row['count']
+        return inventory
+
+    def refresh_cash_snapshots(self, until=None):
+        """Crée les instantanés de fin de mois manquants jusqu'au dernier mois terminé (ou `until`).
+
+        Chaque instantané est calculé à partir du précédent : le premier appel parcourt l'historique
+        une fois, les suivants ne traitent que les mois nouveaux ou invalidés par une modification.
+        Les exercices archivés sont représentés par l'inventaire à leur date de fin.
+        """
+        if not self.read_only:
+            with self.transaction():
+                self._restore_cash_anchors()
+        first = self._one("SELECT MIN(e.date) FROM entries e JOIN cash_details d ON d.entry_id = e.id WHERE e.journal = 'caisse'")[0]
+        if not first:
+            return 0
+        until = until or (date.today().replace(day=1) - timedelta(days=1)).isoformat()
+        last = self._one("SELECT MAX(snapshot_date) FROM cash_snapshots")[0]
+        month = datetime.strptime(last or first, '%Y-%m-%d').date().replace(day=1)
+        if last:
+            month = (month + timedelta(days=32)).replace(day=1)
+        created = 0
+        with self.transaction():
+            while True:
+                month_end = month.replace(day=calendar.monthrange(month.year, month.month)[1]).isoformat()
+                if month_end > until:
+                    break
+                inventory = self.cash_inventory(month_end)
+                self.conn.executemany("INSERT INTO cash_snapshots (snapshot_date, denomination, count) VALUES (?, ?, ?)",
+                                      [(month_end, denom, count) for denom, count in inventory.items()])
+                created += 1
+                month = (month + timedelta(days=32)).replace(day=1)
+        return created
+
+    def year_for_date(self, date_str):
+        return self._one("SELECT * FROM accounting_years WHERE start_date <= ? AND end_date >= ? ORDER BY start_date DESC LIMIT 1", (date_str, date_str))
+
+    def caisse_book_balance(self, date_str):
+        """Solde comptable de la caisse au soir de date_str (solde initial de l'exercice + mouvements)."""
+        year = self.year_for_date(date_str)
+        if year is None:
+            return None, None
+        movements = self._one(self._year_sql("SELECT COALESCE(SUM(amount), 0) FROM entries WHERE year_id = ? AND journal = 'caisse' AND date <= ?", year['id']),
+                              (year['id'], date_str))[0]
+        return year, year['initial_balance_caisse'] + movements
+
+    def save_cash_count(self, count_date, lines, book_balance=None):
+        """Enregistre un comptage physique. lines : {valeur: (attendu, compté)}."""
+        with self.transaction():
+            count_id = self.conn.execute("INSERT INTO cash_counts (count_date, created_at, book_balance) VALUES (?, ?, ?)",
+                                         (count_date, datetime.now().isoformat(timespec="seconds"), book_balance)).lastrowid
+            self.conn.executemany("INSERT INTO cash_count_lines (count_id, denomination, expected, counted) VALUES (?, ?, ?, ?)",
+                                  [(count_id, denom, expected, counted) for denom, (expected, counted) in lines.items()])
+        return count_id
+
+    # --- Intégrité ---
+    def integrity_errors(self, quick=False):
+        """Résultat de PRAGMA integrity_check (ou quick_check) ; liste vide si la base est saine."""
+        rows = self._all("PRAGMA quick_check" if quick else "PRAGMA integrity_check")
+        messages = [row[0] for row in rows]
+        return [] if messages == ["ok"] else messages
+
+    def foreign_key_errors(self):
+        return [(row[0], row[1], row[2]) for row in self._all("PRAGMA foreign_key_check")]
+
+    def orphan_rows(self):
+        """{libellé: (table, [rowid, ...])} pour chaque contrôle qui trouve des lignes orphelines."""
+        orphans = {}
+        for label, sql, table in self.ORPHAN_CHECKS:
+            ids = [row[0] for row in self._all(sql)]
+            if ids:
+                orphans[label] = (table, ids)
+        return orphans
+
+    def delete_orphans(self, orphans):
+        with self.transaction():
+            for table, ids in orphans.values():
+                self.conn.executemany(f"DELETE FROM {table} WHERE rowid = ?", [(rowid,) for rowid in ids])
+            self._touch(None)
+
+    def attachment_references(self):
+        return self._all(self.SQL_ATTACHMENT_REFERENCES)
+
+    def sync_attachment_paths(self):
+        """Pièces jointes connues de la synchronisation, dont celles d'un conflit en attente (sans écriture)."""
+        return {os.path.normpath(row[0]) for row in self._all("SELECT path FROM sync_files")}
+
+    # --- Maintenance ---
+    def storage_stats(self):
+        """Taille du fichier (base + WAL), nombre de pages et pages libres."""
+        page_size = self._one("PRAGMA page_size")[0]
+        page_count = self._one("PRAGMA page_count")[0]
+        free_pages = self._one("PRAGMA freelist_count")[0]
+        file_size = 0
+        for path in (self.db_file, self.db_file + "-wal"):
+            try:
+                file_size += os.path.getsize(path)
+            except OSError:
+                pass
+        return {'page_size': page_size, 'page_count': page_count, 'free_pages': free_pages, 'file_size': file_size}
+
+    def auto_vacuum_mode(self):
+        return self._one("PRAGMA auto_vacuum")[0]  # 0 = aucun, 1 = complet, 2 = incrémental
+
+    def has_statistics(self):
+        return self._one("SELECT COUNT(*) FROM sqlite_master WHERE name = 'sqlite_stat1'")[0] > 0
+
+    def analyze(self, analysis_limit=ANALYSIS_LIMIT):
+        self.conn.execute(f"PRAGMA analysis_limit = {int(analysis_limit)}")
+        self.conn.execute("ANALYZE")
+
+    def optimize(self):
+        self.conn.execute("PRAGMA optimize")
+
+    def vacuum(self):
+        self.conn.execute("VACUUM")
+
+    def incremental_vacuum(self, pages):
+        # execute() n'avance la PRAGMA que d'un pas (une page) ; executescript la mène à terme,
+        # dans sa propre transaction implicite
+        self.conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+
+    def checkpoint(self, mode="PASSIVE"):
+        return self._one(f"PRAGMA wal_checkpoint({mode})")
+
+    def record_maintenance(self, trigger, tasks, duration_ms, before, after):
+        with self.transaction():
+            self.conn.execute("INSERT INTO maintenance_runs (run_at, trigger, tasks, duration_ms, file_size_before, file_size_after, "
+                              "free_pages_before, free_pages_after) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (datetime.now().isoformat(timespec="seconds"), trigger, ",".join(tasks), duration_ms,
+                               before['file_size'], after['file_size'], before['free_pages'], after['free_pages']))
+
+    def maintenance_history(self, limit=20):
+        return self._all("SELECT * FROM maintenance_runs ORDER BY id DESC LIMIT ?", (limit,))
+
+    # --- Rapports pré-générés ---
+    def report_index(self, year_id=None):
+        if year_id is None:
+            return self._all("SELECT * FROM report_index")
+        return self._all("SELECT * FROM report_index WHERE year_id = ? ORDER BY report_type = 'monthly_summary', period DESC, report_type", (year_id,))
+
+    def record_report(self, year_id, report_type, period, path, fingerprint):
+        with self.transaction():
+            self.conn.execute("INSERT OR REPLACE INTO report_index (year_id, report_type, period, path, fingerprint, generated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                              (year_id, report_type, period, path, fingerprint, datetime.now().isoformat(timespec="seconds")))
+
+    def prune_report_index(self):
+        """Oublie les rapports d'exercices supprimés (ou réintégrés sous un nouvel id)."""
+        with self.transaction():
+            self.conn.execute("DELETE FROM report_index WHERE year_id NOT IN (SELECT id FROM accounting_years)")
+
+    # --- Synchronisation ---
+    def site_id(self):
+        """Identifiant de cette installation ; régénéré si le fichier a été copié sur un autre poste ou ailleurs."""
+        host = f"{socket.gethostname()}:{os.path.abspath(self.db_file)}"
+        state = {row['key']: row['value'] for row in self._all("SELECT key, value FROM sync_state WHERE key IN ('site_id', 'site_host')")}
+        if 'site_id' in state and state.get('site_host') == host:
+            return state['site_id']
+        return self.reset_site_id()
+
+    def reset_site_id(self):
+        """Nouvel identifiant d'installation (copie de la base, restauration complète) ; le prochain export sera complet.
+
+        Une base restaurée reprend le journal des modifications et ses numéros de la sauvegarde : sous
+        l'ancien identifiant, les autres postes, déjà plus loin dans cette numérotation, ignoreraient
+        les nouvelles modifications comme déjà reçues.
+        """
+        site = uuid.uuid4().hex
+        host = f"{socket.gethostname()}:{os.path.abspath(self.db_file)}"
+        with self.transaction():
+            self.conn.executemany("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+                                  [('site_id', site), ('site_host', host), ('full_export', '1')])
+            # Nouvelle installation : les postes connus devront recevoir un paquet complet
+            self.conn.execute("DELETE FROM sync_peers")
+        return site
+
+    def full_export_pending(self):
+        return self._one("SELECT 1 FROM sync_state WHERE key = 'full_export'") is not None
+
+    def clear_full_export(self):
+        with self.transaction():
+            self.conn.execute("DELETE FROM sync_state WHERE key = 'full_export'")
+
+    def set_applying(self, applying):
+        """Pendant un import, les triggers ne journalisent pas les modifications reçues."""
+        if applying:
+            self.conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('applying', '1')")
+        else:
+            self.conn.execute("DELETE FROM sync_state WHERE key = 'applying'")
+
+    def last_change_seq(self):
+        return self._one("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'change_log'), 0)")[0]
+
+    def sync_changes_since(self, seq):
+        """Dernière opération (U ou D) de chaque ligne modifiée après seq."""
+        return self._all(self.SQL_SYNC_CHANGES, (seq,))
+
+    def unsynced_changes(self, seq):
+        return {(row[0], row[1]) for row in self._all("SELECT DISTINCT table_name, row_uid FROM change_log WHERE seq > ?", (seq,))}
+
+    def log_change(self, table, uid, op='U'):
+        self.conn.execute("INSERT INTO change_log (table_name, row_uid, op) VALUES (?, ?, ?)", (table, uid, op))
+
+    def prune_change_log(self):
+        """Oublie les modifications déjà reçues par tous les postes connus."""
+        self.conn.execute("DELETE FROM change_log WHERE seq <= (SELECT MIN(acked_seq) FROM sync_peers)")
+
+    def sync_uids(self, table):
+        if table == 'account_balances':
+            return [row[0] for row in self._all(self.SQL_SYNC_BALANCE_KEYS, tuple(LEGACY_BALANCE_COLUMNS))]
+        return [row[0] for row in self._all(f"SELECT uid FROM {table} ORDER BY id")]
+
+    def sync_payload(self, table, uid):
+        """État d'une ligne sous forme de dictionnaire JSON, ou None si elle n'existe pas (chemin local compris pour les écritures)."""
+        row = self._one(self.SQL_SYNC_PAYLOAD[table], (uid,))
+        if row is None:
+            return None
+        payload = dict(row)
+        if table == 'entries':
+            payload['cash'] = [[detail['denomination'], detail['count']] for detail in self.cash_details(payload.pop('id'))]
+        return payload
+
+    def sync_peers(self):
+        return self._all("SELECT * FROM sync_peers ORDER BY last_sync_at DESC")
+
+    def sync_peer(self, site_id):
+        row = self._one("SELECT * FROM sync_peers WHERE site_id = ?", (site_id,))
+        return dict(row) if row else {'site_id': site_id, 'last_applied_seq': 0, 'acked_seq': 0, 'last_sync_at': None}
+
+    def update_sync_peer(self, site_id, last_applied_seq, acked_seq):
+        self.conn.execute("INSERT INTO sync_peers (site_id, last_applied_seq, acked_seq, last_sync_at) VALUES (?, ?, ?, ?) "
+                          "ON CONFLICT(site_id) DO UPDATE SET last_applied_seq = excluded.last_applied_seq, "
+                          "acked_seq = excluded.acked_seq, last_sync_at = excluded.last_sync_at",
+                          (site_id, last_applied_seq, acked_seq, datetime.now().isoformat(timespec="seconds")))
+
+    def sync_file(self, path):
+        return self._one("SELECT * FROM sync_files WHERE path = ?", (path,))
+
+    def sync_file_by_sha(self, sha256):
+        return self._one("SELECT * FROM sync_files WHERE sha256 = ? LIMIT 1", (sha256,))
+
+    def record_sync_files(self, files):
+        """files : [(chemin, empreinte, numéro du paquet qui l'a envoyé ou 0 s'il a été reçu)]."""
+        with self.transaction():
+            self.conn.executemany("INSERT OR REPLACE INTO sync_files (path, sha256, sent_seq) VALUES (?, ?, ?)", files)
+
+    def year_id_for_uid(self, uid):
+        row = self._one("SELECT id FROM accounting_years WHERE uid = ?", (uid,))
+        return row[0] if row else None
+
+    def entry_uids_for_year_uid(self, year_uid):
+        return {row[0] for row in self._all("SELECT e.uid FROM entries e JOIN accounting_years y ON y.id = e.year_id WHERE y.uid = ?", (year_uid,))}
+
+    def apply_sync_year(self, payload):
+        values = (payload['name'], payload['start_date'], payload['end_date'], payload['initial_balance_poste'], payload['initial_balance_caisse'])
+        # Même nom d'exercice créé des deux côtés : on adopte l'identifiant reçu
+        self.conn.execute("UPDATE accounting_years SET uid = ? WHERE name = ? AND uid != ?", (payload['uid'], payload['name'], payload['uid']))
+        if self.conn.execute("UPDATE accounting_years SET name = ?, start_date = ?, end_date = ?, initial_balance_poste = ?, "
+                             "initial_balance_caisse = ? WHERE uid = ?", values + (payload['uid'],)).rowcount == 0:
+            self.conn.execute("INSERT INTO accounting_years (name, start_date, end_date, initial_balance_poste, initial_balance_caisse, uid) "
+                              "VALUES (?, ?, ?, ?, ?, ?)", values + (payload['uid'],))
+        self._touch(None)
+
+    def apply_sync_budget(self, payload, year_id):
+        self.conn.execute("UPDATE budgets SET uid = ? WHERE year_id = ? AND category = ? AND uid != ?",
+                          (payload['uid'], year_id, payload['category'], payload['uid']))
+        if self.conn.execute("UPDATE budgets SET year_id = ?, category = ?, amount = ? WHERE uid = ?",
+                             (year_id, payload['category'], payload['amount'], payload['uid'])).rowcount == 0:
+            self.conn.execute("INSERT INTO budgets (year_id, category, amount, uid) VALUES (?, ?, ?, ?)",
+                              (year_id, payload['category'], payload['amount'], payload['uid']))
+        self._touch(year_id)
+
+    def apply_sync_account(self, payload):
+        # Même compte créé des deux côtés, ou créé ici par une écriture reçue : on adopte l'identifiant reçu
+        self.conn.execute("UPDATE accounts SET uid = ? WHERE code = ? AND uid != ?", (payload['uid'], payload['code'], payload['uid']))
+        next_position = "(SELECT COALESCE(MAX(position), -1) + 1 FROM accounts WHERE position < 1000)"
+        if self.conn.execute(f"UPDATE accounts SET name = ?, kind = ?, position = CASE WHEN position >= 1000 THEN {next_position} "
+                             "ELSE position END WHERE uid = ?", (payload['name'], payload['kind'], payload['uid'])).rowcount == 0:
+            self.conn.execute(f"INSERT INTO accounts (code, name, kind, position, uid) VALUES (?, ?, ?, {next_position}, ?)",
+                              (payload['code'], payload['name'], payload['kind'], payload['uid']))
+        self._touch(None)
+
+    def apply_sync_account_balance(self, payload, year_id):
+        """Solde initial reçu ; False si le compte est inconnu ici."""
+        account = self._one("SELECT id FROM accounts WHERE code = ?", (payload['account'],))
+        if account is None:
+            return False
+        self.conn.execute("INSERT OR REPLACE INTO account_balances (year_id, account_id, opening_balance) VALUES (?, ?, ?)",
+                          (year_id, account['id'], payload['opening_balance']))
+        self._touch(year_id)
+        return True
+
+    def apply_sync_entry(self, payload, year_id, attachment_path):
+        """Crée ou met à jour l'écriture reçue ; retourne le chemin de l'ancienne pièce jointe."""
+        old = self._one("SELECT id, year_id, attachment_path FROM entries WHERE uid = ?", (payload['uid'],))
+        values = (payload['date'], payload['journal'], payload['libelle'], payload['category'], payload['type'], payload['amount'], year_id, attachment_path)
+        if old is None:
+            entry_id = self.conn.execute("INSERT INTO entries (date, journal, libelle, category, type, amount, year_id, attachment_path, uid) "
+                                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", values + (payload['uid'],)).lastrowid
+        else:
+            entry_id = old['id']
+            self._touch(old['year_id'])
+            # version + 1 : une fenêtre de modification ouverte sur cette écriture détectera le conflit
+            self.conn.execute("UPDATE entries SET date = ?, journal = ?, libelle = ?, category = ?, type = ?, amount = ?, year_id = ?, "
+                              "attachment_path = ?, version = version + 1 WHERE id = ?", values + (entry_id,))
+        self.conn.execute(self.SQL_DELETE_CASH_DETAILS, (entry_id,))
+        self.conn.executemany(self.SQL_INSERT_CASH_DETAIL, [(entry_id, denom, count) for denom, count in payload['cash']])
+        self._touch(year_id)
+        return old['attachment_path'] if old else None
+
+    def apply_sync_delete(self, table, uid):
+        """Supprime la ligne reçue comme supprimée ; retourne les pièces jointes devenues inutiles."""
+        if table == 'accounting_years':
+            year_id = self.year_id_for_uid(uid)
+            if year_id is None:
+                return []
+            paths = [row[0] for row in self._all("SELECT attachment_path FROM entries WHERE year_id = ? AND attachment_path IS NOT NULL", (year_id,))]
+            self.delete_year(year_id)
+            return paths
+        if table == 'accounts':
+            row = self._one("SELECT id, code FROM accounts WHERE uid = ?", (uid,))
+            # Un compte qui a des écritures ici est gardé, comme dans delete_account
+            if row is not None and row['code'] not in LEGACY_BALANCE_COLUMNS and not self.account_in_use(row['code']):
+                self.conn.execute("DELETE FROM accounts WHERE id = ?", (row['id'],))
+                self._touch(None)
+            return []
+        if table == 'account_balances':
+            year_uid, code = uid.split(':', 1)
+            year_id = self.year_id_for_uid(year_uid)
+            if year_id is not None:
+                self.conn.execute("DELETE FROM account_balances WHERE year_id = ? AND account_id = (SELECT id FROM accounts WHERE code = ?)",
+                                  (year_id, code))
+                self._touch(year_id)
+            return []
+        row = self._one(f"SELECT * FROM {table} WHERE uid = ?", (uid,))
+        if row is None:
+            return []
+        if table == 'entries':
+            self.conn.execute(self.SQL_DELETE_CASH_DETAILS, (row['id'],))
+        self.conn.execute(f"DELETE FROM {table} WHERE uid = ?", (uid,))
+        self._touch(row['year_id'])
+        return [row['attachment_path']] if table == 'entries' and row['attachment_path'] else []
+
+    def attachment_in_use(self, path):
+        return self._one("SELECT 1 FROM entries WHERE attachment_path = ? LIMIT 1", (path,)) is not None
+
+    def add_sync_conflict(self, site_id, table, uid, remote_payload):
+        self.conn.execute("INSERT INTO sync_conflicts (site_id, table_name, row_uid, remote_payload, received_at) VALUES (?, ?, ?, ?, ?)",
+                          (site_id, table, uid, json.dumps(remote_payload), datetime.now().isoformat(timespec="seconds")))
+
+    def sync_conflicts(self):
+        return self._all("SELECT * FROM sync_conflicts ORDER BY id")
+
+    def delete_sync_conflict(self, conflict_id):
+        self.conn.execute("DELETE FROM sync_conflicts WHERE id = ?", (conflict_id,))
+
+    def restore_year_from(self, backup_path, year_name):
+        """Remplace (ou recrée) l'exercice year_name par sa version dans la sauvegarde, en une seule transaction.
+
+        La sauvegarde est attachée (ATTACH) ; les écritures reçoivent de nouveaux id, leurs détails
+        de caisse sont rattachés par rang. Retourne (écritures, budgets) restaurés.
+        """
+        self.conn.execute("ATTACH DATABASE ? AS bak", (backup_path,))
+        try:
+            year = self._one("SELECT id FROM bak.accounting_years WHERE name = ?", (year_name,))
+            if year is None:
+                raise ValueError(f"L'exercice '{year_name}' n'existe pas dans la sauvegarde.")
+
+            def select_list(table, columns, defaults):
+                # Sauvegarde d'une ancienne version : colonnes manquantes remplacées par leur valeur par défaut
+                available = {row[1] for row in self._all(f"PRAGMA bak.table_info({table})")}
+                expressions = []
+                for column in columns:
+                    if column not in available:
+                        expressions.append(defaults.get(column, "NULL"))
+                    elif column == 'uid':
+                        expressions.append(f"CASE WHEN uid IN (SELECT uid FROM main.{table} WHERE uid IS NOT NULL) THEN NULL ELSE uid END")
+                    else:
+                        expressions.append(column)
+                return ", ".join(expressions)
+
+            year_columns = ["name", "start_date", "end_date", "initial_balance_poste", "initial_balance_caisse", "uid"]
+            entry_columns = ["date", "journal", "libelle", "category", "type", "amount", "attachment_path", "reconciled_on",
+                             "attachment_sha256", "uid"]
+            budget_columns = ["category", "amount", "uid"]
+            zero = {"initial_balance_poste": "0", "initial_balance_caisse": "0"}
+            with self.transaction():
+                local = self._one("SELECT id FROM accounting_years WHERE name = ?", (year_name,))
+                if local is not None:
+                    self.delete_year(local['id'])
+                new_year_id = self.conn.execute(
+                    f"INSERT INTO accounting_years ({', '.join(year_columns)}) "
+                    f"SELECT {select_list('accounting_years', year_columns, zero)} FROM bak.accounting_years WHERE id = ?", (year['id'],)).lastrowid
+                if self._one("SELECT 1 FROM bak.sqlite_master WHERE type = 'table' AND name = 'account_balances'"):
+                    # Soldes initiaux des autres comptes (poste et caisse suivent accounting_years)
+                    self.conn.execute("INSERT OR IGNORE INTO accounts (code, name, kind, position) "
+                                      "SELECT code, name, kind, position FROM bak.accounts")
+                    self.conn.execute("INSERT OR REPLACE INTO account_balances (year_id, account_id, opening_balance) "
+                                      "SELECT ?, a.id, b.opening_balance FROM bak.account_balances b "
+                                      "JOIN bak.accounts ba ON ba.id = b.account_id JOIN main.accounts a ON a.code = ba.code "
+                                      f"WHERE b.year_id = ? AND ba.code NOT IN ({', '.join('?' * len(LEGACY_BALANCE_COLUMNS))})",
+                                      (new_year_id, year['id'], *LEGACY_BALANCE_COLUMNS))
+                first_id = self._one("SELECT COALESCE(MAX(id), 0) FROM entries")[0] + 1
+                entries = self.conn.execute(
+                    f"INSERT INTO entries (year_id, {', '.join(entry_columns)}) "
+                    f"SELECT ?, {select_list('entries', entry_columns, {})} FROM bak.entries WHERE year_id = ? ORDER BY id",
+                    (new_year_id, year['id'])).rowcount
+                # Les nouveaux id se suivent dans l'ordre des anciens (transaction d'écriture exclusive)
+                self.conn.execute("INSERT INTO cash_details (entry_id, denomination, count) "
+                                  "SELECT ? + m.rn, d.denomination, d.count FROM bak.cash_details d JOIN "
+                                  "(SELECT id, ROW_NUMBER() OVER (ORDER BY id) - 1 AS rn FROM bak.entries WHERE year_id = ?) m "
+                                  "ON m.id = d.entry_id", (first_id, year['id']))
+                budgets = self.conn.execute(
+                    f"INSERT INTO budgets (year_id, {', '.join(budget_columns)}) "
+                    f"SELECT ?, {select_list('budgets', budget_columns, {})} FROM bak.budgets WHERE year_id = ?",
+                    (new_year_id, year['id'])).rowcount
+                self._touch(None)
+        finally:
+            self.conn.execute("DETACH DATABASE bak")
+        return entries, budgets
+
+    def backup_to(self, dest_path, progress=None):
+        """Copie cohérente de la base via l'API de sauvegarde SQLite (compatible WAL, sans fermer la connexion).
+
+        progress(status, restantes, total) est appelé par tranche de pages ; s'il lève une exception,
+        la copie est abandonnée et le fichier partiel supprimé.
+        """
+        dest = sqlite3.connect(dest_path)
+        try:
+            if progress is None:
+                self.conn.backup(dest)
+            else:
+                self.conn.backup(dest, pages=BACKUP_PAGES_PER_STEP, progress=progress)
+        except BaseException:
+            dest.close()
+            os.remove(dest_path)
+            raise
+        dest.close()
+
+def backup_database_file(db, save_dir=SAVE_DIR, prefix="backup", progress=None):
+    """Sauvegarde la base dans le dossier de sauvegarde et retourne le chemin créé."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    backup_filepath = os.path.join(save_dir, f"{prefix}_{timestamp}.db")
+    db.backup_to(backup_filepath, progress)
+    return backup_filepath
+
+# --- RESTAURATION ---
+BACKUP_REQUIRED_TABLES = {"accounting_years", "entries", "budgets", "cash_details"}
+
+class BackupError(Exception):
+    """Le fichier choisi n'est pas une sauvegarde utilisable."""
+
+def validate_backup_file(backup_path):
+    """Contrôle une sauvegarde avant restauration (intégrité, tables, version du schéma).
+
+    Retourne la liste des noms d'exercices qu'elle contient ; lève BackupError sinon.
+    """
+    try:
+        conn = db_connect_read_only(backup_path)
+    except sqlite3.Error as e:
+        raise BackupError(f"Impossible d'ouvrir la sauvegarde : {e}")
+    try:
+        messages = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+        if messages != ["ok"]:
+            raise BackupError(f"La sauvegarde est endommagée : {messages[0]}")
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        missing = BACKUP_REQUIRED_TABLES - tables
+        if missing:
+            raise BackupError(f"Ce fichier n'est pas une sauvegarde AETML (tables manquantes : {', '.join(sorted(missing))}).")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise BackupError("Cette sauvegarde a été créée par une version plus récente de l'application.")
+        return [row[0] for row in conn.execute("SELECT name FROM accounting_years ORDER BY start_date DESC")]
+    except sqlite3.DatabaseError as e:
+        raise BackupError(f"Fichier illisible : {e}")
+    finally:
+        conn.close()
+
+def restore_backup_file(backup_path, db_file=DB_FILE):
+    """Remplace le contenu de la base par la sauvegarde via l'API de sauvegarde SQLite.
+
+    La copie se fait en une seule étape : les autres connexions voient l'ancienne ou la nouvelle base,
+    jamais un mélange. Utilise ses propres connexions (appelable depuis un thread de travail).
+    Voir restore_database pour une restauration depuis l'application.
+    """
+    source = db_connect_read_only(backup_path)
+    dest = sqlite3.connect(db_file, timeout=sqlite_pragmas(db_file)["busy_timeout"] / 1000)
+    try:
+        source.backup(dest)
+    finally:
+        dest.close()
+        source.close()
+
+def restore_database(db, backup_path):
+    """Restauration complète par la connexion db : copie, mise à niveau du schéma, nouvel identifiant de synchronisation."""
+    restore_backup_file(backup_path, db.db_file)
+    # Reconnexion : met à niveau le schéma si la sauvegarde vient d'une version antérieure
+    db.reconnect()
+    # Le journal des modifications est revenu en arrière : les autres postes doivent voir une nouvelle installation
+    db.reset_site_id()
+
+# --- ARCHIVAGE DES EXERCICES ---
+class ArchiveError(Exception):
+    """L'exercice ne peut pas être archivé ou désarchivé."""
+
+def archive_paths(year_name, archive_dir=ARCHIVE_DIR):
+    """(base d'archive, dossier des pièces jointes archivées) d'un exercice."""
+    safe_year_name = year_name.replace('/', '-').replace('\\', '-')
+    return os.path.join(archive_dir, f"{safe_year_name}.db"), os.path.join(archive_dir, safe_year_name)
+
+def year_attachment_dir(db, year_id, attachment_dir=ATTACHMENT_DIR):
+    """Dossier auquel sont relatifs les chemins de pièces jointes d'un exercice."""
+    archive_file = db.archive_file(year_id)
+    return os.path.splitext(archive_file)[0] if archive_file else attachment_dir
+
+def _years_by_start(db):
+    return sorted(db.list_years(), key=lambda y: y['start_date'] or '')
+
+def archive_year(db, year_id, attachment_dir=ATTACHMENT_DIR, archive_dir=ARCHIVE_DIR):
+    """Déplace un exercice clôturé dans sa propre base, en lecture seule, avec ses pièces jointes.
+
+    Les exercices s'archivent du plus ancien au plus récent, afin que l'inventaire de caisse
+    conservé à la fin du dernier exercice archivé résume tout l'historique antérieur.
+    Retourne (écritures, pièces jointes) archivées.
+    """
+    years = _years_by_start(db)
+    year = next((y for y in years if y['id'] == year_id), None)
+    if year is None:
+        raise ArchiveError("Exercice introuvable.")
+    if year['archive_file']:
+        raise ArchiveError(f"L'exercice '{year['name']}' est déjà archivé.")
+    if not year['end_date'] or year['end_date'] >= date.today().isoformat():
+        raise ArchiveError(f"L'exercice '{year['name']}' n'est pas encore clôturé.")
+    earlier = [y['name'] for y in years if y['start_date'] < year['start_date'] and not y['archive_file']]
+    if earlier:
+        raise ArchiveError("Archivez d'abord les exercices plus anciens : " + ", ".join(earlier))
+
+    archive_path, files_dir = archive_paths(year['name'], archive_dir)
+    os.makedirs(archive_dir, exist_ok=True)
+    entries = db.copy_year_to_archive(year_id, archive_path)
+    copied = []
+    try:
+        for row in db.entries_for_year(year_id):
+            path = row['attachment_path']
+            if path and os.path.exists(os.path.join(attachment_dir, path)):
+                dest = os.path.join(files_dir, path)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy2(os.path.join(attachment_dir, path), dest)
+                copied.append(path)
+        db.drop_archived_year(year_id, archive_path)
+    except BaseException:
+        os.remove(archive_path)
+        shutil.rmtree(files_dir, ignore_errors=True)
+        raise
+    # Les originaux ne sont supprimés qu'une fois l'exercice retiré de la base principale
+    for path in copied:
+        if not db.attachment_in_use(path):
+            os.remove(os.path.join(attachment_dir, path))
+    year_dir = os.path.join(attachment_dir, str(year_id))
+    if os.path.isdir(year_dir) and not os.listdir(year_dir):
+        os.rmdir(year_dir)
+    os.chmod(archive_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    return entries, len(copied)
+
+def unarchive_year(db, year_id, attachment_dir=ATTACHMENT_DIR):
+    """Réintègre le dernier exercice archivé dans la base principale (il reçoit un nouvel id).
+
+    Retourne le nombre d'écritures réintégrées.
+    """
+    years = _years_by_start(db)
+    year = next((y for y in years if y['id'] == year_id), None)
+    if year is None or not year['archive_file']:
+        raise ArchiveError("Cet exercice n'est pas archivé.")
+    later = [y['name'] for y in years if y['start_date'] > year['start_date'] and y['archive_file']]
+    if later:
+        raise ArchiveError("Désarchivez d'abord les exercices plus récents : " + ", ".join(later))
+
+    archive_path = year['archive_file']
+    files_dir = os.path.splitext(archive_path)[0]
+    restored = []
+    for row in db.entries_for_year(year_id):
+        path = row['attachment_path']
+        if path and os.path.exists(os.path.join(files_dir, path)) and not os.path.exists(os.path.join(attachment_dir, path)):
+            os.makedirs(os.path.dirname(os.path.join(attachment_dir, path)), exist_ok=True)
+            shutil.copy2(os.path.join(files_dir, path), os.path.join(attachment_dir, path))
+            restored.append(path)
+    try:
+        db.detach_archives()  # restore_year_from attache l'archive comme une sauvegarde
+        entries, _ = db.restore_year_from(archive_path, year['name'])
+    except BaseException:
+        for path in restored:
+            os.remove(os.path.join(attachment_dir, path))
+        raise
+    remove_archive_files(archive_path)
+    return entries
+
+def remove_archive_files(archive_path):
+    """Supprime la base d'archive (en lecture seule) et le dossier de ses pièces jointes."""
+    try:
+        os.chmod(archive_path, stat.S_IRUSR | stat.S_IWUSR)
+        os.remove(archive_path)
+    except OSError as e:
+        print(f"Impossible de supprimer l'archive '{archive_path}' : {e}")
+    shutil.rmtree(os.path.splitext(archive_path)[0], ignore_errors=True)
+
+# --- CONTRÔLE D'INTÉGRITÉ ---
+class IntegrityReport:
+    """Résultat d'un contrôle : anomalies de la base et des pièces jointes."""
+    def __init__(self):
+        self.sqlite_errors = []        # messages de PRAGMA integrity_check
+        self.foreign_key_errors = []   # (table, rowid, table parente)
+        self.orphans = {}              # libellé -> (table, [rowid])
+        self.missing_files = []        # (entry_id, chemin) référencés mais absents du disque
+        self.unreferenced_files = []   # chemins présents sur le disque sans écriture
+        self.unreadable_files = []     # (chemin, erreur)
+        self.empty_files = []
+        self.changed_files = []        # contenu modifié sans changement de taille ni de date
+        self.duplicate_files = []      # groupes de chemins au contenu identique
+        self.files_checked = 0
+        self.files_hashed = 0
+        self.duration = 0.0
+
+    @property
+    def ok(self):
+        return not (self.sqlite_errors or self.foreign_key_errors or self.orphans or self.missing_files
+                    or self.unreferenced_files or self.unreadable_files or self.empty_files or self.changed_files)
+
+    def summary(self):
+        lines = [f"Contrôle terminé en {self.duration:.2f} s : {self.files_checked} pièce(s) jointe(s), {self.files_hashed} empreinte(s) calculée(s)."]
+        if self.ok:
+            lines.append("Aucune anomalie détectée.")
+        for message in self.sqlite_errors:
+            lines.append(f"Base SQLite : {message}")
+        for table, rowid, parent in self.foreign_key_errors:
+            lines.append(f"Clé étrangère invalide : {table} #{rowid} -> {parent}")
+        for label, (table, ids) in self.orphans.items():
+            lines.append(f"{label} : {len(ids)} ligne(s) ({table})")
+        for entry_id, path in self.missing_files:
+            lines.append(f"Pièce jointe manquante (écriture #{entry_id}) : {path}")
+        for path in self.unreferenced_files:
+            lines.append(f"Fichier sans écriture : {path}")
+        for path, error in self.unreadable_files:
+            lines.append(f"Fichier illisible : {path} ({error})")
+        for path in self.empty_files:
+            lines.append(f"Fichier vide : {path}")
+        for path in self.changed_files:
+            lines.append(f"Contenu modifié depuis le dernier contrôle : {path}")
+        for group in self.duplicate_files:
+            others = f" (+{len(group) - 3})" if len(group) > 3 else ""
+            lines.append(f"Fichiers identiques : {', '.join(group[:3])}{others}")
+        return "\n".join(lines)
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _load_hash_cache(cache_file):
+    try:
+        with open(cache_file, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_hash_cache(cache_file, cache):
+    tmp_file = cache_file + ".tmp"
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print(f"Impossible d'enregistrer les empreintes des pièces jointes : {e}")
+
+def scan_attachment_files(attachment_dir=ATTACHMENT_DIR):
+    """{chemin relatif (séparateur os.sep) : os.stat_result} des fichiers de pièces jointes, hors quarantaine."""
+    files = {}
+    for root, dirs, filenames in os.walk(attachment_dir):
+        if root == attachment_dir and ORPHAN_ATTACHMENT_DIR in dirs:
+            dirs.remove(ORPHAN_ATTACHMENT_DIR)
+        for filename in filenames:
+            full_path = os.path.join(root, filename)
+            try:
+                files[os.path.relpath(full_path, attachment_dir)] = os.stat(full_path)
+            except OSError:
+                continue
+    return files
+
+def check_integrity(db_file=DB_FILE, attachment_dir=ATTACHMENT_DIR, quick=False, rehash=False,
+                    cache_file=INTEGRITY_HASH_CACHE, workers=INTEGRITY_WORKERS):
+    """Contrôle la base et les pièces jointes ; utilisable depuis n'importe quel thread.
+
+    quick : PRAGMA quick_check au lieu d'integrity_check (contrôle au démarrage).
+    rehash : recalcule toutes les empreintes ; sinon seuls les fichiers nouveaux ou modifiés
+    (taille ou date) sont relus, les autres reprennent l'empreinte du cache.
+    """
+    started = time.perf_counter()
+    report = IntegrityReport()
+    db = LedgerRepository(db_file, read_only=True)
+    try:
+        report.sqlite_errors = db.integrity_errors(quick=quick)
+        report.foreign_key_errors = db.foreign_key_errors()
+        report.orphans = db.orphan_rows()
+        references = {os.path.normpath(row['attachment_path']): row['id'] for row in db.attachment_references()}
+        sync_paths = db.sync_attachment_paths()
+    finally:
+        db.close()
+
+    files = scan_attachment_files(attachment_dir)
+    report.files_checked = len(files)
+    report.missing_files = sorted((entry_id, path) for path, entry_id in references.items() if path not in files)
+    report.unreferenced_files = sorted(path for path in files if path not in references and path not in sync_paths)
+
+    cache = _load_hash_cache(cache_file)
+    to_hash = []
+    hashes = {}
+    for path, st in files.items():
+        cached = cache.get(path)
+        if st.st_size == 0:
+            report.empty_files.append(path)
+        elif cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns and not rehash:
+            hashes[path] = cached[2]
+        else:
+            to_hash.append(path)
+
+    # sha256 libère le GIL sur les gros blocs : la lecture et le hachage avancent en parallèle
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {path: pool.submit(_hash_file, os.path.join(attachment_dir, path)) for path in to_hash}
+        for path, future in futures.items():
+            try:
+                hashes[path] = future.result()
+            except OSError as e:
+                report.unreadable_files.append((path, e.strerror or str(e)))
+                continue
+            cached = cache.get(path)
+            st = files[path]
+            if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns and cached[2] != hashes[path]:
+                report.changed_files.append(path)
+    report.files_hashed = len(to_hash)
+
+    by_hash = defaultdict(list)
+    for path, digest in hashes.items():
+        by_hash[digest].append(path)
+    report.duplicate_files = sorted(sorted(group) for group in by_hash.values() if len(group) > 1)
+    report.empty_files.sort()
+    report.changed_files.sort()
+
+    _save_hash_cache(cache_file, {path: [files[path].st_size, files[path].st_mtime_ns, digest] for path, digest in hashes.items()})
+    report.duration = time.perf_counter() - started
+    return report
+
+def repair_integrity(db, report, attachment_dir=ATTACHMENT_DIR):
+    """Corrige ce qui peut l'être sans perte : supprime les lignes orphelines et met en quarantaine
+    les fichiers sans écriture. Les pièces manquantes et une base corrompue demandent une sauvegarde.
+    Retourne la liste des actions effectuées."""
+    actions = []
+    if report.orphans:
+        db.delete_orphans(report.orphans)
+        for label, (table, ids) in report.orphans.items():
+            actions.append(f"{label} : {len(ids)} ligne(s) supprimée(s)")
+    # Un conflit a pu être importé depuis le contrôle : sa pièce jointe ne doit pas partir en quarantaine
+    sync_paths = db.sync_attachment_paths()
+    for path in report.unreferenced_files:
+        if path in sync_paths:
+            continue
+        destination = os.path.join(attachment_dir, ORPHAN_ATTACHMENT_DIR, path)
+        try:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.move(os.path.join(attachment_dir, path), destination)
+            actions.append(f"Fichier mis en quarantaine : {path}")
+        except OSError as e:
+            actions.append(f"Impossible de déplacer {path} : {e}")
+    return actions
+
+# --- MAINTENANCE DE LA BASE ---
+def run_maintenance(db, budget_s=MAINTENANCE_BUDGET_S, trigger="inactivité", checkpoint_mode="PASSIVE", allow_full_vacuum=True):
+    """Exécute les tâches de maintenance dans la limite de budget_s secondes et les enregistre.
+
+    Ordre : statistiques du planificateur (ANALYZE borné la première fois, puis PRAGMA optimize),
+    conversion unique en auto_vacuum incrémental (seulement si la durée estimée du VACUUM complet
+    tient dans le budget), vacuum incrémental par petites transactions
+    tant qu'il reste des pages libres et du temps, puis checkpoint du WAL.
+    Retourne la liste des tâches effectuées.
+    """
+    started = time.perf_counter()
+    deadline = started + budget_s
+    before = db.storage_stats()
+    tasks = []
+
+    if not db.has_statistics():
+        db.analyze()
+        tasks.append("analyze")
+    else:
+        db.optimize()
+        tasks.append("optimize")
+
+    # Une base créée avant l'auto_vacuum incrémental doit être reconstruite une fois (VACUUM complet,
+    # non interruptible : jamais à la fermeture, ni quand la taille du fichier dépasse le budget restant)
+    vacuum_s = before['file_size'] / VACUUM_BYTES_PER_S
+    if allow_full_vacuum and db.auto_vacuum_mode() != 2 and time.perf_counter() + vacuum_s < deadline:
+        db.vacuum()
+        tasks.append("vacuum")
+
+    free_pages = db.storage_stats()['free_pages']
+    if free_pages and db.auto_vacuum_mode() == 2:
+        while free_pages and time.perf_counter() < deadline:
+            db.incremental_vacuum(VACUUM_PAGES_PER_STEP)
+            free_pages = db.storage_stats()['free_pages']
+        tasks.append("incremental_vacuum")
+
+    if time.perf_counter() < deadline or checkpoint_mode != "PASSIVE":
+        db.checkpoint(checkpoint_mode)
+        tasks.append(f"checkpoint_{checkpoint_mode.lower()}")
+
+    duration_ms = (time.perf_counter() - started) * 1000
+    after = db.storage_stats()
+    db.record_maintenance(trigger, tasks, duration_ms, before, after)
+    return tasks
+
+def format_maintenance_history(rows):
+    lines = ["MAINTENANCE", f"{'date':<20}{'déclencheur':<14}{'durée ms':>10}{'taille Ko':>18}{'pages libres':>16}  tâches"]
+    for row in rows:
+        size = f"{(row['file_size_before'] or 0) // 1024}->{(row['file_size_after'] or 0) // 1024}"
+        free = f"{row['free_pages_before']}->{row['free_pages_after']}"
+        lines.append(f"{row['run_at']:<20}{row['trigger']:<14}{row['duration_ms']:>10.0f}{size:>18}{free:>16}  {row['tasks']}")
+    if not rows:
+        lines.append("(aucune maintenance enregistrée)")
+    return "\n".join(lines)
+
+# --- SYNCHRONISATION ENTRE POSTES ---
+# Un paquet (.aetmlsync) est un zip contenant changes.json (état actuel de chaque ligne modifiée depuis
+# le dernier accusé de réception du poste destinataire) et les pièces jointes qu'il n'a pas encore reçues.
+# Les lignes sont identifiées par un uid global ; l'import est idempotent et signale les conflits
+# (ligne modifiée des deux côtés depuis la dernière synchronisation) au lieu d'écraser.
+SYNC_APPLY_ORDER = {("U", "accounting_years"): 0, ("U", "accounts"): 1, ("U", "account_balances"): 2, ("U", "budgets"): 3, ("U", "entries"): 4,
+                    ("D", "entries"): 5, ("D", "budgets"): 6, ("D", "account_balances"): 7, ("D", "accounts"): 8, ("D", "accounting_years"): 9}
+
+class SyncError(Exception):
+    """Paquet de synchronisation inutilisable (format, provenance, paquet précédent manquant)."""
+
+def _sync_state(db, table, uid, attachment_dir):
+    """État comparable d'une ligne (pièce jointe décrite par nom + empreinte) et chemin local de sa pièce jointe."""
+    payload = db.sync_payload(table, uid)
+    if payload is None or table != 'entries':
+        return payload, None
+    path = payload.pop('attachment_path')
+    payload['attachment'] = None
+    if path:
+        known = db.sync_file(path)
+        full_path = os.path.join(attachment_dir, path)
+        if known:
+            payload['attachment'] = {'name': os.path.basename(path), 'sha256': known['sha256']}
+        elif os.path.exists(full_path):
+            payload['attachment'] = {'name': os.path.basename(path), 'sha256': _hash_file(full_path)}
+    return payload, path
+
+def export_sync_package(db, dest_path, full=False, attachment_dir=ATTACHMENT_DIR):
+    """Écrit un paquet avec les modifications non encore confirmées par les autres postes (tout si full).
+
+    Après un changement d'identifiant (copie ou restauration de la base), l'export est toujours complet.
+    """
+    site = db.site_id()
+    full = full or db.full_export_pending()
+    peers = db.sync_peers()
+    from_seq = 0 if full or not peers else min(peer['acked_seq'] for peer in peers)
+    to_seq = db.last_change_seq()
+    if full:
+        keys = [(table, uid, 'U') for table in SYNC_TABLES for uid in db.sync_uids(table)]
+    else:
+        keys = [(row['table_name'], row['row_uid'], row['op']) for row in db.sync_changes_since(from_seq)]
+
+    records, files, sent_paths = [], {}, []
+    for table, uid, op in keys:
+        payload, path = _sync_state(db, table, uid, attachment_dir) if op == 'U' else (None, None)
+        records.append({'table': table, 'uid': uid, 'data': payload})
+        attachment = payload.get('attachment') if payload and table == 'entries' else None
+        if attachment:
+            sent = db.sync_file(path)
+            # Pièce jointe nouvelle, ou envoyée dans un paquet dont on n'a pas encore l'accusé de réception
+            if full or sent is None or sent['sent_seq'] > from_seq:
+                files.setdefault(attachment['sha256'], path)
+                sent_paths.append((path, attachment['sha256'], to_seq))
+
+    header = {'format': SYNC_FORMAT, 'site_id': site, 'created_at': datetime.now().isoformat(timespec="seconds"),
+              'full': full, 'from_seq': from_seq, 'to_seq': to_seq,
+              'acks': {peer['site_id']: peer['last_applied_seq'] for peer in peers}, 'records': records}
+    tmp_path = dest_path + ".tmp"
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED) as package:
+        package.writestr("changes.json", json.dumps(header, ensure_ascii=False, separators=(",", ":")))
+        for sha256, path in files.items():
+            # Les PDF sont déjà compressés
+            package.write(os.path.join(attachment_dir, path), f"attachments/{sha256}", compress_type=zipfile.ZIP_STORED)
+    os.replace(tmp_path, dest_path)
+    db.record_sync_files(sent_paths)
+    if full:
+        db.clear_full_export()
+    return {'records': len(records), 'files': len(files), 'from_seq': from_seq, 'to_seq': to_seq, 'size': os.path.getsize(dest_path)}
+
+def _import_attachment(db, package, attachment, year_id, local, local_path, attachment_dir, written):
+    """Chemin local de la pièce jointe reçue : existante (même empreinte) ou extraite du paquet."""
+    if not attachment:
+        return None
+    if local and local.get('attachment') == attachment:
+        return local_path
+    name = os.path.basename(attachment['name'])
+    known = db.sync_file_by_sha(attachment['sha256'])
+    known_path = os.path.join(attachment_dir, known['path']) if known else None
+    if known and os.path.basename(known['path']) == name and os.path.exists(known_path):
+        return known['path']
+    member = f"attachments/{attachment['sha256']}"
+    has_member = package is not None and member in package.namelist()
+    if not has_member and not (known and os.path.exists(known_path)):
+        raise FileNotFoundError(name)
+    path = os.path.join(str(year_id), name)
+    if os.path.exists(os.path.join(attachment_dir, path)):
+        path = os.path.join(str(year_id), f"{attachment['sha256'][:8]}_{name}")
+    os.makedirs(os.path.join(attachment_dir, str(year_id)), exist_ok=True)
+    if has_member:
+        with package.open(member) as src, open(os.path.join(attachment_dir, path), 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+    else:
+        # Même contenu déjà présent sous un autre nom : copie locale, rien à transférer
+        shutil.copyfile(known_path, os.path.join(attachment_dir, path))
+    written.append(path)
+    db.record_sync_files([(path, attachment['sha256'], 0)])
+    return path
+
+def _apply_sync_record(db, table, uid, remote, local, local_path, package, attachment_dir, written, removed):
+    """Applique l'état reçu d'une ligne. Retourne False si elle ne peut pas l'être (exercice ou pièce jointe manquants)."""
+    if remote is None:
+        removed.extend(db.apply_sync_delete(table, uid))
+        return True
+    if table == 'accounting_years':
+        db.apply_sync_year(remote)
+        return True
+    if table == 'accounts':
+        db.apply_sync_account(remote)
+        return True
+    year_id = db.year_id_for_uid(remote['year'])
+    if year_id is None or db.archive_file(year_id):
+        return False  # exercice inconnu, ou archivé ici (lecture seule)
+    if table == 'budgets':
+        db.apply_sync_budget(remote, year_id)
+        return True
+    if table == 'account_balances':
+        return db.apply_sync_account_balance(remote, year_id)
+    try:
+        path = _import_attachment(db, package, remote['attachment'], year_id, local, local_path, attachment_dir, written)
+    except FileNotFoundError:
+        return False
+    old_path = db.apply_sync_entry(remote, year_id, path)
+    if old_path and old_path != path:
+        removed.append(old_path)
+    return True
+
+def _remove_unused_attachments(db, paths, attachment_dir):
+    for path in paths:
+        full_path = os.path.join(attachment_dir, path)
+        if not db.attachment_in_use(path) and os.path.exists(full_path):
+            os.remove(full_path)
+
+def import_sync_package(db, package_path, attachment_dir=ATTACHMENT_DIR):
+    """Applique un paquet reçu d'un autre poste. Retourne un résumé (dictionnaire)."""
+    try:
+        package = zipfile.ZipFile(package_path)
+        header = json.loads(package.read("changes.json"))
+    except (OSError, zipfile.BadZipFile, KeyError, ValueError) as e:
+        raise SyncError(f"Paquet illisible : {e}")
+    with package:
+        if header.get('format') != SYNC_FORMAT:
+            raise SyncError("Format de paquet non pris en charge.")
+        site = db.site_id()
+        sender = header['site_id']
+        if sender == site:
+            raise SyncError("Ce paquet a été créé par cette installation.")
+        peer = db.sync_peer(sender)
+        result = {'applied': 0, 'unchanged': 0, 'conflicts': 0, 'skipped': 0, 'files': 0, 'already': False}
+        if not header['full'] and header['from_seq'] > peer['last_applied_seq']:
+            raise SyncError("Un paquet précédent de ce poste n'a pas été importé.\n"
+                            "Demandez-lui un export complet.")
+        acked = max(peer['acked_seq'], header['acks'].get(site, 0))
+        if not header['full'] and header['to_seq'] <= peer['last_applied_seq']:
+            result['already'] = True
+            with db.transaction():
+                db.update_sync_peer(sender, peer['last_applied_seq'], acked)
+            return result
+
+        # Lignes modifiées ici que l'expéditeur n'avait pas encore reçues : conflit si l'état reçu diffère
+        unsynced = db.unsynced_changes(acked)
+        records = sorted(header['records'], key=lambda r: SYNC_APPLY_ORDER[('U' if r['data'] is not None else 'D', r['table'])])
+        written, removed = [], []
+        try:
+            with db.transaction():
+                db.set_applying(True)
+                for record in records:
+                    table, uid, remote = record['table'], record['uid'], record['data']
+                    local, local_path = _sync_state(db, table, uid, attachment_dir)
+                    if local == remote:
+                        result['unchanged'] += 1
+                        continue
+                    conflict = (table, uid) in unsynced
+                    if remote is None and table == 'accounting_years':
+                        conflict = conflict or any(('entries', entry_uid) in unsynced for entry_uid in db.entry_uids_for_year_uid(uid))
+                    if conflict:
+                        db.add_sync_conflict(sender, table, uid, remote)
+                        year_id = db.year_id_for_uid(remote['year']) if table == 'entries' and remote else None
+                        if year_id is not None and remote['attachment']:
+                            # La pièce jointe est conservée pour pouvoir choisir la version reçue plus tard
+                            try:
+                                _import_attachment(db, package, remote['attachment'], year_id, None, None, attachment_dir, written)
+                            except FileNotFoundError:
+                                pass
+                        result['conflicts'] += 1
+                    elif _apply_sync_record(db, table, uid, remote, local, local_path, package, attachment_dir, written, removed):
+                        result['applied'] += 1
+                    else:
+                        result['skipped'] += 1
+                db.update_sync_peer(sender, max(peer['last_applied_seq'], header['to_seq']), acked)
+                db.set_applying(False)
+                db.prune_change_log()
+        except BaseException:
+            for path in written:
+                try:
+                    os.remove(os.path.join(attachment_dir, path))
+                except OSError:
+                    pass
+            raise
+    result['files'] = len(written)
+    _remove_unused_attachments(db, removed, attachment_dir)
+    return result
+
+def resolve_sync_conflict(db, conflict, keep_local, attachment_dir=ATTACHMENT_DIR):
+    """Garde la version locale (renvoyée au prochain export) ou applique la version reçue."""
+    table, uid = conflict['table_name'], conflict['row_uid']
+    written, removed = [], []
+    with db.transaction():
+        if keep_local:
+            if db.sync_payload(table, uid) is not None:
+                db.log_change(table, uid)
+            else:
+                db.log_change(table, uid, 'D')
+        else:
+            remote = json.loads(conflict['remote_payload'])
+            local, local_path = _sync_state(db, table, uid, attachment_dir)
+            db.set_applying(True)
+            applied = _apply_sync_record(db, table, uid, remote, local, local_path, None, attachment_dir, written, removed)
+            db.set_applying(False)
+            if not applied:
+                raise SyncError("La version reçue ne peut pas être appliquée (exercice ou pièce jointe manquants).")
+        db.delete_sync_conflict(conflict['id'])
+    _remove_unused_attachments(db, removed, attachment_dir)
+
+# --- COMPTES ---
+# Codes interdits aux nouveaux comptes : noms des vues et types de rapports (le journal d'un compte a son code pour type)
+RESERVED_ACCOUNT_CODES = {"dashboard", "reports", "years", "budget", "resultat", "monthly_summary", "cash_count", "exploitation"}
+
+def account_code(name):
+    """Code d'un nouveau compte tiré de son nom : « Compte épargne » -> « compte_epargne »."""
+    ascii_name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii').lower()
+    return re.sub(r'[^a-z0-9]+', '_', ascii_name).strip('_') or "compte"
+
+# --- CATÉGORIES ---
+class CategoryTree:
+    """Arborescence des catégories dans l'ordre d'affichage (lignes : id, name, type, parent_id, depth).
+
+    Les lignes sont de simples dictionnaires : elles passent telles quelles aux processus de rendu PDF.
+    """
+    def __init__(self, rows):
+        self.rows = [dict(row) for row in rows]
+        self.by_id = {row['id']: row for row in self.rows}
+        self.by_name = {row['name']: row for row in self.rows}
+
+    @classmethod
+    def load(cls, db):
+        return cls(db.category_rows())
+
+    def of_type(self, type_op):
+        return [row for row in self.rows if row['type'] == type_op]
+
+    def names(self, type_op=None):
+        return [row['name'] for row in self.rows if type_op is None or row['type'] == type_op]
+
+    def roots(self, type_op):
+        return [row for row in self.rows if row['type'] == type_op and row['parent_id'] is None]
+
+    def subtree_ids(self, category_id):
+        ids, stack = set(), [category_id]
+        while stack:
+            current = stack.pop()
+            ids.add(current)
+            stack.extend(row['id'] for row in self.rows if row['parent_id'] == current)
+        return ids
+
+def category_label(row):
+    """Nom indenté selon la profondeur (listes et rapports)."""
+    return "    " * row['depth'] + row['name']
+
+def rollup_by_name(categories, totals_by_name):
+    """Cumule des totaux par nom de catégorie sur les ancêtres -> {id : total}.
+
+    Pour une période quelconque (résumé mensuel), là où category_rollup travaille sur l'exercice.
+    """
+    by_name = {row['name']: row for row in categories}
+    by_id = {row['id']: row for row in categories}
+    rollup = defaultdict(float)
+    for name, total in totals_by_name.items():
+        row = by_name.get(name)
+        while row is not None:
+            rollup[row['id']] += total
+            row = by_id.get(row['parent_id'])
+    return dict(rollup)
+
+# --- INSTANTANÉS D'EXERCICE (cache LRU) ---
+def _iso_to_int(date_str):
+    return int(date_str[0:4]) * 10000 + int(date_str[5:7]) * 100 + int(date_str[8:10])
+
+class YearSnapshot:
+    """Écritures d'un exercice stockées en colonnes compactes (array), partagées par toutes les vues.
+
+    Les dates sont des entiers AAAAMMJJ, journal/type/catégorie des codes vers une table de chaînes
+    par colonne ; les totaux du tableau de bord et du budget sont calculés une seule fois au chargement.
+    """
+    __slots__ = ('year_id', 'ids', 'dates', 'journal_codes', 'type_codes', 'category_codes', 'amounts',
+                 'libelles', 'attachments', 'cash_flags', 'journal_names', 'type_names', 'category_names', 'journal_totals', 'type_totals',
+                 'category_totals', 'budgets', 'categories', 'category_rollup', 'budget_rollup', 'accounts')
+
+    def __init__(self, year_id):
+        self.year_id = year_id
+        self.ids = array('q')
+        self.dates = array('i')
+        self.journal_codes = array('H')
+        self.type_codes = array('H')
+        self.category_codes = array('H')
+        self.amounts = array('d')
+        self.libelles = []
+        self.attachments = {}   # index -> chemin (la plupart des écritures n'en ont pas)
+        self.cash_flags = bytearray()
+        self.journal_names = []     # tables des chaînes codées, une par colonne
+        self.type_names = []
+        self.category_names = []
+        self.journal_totals = defaultdict(float)
+        self.type_totals = defaultdict(float)
+        self.category_totals = defaultdict(float)
+        self.budgets = {}
+        self.categories = []        # lignes de CategoryTree, ordre d'affichage
+        self.category_rollup = {}   # id de catégorie -> total, sous-catégories comprises
+        self.budget_rollup = {}
+        self.accounts = []          # un dict par compte : code, name, kind, opening_balance, movements, balance
+
+    @classmethod
+    def load(cls, db, year_id):
+        snapshot = cls(year_id)
+        def coder(names):
+            codes = {}
+            def code(value):
+                c = codes.get(value)
+                if c is None:
+                    c = codes[value] = len(names)
+                    names.append(value)
+                return c
+            return code
+        journal_code, type_code, category_code = coder(snapshot.journal_names), coder(snapshot.type_names), coder(snapshot.category_names)
+        cash_ids = db.cash_detail_entry_ids(year_id, 'caisse')
+        for index, (entry_id, date_str, journal, libelle, category, type_op, amount, attachment_path) in enumerate(db.iter_year_entries(year_id)):
+            snapshot.ids.append(entry_id)
+            snapshot.dates.append(_iso_to_int(date_str))
+            snapshot.journal_codes.append(journal_code(journal))
+            snapshot.type_codes.append(type_code(type_op))
+            snapshot.category_codes.append(category_code(category))
+            snapshot.amounts.append(amount)
+            snapshot.libelles.append(libelle)
+            if attachment_path:
+                snapshot.attachments[index] = attachment_path
+            snapshot.cash_flags.append(entry_id in cash_ids)
+            snapshot.journal_totals[journal] += amount
+            snapshot.type_totals[type_op] += abs(amount) if type_op == 'depense' else amount
+            snapshot.category_totals[category] += amount
+        snapshot.budgets = db.budgets(year_id)
+        snapshot.categories = CategoryTree.load(db).rows
+        snapshot.category_rollup = db.category_rollup(year_id)
+        snapshot.budget_rollup = db.budget_rollup(year_id)
+        snapshot.accounts = [dict(row) for row in db.account_balances(year_id)]
+        return snapshot
+
+    def __len__(self):
+        return len(self.ids)
+
+    def account(self, code):
+        return next((account for account in self.accounts if account['code'] == code), None)
+
+    def active_accounts(self):
+        """Comptes ayant des écritures ou un solde initial dans l'exercice."""
+        return [account for account in self.accounts if account['code'] in self.journal_totals or account['opening_balance']]
+
+    def dashboard_summary(self):
+        total_recettes = self.type_totals.get('recette', 0.0)
+        total_depenses = self.type_totals.get('depense', 0.0)
+        return {
+            'accounts': self.accounts,
+            'total_recettes': total_recettes,
+            'total_depenses': total_depenses,
+            'benefice': total_recettes - total_depenses,
+        }
+
+    def actual_by_category(self):
+        return dict(self.category_totals)
+
+    def journal_rows(self, journal_type, initial_balance=0.0):
+        """Lignes du Treeview d'un journal. Retourne (lignes, total_debit, total_credit, solde_final)."""
+        journal_code = self.journal_names.index(journal_type) if journal_type in self.journal_names else None
+        category_names, amounts, dates = self.category_names, self.amounts, self.dates
+        rows = []
+        solde = initial_balance
+        total_debit = 0
+        total_credit = 0
+        for i, code in enumerate(self.journal_codes):
+            if code != journal_code:
+                continue
+            amount = amounts[i]
+            solde += amount
+            if amount < 0:
+                total_debit += abs(amount)
+                debit, credit = f"{abs(amount):.2f}", ""
+            else:
+                total_credit += amount
+                debit, credit = "", f"{amount:.2f}"
+            if i in self.attachments:
+                attachment_indicator = "📄"
+            elif self.cash_flags[i]:
+                attachment_indicator = "💰"
+            else:
+                attachment_indicator = ""
+            d = dates[i]
+            rows.append((self.ids[i], f"{d % 100:02d}/{d // 100 % 100:02d}/{d // 10000}", self.libelles[i],
+                         category_names[self.category_codes[i]], debit, credit, f"{solde:.2f}", attachment_indicator))
+        return rows, total_debit, total_credit, solde
+
+    def entries(self, start_date=None, end_date=None, journal=None):
+        """Écritures (dictionnaires, ordre chronologique) entre deux dates ISO incluses, pour les rapports.
+
+        journal : ne garder que les écritures de ce compte.
+        """
+        low = _iso_to_int(start_date) if start_date else 0
+        high = _iso_to_int(end_date) if end_date else 99999999
+        if journal is None:
+            journal_code = None
+        elif journal in self.journal_names:
+            journal_code = self.journal_names.index(journal)
+        else:
+            return []
+        journal_codes = self.journal_codes
+        result = []
+        for i, d in enumerate(self.dates):
+            if low <= d <= high and (journal_code is None or journal_codes[i] == journal_code):
+                result.append({
+                    'id': self.ids[i], 'date': f"{d // 10000:04d}-{d // 100 % 100:02d}-{d % 100:02d}",
+                    'journal': self.journal_names[self.journal_codes[i]], 'libelle': self.libelles[i],
+                    'category': self.category_names[self.category_codes[i]], 'type': self.type_names[self.type_codes[i]],
+                    'amount': self.amounts[i], 'attachment_path': self.attachments.get(i),
+                })
+        return result
+
+class YearSnapshotCache:
+    """Cache LRU borné d'instantanés d'exercice, avec préchargement en arrière-plan.
+
+    L'invalidation incrémente un compteur de génération, de sorte qu'un instantané calculé
+    en parallèle d'une écriture n'est jamais conservé.
+    """
+    def __init__(self, db, capacity=YEAR_CACHE_SIZE):
+        self.db = db
+        self.capacity = capacity
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._year_generations = defaultdict(int)
+        self._queue = queue.Queue()
+        self._worker = None
+
+    def _token(self, year_id):
+        return (self._generation, self._year_generations[year_id])
+
+    def _store(self, year_id, snapshot, token):
+        with self._lock:
+            if self._token(year_id) != token:
+                return
+            self._items[year_id] = snapshot
+            self._items.move_to_end(year_id)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+    def get(self, year_id, db=None):
+        """Instantané de l'exercice, chargé au besoin avec db (par défaut la connexion de l'interface)."""
+        with self._lock:
+            snapshot = self._items.get(year_id)
+            if snapshot is not None:
+                self._items.move_to_end(year_id)
+                return snapshot
+            token = self._token(year_id)
+        snapshot = YearSnapshot.load(db or self.db, year_id)
+        self._store(year_id, snapshot, token)
+        return snapshot
+
+    def peek(self, year_id):
+        """Instantané déjà en cache, ou None (ne charge rien)."""
+        with self._lock:
+            return self._items.get(year_id)
+
+    def invalidate(self, year_ids=None):
+        """Oublie les exercices donnés (tous si year_ids est None ou contient None)."""
+        with self._lock:
+            if year_ids is None or None in year_ids:
+                self._items.clear()
+                self._generation += 1
+            else:
+                for year_id in year_ids:
+                    self._items.pop(year_id, None)
+                    self._year_generations[year_id] += 1
+
+    def prefetch(self, year_ids):
+        """Demande le chargement en arrière-plan des exercices absents du cache."""
+        with self._lock:
+            missing = [y for y in year_ids if y is not None and y not in self._items]
+        for year_id in missing:
+            self._queue.put(year_id)
+        if missing and self._worker is None:
+            self._worker = threading.Thread(target=self._prefetch_loop, name="aetml-prefetch", daemon=True)
+            self._worker.start()
+
+    def _prefetch_loop(self):
+        try:
+            # Connexion dédiée en lecture seule : sqlite3 interdit de partager celle du thread Tk
+            db = LedgerRepository(self.db.db_file, read_only=True)
+            while True:
+                year_id = self._queue.get()
+                with self._lock:
+                    if year_id in self._items:
+                        continue
+                    token = self._token(year_id)
+                try:
+                    snapshot = YearSnapshot.load(db, year_id)
+                except Exception as e:
+                    # Le thread doit survivre : l'exercice sera chargé à la demande par l'interface
+                    print(f"Préchargement de l'exercice {year_id} impossible : {e}")
+                    continue
+                finally:
+                    db.detach_archives()  # ne pas garder ouvert le fichier d'un exercice archivé
+                self._store(year_id, snapshot, token)
+        except Exception as e:
+            print(f"Préchargement des exercices arrêté : {e}")
+        finally:
+            # Un prochain prefetch() relance le thread
+            self._worker = None
+
+# --- COURBES DU TABLEAU DE BORD ---
+def _month_index(date_str):
+    """'AAAA-MM[-JJ]' -> numéro de mois continu (deux mois consécutifs diffèrent de 1)."""
+    return int(date_str[0:4]) * 12 + int(date_str[5:7]) - 1
+
+def _month_label(index):
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+def build_dashboard_series(years, last_month=None):
+    """Séries mensuelles des courbes, calculées à partir des totaux pré-agrégés de chaque exercice.
+
+    years : exercices dans l'ordre chronologique, dictionnaires (start_date, end_date,
+    opening : {code du compte : solde initial}, months : lignes de monthly_totals). Les mois
+    postérieurs à last_month (AAAA-MM, par défaut le mois en cours) ne sont tracés que s'ils
+    ont des écritures. Un solde vaut None tant que le compte n'existe pas dans l'historique.
+    Retourne {'months', 'balances' : {code : valeurs}, 'recettes', 'depenses'}.
+    """
+    last = _month_index(last_month or date.today().strftime('%Y-%m'))
+    months, recettes, depenses, month_balances = [], [], [], []
+    for year in years:
+        by_month = defaultdict(list)
+        for row in year['months']:
+            by_month[_month_index(row[0])].append(row)
+        first = _month_index(year['start_date'])
+        end = min(_month_index(year['end_date']), max(last, max(by_month, default=first)))
+        running = dict(year['opening'])
+        for index in range(first, end + 1):
+            month_recettes = month_depenses = 0.0
+            for _, journal, movements, row_recettes, row_depenses in by_month.get(index, ()):
+                running[journal] = running.get(journal, 0.0) + movements
+                month_recettes += row_recettes
+                month_depenses += row_depenses
+            months.append(_month_label(index))
+            recettes.append(month_recettes)
+            depenses.append(month_depenses)
+            month_balances.append(dict(running))
+    codes = list(dict.fromkeys(code for balances in month_balances for code in balances))
+    balances = {}
+    for code in codes:
+        values = [month.get(code) for month in month_balances]
+        if any(values):  # un compte toujours à zéro n'a pas de courbe
+            balances[code] = values
+    return {'months': months, 'balances': balances, 'recettes': recettes, 'depenses': depenses}
+
+def downsample_series(series, max_points=DASHBOARD_CHART_MAX_POINTS):
+    """Regroupe les mois par trimestre, semestre ou année (par blocs plus grands au besoin) pour tenir en max_points.
+
+    Un solde garde la dernière valeur du bloc (solde de fin de période) ; recettes et dépenses
+    sont additionnées. 'step' indique le nombre de mois par point.
+    """
+    count = len(series['months'])
+    step = next((s for s in (1, 3, 6, 12) if -(-count // s) <= max_points), -(-count // max_points))
+    if step == 1:
+        return dict(series, step=1)
+    starts = range(0, count, step)
+
+    def last_value(values):
+        return [next((v for v in reversed(values[i:i + step]) if v is not None), None) for i in starts]
+    return {
+        'months': [series['months'][i] for i in starts],
+        'balances': {code: last_value(values) for code, values in series['balances'].items()},
+        'recettes': [sum(series['recettes'][i:i + step]) for i in starts],
+        'depenses': [sum(series['depenses'][i:i + step]) for i in starts],
+        'step': step,
+    }
+
+class DashboardSeriesCache:
+    """Totaux mensuels de chaque exercice (une requête groupée par exercice) et séries des courbes.
+
+    Les totaux d'un exercice sont oubliés à chaque écriture qui le touche, avec le même compteur
+    de génération que YearSnapshotCache. Les séries échantillonnées sont gardées par empreinte
+    des totaux : une modification qui ne change aucun total mensuel ne les recalcule pas.
+    """
+    def __init__(self, capacity=DASHBOARD_SERIES_CACHE_SIZE):
+        self.capacity = capacity
+        self._totals = {}   # year_id -> (soldes initiaux, totaux mensuels)
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._year_generations = defaultdict(int)
+
+    def _token(self, year_id):
+        return (self._generation, self._year_generations[year_id])
+
+    def missing(self, year_ids):
+        with self._lock:
+            return [year_id for year_id in year_ids if year_id not in self._totals]
+
+    def load(self, db, year_ids):
+        """Charge les totaux absents du cache (à appeler sur le thread de travail)."""
+        opening = None
+        for year_id in self.missing(year_ids):
+            with self._lock:
+                token = self._token(year_id)
+            if opening is None:
+                opening = db.opening_balances()
+            totals = ({code: amount for code, _, amount in opening.get(year_id, ())},
+                      tuple(tuple(row) for row in db.monthly_totals(year_id)))
+            with self._lock:
+                if self._token(year_id) == token:
+                    self._totals[year_id] = totals
+
+    def series(self, years, max_points=DASHBOARD_CHART_MAX_POINTS):
+        """Séries des exercices donnés (dictionnaires id, start_date, end_date), ou None s'il manque des totaux."""
+        with self._lock:
+            totals = [self._totals.get(year['id']) for year in years]
+        if None in totals:
+            return None
+        payload = repr(([(year['start_date'], year['end_date']) for year in years], totals, max_points, date.today().strftime('%Y-%m')))
+        fingerprint = hashlib.sha1(payload.encode("utf-8")).hexdigest()
+        with self._lock:
+            series = self._series.get(fingerprint)
+            if series is not None:
+                self._series.move_to_end(fingerprint)
+                return series
+        series = downsample_series(build_dashboard_series(
+            [dict(year, opening=opening, months=months) for year, (opening, months) in zip(years, totals)]), max_points)
+        with self._lock:
+            self._series[fingerprint] = series
+            while len(self._series) > self.capacity:
+                self._series.popitem(last=False)
+        return series
+
+    def invalidate(self, year_ids=None):
+        """Oublie les totaux des exercices donnés (tous si year_ids est None ou contient None)."""
+        with self._lock:
+            if year_ids is None or None in year_ids:
+                self._totals.clear()
+                self._generation += 1
+            else:
+                for year_id in year_ids:
+                    self._totals.pop(year_id, None)
+                    self._year_generations[year_id] += 1
+
+# --- CALCULS (indépendants de l'interface Tk) ---
+def load_dashboard_summary(snapshot):
+    """Calcule les soldes et le résultat affichés sur le tableau de bord pour un exercice."""
+    # Le solde final est le solde initial + la somme des mouvements de l'exercice ;
+    # le résultat (bénéfice/perte) ne concerne que les mouvements de l'exercice
+    return snapshot.dashboard_summary()
+
+def build_journal_rows(snapshot, journal_type, initial_balance=0.0):
+    """Prépare les lignes d'un journal (valeurs du Treeview) ainsi que ses totaux.
+
+    Retourne (lignes, total_debit, total_credit, solde_final).
+    """
+    return snapshot.journal_rows(journal_type, initial_balance)
+
+def parse_entry_date(date_str, start_date, end_date):
+    """Date saisie au clavier -> date ISO dans l'exercice [start_date, end_date] (chaînes ISO).
+
+    Formats acceptés : AAAA-MM-JJ, JJ.MM.AAAA, JJ/MM/AAAA, ou JJ.MM (année déduite de l'exercice).
+    """
+    text = date_str.strip()
+    parsed = None
+    for fmt in ('%Y-%m-%d', '%d.%m.%Y', '%d/%m/%Y'):
+        try:
+            parsed = datetime.strptime(text, fmt).date()
+            break
+        except ValueError:
+            pass
+    short = re.fullmatch(r'(\d{1,2})[./](\d{1,2})\.?', text)
+    start, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+    if parsed is None and short:
+        for year in sorted({start.year, end.year}):
+            try:
+                candidate = date(year, int(short.group(2)), int(short.group(1)))
+            except ValueError:
+                continue
+            if start <= candidate <= end:
+                parsed = candidate
+                break
+    if parsed is None:
+        raise ValueError("Date invalide (AAAA-MM-JJ, JJ.MM.AAAA ou JJ.MM)")
+    if not (start <= parsed <= end):
+        raise ValueError("La date doit être dans l'exercice actif")
+    return parsed.isoformat()
+
+def parse_entry_fields(date_str, libelle, type_str, category, amount_str, start_date, end_date, categories):
+    """Valide une ligne de saisie (categories : CategoryTree). Retourne (date ISO, libellé, type, catégorie, montant signé) ou lève ValueError."""
+    iso_date = parse_entry_date(date_str, start_date, end_date)
+    libelle = libelle.strip()
+    if not libelle:
+        raise ValueError("Le libellé est requis")
+    type_key = type_str.strip().lower().replace('é', 'e')
+    type_op = next((t for t in ('depense', 'recette') if type_key and t.startswith(type_key)), None)
+    if type_op is None:
+        raise ValueError("Type invalide (d = dépense, r = recette)")
+    category_key = category.strip().lower()
+    names = categories.names(type_op)
+    matches = [c for c in names if c.lower() == category_key] or \
+              [c for c in names if category_key and c.lower().startswith(category_key)]
+    if len(matches) != 1:
+        raise ValueError(f"Catégorie inconnue pour le type {type_op}")
+    try:
+        amount = float(amount_str.strip().replace("'", "").replace(",", "."))
+    except ValueError:
+        raise ValueError("Le montant doit être un nombre")
+    if amount == 0:
+        raise ValueError("Le montant ne peut pas être nul")
+    if type_op == 'depense':
+        amount = -abs(amount)
+    return iso_date, libelle, type_op, matches[0], amount
+
+def load_report_data(snapshot, report_type, selected_date=None):
+    """Rassemble les données nécessaires à un rapport PDF (arguments nommés de generate_pdf)."""
+    report_kwargs = {}
+    account = snapshot.account(report_type)   # journal d'un compte : le type est le code du compte
+    if account is not None:
+        report_kwargs['data'] = snapshot.entries(journal=report_type)
+        report_kwargs['account'] = account
+    elif report_type == 'exploitation':
+        report_kwargs['data'] = snapshot.entries()
+    elif report_type == 'resultat':
+        report_kwargs['categories'] = snapshot.categories
+        report_kwargs['actual_data'] = snapshot.category_rollup
+    elif report_type == 'budget':
+        report_kwargs['categories'] = snapshot.categories
+        report_kwargs['budget_data'] = snapshot.budget_rollup
+        report_kwargs['actual_data'] = snapshot.category_rollup
+    elif report_type == 'monthly_summary':
+        start_of_month = selected_date.replace(day=1)
+        end_of_month = selected_date.replace(day=calendar.monthrange(selected_date.year, selected_date.month)[1])
+        month_totals = defaultdict(float)
+        for entry in snapshot.entries(start_of_month.strftime('%Y-%m-%d'), end_of_month.strftime('%Y-%m-%d')):
+            month_totals[entry['category']] += entry['amount']
+        report_kwargs['categories'] = snapshot.categories
+        report_kwargs['actual_data'] = rollup_by_name(snapshot.categories, month_totals)
+        report_kwargs['budget_data'] = snapshot.budget_rollup
+        report_kwargs['month_name'] = selected_date.strftime("%B")
+        report_kwargs['report_year'] = selected_date.year
+    return report_kwargs
+
+# --- RAPPROCHEMENT BANCAIRE ---
+class StatementError(Exception):
+    """Relevé bancaire illisible ou de format non reconnu."""
+
+# Mots-clés des en-têtes de colonnes (exports CSV PostFinance en français et en allemand)
+STATEMENT_HEADERS = {
+    'date': ("date", "datum"),
+    'text': ("texte", "text", "avis", "libell", "description"),
+    'credit': ("crédit", "credit", "gutschrift"),
+    'debit': ("débit", "debit", "lastschrift", "belastung"),
+    'amount': ("montant", "betrag"),
+}
+
+def _statement_amount(text):
+    text = text.strip().replace("'", "").replace("\u2019", "").replace(" ", "")
+    if not text:
+        return None
+    if ',' in text and '.' not in text:
+        text = text.replace(',', '.')
+    return float(text)
+
+def _statement_date(text):
+    for fmt in ('%d.%m.%Y', '%Y-%m-%d', '%d.%m.%y', '%d/%m/%Y'):
+        try:
+            return datetime.strptime(text.strip(), fmt).date().isoformat()
+        except ValueError:
+            pass
+    return None
+
+def _statement_columns(row):
+    """Indices des colonnes reconnues dans une ligne d'en-tête, ou None si ce n'en est pas une."""
+    columns = {}
+    for index, cell in enumerate(row):
+        label = cell.strip().lower()
+        for key, words in STATEMENT_HEADERS.items():
+            if key not in columns and any(label.startswith(word) or f" {word}" in label for word in words):
+                columns[key] = index
+                break
+    if 'date' in columns and ('amount' in columns or ('credit' in columns and 'debit' in columns)):
+        return columns
+    return None
+
+def _parse_statement_csv(text):
+    delimiter = ';' if text.count(';') >= text.count(',') else ','
+    columns, lines = None, []
+    for row in csv.reader(text.splitlines(), delimiter=delimiter):
+        if columns is None:
+            columns = _statement_columns(row)
+            continue
+        cells = row + [''] * (max(columns.values()) + 1 - len(row))
+        statement_date = _statement_date(cells[columns['date']])
+        if statement_date is None:
+            continue  # lignes de totaux et de pied de page
+        try:
+            if 'amount' in columns:
+                amount = _statement_amount(cells[columns['amount']])
+            else:
+                credit = _statement_amount(cells[columns['credit']])
+                debit = _statement_amount(cells[columns['debit']])
+                amount = credit if credit else -abs(debit or 0.0)
+        except ValueError:
+            raise StatementError(f"Montant illisible à la ligne {len(lines) + 1} du relevé.")
+        if not amount:
+            continue
+        text_value = cells[columns['text']].strip() if 'text' in columns else ''
+        lines.append({'line': len(lines) + 1, 'date': statement_date, 'amount': amount, 'text': text_value})
+    if columns is None:
+        raise StatementError("Colonnes du relevé non reconnues (date, texte, crédit/débit ou montant).")
+    return lines
+
+def _parse_statement_camt(data):
+    """Relevé ISO 20022 camt.053/camt.054 (écritures Ntry)."""
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError as e:
+        raise StatementError(f"Fichier XML illisible : {e}")
+    lines = []
+    for entry in root.iterfind('.//{*}Ntry'):
+        amount = float(entry.findtext('{*}Amt') or 0)
+        if entry.findtext('{*}CdtDbtInd') == 'DBIT':
+            amount = -amount
+        statement_date = entry.findtext('{*}BookgDt/{*}Dt') or (entry.findtext('{*}BookgDt/{*}DtTm') or '')[:10]
+        texts = [entry.findtext('{*}AddtlNtryInf')] + [node.text for node in entry.iterfind('.//{*}Ustrd')]
+        lines.append({'line': len(lines) + 1, 'date': statement_date, 'amount': amount,
+                      'text': " ".join(text.strip() for text in texts if text)})
+    return lines
+
+def parse_statement(path):
+    """Lit un relevé bancaire (export CSV PostFinance ou camt.053) -> liste de mouvements.
+
+    Chaque mouvement est un dictionnaire : line, date (ISO), amount (positif au crédit), text.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data.lstrip().startswith(b'<'):
+        return _parse_statement_camt(data)
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = data.decode('cp1252')
+    return _parse_statement_csv(text)
+
+def _libelle_words(text):
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode().lower()
+    return set(re.findall(r'[a-z0-9]{3,}', text))
+
+def libelle_similarity(a, b):
+    """Part des mots du plus court des deux textes présents dans l'autre (0 à 1)."""
+    words_a, words_b = _libelle_words(a), _libelle_words(b)
+    if not words_a or not words_b:
+        return 0.0
+    return len(words_a & words_b) / min(len(words_a), len(words_b))
+
+def reconcile_statement(lines, entries, window_days=RECONCILE_DATE_WINDOW_DAYS, margin=RECONCILE_AMBIGUITY_MARGIN):
+    """Apparie les mouvements d'un relevé aux écritures du journal d'un compte bancaire.
+
+    Jointure par hachage sur le montant exact (en centimes), puis recherche dichotomique des
+    écritures dans la fenêtre de dates ; la similarité des libellés ne sert qu'à départager.
+    Les paires candidates sont triées (écart de dates, similarité) et attribuées de façon
+    gloutonne : O(n log n). Une ligne dont les deux meilleurs candidats libres sont ex aequo
+    est laissée ambiguë. Les écritures déjà pointées sur un autre relevé sont ignorées.
+
+    Retourne un dictionnaire : matched [(ligne, écriture)], ambiguous [(ligne, [écritures])],
+    unmatched_lines [ligne], unmatched_entries [écriture] (non pointées, dans la période du relevé).
+    """
+    result = {'matched': [], 'ambiguous': [], 'unmatched_lines': [], 'unmatched_entries': []}
+    if not lines:
+        return result
+    first_day = min(line['date'] for line in lines)
+    last_day = max(line['date'] for line in lines)
+    entries = [entry for entry in entries if not entry['reconciled_on'] or first_day <= entry['reconciled_on'] <= last_day]
+    entries_by_id = {entry['id']: entry for entry in entries}
+
+    buckets = defaultdict(list)
+    for entry in entries:
+        buckets[round(entry['amount'] * 100)].append((date.fromisoformat(entry['date']).toordinal(), entry['id']))
+    ordinals = {}
+    for key, bucket in buckets.items():
+        bucket.sort()
+        ordinals[key] = [ordinal for ordinal, _ in bucket]
+
+    candidates = {}  # indice de ligne -> [(écart en jours, -similarité, id d'écriture)] triés
+    pairs = []
+    for index, line in enumerate(lines):
+        key = round(line['amount'] * 100)
+        if key not in buckets:
+            continue
+        day = date.fromisoformat(line['date']).toordinal()
+        keys = ordinals[key]
+        window = buckets[key][bisect_left(keys, day - window_days):bisect_right(keys, day + window_days)]
+        found = sorted((abs(ordinal - day), -libelle_similarity(line['text'], entries_by_id[entry_id]['libelle']), entry_id)
+                       for ordinal, entry_id in window)
+        if found:
+            candidates[index] = found
+            pairs.extend((gap, score, index, entry_id) for gap, score, entry_id in found)
+    pairs.sort()
+
+    line_entry, taken, ambiguous = {}, set(), set()
+    for gap, score, index, entry_id in pairs:
+        if index in line_entry or index in ambiguous or entry_id in taken:
+            continue
+        # Les meilleurs candidats de la ligne sont déjà pris : entry_id est le meilleur libre
+        rival = next((c for c in candidates[index] if c[2] != entry_id and c[2] not in taken), None)
+        if rival is not None and rival[0] == gap and rival[1] - score < margin:
+            ambiguous.add(index)
+            continue
+        line_entry[index] = entry_id
+        taken.add(entry_id)
+
+    for index, line in enumerate(lines):
+        if index in line_entry:
+            result['matched'].append((line, entries_by_id[line_entry[index]]))
+            continue
+        free = [entries_by_id[c[2]] for c in candidates.get(index, ()) if c[2] not in taken]
+        if index in ambiguous and len(free) == 1:
+            taken.add(free[0]['id'])
+            result['matched'].append((line, free[0]))
+        elif index in ambiguous and free:
+            result['ambiguous'].append((line, free))
+        else:
+            result['unmatched_lines'].append(line)
+    proposed = {entry['id'] for _, free in result['ambiguous'] for entry in free}
+    start = (date.fromisoformat(first_day) - timedelta(days=window_days)).isoformat()
+    end = (date.fromisoformat(last_day) + timedelta(days=window_days)).isoformat()
+    result['unmatched_entries'] = [entry for entry in entries if entry['id'] not in taken and entry['id'] not in proposed
+                                   and not entry['reconciled_on'] and start <= entry['date'] <= end]
+    return result
+
+# --- DÉTECTION DES DOUBLONS ---
+def _normalized_libelle(text):
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode().lower()
+    return " ".join(re.findall(r'[a-z0-9]+', text))
+
+def duplicate_score(libelle, date_str, other_libelle, other_date, window_days=DUPLICATE_DATE_WINDOW_DAYS):
+    """Similarité de deux écritures de même montant (0 à 1) : libellés, pondérés par l'écart de dates."""
+    gap = abs((date.fromisoformat(date_str) - date.fromisoformat(other_date)).days)
+    similarity = difflib.SequenceMatcher(None, _normalized_libelle(libelle), _normalized_libelle(other_libelle)).ratio()
+    return similarity * (1 - gap / (2 * (window_days + 1)))
+
+def find_entry_duplicates(db, journal_type, date_str, libelle, amount, attachment_sha256=None, exclude_id=None,
+                          window_days=DUPLICATE_DATE_WINDOW_DAYS, min_score=DUPLICATE_MIN_SCORE):
+    """Doublons probables d'une écriture sur le point d'être enregistrée.
+
+    Retourne [(score, écriture, même justificatif)] du plus probable au moins probable ; un même
+    justificatif compte pour 1 quel que soit le reste.
+    """
+    day = date.fromisoformat(date_str)
+    start = (day - timedelta(days=window_days)).isoformat()
+    end = (day + timedelta(days=window_days)).isoformat()
+    found = []
+    for row in db.duplicate_candidates(journal_type, amount, start, end, attachment_sha256, exclude_id):
+        same_attachment = bool(attachment_sha256) and row['attachment_sha256'] == attachment_sha256
+        if same_attachment:
+            score = 1.0
+        elif row['journal'] == journal_type and row['amount'] == amount and start <= row['date'] <= end:
+            score = duplicate_score(libelle, date_str, row['libelle'], row['date'], window_days)
+        else:
+            continue
+        if score >= min_score:
+            found.append((score, row, same_attachment))
+    found.sort(key=lambda item: (-item[0], item[1]['id']))
+    return found
+
+def find_batch_duplicates(db, journal_type, rows, window_days=DUPLICATE_DATE_WINDOW_DAYS, min_score=DUPLICATE_MIN_SCORE):
+    """Doublons probables d'un lot (lignes de insert_entries) -> {rang de la ligne : [(score, écriture, même justificatif)]}.
+
+    Chaque ligne est comparée aux écritures existantes puis aux lignes précédentes du lot ; une
+    ligne du lot est décrite par un dictionnaire sans id, avec son rang ('line').
+    """
+    found = {}
+    for index, (date_str, libelle, _, _, amount, _) in enumerate(rows):
+        duplicates = find_entry_duplicates(db, journal_type, date_str, libelle, amount, window_days=window_days, min_score=min_score)
+        for other_index, (other_date, other_libelle, _, _, other_amount, _) in enumerate(rows[:index]):
+            if other_amount != amount or abs((date.fromisoformat(other_date) - date.fromisoformat(date_str)).days) > window_days:
+                continue
+            score = duplicate_score(libelle, date_str, other_libelle, other_date, window_days)
+            if score >= min_score:
+                duplicates.append((score, {'id': None, 'line': other_index, 'date': other_date, 'libelle': other_libelle,
+                                           'amount': other_amount}, False))
+        if duplicates:
+            found[index] = duplicates
+    return found
+
+def hash_missing_attachments(db, year_id, attachment_dir=ATTACHMENT_DIR):
+    """Calcule les empreintes des justificatifs qui n'en ont pas encore (écritures reçues, anciennes versions)."""
+    hashes = []
+    for row in db.entries_without_attachment_hash(year_id):
+        try:
+            hashes.append((row['id'], _hash_file(os.path.join(attachment_dir, row['attachment_path']))))
+        except OSError:
+            continue  # pièce manquante : signalée par le contrôle d'intégrité
+    if hashes:
+        db.set_attachment_hashes(hashes)
+    return len(hashes)
+
+def scan_year_duplicates(db, year_id, window_days=DUPLICATE_DATE_WINDOW_DAYS, min_score=DUPLICATE_MIN_SCORE,
+                         attachment_dir=ATTACHMENT_DIR):
+    """Recherche complète des doublons d'un exercice -> [(score, écriture, écriture, même justificatif)].
+
+    Les écritures sont triées par (journal, montant, date) : seules les voisines d'un même bloc
+    et à moins de window_days jours sont comparées, puis les justificatifs identiques sont regroupés.
+    """
+    if not db.archive_file(year_id):
+        hash_missing_attachments(db, year_id, attachment_dir)
+    rows = db.duplicate_scan_rows(year_id)
+    pairs = {}
+    for index, row in enumerate(rows):
+        limit = (date.fromisoformat(row['date']) + timedelta(days=window_days)).isoformat()
+        for other in rows[index + 1:]:
+            if other['journal'] != row['journal'] or other['amount'] != row['amount'] or other['date'] > limit:
+                break
+            score = duplicate_score(row['libelle'], row['date'], other['libelle'], other['date'], window_days)
+            if score >= min_score:
+                pairs[(row['id'], other['id'])] = (score, row, other, False)
+    by_hash = defaultdict(list)
+    for row in rows:
+        if row['attachment_sha256']:
+            by_hash[row['attachment_sha256']].append(row)
+    for group in by_hash.values():
+        # Chaque copie est rapprochée de la première écriture du groupe (pas de paires quadratiques)
+        group.sort(key=lambda row: row['id'])
+        for other in group[1:]:
+            pairs[(group[0]['id'], other['id'])] = (1.0, group[0], other, True)
+    return sorted(pairs.values(), key=lambda item: (-item[0], item[1]['date'], item[1]['id']))
+
+# --- CLASSEMENT AUTOMATIQUE ---
+def _rule_regex(pattern):
+    """Motif d'une règle -> expression sur le libellé normalisé ; « * » remplace une suite quelconque de caractères."""
+    return ".*?".join(re.escape(_normalized_libelle(part)) for part in pattern.split("*"))
+
+class CategoryRuleSet:
+    """Règles de classement préparées pour être essayées sur de nombreuses écritures.
+
+    Les règles sont rangées par type de catégorie ; pour une écriture, elles sont parcourues dans
+    leur ordre et la première dont le journal, la fourchette de montant et le motif conviennent
+    l'emporte. Le motif n'est évalué qu'en dernier, et seulement si sa plus longue partie fixe
+    figure dans le libellé (recherche de sous-chaîne, bien moins coûteuse qu'une expression).
+    """
+    def __init__(self, rules):
+        self.rules = [dict(rule, rank=rank) for rank, rule in enumerate(rules, start=1)]
+        self.by_type = defaultdict(list)
+        for rule in self.rules:
+            parts = [_normalized_libelle(part) for part in rule['pattern'].split("*")]
+            regex = re.compile(_rule_regex(rule['pattern'])) if len(parts) > 1 else None
+            self.by_type[rule['type']].append((rule, max(parts, key=len), regex))
+
+    def match(self, libelle, journal, type_op, amount):
+        """Règle applicable à l'écriture, ou None."""
+        amount = abs(amount)
+        text = None
+        for rule, literal, regex in self.by_type.get(type_op, ()):
+            if rule['journal'] and rule['journal'] != journal:
+                continue
+            if rule['min_amount'] is not None and amount < rule['min_amount']:
+                continue
+            if rule['max_amount'] is not None and amount > rule['max_amount']:
+                continue
+            if text is None:
+                text = _normalized_libelle(libelle)
+            if literal not in text or (regex is not None and regex.search(text) is None):
+                continue
+            return rule
+        return None
+
+def learn_category_history(db, min_count=AUTO_CATEGORY_MIN_COUNT, min_share=AUTO_CATEGORY_MIN_SHARE):
+    """Catégorie habituelle de chaque libellé -> {(libellé normalisé, type) : (catégorie, nombre d'écritures, journaux)}.
+
+    Un libellé n'est retenu que s'il revient au moins min_count fois hors catégories fourre-tout
+    et qu'une catégorie en représente au moins la part min_share. journaux : ceux où il apparaît.
+    """
+    counts = defaultdict(Counter)
+    journals = defaultdict(set)
+    for row in db.category_history():
+        if row['category'] not in AUTO_CATEGORY_FALLBACKS:
+            key = (_normalized_libelle(row['libelle']), row['type'])
+            counts[key][row['category']] += row['count']
+            journals[key].add(row['journal'])
+    learned = {}
+    for key, by_category in counts.items():
+        category, count = by_category.most_common(1)[0]
+        total = sum(by_category.values())
+        if key[0] and total >= min_count and count >= min_share * total:
+            learned[key] = (category, total, frozenset(journals[key]))
+    return learned
+
+def suggest_category_rules(ruleset, learned):
+    """Règles proposées à partir de l'historique : libellés appris qu'aucune règle existante ne classe déjà.
+
+    Un libellé est déjà classé si, dans chacun des journaux où il apparaît, une règle (de ce
+    journal ou de tous) s'applique. -> [(motif, type, catégorie, nombre d'écritures)], les plus fréquents d'abord.
+    """
+    suggestions = [(libelle, type_op, category, count) for (libelle, type_op), (category, count, journals) in learned.items()
+                   if not all(ruleset.match(libelle, journal, type_op, 0.0) for journal in journals)]
+    return sorted(suggestions, key=lambda item: (-item[3], item[0]))
+
+def propose_categories(db, year_id, ruleset, learned, include_classified=False):
+    """Reclassements proposés pour un exercice, en un passage sur ses écritures.
+
+    Par défaut seules les écritures d'une catégorie fourre-tout (AUTO_CATEGORY_FALLBACKS) sont
+    reclassées ; avec include_classified, toutes. Une règle prime sur l'historique.
+    -> [(écriture, nouvelle catégorie, origine)].
+    """
+    changes = []
+    for entry in db.categorization_entries(year_id):
+        if not include_classified and entry['category'] not in AUTO_CATEGORY_FALLBACKS:
+            continue
+        rule = ruleset.match(entry['libelle'], entry['journal'], entry['type'], entry['amount'])
+        if rule is not None:
+            category, source = rule['category'], f"Règle {rule['rank']}"
+        else:
+            category = learned.get((_normalized_libelle(entry['libelle']), entry['type']), (None,))[0]
+            source = "Historique"
+        if category is not None and category != entry['category']:
+            changes.append((entry, category, source))
+    return changes
+
 # --- GÉNÉRATION PDF ---
 class PDF(FPDF):
     def header(self):
@@ -82,10 +3783,10 @@ class PDF(FPDF):
         self.cell(0, 10, f'Page {self.page_no()}', 0, align='C')
 
 # ... (fonctions _draw_journal_report, _draw_resultat_report, _draw_budget_report inchangées)
-def _draw_journal_report(pdf, data, year_name, journal_type):
-    # Cette fonction pourrait être améliorée pour inclure le solde initial, mais pour l'instant on la laisse telle quelle
-    # Le calcul du solde se fait à la volée, donc il sera correct si on ajoute le solde initial au début
-    title = "Journal de Caisse" if journal_type == 'caisse' else "Journal de Poste"
+def _draw_journal_report(pdf, data, year_name, account):
+    """Journal d'un compte ; le solde part du solde initial de l'exercice."""
+    journal_type = account['code']
+    title = f"Journal de {account['name']}"
     pdf.set_font('Helvetica', 'B', 14)
     pdf.cell(0, 10, f'{title} - Exercice {year_name}', 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='L')
     pdf.ln(5)
@@ -97,7 +3798,10 @@ def _draw_journal_report(pdf, data, year_name, journal_type):
     pdf.cell(25, 8, 'Montant', 1, align='C', fill=True)
     pdf.cell(25, 8, 'Solde', 1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C', fill=True)
     pdf.set_font('Helvetica', '', 9)
-    solde = 0 # Le rapport PDF commence à 0, mais l'appli affichera le bon solde
+    solde = account['opening_balance']
+    if solde:
+        pdf.cell(155, 7, 'Report à nouveau', 1)
+        pdf.cell(25, 7, f"{solde:.2f}", 1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='R')
     journal_entries = sorted([e for e in data if e['journal'] == journal_type], key=lambda x: x['date'])
     for entry in journal_entries:
         solde += entry['amount']
@@ -108,9 +3812,10 @@ def _draw_journal_report(pdf, data, year_name, journal_type):
         pdf.cell(60, 7, safe_libelle, 1)
         pdf.cell(25, 7, f"{entry['amount']:.2f}", 1, align='R')
         pdf.cell(25, 7, f"{solde:.2f}", 1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='R')
-    return f"{title.replace(' ', '_')}.pdf"
+    return re.sub(r'[^\w-]+', '_', title) + ".pdf"
 
-def _draw_resultat_report(pdf, data, year_name):
+def _draw_resultat_report(pdf, categories, actual_data, year_name):
+    """Compte de résultat ; actual_data contient les totaux cumulés (sous-catégories comprises)."""
     pdf.set_font('Helvetica', 'B', 14)
     pdf.cell(0, 10, f'Compte de Résultat - Exercice {year_name}', 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='L')
     pdf.ln(5)
@@ -118,11 +3823,12 @@ def _draw_resultat_report(pdf, data, year_name):
     pdf.set_font('Helvetica', 'B', 12)
     pdf.cell(0, 10, "Produits (Recettes)", 'B', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
     pdf.set_font('Helvetica', '', 10)
-    for cat in CATEGORIES['recette']:
-        cat_total = sum(e['amount'] for e in data if e['category'] == cat)
-        if cat_total > 0:
-            total_recettes += cat_total
-            pdf.cell(130, 7, cat.encode('latin-1', 'replace').decode('latin-1'))
+    for row in categories:
+        cat_total = actual_data.get(row['id'], 0.0)
+        if row['type'] == 'recette' and cat_total > 0:
+            if row['parent_id'] is None:
+                total_recettes += cat_total
+            pdf.cell(130, 7, category_label(row).encode('latin-1', 'replace').decode('latin-1'))
             pdf.cell(40, 7, f"{cat_total:.2f}", 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='R')
     pdf.set_font('Helvetica', 'B', 10)
     pdf.cell(130, 8, "Total des Produits", 'T', align='R')
@@ -132,11 +3838,12 @@ def _draw_resultat_report(pdf, data, year_name):
     pdf.set_font('Helvetica', 'B', 12)
     pdf.cell(0, 10, "Charges (Dépenses)", 'B', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
     pdf.set_font('Helvetica', '', 10)
-    for cat in CATEGORIES['depense']:
-        cat_total = sum(e['amount'] for e in data if e['category'] == cat)
-        if cat_total < 0:
-            total_depenses += abs(cat_total)
-            pdf.cell(130, 7, cat.encode('latin-1', 'replace').decode('latin-1'))
+    for row in categories:
+        cat_total = actual_data.get(row['id'], 0.0)
+        if row['type'] == 'depense' and cat_total < 0:
+            if row['parent_id'] is None:
+                total_depenses += abs(cat_total)
+            pdf.cell(130, 7, category_label(row).encode('latin-1', 'replace').decode('latin-1'))
             pdf.cell(40, 7, f"{abs(cat_total):.2f}", 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='R')
     pdf.set_font('Helvetica', 'B', 10)
     pdf.cell(130, 8, "Total des Charges", 'T', align='R')
@@ -149,7 +3856,8 @@ def _draw_resultat_report(pdf, data, year_name):
     pdf.cell(40, 8, f"{benefice:.2f}", 1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='R')
     return "Compte_de_Resultat.pdf"
 
-def _draw_budget_report(pdf, budget_data, actual_data, year_name):
+def _draw_budget_report(pdf, categories, budget_data, actual_data, year_name):
+    """Budget et réel par catégorie ; les deux dictionnaires (par id) sont des totaux cumulés."""
     pdf.set_font('Helvetica', 'B', 14)
     pdf.cell(0, 10, f'Rapport de Budget - Exercice {year_name}', 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='L')
     pdf.ln(5)
@@ -160,18 +3868,21 @@ def _draw_budget_report(pdf, budget_data, actual_data, year_name):
     pdf.cell(30, 8, 'Réel', 1, align='C', fill=True)
     pdf.cell(30, 8, 'Différence', 1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C', fill=True)
 
-    def draw_category_table(title, categories):
+    def draw_category_table(title, type_op):
         pdf.set_font('Helvetica', 'B', 11)
         pdf.cell(0, 10, title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         total_budget, total_actual = 0.0, 0.0
-        for cat in categories:
-            budget = budget_data.get(cat, 0.0)
-            actual = abs(actual_data.get(cat, 0.0))
+        for row in categories:
+            if row['type'] != type_op:
+                continue
+            budget = budget_data.get(row['id'], 0.0)
+            actual = abs(actual_data.get(row['id'], 0.0))
             diff = budget - actual
-            total_budget += budget
-            total_actual += actual
+            if row['parent_id'] is None:
+                total_budget += budget
+                total_actual += actual
             pdf.set_font('Helvetica', '', 9)
-            pdf.cell(80, 7, cat.encode('latin-1', 'replace').decode('latin-1'), 1)
+            pdf.cell(80, 7, category_label(row).encode('latin-1', 'replace').decode('latin-1'), 1)
             pdf.cell(30, 7, f"{budget:.2f}", 1, align='R')
             pdf.cell(30, 7, f"{actual:.2f}", 1, align='R')
             pdf.cell(30, 7, f"{diff:.2f}", 1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='R')
@@ -182,9 +3893,9 @@ def _draw_budget_report(pdf, budget_data, actual_data, year_name):
         pdf.cell(30, 7, f"{total_budget - total_actual:.2f}", 1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='R')
         return total_budget, total_actual
 
-    total_budget_rec, total_actual_rec = draw_category_table("Recettes", CATEGORIES['recette'])
+    total_budget_rec, total_actual_rec = draw_category_table("Recettes", 'recette')
     pdf.ln(5)
-    total_budget_dep, total_actual_dep = draw_category_table("Dépenses", CATEGORIES['depense'])
+    total_budget_dep, total_actual_dep = draw_category_table("Dépenses", 'depense')
     pdf.ln(10)
     pdf.set_font('Helvetica', 'B', 12)
     pdf.cell(80, 8, "Résultat Budgeté", align='R')
@@ -193,8 +3904,8 @@ def _draw_budget_report(pdf, budget_data, actual_data, year_name):
     pdf.cell(40, 8, f"{total_actual_rec - total_actual_dep:.2f}", 1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='R')
     return "Rapport_Budget.pdf"
 ### MODIFIÉ ###
-def _draw_monthly_summary_report(pdf, monthly_entries, budget_data, year_name, month_name, report_year):
-    """Génère le PDF pour le résumé budgétaire du mois sélectionné."""
+def _draw_monthly_summary_report(pdf, categories, actual_data, budget_data, year_name, month_name, report_year):
+    """Génère le PDF pour le résumé budgétaire du mois sélectionné (totaux cumulés par id de catégorie)."""
     title = f"Résumé Budgétaire Mensuel - {month_name.capitalize()} {report_year}"
     pdf.set_font('Helvetica', 'B', 14)
     pdf.cell(0, 10, title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='L')
@@ -211,29 +3922,28 @@ def _draw_monthly_summary_report(pdf, monthly_entries, budget_data, year_name, m
     pdf.cell(35, 8, 'Réel du Mois', 1, align='C', fill=True)
     pdf.cell(30, 8, 'Différence', 1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C', fill=True)
 
-    def draw_monthly_table(title, categories, is_expense=False):
+    def draw_monthly_table(title, type_op, is_expense=False):
         pdf.set_font('Helvetica', 'B', 11)
         pdf.cell(0, 10, title, 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         total_budget, total_actual = 0.0, 0.0
 
-        actual_monthly_data = {}
-        for cat in categories:
-            actual_monthly_data[cat] = sum(e['amount'] for e in monthly_entries if e['category'] == cat)
-
-        for cat in categories:
-            budget_annuel = budget_data.get(cat, 0.0)
+        for row in categories:
+            if row['type'] != type_op:
+                continue
+            budget_annuel = budget_data.get(row['id'], 0.0)
             budget_mensuel = budget_annuel / 12
             
-            actual = actual_monthly_data.get(cat, 0.0)
+            actual = actual_data.get(row['id'], 0.0)
             if is_expense:
                 actual = abs(actual)
 
             diff = budget_mensuel - actual
-            total_budget += budget_mensuel
-            total_actual += actual
+            if row['parent_id'] is None:
+                total_budget += budget_mensuel
+                total_actual += actual
             
             pdf.set_font('Helvetica', '', 9)
-            pdf.cell(80, 7, cat.encode('latin-1', 'replace').decode('latin-1'), 1)
+            pdf.cell(80, 7, category_label(row).encode('latin-1', 'replace').decode('latin-1'), 1)
             pdf.cell(35, 7, f"{budget_mensuel:.2f}", 1, align='R')
             pdf.cell(35, 7, f"{actual:.2f}", 1, align='R')
             pdf.cell(30, 7, f"{diff:.2f}", 1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='R')
@@ -245,9 +3955,9 @@ def _draw_monthly_summary_report(pdf, monthly_entries, budget_data, year_name, m
         pdf.cell(30, 7, f"{total_budget - total_actual:.2f}", 1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='R')
         return total_budget, total_actual
 
-    total_budget_rec, total_actual_rec = draw_monthly_table("Recettes", CATEGORIES['recette'])
+    total_budget_rec, total_actual_rec = draw_monthly_table("Recettes", 'recette')
     pdf.ln(5)
-    total_budget_dep, total_actual_dep = draw_monthly_table("Dépenses", CATEGORIES['depense'], is_expense=True)
+    total_budget_dep, total_actual_dep = draw_monthly_table("Dépenses", 'depense', is_expense=True)
     pdf.ln(10)
 
     pdf.set_font('Helvetica', 'B', 12)
@@ -259,43 +3969,976 @@ def _draw_monthly_summary_report(pdf, monthly_entries, budget_data, year_name, m
     return "Resume_Mensuel.pdf"
 
 
-def generate_pdf(report_type, year_name, **kwargs):
-    safe_year_name = year_name.replace('/', '-').replace('\\', '-')
-    year_report_dir = os.path.join(REPORTS_DIR, safe_year_name)
-    os.makedirs(year_report_dir, exist_ok=True)
+def _draw_cash_count_report(pdf, lines, count_date, book_balance, year_name):
+    """Comptage de caisse : inventaire théorique (détails de monnaie) comparé au comptage physique."""
+    pdf.set_font('Helvetica', 'B', 14)
+    pdf.cell(0, 10, f"Comptage de caisse du {datetime.strptime(count_date, '%Y-%m-%d').strftime('%d/%m/%Y')}", 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='L')
+    pdf.set_font('Helvetica', 'I', 10)
+    pdf.cell(0, 8, f"(Exercice {year_name})", 0, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='L')
+    pdf.ln(5)
+    pdf.set_fill_color(220, 220, 220)
+    pdf.set_font('Helvetica', 'B', 10)
+    for title, width in (('Valeur', 30), ('Théorique', 30), ('Compté', 30), ('Écart', 30), ('Écart CHF', 40)):
+        pdf.cell(width, 8, title, 1, align='C', fill=True)
+    pdf.ln()
+    pdf.set_font('Helvetica', '', 9)
+    total_expected, total_counted = 0.0, 0.0
+    for denom in DENOMINATIONS:
+        expected, counted = lines.get(denom, (0, 0))
+        total_expected += denom * expected
+        total_counted += denom * counted
+        pdf.cell(30, 7, f"{denom:.2f}", 1, align='R')
+        pdf.cell(30, 7, str(expected), 1, align='R')
+        pdf.cell(30, 7, str(counted), 1, align='R')
+        pdf.cell(30, 7, str(counted - expected), 1, align='R')
+        pdf.cell(40, 7, f"{denom * (counted - expected):.2f}", 1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='R')
+    pdf.ln(5)
+    pdf.set_font('Helvetica', 'B', 10)
+    totals = [("Inventaire théorique (détails de monnaie)", total_expected), ("Comptage physique", total_counted),
+              ("Écart comptage / inventaire", total_counted - total_expected)]
+    if book_balance is not None:
+        totals += [("Solde comptable de la caisse", book_balance), ("Écart comptage / solde comptable", total_counted - book_balance)]
+    for label, value in totals:
+        pdf.cell(120, 8, label, align='R')
+        pdf.cell(40, 8, f"{value:.2f}", 1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='R')
+    return "Comptage_Caisse.pdf"
+
+def render_report(report_type, year_name, **kwargs):
+    """Dessine un rapport sans l'enregistrer. Retourne (pdf, nom_de_fichier) ou (None, None) si le type est inconnu."""
     pdf = PDF()
     pdf.add_page()
-    filename = ""
+    if kwargs.get('account'):
+        return pdf, _draw_journal_report(pdf, kwargs.get('data'), year_name, kwargs['account'])
     report_drawers = {
-        'caisse': lambda: _draw_journal_report(pdf, kwargs.get('data'), year_name, 'caisse'),
-        'poste': lambda: _draw_journal_report(pdf, kwargs.get('data'), year_name, 'poste'),
-        'resultat': lambda: _draw_resultat_report(pdf, kwargs.get('data'), year_name),
-        'budget': lambda: _draw_budget_report(pdf, kwargs.get('budget_data'), kwargs.get('actual_data'), year_name),
+        'resultat': lambda: _draw_resultat_report(pdf, kwargs.get('categories'), kwargs.get('actual_data'), year_name),
+        'budget': lambda: _draw_budget_report(pdf, kwargs.get('categories'), kwargs.get('budget_data'), kwargs.get('actual_data'), year_name),
         ### MODIFIÉ ###
         'monthly_summary': lambda: _draw_monthly_summary_report(
             pdf, 
-            kwargs.get('monthly_entries'), 
+            kwargs.get('categories'),
+            kwargs.get('actual_data'),
             kwargs.get('budget_data'),
             year_name,
             kwargs.get('month_name'),
             kwargs.get('report_year')
         ),
+        'cash_count': lambda: _draw_cash_count_report(pdf, kwargs.get('lines'), kwargs.get('count_date'), kwargs.get('book_balance'), year_name),
     }
-    # ... (le reste de la fonction est inchangé)
-    if report_type in report_drawers:
-        filename = report_drawers[report_type]()
-    else:
+    if report_type not in report_drawers:
+        return None, None
+    return pdf, report_drawers[report_type]()
+
+def report_dir_for_year(year_name):
+    safe_year_name = year_name.replace('/', '-').replace('\\', '-')
+    return os.path.join(REPORTS_DIR, safe_year_name)
+
+def write_report_pdf(report_type, year_name, report_kwargs):
+    """Dessine et enregistre un rapport horodaté ; retourne son chemin, ou None si le type n'est pas configuré.
+
+    N'utilise pas Tk : peut s'exécuter dans un processus de rendu.
+    """
+    year_report_dir = report_dir_for_year(year_name)
+    os.makedirs(year_report_dir, exist_ok=True)
+    pdf, filename = render_report(report_type, year_name, **report_kwargs)
+    if pdf is None or not filename:
+        return None
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    final_filename = f"{os.path.splitext(filename)[0]}_{timestamp}.pdf"
+    filepath = os.path.join(year_report_dir, final_filename)
+    pdf.output(filepath)
+    return filepath
+
+def show_report_result(report_type, filepath, error=None):
+    if error is not None:
+        messagebox.showerror("Erreur de sauvegarde PDF", f"Impossible de sauvegarder le fichier:\n{error}")
+    elif filepath is None:
         messagebox.showwarning("Non implémenté", f"Le rapport de type '{report_type}' n'est pas configuré.")
+    else:
+        messagebox.showinfo("Succès", f"Le rapport a été généré ici :\n{os.path.abspath(filepath)}")
+
+def generate_pdf(report_type, year_name, **kwargs):
+    try:
+        filepath = write_report_pdf(report_type, year_name, kwargs)
+    except Exception as e:
+        show_report_result(report_type, None, e)
         return
-    if filename:
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        final_filename = f"{os.path.splitext(filename)[0]}_{timestamp}.pdf"
-        filepath = os.path.join(year_report_dir, final_filename)
+    show_report_result(report_type, filepath)
+
+# --- PRÉ-GÉNÉRATION DES RAPPORTS ---
+def report_fingerprint(report_type, year_name, period, report_kwargs):
+    """Empreinte des données d'un rapport : le PDF est périmé dès qu'elle change."""
+    payload = json.dumps([APP_VERSION, report_type, year_name, period, report_kwargs], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def completed_months(start_date, end_date, today):
+    """Premiers jours des mois de l'exercice entièrement écoulés avant today."""
+    months = []
+    month = start_date.replace(day=1)
+    while month <= end_date:
+        month_end = month.replace(day=calendar.monthrange(month.year, month.month)[1])
+        if month_end >= today:
+            break
+        months.append(month)
+        month = (month + timedelta(days=32)).replace(day=1)
+    return months
+
+def pending_reports(db, today=None, checked=None):
+    """Rapports des mois terminés et des exercices clôturés absents ou périmés.
+
+    Produit, exercice par exercice (pour ne garder en mémoire que les données d'un seul),
+    des listes de tâches (year_id, year_name, report_type, period, report_kwargs, fingerprint).
+    checked (dict conservé d'un passage à l'autre) retient le jeton de modification des exercices
+    trouvés à jour : tant qu'il ne change pas, l'exercice n'est pas rechargé.
+    """
+    today = today or date.today()
+    checked = {} if checked is None else checked
+    db.prune_report_index()
+    index = {(row['year_id'], row['report_type'], row['period']): row for row in db.report_index()}
+    versions = db.year_versions()
+    for year in db.list_years():
         try:
-            pdf.output(filepath)
-            messagebox.showinfo("Succès", f"Le rapport a été généré ici :\n{os.path.abspath(filepath)}")
-        except Exception as e:
-            messagebox.showerror("Erreur de sauvegarde PDF", f"Impossible de sauvegarder le fichier:\n{e}")
+            start = datetime.strptime(year['start_date'], '%Y-%m-%d').date()
+            end = datetime.strptime(year['end_date'], '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            continue
+        periods = [('monthly_summary', month.strftime('%Y-%m'), month) for month in completed_months(start, end, today)]
+        if end < today:
+            periods += [(report_type, 'exercice', None) for report_type in REPORT_PREGEN_TYPES]
+        if not periods:
+            continue
+        marker = (versions.get(year['id']), year['name'], tuple(period for _, period, _ in periods))
+        known_paths = [row['path'] for key, row in index.items() if key[0] == year['id']]
+        if checked.get(year['id']) == marker and all(os.path.exists(path) for path in known_paths):
+            continue
+        snapshot = YearSnapshot.load(db, year['id'])
+        if end < today:
+            periods += [(account['code'], 'exercice', None) for account in snapshot.active_accounts()]
+        jobs = []
+        for report_type, period, selected_date in periods:
+            report_kwargs = load_report_data(snapshot, report_type, selected_date)
+            fingerprint = report_fingerprint(report_type, year['name'], period, report_kwargs)
+            known = index.get((year['id'], report_type, period))
+            if known and known['fingerprint'] == fingerprint and os.path.exists(known['path']):
+                continue
+            jobs.append((year['id'], year['name'], report_type, period, report_kwargs, fingerprint))
+        if jobs:
+            yield jobs
+        else:
+            checked[year['id']] = marker
+
+def render_report_file(report_type, year_name, period, report_kwargs):
+    """Exécuté dans un processus de rendu : écrit le PDF (remplacement atomique) et retourne son chemin."""
+    year_report_dir = report_dir_for_year(year_name)
+    os.makedirs(year_report_dir, exist_ok=True)
+    pdf, filename = render_report(report_type, year_name, **report_kwargs)
+    filepath = os.path.join(year_report_dir, f"{os.path.splitext(filename)[0]}_{period}.pdf")
+    pdf.output(filepath + ".tmp")
+    os.replace(filepath + ".tmp", filepath)
+    return filepath
+
+def pregenerate_reports(db, today=None, workers=REPORT_PREGEN_WORKERS, stop_event=None, checked=None):
+    """Rend les rapports en attente dans des processus séparés et les inscrit dans l'index.
+
+    Le rendu PDF n'occupe ainsi ni la boucle Tk ni le GIL du processus principal.
+    checked : voir pending_reports. Retourne le nombre de rapports générés.
+    """
+    generated = 0
+    executor = None  # processus lancés seulement s'il y a quelque chose à rendre
+    try:
+        for jobs in pending_reports(db, today, checked):
+            if stop_event is not None and stop_event.is_set():
+                break
+            if executor is None:
+                executor = ProcessPoolExecutor(max_workers=workers)
+            futures = {executor.submit(render_report_file, report_type, year_name, period, report_kwargs): (year_id, report_type, period, fingerprint)
+                       for year_id, year_name, report_type, period, report_kwargs, fingerprint in jobs}
+            for future in as_completed(futures):
+                if stop_event is not None and stop_event.is_set():
+                    break
+                year_id, report_type, period, fingerprint = futures[future]
+                try:
+                    path = future.result()
+                except Exception as e:
+                    print(f"Rapport {report_type} {period} non généré : {e}")
+                    continue
+                db.record_report(year_id, report_type, period, path, fingerprint)
+                generated += 1
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+    return generated
+
+# --- INDEX DES JUSTIFICATIFS ---
+def extract_attachment_text(path, max_pages=ATTACHMENT_INDEX_MAX_PAGES, max_chars=ATTACHMENT_INDEX_MAX_CHARS):
+    """Exécuté dans un processus d'indexation : texte des premières pages d'un PDF ('' si illisible)."""
+    try:
+        reader = PdfReader(path)
+        parts = [reader.pages[index].extract_text() or "" for index in range(min(len(reader.pages), max_pages))]
+    except Exception as e:  # PDF chiffré, tronqué ou non conforme : la pièce reste simplement introuvable
+        print(f"Texte de '{path}' non extrait : {e}")
+        return ""
+    return " ".join(" ".join(parts).split())[:max_chars]
+
+def fts_query(text):
+    """Requête FTS5 tolérante : chaque mot saisi doit apparaître, éventuellement comme début de mot."""
+    words = re.findall(r"\w+", text)
+    return " ".join(f'"{word}"*' for word in words) if words else None
+
+def index_attachments(db, attachment_dir=ATTACHMENT_DIR, workers=ATTACHMENT_INDEX_WORKERS, stop_event=None):
+    """Indexe le texte des justificatifs nouveaux ou modifiés (taille ou date du fichier différentes).
+
+    L'extraction du texte tourne dans des processus séparés ; le thread appelant n'écrit en base
+    que par lots. Retourne le nombre de justificatifs indexés.
+    """
+    if PdfReader is None or not db.attachment_index_available():
+        return 0
+    jobs, others = [], []
+    for row in db.attachments_for_indexing():
+        try:
+            st = os.stat(os.path.join(attachment_dir, row['attachment_path']))
+        except OSError:
+            continue  # pièce manquante : signalée par le contrôle d'intégrité
+        if row['size'] == st.st_size and row['mtime_ns'] == st.st_mtime_ns:
+            continue
+        job = (row['id'], row['attachment_path'], st.st_size, st.st_mtime_ns)
+        if row['attachment_path'].lower().endswith(".pdf"):
+            jobs.append(job)
+        else:
+            others.append(job + ("",))  # photo ou autre format : rien à extraire, mais plus à réexaminer
+    indexed = db.store_attachment_texts(others) if others else 0
+    if not jobs:
+        return indexed
+    executor = ProcessPoolExecutor(max_workers=workers)
+    batch = []
+    try:
+        futures = {executor.submit(extract_attachment_text, os.path.join(attachment_dir, job[1])): job for job in jobs}
+        for future in as_completed(futures):
+            if stop_event is not None and stop_event.is_set():
+                break
+            try:
+                text = future.result()
+            except Exception as e:
+                print(f"Indexation de '{futures[future][1]}' impossible : {e}")
+                continue
+            batch.append(futures[future] + (text,))
+            if len(batch) >= ATTACHMENT_INDEX_BATCH:
+                indexed += db.store_attachment_texts(batch)
+                batch = []
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    if batch:
+        indexed += db.store_attachment_texts(batch)
+    return indexed
+
+# --- DOSSIER DE CLÔTURE ---
+class _CountingWriter(io.RawIOBase):
+    """Flux d'écriture séquentiel avec tell() : pypdf en a besoin, l'écriture dans un ZIP n'en a pas."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.stream.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+def _dossier_receipt_name(entry):
+    return f"justificatifs/{entry['journal']}/{entry['date']}_{entry['id']}_{os.path.basename(entry['attachment_path'])}"
+
+def _write_appendix_volumes(archive, stem, report_bytes, receipts, check):
+    """Journal suivi de ses justificatifs, par volumes de DOSSIER_APPENDIX_VOLUME_RECEIPTS pièces.
+
+    Chaque volume est écrit directement dans l'archive puis libéré. Retourne les justificatifs
+    qui n'ont pas pu être fusionnés (PDF illisible).
+    """
+    failed = []
+    size = DOSSIER_APPENDIX_VOLUME_RECEIPTS
+    volumes = [receipts[i:i + size] for i in range(0, len(receipts), size)] or [[]]
+    for number, volume in enumerate(volumes, 1):
+        writer = PdfWriter()
+        if number == 1:
+            writer.append(io.BytesIO(report_bytes))
+        for entry, full_path in volume:
+            check()
+            try:
+                writer.append(full_path)
+            except (OSError, PyPdfError, ValueError):
+                failed.append(entry['id'])
+        suffix = f"_{number:02d}" if len(volumes) > 1 else ""
+        with archive.open(f"annexes/{stem}_avec_justificatifs{suffix}.pdf", 'w', force_zip64=True) as stream:
+            writer.write(_CountingWriter(stream))
+        writer.close()
+    return failed
+
+def export_year_dossier(db, year_id, dest_path, merge_receipts=False, attachment_dir=ATTACHMENT_DIR, check=lambda: None):
+    """Dossier de clôture : rapports de l'exercice, justificatifs et index CSV dans une seule archive ZIP.
+
+    Les rapports sont rendus en mémoire (pdf.output() -> octets) et les justificatifs recopiés
+    par blocs dans l'archive, sans copie intermédiaire. Avec merge_receipts (pypdf requis), chaque
+    journal est aussi livré avec ses justificatifs en annexe. check() est appelé entre deux
+    fichiers (annulation). Retourne (justificatifs inclus, justificatifs manquants).
+    """
+    year = next((y for y in db.list_years() if y['id'] == year_id), None)
+    if year is None:
+        raise ValueError(f"Exercice {year_id} introuvable.")
+    snapshot = YearSnapshot.load(db, year_id)
+    base_dir = year_attachment_dir(db, year_id, attachment_dir)
+    entries = snapshot.entries()
+    tmp_path = dest_path + ".tmp"
+    included, missing = 0, 0
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            journal_reports = {}
+            journal_types = [account['code'] for account in snapshot.active_accounts()]
+            for report_type in journal_types + list(DOSSIER_REPORT_TYPES):
+                check()
+                pdf, filename = render_report(report_type, year['name'], **load_report_data(snapshot, report_type))
+                report_bytes = bytes(pdf.output())
+                archive.writestr(f"rapports/{filename}", report_bytes)
+                if report_type in journal_types:
+                    journal_reports[report_type] = (os.path.splitext(filename)[0], report_bytes)
+
+            index_rows = []
+            receipts = defaultdict(list)
+            for entry in entries:
+                name, status = "", ""
+                if entry['attachment_path']:
+                    full_path = os.path.join(base_dir, entry['attachment_path'])
+                    name = _dossier_receipt_name(entry)
+                    check()
+                    try:
+                        # Les PDF sont déjà compressés : stockés tels quels, lus par blocs
+                        archive.write(full_path, name, compress_type=zipfile.ZIP_STORED)
+                        receipts[entry['journal']].append((entry, full_path))
+                        status = "inclus"
+                        included += 1
+                    except OSError:
+                        status = "manquant"
+                        missing += 1
+                index_rows.append((entry['id'], entry['date'], entry['journal'], entry['libelle'], entry['category'],
+                                   entry['type'], f"{entry['amount']:.2f}", name, status))
+
+            not_merged = set()
+            if merge_receipts and PdfWriter is not None:
+                for journal, (stem, report_bytes) in journal_reports.items():
+                    not_merged.update(_write_appendix_volumes(archive, stem, report_bytes, receipts[journal], check))
+
+            with archive.open("index.csv", 'w') as raw, io.TextIOWrapper(raw, encoding='utf-8-sig', newline='') as text:
+                writer = csv.writer(text, delimiter=';')
+                writer.writerow(("ID", "Date", "Journal", "Libellé", "Catégorie", "Type", "Montant", "Justificatif", "Statut"))
+                for row in index_rows:
+                    if row[0] in not_merged:
+                        row = row[:-1] + ("inclus, non fusionné (PDF illisible)",)
+                    writer.writerow(row)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return included, missing
+
+# --- API JSON LOCALE (lecture seule) ---
+class PooledHTTPServer(HTTPServer):
+    """Serveur HTTP dont les requêtes sont traitées par un pool de threads de taille fixe."""
+    request_queue_size = 64
+
+    def __init__(self, server_address, handler_class, workers=API_WORKERS):
+        super().__init__(server_address, handler_class)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="aetml-api")
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request_in_pool, request, client_address)
+
+    def _process_request_in_pool(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+class LedgerAPI:
+    """Réponses JSON de l'API, avec une connexion en lecture seule par thread et un cache des réponses.
+
+    Le cache est vidé dès qu'un thread constate via PRAGMA data_version qu'une autre connexion
+    (l'application ou un autre poste) a écrit dans la base.
+    """
+    def __init__(self, db_file=DB_FILE):
+        self.db_file = db_file
+        self._local = threading.local()
+        self._cache = {}
+        self._generation = 0
+        self._cache_lock = threading.Lock()
+        self.routes = {
+            "/api/health": self.health,
+            "/api/years": self.years,
+            "/api/balances": self.balances,
+            "/api/categories": self.categories,
+            "/api/budget": self.budget,
+            "/api/history": self.history,
+        }
+
+    def invalidate(self):
+        with self._cache_lock:
+            self._cache.clear()
+            self._generation += 1
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # Une nouvelle connexion ne sait pas ce qui a changé avant son ouverture
+            db = self._local.db = LedgerRepository(self.db_file, read_only=True)
+            self.invalidate()
+        elif db.has_external_changes():
+            self.invalidate()
+            db.detach_archives()  # un exercice a pu être archivé ou réintégré
+        return db
+
+    def cached(self, path, query):
+        """Retourne le corps JSON (bytes) d'une route, depuis le cache si la base n'a pas changé."""
+        db = self._db()
+        key = (path, query)
+        with self._cache_lock:
+            body = self._cache.get(key)
+            generation = self._generation
+        if body is None:
+            params = dict(urllib.parse.parse_qsl(query))
+            body = json.dumps(self.routes[path](db, params), ensure_ascii=False).encode("utf-8")
+            with self._cache_lock:
+                # Ne pas mettre en cache un résultat calculé pendant qu'une invalidation avait lieu
+                if self._generation == generation:
+                    self._cache[key] = body
+        return body
+
+    def _year(self, db, params):
+        years = db.list_years()
+        wanted = params.get("year")
+        for year in years:
+            if wanted is None or wanted in (str(year['id']), year['name']):
+                return year
+        raise LookupError(f"Exercice introuvable : {wanted}" if wanted else "Aucun exercice")
+
+    def health(self, db, params):
+        return {"status": "ok", "version": APP_VERSION}
+
+    def years(self, db, params):
+        return [{"id": y['id'], "name": y['name'], "start_date": y['start_date'], "end_date": y['end_date']} for y in db.list_years()]
+
+    def balances(self, db, params):
+        year = self._year(db, params)
+        totals = db.dashboard_totals(year['id'])
+        journals = {}
+        for account in db.account_balances(year['id']):
+            journals[account['code']] = {"name": account['name'], "initial": round(account['opening_balance'], 2),
+                                         "mouvements": round(account['movements'], 2), "solde": round(account['balance'], 2)}
+        return {"year": year['name'], "journals": journals,
+                "total_recettes": round(totals['total_recettes'], 2), "total_depenses": round(totals['total_depenses'], 2),
+                "benefice": round(totals['total_recettes'] - totals['total_depenses'], 2)}
+
+    def categories(self, db, params):
+        year = self._year(db, params)
+        pivot = {}
+        for row in db.category_month_pivot(year['id']):
+            cat = pivot.setdefault(row['category'], {"type": row['type'], "total": 0.0, "count": 0, "months": {}})
+            cat["months"][row['month']] = round(row['total'], 2)
+            cat["total"] = round(cat["total"] + row['total'], 2)
+            cat["count"] += row['count']
+        return {"year": year['name'], "categories": pivot}
+
+    def budget(self, db, params):
+        year = self._year(db, params)
+        categories = CategoryTree.load(db)
+        budget_data = db.budget_rollup(year['id'])
+        actual_data = db.category_rollup(year['id'])
+        lines = []
+        for row in categories.rows:
+            budget = budget_data.get(row['id'], 0.0)
+            actual = abs(actual_data.get(row['id'], 0.0))
+            parent = categories.by_id.get(row['parent_id'])
+            lines.append({"category": row['name'], "type": row['type'], "parent": parent['name'] if parent else None,
+                          "budget": round(budget, 2), "actual": round(actual, 2), "difference": round(budget - actual, 2)})
+        return {"year": year['name'], "lines": lines}
+
+    def history(self, db, params):
+        """Résultat de chaque exercice, archivés compris."""
+        years = []
+        for year, totals in db.yearly_totals():
+            years.append({"year": year['name'], "start_date": year['start_date'], "end_date": year['end_date'],
+                          "archived": bool(year['archive_file']),
+                          "total_recettes": round(totals['total_recettes'], 2), "total_depenses": round(totals['total_depenses'], 2),
+                          "benefice": round(totals['total_recettes'] - totals['total_depenses'], 2)})
+        return {"years": years}
+
+    @staticmethod
+    def _safe_segment(name):
+        """Un segment d'URL ne doit désigner qu'un nom de fichier, jamais un chemin."""
+        return bool(name) and name not in (".", "..") and "/" not in name and "\\" not in name and "\0" not in name
+
+    def _report_year(self, year_name):
+        """Nom d'un exercice existant ; LookupError sinon (seuls les exercices de la base sont exposés)."""
+        if self._safe_segment(year_name):
+            for year in self._db().list_years():
+                if year['name'] == year_name:
+                    return year_name
+        raise LookupError(f"Exercice introuvable : {year_name}")
+
+    def reports(self, year_name):
+        """Liste des rapports PDF déjà générés pour un exercice (non mise en cache : fichiers hors base)."""
+        year_name = self._report_year(year_name)
+        report_dir = report_dir_for_year(year_name)
+        files = []
+        if os.path.isdir(report_dir):
+            for item in sorted(os.scandir(report_dir), key=lambda e: e.name):
+                if item.is_file(follow_symlinks=False) and item.name.lower().endswith(".pdf"):
+                    st = item.stat()
+                    files.append({"name": item.name, "size": st.st_size,
+                                  "modified": datetime.fromtimestamp(st.st_mtime).isoformat(timespec="seconds"),
+                                  "url": f"/api/reports/{urllib.parse.quote(year_name)}/{urllib.parse.quote(item.name)}"})
+        return {"year": year_name, "reports": files}
+
+    def report_file(self, year_name, filename):
+        """Chemin d'un rapport existant, ou None ; empêche de sortir du dossier des rapports.
+
+        report_dir_for_year ne neutralise que les séparateurs : l'exercice doit exister en base,
+        les deux segments ne peuvent être ni '.', ni '..', ni contenir de séparateur, et le chemin
+        résolu (liens symboliques compris) doit rester dans REPORTS_DIR/<exercice>.
+        """
+        try:
+            year_name = self._report_year(year_name)
+        except LookupError:
+            return None
+        if not self._safe_segment(filename) or not filename.lower().endswith(".pdf"):
+            return None
+        reports_root = os.path.realpath(REPORTS_DIR)
+        report_dir = os.path.realpath(report_dir_for_year(year_name))
+        if os.path.dirname(report_dir) != reports_root:
+            return None
+        path = os.path.realpath(os.path.join(report_dir, filename))
+        if os.path.dirname(path) != report_dir or not os.path.isfile(path):
+            return None
+        return path
+
+class LedgerAPIRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = 10
+    api = None  # LedgerAPI, fixé par start_api_server
+
+    def setup(self):
+        super().setup()
+        # En-têtes et corps sont écrits séparément : sans TCP_NODELAY, Nagle ajoute ~40 ms par réponse
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json; charset=utf-8"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error_json(self, status, message):
+        self._send(status, json.dumps({"error": message}, ensure_ascii=False).encode("utf-8"))
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path.rstrip("/") or "/"
+        try:
+            if path in self.api.routes:
+                self._send(200, self.api.cached(path, url.query))
+            elif path.startswith("/api/reports/"):
+                parts = [urllib.parse.unquote(p) for p in path[len("/api/reports/"):].split("/")]
+                if len(parts) == 1:
+                    self._send(200, json.dumps(self.api.reports(parts[0]), ensure_ascii=False).encode("utf-8"))
+                elif len(parts) == 2 and (file_path := self.api.report_file(*parts)):
+                    with open(file_path, "rb") as f:
+                        self._send(200, f.read(), "application/pdf")
+                else:
+                    self._send_error_json(404, "Rapport introuvable")
+            else:
+                self._send_error_json(404, "Route inconnue")
+        except LookupError as e:
+            self._send_error_json(404, str(e))
+        except sqlite3.Error as e:
+            self._send_error_json(503, f"Base de données indisponible : {e}")
+
+def start_api_server(db_file=DB_FILE, host=API_HOST, port=API_PORT, workers=API_WORKERS):
+    """Démarre l'API dans un thread d'arrière-plan et retourne le serveur (server.shutdown() pour l'arrêter)."""
+    handler = type("BoundLedgerAPIRequestHandler", (LedgerAPIRequestHandler,), {"api": LedgerAPI(db_file)})
+    server = PooledHTTPServer((host, port), handler, workers)
+    threading.Thread(target=server.serve_forever, name="aetml-api-accept", daemon=True).start()
+    return server
+
+# --- TÂCHES D'ARRIÈRE-PLAN ---
+class TaskCancelled(Exception):
+    """La tâche a été annulée par l'utilisateur."""
+
+class Task:
+    """Tâche soumise à un TaskRunner : libellé affiché, future et demande d'annulation.
+
+    action : nom sous lequel le profileur chronomètre l'exécution de la tâche (et non sa soumission).
+    """
+    def __init__(self, label, on_done, cancellable, action=None):
+        self.label = label
+        self.on_done = on_done
+        self.cancellable = cancellable
+        self.action = action
+        self.future = None
+        self._cancel_requested = threading.Event()
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_requested.is_set()
+
+    def cancel(self):
+        """Une tâche en attente est abandonnée ; une tâche en cours s'arrête à son prochain check()."""
+        self._cancel_requested.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def check(self):
+        """Point d'annulation, à appeler entre deux étapes d'une tâche longue."""
+        if self._cancel_requested.is_set():
+            raise TaskCancelled()
+
+def copy_attachment(source_path, year_id, attachment_dir=ATTACHMENT_DIR):
+    """Copie un justificatif dans le dossier de l'exercice ; retourne son chemin relatif."""
+    year_folder = os.path.join(attachment_dir, str(year_id))
+    os.makedirs(year_folder, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    filename = f"{timestamp}_{os.path.basename(source_path)}"
+    shutil.copy(source_path, os.path.join(year_folder, filename))
+    return os.path.join(str(year_id), filename)
+
+class TaskRunner:
+    """Exécute le travail lent hors de la boucle Tk : un thread de travail et un pool de processus optionnel.
+
+    Le thread de travail possède sa propre connexion (sqlite3 interdit de partager celle de
+    l'interface) et traite les tâches dans l'ordre de soumission : les écritures ne se
+    concurrencent pas entre elles. Le pool de processus, créé à la première utilisation, sert
+    au rendu PDF. Les callbacks on_done(résultat, erreur) sont exécutés par pump(), appelé
+    depuis la boucle Tk avec after() : aucun widget n'est touché depuis un autre thread.
+    """
+    def __init__(self, db_file=DB_FILE, process_workers=REPORT_PREGEN_WORKERS, write_listeners=()):
+        self.db_file = db_file
+        self.process_workers = process_workers
+        self.write_listeners = list(write_listeners)
+        self.active = []  # tâches non terminées, dans l'ordre de soumission (boucle Tk uniquement)
+        self._finished = queue.Queue()
+        self._db = None   # connexion du thread de travail, ouverte par lui
+        self._thread_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="aetml-worker", initializer=self._open_db)
+        self._process_pool = None
+
+    def _open_db(self):
+        self._db = LedgerRepository(self.db_file)
+        for callback in self.write_listeners:
+            self._db.add_write_listener(callback)
+
+    def _close_db(self):
+        if self._db is not None:
+            self._db.close()
+
+    def _run(self, task, func, args):
+        task.check()
+        if task.action is None or not PROFILER.enabled:
+            return func(self._db, task, *args)
+        with PROFILER.action(task.action):
+            return func(self._db, task, *args)
+
+    def submit(self, func, *args, label="", on_done=None, cancellable=False, action=None):
+        """Exécute func(db, task, *args) sur le thread de travail ; db est la connexion de ce thread."""
+        task = Task(label, on_done, cancellable, action)
+        task.future = self._thread_pool.submit(self._run, task, func, args)
+        self._track(task)
+        return task
+
+    def submit_process(self, func, *args, label="", on_done=None, cancellable=True, action=None):
+        """Exécute func(*args) dans un processus de rendu : ni la boucle Tk ni le GIL ne sont occupés.
+
+        func et ses arguments doivent pouvoir être sérialisés (pickle). Le profileur du processus
+        de rendu n'est pas actif : l'action est chronométrée de la soumission à la fin du rendu.
+        """
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(max_workers=self.process_workers)
+        task = Task(label, on_done, cancellable, action)
+        started = time.perf_counter()
+        task.future = self._process_pool.submit(func, *args)
+        if action is not None and PROFILER.enabled:
+            task.future.add_done_callback(lambda future: PROFILER.record(action, (time.perf_counter() - started) * 1000))
+        self._track(task)
+        return task
+
+    def _track(self, task):
+        self.active.append(task)
+        task.future.add_done_callback(lambda future: self._finished.put(task))
+
+    def pump(self):
+        """Appelle, dans le thread courant (la boucle Tk), les callbacks des tâches terminées.
+
+        Une tâche annulée reçoit l'erreur TaskCancelled ; son résultat est transmis si elle
+        était déjà allée au bout (par exemple pour supprimer un fichier devenu inutile).
+        """
+        while True:
+            try:
+                task = self._finished.get_nowait()
+            except queue.Empty:
+                return
+            self.active.remove(task)
+            if task.on_done is None:
+                continue
+            future = task.future
+            result, error = None, None
+            if future.cancelled():
+                error = TaskCancelled()
+            elif future.exception() is not None:
+                error = future.exception()
+            else:
+                result = future.result()
+                if task.cancel_requested:
+                    error = TaskCancelled()
+            task.on_done(result, error)
+
+    def cancel_all(self):
+        for task in list(self.active):
+            if task.cancellable:
+                task.cancel()
+
+    def shutdown(self):
+        """Abandonne les tâches annulables, laisse finir les écritures en attente puis ferme la connexion du thread de travail."""
+        self.cancel_all()
+        self._thread_pool.submit(self._close_db)
+        self._thread_pool.shutdown(wait=True)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
+
+# --- BOÎTE DE RÉCEPTION DES JUSTIFICATIFS ---
+# « #123 » ou « E123 » formant un mot entier : « IMG_E1234.JPG » (photo retouchée d'iPhone) ne désigne aucune écriture
+_INBOX_ENTRY_ID = re.compile(r'(?<![\w#])[#e](\d+)(?![\w.,])')
+_INBOX_DATES = (
+    (re.compile(r'(?<!\d)(\d{4})-(\d{2})-(\d{2})(?!\d)'), (1, 2, 3)),
+    (re.compile(r'(?<!\d)(\d{2})[.](\d{2})[.](\d{4})(?!\d)'), (3, 2, 1)),
+    (re.compile(r'(?<!\d)(20\d{2})(\d{2})(\d{2})(?!\d)'), (1, 2, 3)),
+)
+_INBOX_AMOUNT = re.compile(r"(?<![\d.,'])(\d{1,3}(?:'\d{3})+|\d+)[.,](\d{2})(?![\d.,])|chf\s*(\d+)(?!\d)")
+
+def parse_inbox_filename(filename):
+    """Conventions de nommage des justificatifs déposés -> (id d'écriture, date ISO, montant), None si absents.
+
+    « E123 » ou « #123 » désigne l'écriture 123. La date (AAAA-MM-JJ, JJ.MM.AAAA ou AAAAMMJJ)
+    et le montant (120.50, 1'250,00 ou CHF 120) permettent de retrouver l'écriture, par exemple
+    « 2025-03-14 imprimerie 120.50.pdf », ou de confirmer celle désignée par son numéro.
+    """
+    stem = os.path.splitext(os.path.basename(filename))[0].lower()
+    entry_id = None
+    match = _INBOX_ENTRY_ID.search(stem)
+    if match:
+        entry_id = int(match.group(1))
+        stem = stem[:match.start()] + " " + stem[match.end():]
+    file_date = None
+    for pattern, (year, month, day) in _INBOX_DATES:
+        match = pattern.search(stem)
+        if match:
+            try:
+                file_date = date(int(match.group(year)), int(match.group(month)), int(match.group(day))).isoformat()
+            except ValueError:
+                continue
+            stem = stem[:match.start()] + " " + stem[match.end():]
+            break
+    amount = None
+    match = _INBOX_AMOUNT.search(stem)
+    if match:
+        if match.group(3):
+            amount = float(match.group(3))
+        else:
+            amount = float(match.group(1).replace("'", "") + "." + match.group(2))
+    return entry_id, file_date, amount
+
+def match_inbox_file(db, filename, window_days=INBOX_DATE_WINDOW_DAYS):
+    """Écriture sans justificatif désignée par le nom du fichier -> (écriture ou None, date, montant, remarque)."""
+    entry_id, file_date, amount = parse_inbox_filename(filename)
+    if entry_id is not None:
+        entry = db.get_entry(entry_id)
+        if entry is None:
+            return None, file_date, amount, f"Écriture #{entry_id} introuvable"
+        if entry['attachment_path']:
+            return None, file_date, amount, f"L'écriture #{entry_id} a déjà un justificatif"
+        # Le numéro seul ne suffit pas : la date ou le montant du nom doit correspondre à l'écriture
+        same_amount = amount is not None and round(abs(entry['amount']), 2) == round(amount, 2)
+        near_date = file_date is not None and abs((date.fromisoformat(entry['date']) - date.fromisoformat(file_date)).days) <= window_days
+        if not (same_amount or near_date):
+            return None, file_date, amount, f"Écriture #{entry_id} non confirmée par la date ou le montant du nom"
+        return entry, file_date, amount, None
+    if file_date is None or amount is None:
+        return None, file_date, amount, "Nom sans date ni montant"
+    day = date.fromisoformat(file_date)
+    candidates = db.inbox_candidates(amount, (day - timedelta(days=window_days)).isoformat(), (day + timedelta(days=window_days)).isoformat())
+    if not candidates:
+        return None, file_date, amount, "Aucune écriture sans justificatif pour ce montant et cette date"
+    # À égalité d'écart de dates, plusieurs écritures possibles : l'utilisateur choisit
+    gaps = sorted((abs((date.fromisoformat(row['date']) - day).days), row['id'], row) for row in candidates)
+    if len(gaps) > 1 and gaps[0][0] == gaps[1][0]:
+        return None, file_date, amount, f"{sum(1 for gap in gaps if gap[0] == gaps[0][0])} écritures possibles"
+    return gaps[0][2], file_date, amount, None
+
+def _unique_path(folder, filename):
+    base, ext = os.path.splitext(filename)
+    path, counter = os.path.join(folder, filename), 1
+    while os.path.exists(path):
+        path = os.path.join(folder, f"{base}_{counter}{ext}")
+        counter += 1
+    return path
+
+def attach_inbox_file(db, source_path, entry, sha256, pending_id=None, attachment_dir=ATTACHMENT_DIR):
+    """Copie le fichier dans le dossier de l'exercice, le joint à l'écriture puis le retire de la boîte de réception."""
+    relative_path = copy_attachment(source_path, entry['year_id'], attachment_dir)
+    try:
+        db.attach_receipt(entry['id'], relative_path, sha256, pending_id)
+    except Exception:
+        os.remove(os.path.join(attachment_dir, relative_path))
+        raise
+    os.remove(source_path)
+    return relative_path
+
+def ingest_inbox_file(db, path, inbox_dir=INBOX_DIR, attachment_dir=ATTACHMENT_DIR):
+    """Traite un fichier déposé : joint à l'écriture reconnue, sinon mis en attente d'attribution.
+
+    Retourne (id de l'écriture, None) ou (None, remarque).
+    """
+    sha256 = _hash_file(path)
+    filename = os.path.basename(path)
+    known = db.entry_with_attachment_sha(sha256)
+    if known is not None:
+        entry, file_date, amount, note = None, None, None, f"Déjà joint à l'écriture #{known['id']} du {known['date']}"
+    else:
+        entry, file_date, amount, note = match_inbox_file(db, filename)
+    if entry is not None:
+        try:
+            attach_inbox_file(db, path, entry, sha256, attachment_dir=attachment_dir)
+            return entry['id'], None
+        except ConflictError as e:
+            note = str(e)
+    pending_dir = os.path.join(inbox_dir, INBOX_PENDING_DIR)
+    os.makedirs(pending_dir, exist_ok=True)
+    pending_path = _unique_path(pending_dir, filename)
+    os.replace(path, pending_path)
+    try:
+        db.add_inbox_pending(pending_path, filename, sha256, file_date, amount, note)
+    except sqlite3.Error:
+        os.replace(pending_path, path)  # retraité au prochain passage
+        raise
+    return None, note
+
+def _open_inotify(folder):
+    """Descripteur inotify signalant les fichiers écrits ou déplacés dans folder ; None hors Linux ou en cas d'échec."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        in_close_write, in_moved_to = 0x00000008, 0x00000080
+        if libc.inotify_add_watch(fd, os.fsencode(folder), in_close_write | in_moved_to) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+class InboxWatcher:
+    """Surveille le dossier de réception et y traite les justificatifs déposés, hors de la boucle Tk.
+
+    Sous Linux, inotify réveille le thread dès qu'un fichier est écrit ; ailleurs le dossier est
+    scruté toutes les INBOX_POLL_S secondes. Un fichier n'est traité qu'une fois sa taille stable
+    depuis INBOX_SETTLE_S (scanner encore en train d'écrire). Le thread a sa propre connexion :
+    l'interface voit ses écritures comme celles d'un autre poste (voir poll_external_changes).
+    """
+    def __init__(self, db_file=DB_FILE, inbox_dir=INBOX_DIR, attachment_dir=ATTACHMENT_DIR):
+        self.db_file = db_file
+        self.inbox_dir = inbox_dir
+        self.attachment_dir = attachment_dir
+        self.events = deque(maxlen=100)   # (nom du fichier, id de l'écriture ou None, remarque), relevés par l'interface
+        self.stop_event = threading.Event()
+        self.uses_inotify = False
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.inbox_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="aetml-inbox", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _ready_files(self, seen):
+        """Fichiers dont la taille et la date n'ont pas bougé depuis INBOX_SETTLE_S ; seen garde l'état des autres."""
+        now = time.monotonic()
+        ready, present = [], set()
+        with os.scandir(self.inbox_dir) as it:
+            for item in it:
+                if not item.is_file() or not item.name.lower().endswith(INBOX_EXTENSIONS):
+                    continue
+                st = item.stat()
+                present.add(item.path)
+                state = (st.st_size, st.st_mtime_ns)
+                previous = seen.get(item.path)
+                if previous is None or previous[0] != state:
+                    seen[item.path] = (state, now)
+                elif previous[1] is not None and now - previous[1] >= INBOX_SETTLE_S:
+                    ready.append(item.path)
+                    seen[item.path] = (state, None)  # traité (ou en échec) : ignoré tant qu'il ne change pas
+        for path in set(seen) - present:
+            del seen[path]
+        return ready
+
+    def _run(self):
+        fd = _open_inotify(self.inbox_dir)
+        self.uses_inotify = fd is not None
+        db = LedgerRepository(self.db_file)
+        seen = {}
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    ready = self._ready_files(seen)
+                except OSError as e:
+                    print(f"Boîte de réception illisible : {e}")
+                    ready = []
+                for path in ready:
+                    if self.stop_event.is_set():
+                        break
+                    try:
+                        entry_id, note = ingest_inbox_file(db, path, self.inbox_dir, self.attachment_dir)
+                    except (sqlite3.Error, OSError) as e:
+                        print(f"Justificatif '{os.path.basename(path)}' non traité : {e}")
+                        continue
+                    self.events.append((os.path.basename(path), entry_id, note))
+                waiting = any(started is not None for _, started in seen.values())
+                timeout = INBOX_SETTLE_S if waiting else (INBOX_IDLE_WAKE_S if fd is not None else INBOX_POLL_S)
+                if fd is None:
+                    self.stop_event.wait(timeout)
+                    continue
+                if select.select([fd], [], [], timeout)[0]:
+                    try:
+                        while os.read(fd, 4096):
+                            pass  # les événements ne servent qu'à réveiller : le dossier est relu
+                    except BlockingIOError:
+                        pass
+        finally:
+            db.close()
+            if fd is not None:
+                os.close(fd)
 
 # --- APPLICATION PRINCIPALE ---
 class App(ctk.CTk):
@@ -313,9 +4956,24 @@ class App(ctk.CTk):
         os.makedirs(REPORTS_DIR, exist_ok=True)
         os.makedirs(SAVE_DIR, exist_ok=True)
 
-        self.conn = db_connect()
+        self.db = LedgerRepository()
+        self.categories = CategoryTree.load(self.db)
+        self.accounts = self.db.accounts()
+        self.year_cache = YearSnapshotCache(self.db)
+        self.chart_cache = DashboardSeriesCache()
+        self.db.add_write_listener(self.year_cache.invalidate)
+        self.db.add_write_listener(self.chart_cache.invalidate)
+        # Écritures, sauvegardes et rapports passent par le thread de travail ; voir pump_tasks
+        self.tasks = TaskRunner(self.db.db_file, write_listeners=[self.year_cache.invalidate, self.chart_cache.invalidate])
+        self.chart_series = None
+        self.chart_task = None
+        self.busy_shown = False
         self.current_year_id = None
         self.accounting_years = {}
+        # Journaux des comptes : créés à leur première ouverture (voir journal_view)
+        self.journal_views = {}
+        self.stale_journals = set()
+        self.current_view = None
 
         self.grid_columnconfigure(1, weight=1)
         self.grid_rowconfigure(1, weight=1)
@@ -332,26 +4990,77 @@ class App(ctk.CTk):
         self.main_frame.grid_columnconfigure(0, weight=1)
 
         self.dashboard_frame = ctk.CTkFrame(self.main_frame, fg_color="transparent")
-        self.journal_poste_frame = ctk.CTkFrame(self.main_frame, fg_color="transparent")
-        self.journal_caisse_frame = ctk.CTkFrame(self.main_frame, fg_color="transparent")
         self.reports_frame = ctk.CTkFrame(self.main_frame, fg_color="transparent")
         self.years_frame = ctk.CTkFrame(self.main_frame, fg_color="transparent")
         self.budget_frame = ctk.CTkFrame(self.main_frame, fg_color="transparent")
 
+        self.setup_treeview_style()
         self.create_sidebar_buttons()
         self.setup_topbar()
         self.setup_dashboard()
-        self.setup_journal_view(self.journal_poste_frame, "poste")
-        self.setup_journal_view(self.journal_caisse_frame, "caisse")
         self.setup_reports_view()
         self.setup_years_view()
         self.setup_budget_view()
 
+        self.after(TASK_POLL_MS, self.pump_tasks)
         self.update_year_selector()
         self.select_frame_by_name("dashboard")
         
         # Lance la vérification des mises à jour 2 secondes après le démarrage
         self.after(2000, self.check_for_updates)
+
+        # Détection des écritures faites par un autre poste sur la même base
+        self.after(DATA_VERSION_POLL_MS, self.poll_external_changes)
+
+        # API JSON locale optionnelle, servie par ses propres threads (n'utilise pas la boucle Tk)
+        self.api_server = None
+        if os.environ.get(API_ENV_VAR) == "1" or "--api" in sys.argv:
+            try:
+                self.api_server = start_api_server()
+                print(f"API locale disponible sur http://{API_HOST}:{API_PORT}/api/balances")
+            except OSError as e:
+                print(f"Impossible de démarrer l'API locale : {e}")
+
+        # Contrôle d'intégrité rapide en arrière-plan ; le résultat est relevé depuis la boucle Tk
+        self.integrity_result = None
+        threading.Thread(target=self.run_startup_integrity_check, name="aetml-integrity", daemon=True).start()
+        self.after(1000, self.poll_integrity_result)
+
+        # Détection des blocages de l'interface, journalisés avec la pile en cause
+        if os.environ.get(WATCHDOG_ENV_VAR) == "1" or "--watchdog" in sys.argv or PROFILER.enabled:
+            WATCHDOG.start(self)
+
+        # Panneau de diagnostic caché (Ctrl+Maj+D)
+        self.bind_all("<Control-Shift-D>", lambda event: self.open_diagnostics_window())
+
+        # Maintenance de la base quand l'utilisateur est inactif, et à la fermeture
+        self.last_activity = time.monotonic()
+        self.last_maintenance = 0.0
+        self.maintenance_thread = None
+        self.bind_all("<Key>", self.mark_activity, add="+")
+        self.bind_all("<Button>", self.mark_activity, add="+")
+        self.after(MAINTENANCE_CHECK_MS, self.maybe_run_maintenance)
+
+        # Rapports des mois terminés et exercices clôturés préparés en arrière-plan
+        self.report_thread = None
+        self.report_stop = threading.Event()
+        self.last_report_pregen = 0.0
+        self.report_checks = {}  # exercice -> jeton de modification au dernier passage sans rapport à refaire
+        self.after(REPORT_PREGEN_DELAY_MS, self.maybe_pregenerate_reports)
+
+        # Texte des justificatifs indexé en arrière-plan pour la recherche
+        self.index_thread = None
+        self.index_stop = threading.Event()
+        self.last_attachment_index = 0.0
+        self.pending_entry_focus = None
+        self.after(ATTACHMENT_INDEX_DELAY_MS, self.maybe_index_attachments)
+
+        # Justificatifs déposés dans la boîte de réception, traités par leur propre thread
+        self.inbox = InboxWatcher(self.db.db_file)
+        self.inbox.start()
+        self.inbox_window_refresh = None
+        self.after(DATA_VERSION_POLL_MS, self.poll_inbox_events)
+        self.protocol("WM_DELETE_WINDOW", self.on_closing)
     
     #... (toutes les fonctions intermédiaires jusqu'à setup_reports_view)
     def cleanup_old_version(self):
@@ -374,6 +5083,7 @@ class App(ctk.CTk):
         except Exception as e:
             print(f"Impossible de supprimer l'ancienne version : {e}")
 
+    @profiled("check_for_updates")
     def check_for_updates(self):
         """Vérifie sur GitHub si une nouvelle version est disponible."""
         version_url = "https://raw.githubusercontent.com/AE2TML/app-compta-aetml/main/version.txt"
@@ -446,13 +5156,377 @@ class App(ctk.CTk):
         except Exception as e:
             messagebox.showerror("Erreur", f"Une erreur inattendue est survenue : {e}")
 
+    def open_diagnostics_window(self):
+        """Affiche les mesures du profileur (opérations, requêtes lentes, motifs N+1) et les blocages de l'interface."""
+        win = ctk.CTkToplevel(self)
+        win.title("Diagnostics")
+        win.geometry("900x600")
+        win.transient(self)
+
+        textbox = ctk.CTkTextbox(win, font=ctk.CTkFont(family="Courier", size=12), wrap="none")
+        textbox.pack(expand=True, fill="both", padx=10, pady=(10, 0))
+
+        def refresh():
+            textbox.configure(state="normal")
+            textbox.delete("1.0", "end")
+            textbox.insert("1.0", PROFILER.report() + "\n\n" + WATCHDOG.report() + "\n\n" + format_maintenance_history(self.db.maintenance_history()))
+            textbox.configure(state="disabled")
+            toggle_button.configure(text="Désactiver le profilage" if PROFILER.enabled else "Activer le profilage")
+            watchdog_button.configure(text="Arrêter la surveillance" if WATCHDOG.enabled else "Surveiller les blocages")
+
+        def toggle():
+            if PROFILER.enabled:
+                PROFILER.enabled = False
+                self.db.conn.set_trace_callback(None)
+            else:
+                PROFILER.enable()
+                # Reconnexion pour bénéficier des curseurs instrumentés
+                self.db.reconnect()
+            refresh()
+
+        def toggle_watchdog():
+            if WATCHDOG.enabled:
+                WATCHDOG.stop()
+            else:
+                WATCHDOG.start(self)
+            refresh()
+
+        def open_log():
+            if os.path.exists(DIAGNOSTICS_LOG):
+                webbrowser.open(f'file://{os.path.realpath(DIAGNOSTICS_LOG)}')
+            else:
+                messagebox.showinfo("Information", "Aucun journal de diagnostic n'a encore été écrit.", parent=win)
+
+        button_frame = ctk.CTkFrame(win, fg_color="transparent")
+        button_frame.pack(fill="x", padx=10, pady=10)
+        ctk.CTkButton(button_frame, text="Rafraîchir", command=refresh).pack(side="left", padx=5)
+        toggle_button = ctk.CTkButton(button_frame, text="", command=toggle)
+        toggle_button.pack(side="left", padx=5)
+        watchdog_button = ctk.CTkButton(button_frame, text="", command=toggle_watchdog)
+        watchdog_button.pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Ouvrir le journal", command=open_log).pack(side="left", padx=5)
+        refresh()
+
+    def run_startup_integrity_check(self):
+        try:
+            self.integrity_result = check_integrity(quick=True)
+        except Exception as e:
+            self.integrity_result = e
+
+    def poll_integrity_result(self):
+        result = self.integrity_result
+        if result is None:
+            self.after(1000, self.poll_integrity_result)
+            return
+        if isinstance(result, Exception):
+            print(f"Contrôle d'intégrité impossible : {result}")
+            return
+        self.set_integrity_status(result.ok)
+        if not result.ok:
+            if messagebox.askyesno("Contrôle d'intégrité", "Des anomalies ont été détectées dans la base ou les pièces jointes.\n\nAfficher le rapport ?"):
+                self.open_integrity_window(result)
+
+    def set_integrity_status(self, ok):
+        if ok:
+            self.integrity_button.configure(text="Vérifier l'intégrité", border_color=self.integrity_button_border)
+        else:
+            self.integrity_button.configure(text="⚠ Vérifier l'intégrité", border_color="#D32F2F")
+
+    def open_integrity_window(self, report=None):
+        """Rapport du contrôle d'intégrité, avec relance complète et réparation."""
+        win = ctk.CTkToplevel(self)
+        win.title("Contrôle d'intégrité")
+        win.geometry("900x550")
+        win.transient(self)
+
+        textbox = ctk.CTkTextbox(win, font=ctk.CTkFont(family="Courier", size=12), wrap="none")
+        textbox.pack(expand=True, fill="both", padx=10, pady=(10, 0))
+        state = {'report': report}
+
+        def show(text):
+            textbox.configure(state="normal")
+            textbox.delete("1.0", "end")
+            textbox.insert("1.0", text)
+            textbox.configure(state="disabled")
+
+        def run_full_check():
+            self.configure(cursor="watch")
+            self.update_idletasks()
+            try:
+                state['report'] = check_integrity(rehash=True)
+            except (sqlite3.Error, OSError) as e:
+                messagebox.showerror("Erreur", f"Le contrôle a échoué : {e}", parent=win)
+                return
+            finally:
+                self.configure(cursor="")
+            show(state['report'].summary())
+            self.set_integrity_status(state['report'].ok)
+
+        def repair():
+            current = state['report']
+            if current is None or not (current.orphans or current.unreferenced_files):
+                messagebox.showinfo("Information", "Rien à réparer automatiquement.", parent=win)
+                return
+            if not messagebox.askyesno("Confirmation", "Supprimer les lignes orphelines et déplacer les fichiers sans écriture "
+                                       f"dans '{ORPHAN_ATTACHMENT_DIR}' ?\nUne sauvegarde est conseillée avant.", parent=win):
+                return
+            try:
+                actions = repair_integrity(self.db, current)
+            except sqlite3.Error as e:
+                messagebox.showerror("Erreur", f"La réparation a échoué : {e}", parent=win)
+                return
+            self.refresh_all_views()
+            run_full_check()
+            show("\n".join(actions) + "\n\n" + state['report'].summary())
+
+        button_frame = ctk.CTkFrame(win, fg_color="transparent")
+        button_frame.pack(fill="x", padx=10, pady=10)
+        ctk.CTkButton(button_frame, text="Contrôle complet", command=run_full_check).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Réparer", command=repair, fg_color="#D32F2F", hover_color="#B71C1C").pack(side="left", padx=5)
+        if report is None:
+            win.after(100, run_full_check)
+        else:
+            show(report.summary())
+
+    def mark_activity(self, event=None):
+        self.last_activity = time.monotonic()
+
+    def maybe_run_maintenance(self):
+        """Lance la maintenance sur un thread dédié après MAINTENANCE_IDLE_MS sans activité."""
+        now = time.monotonic()
+        idle = (now - self.last_activity) * 1000 >= MAINTENANCE_IDLE_MS
+        due = now - self.last_maintenance >= MAINTENANCE_INTERVAL_S or not self.last_maintenance
+        running = self.maintenance_thread is not None and self.maintenance_thread.is_alive()
+        if idle and due and not running:
+            self.last_maintenance = now
+            self.maintenance_thread = threading.Thread(target=self.run_background_maintenance, name="aetml-maintenance", daemon=True)
+            self.maintenance_thread.start()
+        self.after(MAINTENANCE_CHECK_MS, self.maybe_run_maintenance)
+
+    def run_background_maintenance(self):
+        # Connexion propre au thread : sqlite3 interdit de partager celle de l'interface
+        db = LedgerRepository(self.db.db_file)
+        try:
+            run_maintenance(db)
+        except sqlite3.Error as e:
+            print(f"Maintenance interrompue : {e}")
+        finally:
+            db.close()
+
+    def maybe_pregenerate_reports(self):
+        """Au démarrage puis en inactivité, prépare les rapports manquants ou périmés sur un thread dédié."""
+        running = self.report_thread is not None and self.report_thread.is_alive()
+        if self.report_thread is not None and not running:
+            # Passage terminé : la liste des rapports prêts est relue
+            self.report_thread = None
+            self.refresh_ready_reports()
+        now = time.monotonic()
+        idle = (now - self.last_activity) * 1000 >= REPORT_PREGEN_IDLE_MS
+        due = not self.last_report_pregen or (idle and now - self.last_report_pregen >= REPORT_PREGEN_INTERVAL_S)
+        if due and not running:
+            self.last_report_pregen = now
+            self.report_thread = threading.Thread(target=self.run_report_pregeneration, name="aetml-reports", daemon=True)
+            self.report_thread.start()
+        self.after(MAINTENANCE_CHECK_MS, self.maybe_pregenerate_reports)
+
+    def run_report_pregeneration(self):
+        db = LedgerRepository(self.db.db_file)
+        try:
+            pregenerate_reports(db, stop_event=self.report_stop, checked=self.report_checks)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Pré-génération des rapports interrompue : {e}")
+        finally:
+            db.close()
+
+    def maybe_index_attachments(self):
+        """Relance régulièrement l'indexation des justificatifs nouveaux ou modifiés."""
+        if not self.last_attachment_index or time.monotonic() - self.last_attachment_index >= ATTACHMENT_INDEX_INTERVAL_S:
+            self.start_attachment_indexing()
+        self.after(MAINTENANCE_CHECK_MS, self.maybe_index_attachments)
+
+    def start_attachment_indexing(self):
+        if self.index_thread is not None and self.index_thread.is_alive():
+            return
+        self.last_attachment_index = time.monotonic()
+        self.index_thread = threading.Thread(target=self.run_attachment_indexing, name="aetml-index", daemon=True)
+        self.index_thread.start()
+
+    def run_attachment_indexing(self):
+        db = LedgerRepository(self.db.db_file)
+        try:
+            index_attachments(db, stop_event=self.index_stop)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Indexation des justificatifs interrompue : {e}")
+        finally:
+            db.close()
+
+    def poll_inbox_events(self):
+        """Relève les justificatifs traités par la boîte de réception depuis le dernier passage."""
+        events = []
+        while self.inbox.events:
+            events.append(self.inbox.events.popleft())
+        if events:
+            self.update_inbox_button()
+            if self.inbox_window_refresh is not None:
+                self.inbox_window_refresh()
+        self.after(DATA_VERSION_POLL_MS, self.poll_inbox_events)
+
+    def update_inbox_button(self):
+        try:
+            count = self.db.inbox_pending_count()
+        except sqlite3.Error:
+            return
+        self.inbox_button.configure(text=f"Justificatifs reçus ({count})..." if count else "Justificatifs reçus...")
+
+    def on_closing(self):
+        WATCHDOG.stop()
+        self.report_stop.set()
+        self.index_stop.set()
+        self.inbox.stop()
+        if any(not task.cancellable for task in self.tasks.active):
+            # Les écritures soumises au thread de travail vont au bout avant la fermeture
+            self.busy_label.configure(text="Fin des enregistrements en cours...")
+            self.update_idletasks()
+        self.tasks.shutdown()
+        if self.maintenance_thread is not None and self.maintenance_thread.is_alive():
+            self.maintenance_thread.join(timeout=MAINTENANCE_BUDGET_S)
+        try:
+            # Checkpoint complet : le fichier .db reste autonome (copie, sauvegarde manuelle)
+            run_maintenance(self.db, MAINTENANCE_EXIT_BUDGET_S, trigger="fermeture",
+                            checkpoint_mode="TRUNCATE", allow_full_vacuum=False)
+        except sqlite3.Error as e:
+            print(f"Maintenance à la fermeture impossible : {e}")
+        if self.api_server is not None:
+            self.api_server.shutdown()
+        self.db.close()
+        self.destroy()
+
+    def open_sync_window(self):
+        """Échange de paquets de modifications avec un autre poste (export, import, conflits)."""
+        win = ctk.CTkToplevel(self)
+        win.title("Synchronisation entre postes")
+        win.geometry("900x550")
+        win.transient(self)
+
+        info_label = ctk.CTkLabel(win, text="", justify="left", anchor="w")
+        info_label.pack(fill="x", padx=10, pady=(10, 5))
+
+        action_frame = ctk.CTkFrame(win, fg_color="transparent")
+        action_frame.pack(fill="x", padx=10, pady=5)
+        full_var = ctk.BooleanVar(value=False)
+
+        ctk.CTkLabel(win, text="Conflits (écriture modifiée sur les deux postes)", font=ctk.CTkFont(weight="bold")).pack(anchor="w", padx=10, pady=(10, 0))
+        conflicts_tree = ttk.Treeview(win, columns=("Type", "Reçu le", "Version locale", "Version reçue"), show="headings", height=8)
+        for col, width in (("Type", 110), ("Reçu le", 140), ("Version locale", 300), ("Version reçue", 300)):
+            conflicts_tree.heading(col, text=col)
+            conflicts_tree.column(col, width=width)
+        conflicts_tree.pack(expand=True, fill="both", padx=10, pady=5)
+        conflicts = {}
+
+        def describe(table, payload):
+            if payload is None:
+                return "(supprimée)"
+            if table == 'entries':
+                return f"{payload['date']} {payload['libelle']} {payload['amount']:.2f}"
+            if table == 'budgets':
+                return f"Budget {payload['category']} : {payload['amount']:.2f}"
+            if table == 'accounts':
+                return f"Compte {payload['name']} ({payload['code']})"
+            if table == 'account_balances':
+                return f"Solde initial {payload['account']} : {payload['opening_balance']:.2f}"
+            return f"Exercice {payload['name']}"
+
+        def refresh():
+            site = self.db.site_id()
+            lines = [f"Cette installation : {site[:8]}"]
+            for peer in self.db.sync_peers():
+                lines.append(f"Poste {peer['site_id'][:8]} : dernière synchronisation le {peer['last_sync_at']}")
+            if len(lines) == 1:
+                lines.append("Aucun autre poste connu : le premier export sera complet.")
+            info_label.configure(text="\n".join(lines))
+            conflicts_tree.delete(*conflicts_tree.get_children())
+            conflicts.clear()
+            labels = {'entries': "Écriture", 'budgets': "Budget", 'accounting_years': "Exercice",
+                      'accounts': "Compte", 'account_balances': "Solde initial"}
+            for conflict in self.db.sync_conflicts():
+                table = conflict['table_name']
+                local = _sync_state(self.db, table, conflict['row_uid'], ATTACHMENT_DIR)[0]
+                remote = json.loads(conflict['remote_payload'])
+                conflicts[str(conflict['id'])] = conflict
+                conflicts_tree.insert("", "end", iid=str(conflict['id']), values=(
+                    labels.get(table, table), conflict['received_at'], describe(table, local), describe(table, remote)))
+
+        def export_package():
+            default_name = f"aetml_{self.db.site_id()[:8]}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{SYNC_PACKAGE_EXT}"
+            dest_path = filedialog.asksaveasfilename(parent=win, title="Enregistrer le paquet de synchronisation", initialfile=default_name,
+                                                     defaultextension=SYNC_PACKAGE_EXT, filetypes=[("Paquet AETML", f"*{SYNC_PACKAGE_EXT}")])
+            if not dest_path:
+                return
+            try:
+                result = export_sync_package(self.db, dest_path, full=full_var.get())
+            except (sqlite3.Error, OSError) as e:
+                messagebox.showerror("Erreur", f"L'export a échoué : {e}", parent=win)
+                return
+            messagebox.showinfo("Export terminé", f"{result['records']} modification(s) et {result['files']} pièce(s) jointe(s) exportées "
+                                f"({result['size'] / 1024:.0f} Ko).", parent=win)
+
+        def import_package():
+            package_path = filedialog.askopenfilename(parent=win, title="Importer un paquet de synchronisation",
+                                                      filetypes=[("Paquet AETML", f"*{SYNC_PACKAGE_EXT}")])
+            if not package_path:
+                return
+            try:
+                result = import_sync_package(self.db, package_path)
+            except SyncError as e:
+                messagebox.showerror("Import impossible", str(e), parent=win)
+                return
+            except (sqlite3.Error, OSError) as e:
+                messagebox.showerror("Erreur", f"L'import a échoué : {e}", parent=win)
+                return
+            self.year_cache.invalidate()
+            self.chart_cache.invalidate()
+            self.refresh_years_view()
+            self.update_year_selector(keep_selection=True)
+            refresh()
+            if result['already']:
+                messagebox.showinfo("Import", "Ce paquet avait déjà été importé.", parent=win)
+            else:
+                messagebox.showinfo("Import terminé", f"{result['applied']} modification(s) appliquée(s), {result['unchanged']} inchangée(s), "
+                                    f"{result['conflicts']} conflit(s), {result['skipped']} ignorée(s), {result['files']} pièce(s) jointe(s) reçue(s).", parent=win)
+
+        def resolve(keep_local):
+            selection = conflicts_tree.selection()
+            if not selection:
+                messagebox.showwarning("Sélection requise", "Veuillez sélectionner un conflit.", parent=win)
+                return
+            try:
+                for iid in selection:
+                    resolve_sync_conflict(self.db, conflicts[iid], keep_local)
+            except (SyncError, sqlite3.Error) as e:
+                messagebox.showerror("Erreur", str(e), parent=win)
+            self.year_cache.invalidate()
+            self.chart_cache.invalidate()
+            self.refresh_all_views()
+            refresh()
+
+        ctk.CTkButton(action_frame, text="Exporter les modifications...", command=export_package).pack(side="left", padx=5)
+        ctk.CTkCheckBox(action_frame, text="Export complet", variable=full_var).pack(side="left", padx=5)
+        ctk.CTkButton(action_frame, text="Importer un paquet...", command=import_package).pack(side="left", padx=20)
+
+        resolve_frame = ctk.CTkFrame(win, fg_color="transparent")
+        resolve_frame.pack(fill="x", padx=10, pady=(0, 10))
+        ctk.CTkButton(resolve_frame, text="Garder la version locale", command=lambda: resolve(True)).pack(side="left", padx=5)
+        ctk.CTkButton(resolve_frame, text="Prendre la version reçue", command=lambda: resolve(False)).pack(side="left", padx=5)
+        refresh()
+
     def create_sidebar_buttons(self):
         self.dashboard_button = ctk.CTkButton(self.sidebar_frame, text="Tableau de Bord", command=self.dashboard_frame_event)
         self.dashboard_button.grid(row=1, column=0, padx=20, pady=10)
-        self.journal_poste_button = ctk.CTkButton(self.sidebar_frame, text="Journal de Poste", command=self.journal_poste_frame_event)
-        self.journal_poste_button.grid(row=2, column=0, padx=20, pady=10)
-        self.journal_caisse_button = ctk.CTkButton(self.sidebar_frame, text="Journal de Caisse", command=self.journal_caisse_frame_event)
-        self.journal_caisse_button.grid(row=3, column=0, padx=20, pady=10)
+        # Un bouton par compte (voir build_account_buttons)
+        self.accounts_nav_frame = ctk.CTkFrame(self.sidebar_frame, fg_color="transparent")
+        self.accounts_nav_frame.grid(row=2, column=0, rowspan=2)
+        self.account_buttons = {}
+        self.build_account_buttons()
         self.reports_button = ctk.CTkButton(self.sidebar_frame, text="Rapports", command=self.reports_frame_event)
         self.reports_button.grid(row=4, column=0, padx=20, pady=10)
         self.budget_button = ctk.CTkButton(self.sidebar_frame, text="Budget", command=self.budget_frame_event)
@@ -463,6 +5537,12 @@ class App(ctk.CTk):
         self.save_button.grid(row=7, column=0, padx=20, pady=10)
         self.load_button = ctk.CTkButton(self.sidebar_frame, text="Charger une sauvegarde", command=self.restore_database)
         self.load_button.grid(row=8, column=0, padx=20, pady=10)
+        self.integrity_button = ctk.CTkButton(self.sidebar_frame, text="Vérifier l'intégrité", command=self.open_integrity_window,
+                                              fg_color="transparent", border_width=1)
+        self.integrity_button.grid(row=10, column=0, padx=20, pady=(10, 20))
+        self.integrity_button_border = self.integrity_button.cget("border_color")
+        self.sync_button = ctk.CTkButton(self.sidebar_frame, text="Synchroniser...", command=self.open_sync_window)
+        self.sync_button.grid(row=11, column=0, padx=20, pady=(0, 20))
 
     def setup_topbar(self):
         self.topbar_frame = ctk.CTkFrame(self, height=50, corner_radius=0, fg_color="transparent")
@@ -471,19 +5551,55 @@ class App(ctk.CTk):
         self.year_selector_var = ctk.StringVar(value="Aucun exercice sélectionné")
         self.year_selector = ctk.CTkOptionMenu(self.topbar_frame, variable=self.year_selector_var, command=self.on_year_selected)
         self.year_selector.pack(side="left", padx=10)
+
+        # Indicateur des tâches d'arrière-plan (affiché seulement pendant qu'elles tournent)
+        self.cancel_tasks_button = ctk.CTkButton(self.topbar_frame, text="Annuler", width=80, command=self.tasks.cancel_all)
+        self.busy_bar = ctk.CTkProgressBar(self.topbar_frame, mode="indeterminate", width=120)
+        self.busy_label = ctk.CTkLabel(self.topbar_frame, text="")
+        self.busy_label.pack(side="right", padx=10)
+
+    def pump_tasks(self):
+        self.tasks.pump()
+        self.update_busy_indicator()
+        self.after(TASK_POLL_MS, self.pump_tasks)
+
+    def update_busy_indicator(self):
+        active = self.tasks.active
+        if not active:
+            if self.busy_shown:
+                self.busy_bar.stop()
+                self.busy_bar.pack_forget()
+                self.cancel_tasks_button.pack_forget()
+                self.busy_label.configure(text="")
+                self.configure(cursor="")
+                self.busy_shown = False
+            return
+        self.busy_label.configure(text=active[0].label + (f" (+{len(active) - 1})" if len(active) > 1 else ""))
+        if not self.busy_shown:
+            self.busy_bar.pack(side="right", padx=5)
+            self.busy_bar.start()
+            self.configure(cursor="watch")
+            self.busy_shown = True
+        if any(task.cancellable for task in active):
+            if not self.cancel_tasks_button.winfo_ismapped():
+                self.cancel_tasks_button.pack(side="right", padx=5)
+        else:
+            self.cancel_tasks_button.pack_forget()
+
+    def after_db_write(self):
+        """Après une écriture du thread de travail, que la connexion de l'interface voit comme externe."""
+        # Le thread de travail a déjà invalidé les exercices touchés : pas de rechargement complet
+        self.db.has_external_changes()
+        self.refresh_current_year()
         
     def setup_dashboard(self):
         self.dashboard_frame.grid_columnconfigure((0, 1), weight=1)
-        self.solde_poste_card = ctk.CTkFrame(self.dashboard_frame)
-        self.solde_poste_card.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
-        ctk.CTkLabel(self.solde_poste_card, text="Solde Compte Postal (Exercice)", font=ctk.CTkFont(size=16, weight="bold")).pack(pady=(10,0))
-        self.solde_poste_label = ctk.CTkLabel(self.solde_poste_card, text="0.00 CHF", font=ctk.CTkFont(size=24))
-        self.solde_poste_label.pack(pady=10, padx=20)
-        self.solde_caisse_card = ctk.CTkFrame(self.dashboard_frame)
-        self.solde_caisse_card.grid(row=0, column=1, padx=10, pady=10, sticky="nsew")
-        ctk.CTkLabel(self.solde_caisse_card, text="Solde Caisse (Exercice)", font=ctk.CTkFont(size=16, weight="bold")).pack(pady=(10,0))
-        self.solde_caisse_label = ctk.CTkLabel(self.solde_caisse_card, text="0.00 CHF", font=ctk.CTkFont(size=24))
-        self.solde_caisse_label.pack(pady=10, padx=20)
+        # Une carte de solde par compte (voir update_account_cards)
+        self.account_cards_frame = ctk.CTkFrame(self.dashboard_frame, fg_color="transparent")
+        self.account_cards_frame.grid(row=0, column=0, columnspan=2, sticky="nsew")
+        self.account_cards_frame.grid_columnconfigure((0, 1, 2), weight=1)
+        self.account_cards_key = None
+        self.account_balance_labels = {}
         self.resultat_card = ctk.CTkFrame(self.dashboard_frame)
         self.resultat_card.grid(row=1, column=0, columnspan=2, padx=10, pady=10, sticky="nsew")
         self.resultat_card.grid_columnconfigure((0,1), weight=1)
@@ -497,13 +5613,44 @@ class App(ctk.CTk):
         ctk.CTkLabel(self.resultat_card, text="Bénéfice / Perte", font=ctk.CTkFont(weight="bold")).grid(row=3, column=0, columnspan=2, pady=(10,0))
         self.benefice_label = ctk.CTkLabel(self.resultat_card, text="0.00 CHF", font=ctk.CTkFont(size=22, weight="bold"))
         self.benefice_label.grid(row=4, column=0, columnspan=2, pady=(0,10))
-
-    def setup_journal_view(self, frame, journal_type):
-        frame.grid_rowconfigure(1, weight=1)
-        frame.grid_columnconfigure(0, weight=1)
-        title = "Journal de Poste" if journal_type == "poste" else "Journal de Caisse"
-        ctk.CTkLabel(frame, text=title, font=ctk.CTkFont(size=22, weight="bold")).grid(row=0, column=0, sticky="w", pady=(0,10))
-
+        attachment_buttons = ctk.CTkFrame(self.dashboard_frame, fg_color="transparent")
+        attachment_buttons.grid(row=2, column=0, padx=10, pady=10, sticky="w")
+        ctk.CTkButton(attachment_buttons, text="Rechercher dans les justificatifs...", command=self.open_attachment_search_window).pack(side="left")
+        self.inbox_button = ctk.CTkButton(attachment_buttons, text="Justificatifs reçus...", command=self.open_inbox_window)
+        self.inbox_button.pack(side="left", padx=10)
+        self.update_inbox_button()
+        ctk.CTkButton(self.dashboard_frame, text="Comptes...", command=self.open_accounts_window).grid(row=2, column=1, padx=10, pady=10, sticky="e")
+        # Courbes mensuelles dessinées directement sur des canevas (voir draw_dashboard_charts)
+        self.dashboard_frame.grid_rowconfigure(4, weight=1)
+        self.chart_range_var = ctk.StringVar(value=next(iter(DASHBOARD_CHART_RANGES)))
+        ctk.CTkSegmentedButton(self.dashboard_frame, values=list(DASHBOARD_CHART_RANGES), variable=self.chart_range_var,
+                               command=lambda value: self.update_dashboard_charts()).grid(row=3, column=0, columnspan=2, padx=10, sticky="w")
+        self.balance_chart = ctk.CTkCanvas(self.dashboard_frame, height=DASHBOARD_CHART_HEIGHT, background="#2b2b2b", highlightthickness=0)
+        self.balance_chart.grid(row=4, column=0, padx=10, pady=10, sticky="nsew")
+        self.flow_chart = ctk.CTkCanvas(self.dashboard_frame, height=DASHBOARD_CHART_HEIGHT, background="#2b2b2b", highlightthickness=0)
+        self.flow_chart.grid(row=4, column=1, padx=10, pady=10, sticky="nsew")
+        for canvas in (self.balance_chart, self.flow_chart):
+            canvas.bind("<Configure>", lambda event: self.draw_dashboard_charts())
+
+    def update_account_cards(self, accounts):
+        """Une carte par compte ; les cartes ne sont recréées que si la liste des comptes a changé."""
+        key = [(account['code'], account['name']) for account in accounts]
+        if key != self.account_cards_key:
+            for widget in self.account_cards_frame.winfo_children():
+                widget.destroy()
+            self.account_balance_labels = {}
+            for index, account in enumerate(accounts):
+                card = ctk.CTkFrame(self.account_cards_frame)
+                card.grid(row=index // 3, column=index % 3, padx=10, pady=10, sticky="nsew")
+                ctk.CTkLabel(card, text=f"Solde {account['name']} (Exercice)", font=ctk.CTkFont(size=16, weight="bold")).pack(pady=(10,0))
+                label = ctk.CTkLabel(card, text="0.00 CHF", font=ctk.CTkFont(size=24))
+                label.pack(pady=10, padx=20)
+                self.account_balance_labels[account['code']] = label
+            self.account_cards_key = key
+        for account in accounts:
+            self.account_balance_labels[account['code']].configure(text=f"{account['balance']:.2f} CHF")
+
+    def setup_treeview_style(self):
         style = ttk.Style()
         style.theme_use("default")
         style.configure("Treeview", background="#2b2b2b", foreground="white", fieldbackground="#2b2b2b", borderwidth=0)
@@ -511,6 +5658,26 @@ class App(ctk.CTk):
         style.configure("Treeview.Heading", background="#565b5e", foreground="white", font=('Calibri', 10, 'bold'))
         style.configure("initial.Treeview", background="#333", foreground="cyan")
 
+    def account_named(self, code):
+        return next((account for account in self.accounts if account['code'] == code), None)
+
+    def journal_view(self, journal_type):
+        """Widgets du journal d'un compte, créés à sa première ouverture."""
+        view = self.journal_views.get(journal_type)
+        if view is None:
+            frame = ctk.CTkFrame(self.main_frame, fg_color="transparent")
+            view = self.journal_views[journal_type] = self.setup_journal_view(frame, journal_type)
+            self.stale_journals.add(journal_type)
+        return view
+
+    def setup_journal_view(self, frame, journal_type):
+        frame.grid_rowconfigure(1, weight=1)
+        frame.grid_columnconfigure(0, weight=1)
+        account = self.account_named(journal_type)
+        view = {'frame': frame}
+        view['title_label'] = ctk.CTkLabel(frame, text=f"Journal de {account['name']}", font=ctk.CTkFont(size=22, weight="bold"))
+        view['title_label'].grid(row=0, column=0, sticky="w", pady=(0,10))
+
         tree = ttk.Treeview(frame, columns=("ID", "Date", "Libellé", "Catégorie", "Débit", "Crédit", "Solde", "Pièce"), show="headings")
         headings = {"ID": 40, "Date": 100, "Libellé": 250, "Catégorie": 150, "Débit": 100, "Crédit": 100, "Solde": 100, "Pièce": 50}
         for col, width in headings.items():
@@ -518,7 +5685,7 @@ class App(ctk.CTk):
             tree.column(col, width=width, anchor="center")
 
         tree.grid(row=1, column=0, sticky="nsew")
-        setattr(self, f"{journal_type}_tree", tree)
+        view['tree'] = tree
         tree.bind("<<TreeviewSelect>>", lambda event, jt=journal_type: self.on_journal_select(event, jt))
         
         # Configuration du tag pour la ligne de solde initial
@@ -530,40 +5697,62 @@ class App(ctk.CTk):
 
         total_credit_label = ctk.CTkLabel(totals_frame, text="Total Crédit: 0.00", font=ctk.CTkFont(weight="bold"))
         total_credit_label.grid(row=0, column=5, sticky="e")
-        setattr(self, f"{journal_type}_total_credit_label", total_credit_label)
+        view['total_credit_label'] = total_credit_label
 
         total_debit_label = ctk.CTkLabel(totals_frame, text="Total Débit: 0.00", font=ctk.CTkFont(weight="bold"))
         total_debit_label.grid(row=0, column=4, sticky="e")
-        setattr(self, f"{journal_type}_total_debit_label", total_debit_label)
+        view['total_debit_label'] = total_debit_label
 
         solde_final_label = ctk.CTkLabel(totals_frame, text="Solde Final: 0.00", font=ctk.CTkFont(weight="bold"))
         solde_final_label.grid(row=0, column=6, sticky="e")
-        setattr(self, f"{journal_type}_solde_final_label", solde_final_label)
+        view['solde_final_label'] = solde_final_label
 
         button_frame = ctk.CTkFrame(frame, fg_color="transparent")
         button_frame.grid(row=3, column=0, pady=10, sticky="e")
 
         view_attachment_button = ctk.CTkButton(button_frame, text="Voir Pièce/Détail", state="disabled", command=lambda: self.view_attachment(journal_type))
         view_attachment_button.pack(side="left", padx=5)
-        setattr(self, f"{journal_type}_view_attachment_button", view_attachment_button)
+        view['view_attachment_button'] = view_attachment_button
 
         ctk.CTkButton(button_frame, text="Ajouter Écriture", command=lambda: self.open_entry_window(journal_type, edit_mode=False)).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Saisie en lot...", command=lambda: self.open_batch_entry_window(journal_type)).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Doublons...", command=self.open_duplicates_window).pack(side="left", padx=5)
         edit_button = ctk.CTkButton(button_frame, text="Modifier Écriture", state="disabled", command=lambda: self.open_entry_window(journal_type, edit_mode=True))
         edit_button.pack(side="left", padx=5)
-        setattr(self, f"{journal_type}_edit_button", edit_button)
+        view['edit_button'] = edit_button
         delete_button = ctk.CTkButton(button_frame, text="Supprimer Écriture", state="disabled", command=lambda: self.delete_entry(journal_type))
         delete_button.pack(side="left", padx=5)
-        setattr(self, f"{journal_type}_delete_button", delete_button)
+        view['delete_button'] = delete_button
+
+        # Le détail de la monnaie et le comptage concernent la caisse principale
+        if journal_type == 'caisse':
+            ctk.CTkButton(button_frame, text="Comptage de caisse...", command=self.open_cash_count_window).pack(side="left", padx=5)
+        elif account['kind'] == 'banque':
+            ctk.CTkButton(button_frame, text="Rapprochement bancaire...", command=lambda: self.open_reconciliation_window(journal_type)).pack(side="left", padx=5)
+        return view
 
     def setup_reports_view(self):
         self.reports_frame.grid_columnconfigure(0, weight=1)
         ctk.CTkLabel(self.reports_frame, text="Génération de Rapports", font=ctk.CTkFont(size=22, weight="bold")).pack(pady=(0,20))
-        ctk.CTkButton(self.reports_frame, text="Générer Journal de Caisse (PDF)", command=lambda: self.generate_report('caisse')).pack(pady=10, padx=20)
-        ctk.CTkButton(self.reports_frame, text="Générer Journal de Poste (PDF)", command=lambda: self.generate_report('poste')).pack(pady=10, padx=20)
+        journal_frame = ctk.CTkFrame(self.reports_frame, fg_color="transparent")
+        journal_frame.pack(pady=10, padx=20)
+        self.journal_report_var = ctk.StringVar(value=self.accounts[0]['name'] if self.accounts else "")
+        self.journal_report_menu = ctk.CTkOptionMenu(journal_frame, variable=self.journal_report_var, values=[a['name'] for a in self.accounts])
+        self.journal_report_menu.pack(side="left", padx=5)
+        ctk.CTkButton(journal_frame, text="Générer Journal (PDF)", command=self.generate_journal_report).pack(side="left", padx=5)
         ctk.CTkButton(self.reports_frame, text="Générer Compte de Résultat (PDF)", command=lambda: self.generate_report('resultat')).pack(pady=10, padx=20)
         ctk.CTkButton(self.reports_frame, text="Générer Rapport de Budget Annuel (PDF)", command=lambda: self.generate_report('budget')).pack(pady=10, padx=20)
         ### MODIFIÉ ###
         ctk.CTkButton(self.reports_frame, text="Générer Résumé Budgétaire Mensuel (PDF)", command=self.prompt_for_monthly_report).pack(pady=10, padx=20)
+
+        # Rapports des mois terminés et de l'exercice clôturé, préparés en arrière-plan
+        ctk.CTkLabel(self.reports_frame, text="Rapports prêts (double-clic pour ouvrir)", font=ctk.CTkFont(weight="bold")).pack(pady=(20, 5))
+        self.ready_reports_tree = ttk.Treeview(self.reports_frame, columns=("Rapport", "Période", "Généré le"), show="headings", height=10)
+        for col, width in (("Rapport", 220), ("Période", 120), ("Généré le", 160)):
+            self.ready_reports_tree.heading(col, text=col)
+            self.ready_reports_tree.column(col, width=width)
+        self.ready_reports_tree.pack(expand=True, fill="both", padx=20, pady=5)
+        self.ready_reports_tree.bind("<Double-1>", self.open_ready_report)
     
     # ... (toutes les fonctions jusqu'à generate_report)
     def setup_years_view(self):
@@ -589,30 +5778,31 @@ class App(ctk.CTk):
         self.end_date_entry = ctk.CTkEntry(form_frame, placeholder_text="Date de fin")
         self.end_date_entry.grid(row=0, column=5, padx=2, pady=5, sticky="ew")
         
-        # Ligne 2: Soldes Initiaux
-        ctk.CTkLabel(form_frame, text="Solde Initial Poste").grid(row=1, column=0, padx=(10,2), pady=5, sticky="w")
-        self.initial_poste_entry = ctk.CTkEntry(form_frame, placeholder_text="0.00")
-        self.initial_poste_entry.grid(row=1, column=1, padx=2, pady=5, sticky="ew")
-        
-        ctk.CTkLabel(form_frame, text="Solde Initial Caisse").grid(row=1, column=2, padx=(10,2), pady=5, sticky="w")
-        self.initial_caisse_entry = ctk.CTkEntry(form_frame, placeholder_text="0.00")
-        self.initial_caisse_entry.grid(row=1, column=3, padx=2, pady=5, sticky="ew")
+        # Ligne 2: Soldes Initiaux (un champ par compte)
+        self.opening_balances_frame = ctk.CTkFrame(form_frame, fg_color="transparent")
+        self.opening_balances_frame.grid(row=1, column=0, columnspan=6, sticky="ew")
+        self.opening_balance_entries = {}
+        self.build_opening_balance_form()
 
         # Boutons
         button_frame = ctk.CTkFrame(self.years_frame, fg_color="transparent")
         button_frame.grid(row=1, column=0, columnspan=2, sticky="e", pady=5, padx=10)
         ctk.CTkButton(button_frame, text="Ajouter Exercice", command=self.add_year).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Soldes initiaux...", command=self.edit_opening_balances).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Archiver", command=self.archive_selected_year).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Désarchiver", command=self.unarchive_selected_year).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Dossier de clôture...", command=self.export_selected_year_dossier).pack(side="left", padx=5)
         delete_button = ctk.CTkButton(button_frame, text="Supprimer Exercice", command=self.delete_year, fg_color="#D32F2F", hover_color="#B71C1C")
         delete_button.pack(side="left", padx=5)
 
         # Treeview
-        self.years_tree = ttk.Treeview(self.years_frame, columns=("ID", "Nom", "Début", "Fin", "Solde Poste", "Solde Caisse"), show="headings")
+        self.years_tree = ttk.Treeview(self.years_frame, columns=("ID", "Nom", "Début", "Fin", "Soldes", "Statut"), show="headings")
         self.years_tree.heading("ID", text="ID"); self.years_tree.column("ID", width=50)
         self.years_tree.heading("Nom", text="Nom"); self.years_tree.column("Nom", width=200)
         self.years_tree.heading("Début", text="Date de début"); self.years_tree.column("Début", width=120)
         self.years_tree.heading("Fin", text="Date de fin"); self.years_tree.column("Fin", width=120)
-        self.years_tree.heading("Solde Poste", text="Solde Init. Poste"); self.years_tree.column("Solde Poste", width=120, anchor="e")
-        self.years_tree.heading("Solde Caisse", text="Solde Init. Caisse"); self.years_tree.column("Solde Caisse", width=120, anchor="e")
+        self.years_tree.heading("Soldes", text="Soldes initiaux"); self.years_tree.column("Soldes", width=300)
+        self.years_tree.heading("Statut", text="Statut"); self.years_tree.column("Statut", width=90)
         self.years_tree.grid(row=2, column=0, sticky="nsew", padx=10, pady=10)
         self.refresh_years_view()
 
@@ -624,42 +5814,542 @@ class App(ctk.CTk):
         self.tabview.grid(row=0, column=0, sticky="nsew")
         self.tabview.add("Créer / Modifier le Budget Annuel")
         self.tabview.add("Suivi du Budget Annuel")
+        self.tabview.add("Catégories")
+
+        self.budget_edit_frame = ctk.CTkScrollableFrame(self.tabview.tab("Créer / Modifier le Budget Annuel"))
+        self.budget_edit_frame.pack(expand=True, fill="both")
+        self.budget_entries = {}
+        self.build_budget_editor()
+
+        self.budget_view_frame = ctk.CTkFrame(self.tabview.tab("Suivi du Budget Annuel"))
+        self.budget_view_frame.pack(expand=True, fill="both")
+
+        categories_tab = self.tabview.tab("Catégories")
+        self.categories_tree = ttk.Treeview(categories_tab, columns=("Type",), show="tree headings")
+        self.categories_tree.heading("#0", text="Catégorie")
+        self.categories_tree.heading("Type", text="Type")
+        self.categories_tree.column("#0", width=350)
+        self.categories_tree.column("Type", width=100, anchor="center")
+        self.categories_tree.pack(expand=True, fill="both", padx=10, pady=10)
+        button_frame = ctk.CTkFrame(categories_tab, fg_color="transparent")
+        button_frame.pack(pady=(0, 10))
+        ctk.CTkButton(button_frame, text="Nouvelle catégorie", command=lambda: self.add_category(as_child=False)).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Nouvelle sous-catégorie", command=lambda: self.add_category(as_child=True)).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Renommer", command=self.rename_category).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Déplacer", command=self.move_category).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Supprimer", command=self.delete_category, fg_color="#D32F2F", hover_color="#B71C1C").pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Classement automatique...", command=self.open_auto_categorize_window).pack(side="left", padx=5)
+        self.refresh_categories_tree()
+
+    def build_budget_editor(self):
+        """(Re)construit la grille de saisie du budget à partir de l'arborescence des catégories."""
+        for widget in self.budget_edit_frame.winfo_children():
+            widget.destroy()
+        self.budget_entries = {}
+        row = 0
+        for type_op, title in (("recette", "Revenus"), ("depense", "Dépenses")):
+            ctk.CTkLabel(self.budget_edit_frame, text=title, font=ctk.CTkFont(size=16, weight="bold")).grid(row=row, column=0, columnspan=2, pady=10, sticky="w")
+            row += 1
+            for category in self.categories.of_type(type_op):
+                label = ctk.CTkLabel(self.budget_edit_frame, text=category_label(category))
+                label.grid(row=row, column=0, padx=10, pady=5, sticky="w")
+                entry = ctk.CTkEntry(self.budget_edit_frame, placeholder_text="0.00")
+                entry.grid(row=row, column=1, padx=10, pady=5, sticky="ew")
+                self.budget_entries[category['name']] = entry
+                row += 1
+
+        save_button = ctk.CTkButton(self.budget_edit_frame, text="Sauvegarder le Budget", command=self.save_budget)
+        save_button.grid(row=row, column=0, columnspan=2, pady=20)
+
+    # --- Gestion des comptes ---
+    def build_account_buttons(self):
+        for widget in self.accounts_nav_frame.winfo_children():
+            widget.destroy()
+        self.account_buttons = {}
+        for account in self.accounts:
+            button = ctk.CTkButton(self.accounts_nav_frame, text=f"Journal de {account['name']}",
+                                   command=lambda code=account['code']: self.select_frame_by_name(code))
+            button.pack(padx=20, pady=10)
+            self.account_buttons[account['code']] = button
+
+    def build_opening_balance_form(self):
+        for widget in self.opening_balances_frame.winfo_children():
+            widget.destroy()
+        self.opening_balance_entries = {}
+        for index, account in enumerate(self.accounts):
+            row, column = divmod(index, 3)
+            ctk.CTkLabel(self.opening_balances_frame, text=f"Solde Initial {account['name']}").grid(row=row, column=2 * column, padx=(10,2), pady=5, sticky="w")
+            entry = ctk.CTkEntry(self.opening_balances_frame, placeholder_text="0.00")
+            entry.grid(row=row, column=2 * column + 1, padx=2, pady=5, sticky="ew")
+            self.opening_balance_entries[account['code']] = entry
+
+    def refresh_accounts(self):
+        """Relit les comptes (un compte peut arriver avec des écritures synchronisées) et met à jour les vues qui en dépendent."""
+        accounts = self.db.accounts()
+        if [tuple(row) for row in accounts] == [tuple(row) for row in self.accounts]:
+            return
+        self.accounts = accounts
+        self.build_account_buttons()
+        self.build_opening_balance_form()
+        names = [account['name'] for account in accounts]
+        self.journal_report_menu.configure(values=names)
+        if self.journal_report_var.get() not in names:
+            self.journal_report_var.set(names[0] if names else "")
+        for journal_type, view in list(self.journal_views.items()):
+            account = self.account_named(journal_type)
+            if account is None:
+                view['frame'].destroy()
+                del self.journal_views[journal_type]
+                self.stale_journals.discard(journal_type)
+            else:
+                view['title_label'].configure(text=f"Journal de {account['name']}")
+        if self.current_view in self.account_buttons or self.current_view in ("dashboard", "reports", "years", "budget"):
+            self.select_frame_by_name(self.current_view)
+        else:
+            self.select_frame_by_name("dashboard")
+        self.refresh_years_view()
+
+    def open_accounts_window(self):
+        """Liste des comptes : ajout, changement de nom et suppression d'un compte sans écriture."""
+        win = ctk.CTkToplevel(self)
+        win.title("Comptes")
+        win.geometry("600x400")
+        win.transient(self)
+        tree = ttk.Treeview(win, columns=("Nom", "Code", "Nature"), show="headings", height=8)
+        for col, width in (("Nom", 250), ("Code", 150), ("Nature", 100)):
+            tree.heading(col, text=col)
+            tree.column(col, width=width)
+        tree.pack(expand=True, fill="both", padx=10, pady=10)
+
+        def refresh(changed=True):
+            if changed:
+                self.refresh_current_year()   # relit les comptes et les soldes du tableau de bord
+            self.refresh_accounts()
+            tree.delete(*tree.get_children())
+            for account in self.accounts:
+                tree.insert("", "end", iid=str(account['id']), values=(account['name'], account['code'],
+                                                                       "Caisse" if account['kind'] == 'caisse' else "Banque"))
+
+        def selected():
+            if not tree.focus():
+                messagebox.showwarning("Sélection requise", "Veuillez sélectionner un compte.", parent=win)
+                return None
+            return int(tree.focus())
+
+        form = ctk.CTkFrame(win, fg_color="transparent")
+        form.pack(fill="x", padx=10)
+        name_entry = ctk.CTkEntry(form, placeholder_text="Nom du compte (ex : Compte épargne)")
+        name_entry.pack(side="left", expand=True, fill="x", padx=5)
+        kind_var = ctk.StringVar(value="Banque")
+        ctk.CTkOptionMenu(form, variable=kind_var, values=["Banque", "Caisse"], width=100).pack(side="left", padx=5)
+
+        def add():
+            name = name_entry.get().strip()
+            if not name:
+                messagebox.showerror("Erreur", "Le nom du compte est requis.", parent=win)
+                return
+            try:
+                self.db.add_account(name, 'caisse' if kind_var.get() == "Caisse" else 'banque')
+            except ValueError as e:
+                messagebox.showerror("Erreur", str(e), parent=win)
+                return
+            name_entry.delete(0, 'end')
+            refresh()
+
+        def rename():
+            account_id = selected()
+            if account_id is None:
+                return
+            name = (ctk.CTkInputDialog(title="Renommer le compte", text="Nouveau nom :").get_input() or "").strip()
+            if not name:
+                return
+            try:
+                self.db.rename_account(account_id, name)
+            except ValueError as e:
+                messagebox.showerror("Erreur", str(e), parent=win)
+                return
+            refresh()
+
+        def delete():
+            account_id = selected()
+            if account_id is None or not messagebox.askyesno("Supprimer le compte", "Supprimer ce compte ?", parent=win):
+                return
+            try:
+                self.db.delete_account(account_id)
+            except ValueError as e:
+                messagebox.showerror("Suppression impossible", str(e), parent=win)
+                return
+            refresh()
+
+        ctk.CTkButton(form, text="Ajouter", command=add, width=90).pack(side="left", padx=5)
+        button_frame = ctk.CTkFrame(win, fg_color="transparent")
+        button_frame.pack(pady=10)
+        ctk.CTkButton(button_frame, text="Renommer", command=rename).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Supprimer", command=delete, fg_color="#D32F2F", hover_color="#B71C1C").pack(side="left", padx=5)
+        refresh(changed=False)
+
+    def edit_opening_balances(self):
+        """Soldes initiaux de l'exercice sélectionné, un champ par compte."""
+        selected = self.selected_year_row("modifier")
+        if selected is None:
+            return
+        year_id, year_name = selected
+        if self.db.archive_file(year_id):
+            messagebox.showinfo("Exercice archivé", f"L'exercice '{year_name}' est archivé : ses soldes initiaux ne sont plus modifiables.")
+            return
+        current = {code: amount for code, name, amount in self.db.opening_balances()[year_id]}
+        win = ctk.CTkToplevel(self)
+        win.title(f"Soldes initiaux - {year_name}")
+        win.transient(self)
+        entries = {}
+        for row, account in enumerate(self.accounts):
+            ctk.CTkLabel(win, text=account['name']).grid(row=row, column=0, padx=10, pady=5, sticky="w")
+            entry = ctk.CTkEntry(win)
+            entry.insert(0, f"{current.get(account['code'], 0.0):.2f}")
+            entry.grid(row=row, column=1, padx=10, pady=5)
+            entries[account['code']] = entry
+
+        def save():
+            try:
+                balances = {code: float(entry.get() or 0.0) for code, entry in entries.items()}
+            except ValueError:
+                messagebox.showerror("Erreur", "Les soldes initiaux doivent être des nombres.", parent=win)
+                return
+            self.db.set_opening_balances(year_id, balances)
+            win.destroy()
+            self.refresh_years_view()
+            self.refresh_current_year()
+        ctk.CTkButton(win, text="Enregistrer", command=save).grid(row=len(self.accounts), column=0, columnspan=2, pady=10)
+
+    # --- Gestion des catégories ---
+    def refresh_categories_tree(self):
+        tree = self.categories_tree
+        tree.delete(*tree.get_children())
+        for category in self.categories.rows:
+            parent = str(category['parent_id']) if category['parent_id'] is not None else ""
+            tree.insert(parent, "end", iid=str(category['id']), text=category['name'], open=True,
+                        values=("Recette" if category['type'] == 'recette' else "Dépense",))
+
+    def selected_category(self):
+        focus = self.categories_tree.focus()
+        if not focus:
+            messagebox.showwarning("Sélection requise", "Veuillez sélectionner une catégorie.")
+            return None
+        return self.categories.by_id[int(focus)]
+
+    def categories_changed(self):
+        """Après une modification des catégories : arborescence, grille du budget et vues de l'exercice."""
+        self.categories = CategoryTree.load(self.db)
+        self.refresh_categories_tree()
+        self.build_budget_editor()
+        self.refresh_all_views()
 
-        self.budget_edit_frame = ctk.CTkScrollableFrame(self.tabview.tab("Créer / Modifier le Budget Annuel"))
-        self.budget_edit_frame.pack(expand=True, fill="both")
+    def ask_category_name(self, title, initial=""):
+        dialog = ctk.CTkInputDialog(title=title, text="Nom de la catégorie :")
+        name = (dialog.get_input() or "").strip()
+        if name and name != initial and name in self.categories.by_name:
+            messagebox.showerror("Erreur", f"La catégorie '{name}' existe déjà.")
+            return None
+        return name or None
+
+    def add_category(self, as_child):
+        parent = None
+        if as_child:
+            parent = self.selected_category()
+            if parent is None:
+                return
+            type_op = parent['type']
+        else:
+            type_op = "recette" if messagebox.askyesno("Nouvelle catégorie", "Catégorie de recettes ?\n(Non : catégorie de dépenses)") else "depense"
+        name = self.ask_category_name("Nouvelle sous-catégorie" if parent else "Nouvelle catégorie")
+        if not name:
+            return
+        self.db.add_category(name, type_op, parent['id'] if parent else None)
+        self.categories_changed()
 
-        self.budget_entries = {}
-        row = 0
-        ctk.CTkLabel(self.budget_edit_frame, text="Revenus", font=ctk.CTkFont(size=16, weight="bold")).grid(row=row, column=0, columnspan=2, pady=10, sticky="w")
-        row += 1
-        for cat in CATEGORIES["recette"]:
-            label = ctk.CTkLabel(self.budget_edit_frame, text=cat)
-            label.grid(row=row, column=0, padx=10, pady=5, sticky="w")
-            entry = ctk.CTkEntry(self.budget_edit_frame, placeholder_text="0.00")
-            entry.grid(row=row, column=1, padx=10, pady=5, sticky="ew")
-            self.budget_entries[cat] = entry
-            row += 1
+    def rename_category(self):
+        category = self.selected_category()
+        if category is None:
+            return
+        name = self.ask_category_name(f"Renommer '{category['name']}'", category['name'])
+        if not name or name == category['name']:
+            return
+        self.db.rename_category(category['id'], name)
+        self.categories_changed()
 
-        ctk.CTkLabel(self.budget_edit_frame, text="Dépenses", font=ctk.CTkFont(size=16, weight="bold")).grid(row=row, column=0, columnspan=2, pady=10, sticky="w")
-        row += 1
-        for cat in CATEGORIES["depense"]:
-            label = ctk.CTkLabel(self.budget_edit_frame, text=cat)
-            label.grid(row=row, column=0, padx=10, pady=5, sticky="w")
-            entry = ctk.CTkEntry(self.budget_edit_frame, placeholder_text="0.00")
-            entry.grid(row=row, column=1, padx=10, pady=5, sticky="ew")
-            self.budget_entries[cat] = entry
-            row += 1
+    def move_category(self):
+        category = self.selected_category()
+        if category is None:
+            return
+        excluded = self.categories.subtree_ids(category['id'])
+        choices = ["(aucune)"] + [row['name'] for row in self.categories.of_type(category['type']) if row['id'] not in excluded]
+        win = ctk.CTkToplevel(self)
+        win.title(f"Déplacer '{category['name']}'")
+        win.transient(self)
+        ctk.CTkLabel(win, text="Catégorie parente :").grid(row=0, column=0, padx=10, pady=10)
+        parent = self.categories.by_id.get(category['parent_id'])
+        parent_var = ctk.StringVar(value=parent['name'] if parent else choices[0])
+        ctk.CTkOptionMenu(win, variable=parent_var, values=choices).grid(row=0, column=1, padx=10, pady=10)
+
+        def apply():
+            target = self.categories.by_name.get(parent_var.get())
+            try:
+                self.db.move_category(category['id'], target['id'] if target else None)
+            except ValueError as e:
+                messagebox.showerror("Déplacement impossible", str(e), parent=win)
+                return
+            win.destroy()
+            self.categories_changed()
+        ctk.CTkButton(win, text="Déplacer", command=apply).grid(row=1, column=0, columnspan=2, pady=10)
 
-        save_button = ctk.CTkButton(self.budget_edit_frame, text="Sauvegarder le Budget", command=self.save_budget)
-        save_button.grid(row=row, column=0, columnspan=2, pady=20)
+    def delete_category(self):
+        category = self.selected_category()
+        if category is None:
+            return
+        if not messagebox.askyesno("Supprimer la catégorie", f"Supprimer la catégorie '{category['name']}' ?"):
+            return
+        try:
+            self.db.delete_category(category['id'])
+        except ValueError as e:
+            messagebox.showerror("Suppression impossible", str(e))
+            return
+        self.categories_changed()
 
-        self.budget_view_frame = ctk.CTkFrame(self.tabview.tab("Suivi du Budget Annuel"))
-        self.budget_view_frame.pack(expand=True, fill="both")
+    # --- Classement automatique ---
+    def open_auto_categorize_window(self):
+        """Règles de classement, suggestions apprises de l'historique et aperçu des reclassements de l'exercice."""
+        if not self.current_year_id:
+            messagebox.showerror("Erreur", "Veuillez d'abord sélectionner ou créer un exercice comptable.")
+            return
+        if self.current_year_is_archived():
+            return
+        year_id, year_name = self.current_year_id, self.year_selector_var.get()
+        win = ctk.CTkToplevel(self)
+        win.title(f"Classement automatique - {year_name}")
+        win.geometry("1000x560")
+        win.transient(self)
+        tabs = ctk.CTkTabview(win)
+        tabs.pack(expand=True, fill="both", padx=10, pady=(0, 10))
+        for name in ("Règles", "Suggestions", "Aperçu"):
+            tabs.add(name)
+        state = {'rules': [], 'learned': {}, 'suggestions': [], 'changes': []}
+
+        def make_tree(parent, columns):
+            tree = ttk.Treeview(parent, columns=[col for col, _ in columns], show="headings")
+            for col, width in columns:
+                tree.heading(col, text=col)
+                tree.column(col, width=width, anchor="w" if col in ("Libellé", "Libellé contient", "Catégorie", "Nouvelle") else "center")
+            tree.pack(expand=True, fill="both", padx=5, pady=5)
+            return tree
+
+        rules_tree = make_tree(tabs.tab("Règles"), (("N°", 40), ("Libellé contient", 260), ("Journal", 100), ("Montant", 140), ("Catégorie", 220)))
+        suggestions_tree = make_tree(tabs.tab("Suggestions"), (("Libellé", 360), ("Type", 90), ("Catégorie", 240), ("Écritures", 90)))
+        preview_tree = make_tree(tabs.tab("Aperçu"), (("Date", 90), ("Journal", 90), ("Libellé", 280), ("Montant", 90),
+                                                      ("Actuelle", 160), ("Nouvelle", 160), ("Origine", 90)))
+
+        def amount_range(rule):
+            low, high = rule['min_amount'], rule['max_amount']
+            if low is None and high is None:
+                return ""
+            if high is None:
+                return f"≥ {low:.2f}"
+            return f"≤ {high:.2f}" if low is None else f"{low:.2f} - {high:.2f}"
+
+        def show_rules():
+            rules_tree.delete(*rules_tree.get_children())
+            for number, rule in enumerate(state['rules'], start=1):
+                account = self.account_named(rule['journal']) if rule['journal'] else None
+                rules_tree.insert("", "end", iid=str(rule['id']), values=(
+                    number, rule['pattern'], account['name'] if account else (rule['journal'] or "Tous"), amount_range(rule), rule['category']))
+            ruleset = CategoryRuleSet(state['rules'])
+            state['suggestions'] = suggest_category_rules(ruleset, state['learned'])
+            suggestions_tree.delete(*suggestions_tree.get_children())
+            for index, (libelle, type_op, category, count) in enumerate(state['suggestions']):
+                suggestions_tree.insert("", "end", iid=str(index), values=(
+                    libelle, "Recette" if type_op == 'recette' else "Dépense", category, count))
+            status_label.configure(text=f"{len(state['rules'])} règle(s), {len(state['suggestions'])} suggestion(s)")
+
+        def reload_rules():
+            state['rules'] = self.db.category_rules()
+            show_rules()
+
+        def loaded(result, error):
+            if not win.winfo_exists():
+                return
+            if error is not None:
+                messagebox.showerror("Erreur", f"L'historique des catégories n'a pas pu être lu : {error}", parent=win)
+                return
+            state['rules'], state['learned'] = result
+            show_rules()
+
+        def add_rule(pattern="", category=None):
+            dialog = ctk.CTkToplevel(win)
+            dialog.title("Nouvelle règle")
+            dialog.transient(win)
+            journals = {"Tous": None, **{account['name']: account['code'] for account in self.accounts}}
+            names = [category_label(row) for row in self.categories.rows]
+            fields = {}
+            for row, (label, widget) in enumerate((
+                    ("Libellé contient (* = n'importe quoi) :", ctk.CTkEntry(dialog, width=260)),
+                    ("Journal :", ctk.CTkOptionMenu(dialog, values=list(journals))),
+                    ("Montant minimum :", ctk.CTkEntry(dialog, width=120, placeholder_text="aucun")),
+                    ("Montant maximum :", ctk.CTkEntry(dialog, width=120, placeholder_text="aucun")),
+                    ("Catégorie :", ctk.CTkOptionMenu(dialog, values=names)))):
+                ctk.CTkLabel(dialog, text=label).grid(row=row, column=0, padx=10, pady=5, sticky="w")
+                widget.grid(row=row, column=1, padx=10, pady=5, sticky="w")
+                fields[row] = widget
+            fields[0].insert(0, pattern)
+            if category in self.categories.by_name:
+                fields[4].set(category_label(self.categories.by_name[category]))
+
+            def amount(entry):
+                text = entry.get().strip().replace("'", "").replace(",", ".")
+                return abs(float(text)) if text else None
+
+            def save():
+                category_row = self.categories.rows[names.index(fields[4].get())]
+                try:
+                    low, high = amount(fields[2]), amount(fields[3])
+                except ValueError:
+                    messagebox.showerror("Règle invalide", "Les montants doivent être des nombres.", parent=dialog)
+                    return
+                try:
+                    self.db.add_category_rule(fields[0].get(), category_row['id'], journals[fields[1].get()], low, high)
+                except ValueError as e:
+                    messagebox.showerror("Règle invalide", str(e), parent=dialog)
+                    return
+                dialog.destroy()
+                reload_rules()
+            ctk.CTkButton(dialog, text="Ajouter", command=save).grid(row=5, column=0, columnspan=2, pady=10)
+
+        def selected_rule():
+            focus = rules_tree.focus()
+            if not focus:
+                messagebox.showwarning("Sélection requise", "Veuillez sélectionner une règle.", parent=win)
+                return None
+            return int(focus)
+
+        def delete_rule():
+            rule_id = selected_rule()
+            if rule_id is not None:
+                self.db.delete_category_rule(rule_id)
+                reload_rules()
+
+        def move_rule(offset):
+            rule_id = selected_rule()
+            if rule_id is not None:
+                self.db.move_category_rule(rule_id, offset)
+                reload_rules()
+                rules_tree.focus(str(rule_id))
+                rules_tree.selection_set(str(rule_id))
+
+        def accept_suggestions():
+            selection = suggestions_tree.selection()
+            if not selection:
+                messagebox.showwarning("Sélection requise", "Veuillez sélectionner une ou plusieurs suggestions.", parent=win)
+                return
+            for iid in selection:
+                libelle, _, category, _ = state['suggestions'][int(iid)]
+                self.db.add_category_rule(libelle, self.categories.by_name[category]['id'])
+            reload_rules()
+
+        def edit_suggestion():
+            focus = suggestions_tree.focus()
+            if not focus:
+                messagebox.showwarning("Sélection requise", "Veuillez sélectionner une suggestion.", parent=win)
+                return
+            libelle, _, category, _ = state['suggestions'][int(focus)]
+            add_rule(libelle, category)
+
+        def preview():
+            ruleset, learned, include_classified = CategoryRuleSet(state['rules']), state['learned'], include_var.get()
+
+            def proposed(changes, error):
+                if not win.winfo_exists():
+                    return
+                if error is not None:
+                    messagebox.showerror("Erreur", f"Le classement n'a pas pu être calculé : {error}", parent=win)
+                    return
+                state['changes'] = changes
+                preview_tree.delete(*preview_tree.get_children())
+                for index, (entry, category, source) in enumerate(changes):
+                    account = self.account_named(entry['journal'])
+                    preview_tree.insert("", "end", iid=str(index), values=(
+                        entry['date'], account['name'] if account else entry['journal'], entry['libelle'], f"{entry['amount']:.2f}",
+                        entry['category'], category, source))
+                apply_button.configure(text=f"Appliquer ({len(changes)})")
+                tabs.set("Aperçu")
+            self.tasks.submit(lambda db, task: propose_categories(db, year_id, ruleset, learned, include_classified),
+                              label="Classement des écritures...", on_done=proposed)
+
+        def exclude_selection():
+            for iid in preview_tree.selection():
+                preview_tree.delete(iid)
+            apply_button.configure(text=f"Appliquer ({len(preview_tree.get_children())})")
+
+        def apply():
+            changes = [(state['changes'][int(iid)][1], state['changes'][int(iid)][0]['id'], state['changes'][int(iid)][0]['version'])
+                       for iid in preview_tree.get_children()]
+            if not changes:
+                messagebox.showinfo("Information", "Aucun reclassement à appliquer.", parent=win)
+                return
 
-    def update_year_selector(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM accounting_years ORDER BY start_date DESC")
-        years = cursor.fetchall()
+            def applied(updated, error):
+                if error is not None:
+                    messagebox.showerror("Erreur", f"Le reclassement a échoué : {error}", parent=win)
+                    return
+                self.after_db_write()
+                skipped = len(changes) - updated
+                message = f"{updated} écriture(s) reclassée(s)."
+                if skipped:
+                    message += f"\n{skipped} écriture(s) modifiée(s) entre-temps par un autre poste n'ont pas été touchées."
+                messagebox.showinfo("Classement automatique", message, parent=win)
+                win.destroy()
+            self.tasks.submit(lambda db, task: db.set_entry_categories(year_id, changes), label="Reclassement des écritures...", on_done=applied)
+
+        rule_buttons = ctk.CTkFrame(tabs.tab("Règles"), fg_color="transparent")
+        rule_buttons.pack(pady=5)
+        ctk.CTkButton(rule_buttons, text="Nouvelle règle...", command=add_rule).pack(side="left", padx=5)
+        ctk.CTkButton(rule_buttons, text="Monter", width=80, command=lambda: move_rule(-1)).pack(side="left", padx=5)
+        ctk.CTkButton(rule_buttons, text="Descendre", width=80, command=lambda: move_rule(1)).pack(side="left", padx=5)
+        ctk.CTkButton(rule_buttons, text="Supprimer", command=delete_rule, fg_color="#D32F2F", hover_color="#B71C1C").pack(side="left", padx=5)
+        suggestion_buttons = ctk.CTkFrame(tabs.tab("Suggestions"), fg_color="transparent")
+        suggestion_buttons.pack(pady=5)
+        ctk.CTkButton(suggestion_buttons, text="Ajouter comme règles", command=accept_suggestions).pack(side="left", padx=5)
+        ctk.CTkButton(suggestion_buttons, text="Modifier puis ajouter...", command=edit_suggestion).pack(side="left", padx=5)
+        preview_buttons = ctk.CTkFrame(tabs.tab("Aperçu"), fg_color="transparent")
+        preview_buttons.pack(pady=5)
+        ctk.CTkButton(preview_buttons, text="Exclure la sélection", command=exclude_selection).pack(side="left", padx=5)
+        apply_button = ctk.CTkButton(preview_buttons, text="Appliquer (0)", command=apply)
+        apply_button.pack(side="left", padx=5)
+
+        bottom = ctk.CTkFrame(win, fg_color="transparent")
+        bottom.pack(fill="x", padx=10, pady=(0, 10))
+        status_label = ctk.CTkLabel(bottom, text="Lecture de l'historique...", anchor="w")
+        status_label.pack(side="left", padx=5)
+        ctk.CTkButton(bottom, text="Prévisualiser le classement", command=preview).pack(side="right", padx=5)
+        include_var = ctk.BooleanVar(value=False)
+        ctk.CTkCheckBox(bottom, text="Reclasser aussi les écritures déjà classées", variable=include_var).pack(side="right", padx=10)
+        self.tasks.submit(lambda db, task: (db.category_rules(), learn_category_history(db)),
+                          label="Lecture de l'historique des catégories...", on_done=loaded)
+
+    def poll_external_changes(self):
+        """Rafraîchit les vues uniquement si un autre processus a modifié la base."""
+        try:
+            if self.db.has_external_changes():
+                self.year_cache.invalidate()
+                self.chart_cache.invalidate()
+                self.categories = CategoryTree.load(self.db)
+                self.refresh_categories_tree()
+                self.refresh_years_view()
+                self.update_year_selector(keep_selection=True)
+        except sqlite3.Error as e:
+            print(f"Impossible de vérifier les modifications externes : {e}")
+        self.after(DATA_VERSION_POLL_MS, self.poll_external_changes)
+
+    def update_year_selector(self, keep_selection=False):
+        current_name = self.year_selector_var.get()
+        years = self.db.list_years()
         self.accounting_years.clear()
         year_names = []
         for year in years:
@@ -667,38 +6357,100 @@ class App(ctk.CTk):
                 'id': year['id'], 
                 'start': year['start_date'], 
                 'end': year['end_date'],
-                'initial_poste': year['initial_balance_poste'],
-                'initial_caisse': year['initial_balance_caisse']
+                'archived': bool(year['archive_file'])
             }
             year_names.append(year['name'])
         if not year_names:
             year_names = ["Créez un exercice d'abord"]
         self.year_selector.configure(values=year_names)
-        if year_names and year_names[0] != "Créez un exercice d'abord":
+        if keep_selection and current_name in self.accounting_years:
+            self.on_year_selected(current_name)
+        elif year_names and year_names[0] != "Créez un exercice d'abord":
             self.year_selector_var.set(year_names[0])
             self.on_year_selected(year_names[0])
         else:
             self.year_selector_var.set(year_names[0])
             self.on_year_selected(None)
 
+    @profiled("year_selected")
     def on_year_selected(self, selected_year_name):
         if selected_year_name and selected_year_name in self.accounting_years:
             self.current_year_id = self.accounting_years[selected_year_name]['id']
         else:
             self.current_year_id = None
-        self.refresh_all_views()
+        self.refresh_current_year()
+        self.prefetch_adjacent_years(selected_year_name)
+
+    def current_snapshot(self):
+        return self.year_cache.get(self.current_year_id)
+
+    def refresh_current_year(self):
+        """Charge au besoin l'exercice affiché sur le thread de travail, puis rafraîchit les vues."""
+        year_id = self.current_year_id
+        if year_id is None or self.year_cache.peek(year_id) is not None:
+            self.refresh_all_views()
+            return
+
+        def loaded(snapshot, error):
+            if error is not None:
+                print(f"Chargement de l'exercice {year_id} impossible : {error}")
+            if year_id == self.current_year_id:
+                self.refresh_all_views()
+        self.tasks.submit(lambda db, task: self.year_cache.get(year_id, db), label="Chargement de l'exercice...", on_done=loaded)
+
+    def current_year_is_archived(self, parent=None):
+        """Un exercice archivé est en lecture seule : prévient l'utilisateur et retourne True."""
+        year_info = self.accounting_years.get(self.year_selector_var.get())
+        if year_info and year_info['archived']:
+            messagebox.showinfo("Exercice archivé", "Cet exercice est archivé et ne peut plus être modifié.\n"
+                                "Désarchivez-le depuis la gestion des exercices pour le corriger.", parent=parent)
+            return True
+        return False
+
+    def prefetch_adjacent_years(self, selected_year_name):
+        """Précharge en arrière-plan les exercices voisins de celui affiché."""
+        names = list(self.accounting_years)
+        if selected_year_name not in names:
+            return
+        index = names.index(selected_year_name)
+        neighbours = names[max(index - 1, 0):index] + names[index + 1:index + 2]
+        self.year_cache.prefetch([self.accounting_years[name]['id'] for name in neighbours])
 
+    @profiled("refresh")
     def refresh_all_views(self):
+        self.refresh_accounts()
         self.update_dashboard()
-        self.refresh_journal_view("poste")
-        self.refresh_journal_view("caisse")
+        for journal_type in list(self.journal_views):
+            self.refresh_journal_view(journal_type)
         self.update_budget_view()
         self.load_budget_for_editing()
+        self.refresh_ready_reports()
+
+    def refresh_ready_reports(self):
+        tree = self.ready_reports_tree
+        for item in tree.get_children():
+            tree.delete(item)
+        if not self.current_year_id:
+            return
+        for row in self.db.report_index(self.current_year_id):
+            if os.path.exists(row['path']):
+                tree.insert("", "end", iid=row['path'], values=(
+                    self.report_label(row['report_type']),
+                    "Exercice" if row['period'] == 'exercice' else row['period'],
+                    row['generated_at'].replace("T", " ")))
+
+    def open_ready_report(self, event=None):
+        path = self.ready_reports_tree.focus()
+        if not path:
+            return
+        try:
+            webbrowser.open(f'file://{os.path.realpath(path)}')
+        except Exception as e:
+            messagebox.showerror("Erreur", f"Impossible d'ouvrir le fichier : {e}")
 
     def select_frame_by_name(self, name):
-        buttons = {"dashboard": self.dashboard_button, "poste": self.journal_poste_button,
-                   "caisse": self.journal_caisse_button, "reports": self.reports_button,
-                   "years": self.years_button, "budget": self.budget_button}
+        buttons = {"dashboard": self.dashboard_button, "reports": self.reports_button,
+                   "years": self.years_button, "budget": self.budget_button, **self.account_buttons}
         
         bold_font = ctk.CTkFont(weight="bold")
         normal_font = ctk.CTkFont(weight="normal")
@@ -706,76 +6458,167 @@ class App(ctk.CTk):
         for btn_name, button in buttons.items():
             button.configure(font=bold_font if name == btn_name else normal_font)
 
-        frames = {"dashboard": self.dashboard_frame, "poste": self.journal_poste_frame,
-                  "caisse": self.journal_caisse_frame, "reports": self.reports_frame,
+        if name in self.account_buttons:
+            self.journal_view(name)
+        frames = {"dashboard": self.dashboard_frame, "reports": self.reports_frame,
                   "years": self.years_frame, "budget": self.budget_frame}
+        frames.update((journal_type, view['frame']) for journal_type, view in self.journal_views.items())
         for frame_name, frame in frames.items():
             if name == frame_name:
                 frame.grid(row=0, column=0, sticky="nsew")
             else:
                 frame.grid_forget()
+        self.current_view = name
+        if name in self.stale_journals:
+            self.refresh_journal_view(name)
         if name == "budget":
             self.load_budget_for_editing()
             self.update_budget_view()
 
     def dashboard_frame_event(self): self.select_frame_by_name("dashboard")
-    def journal_poste_frame_event(self): self.select_frame_by_name("poste")
-    def journal_caisse_frame_event(self): self.select_frame_by_name("caisse")
     def reports_frame_event(self): self.select_frame_by_name("reports")
     def years_frame_event(self): self.select_frame_by_name("years")
     def budget_frame_event(self): self.select_frame_by_name("budget")
 
     def get_entries_for_selected_year(self):
         if not self.current_year_id: return []
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM entries WHERE year_id = ? ORDER BY date ASC, id ASC", (self.current_year_id,))
-        return cursor.fetchall()
+        return self.db.entries_for_year(self.current_year_id)
 
     def get_entry_by_id(self, entry_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM entries WHERE id = ?", (entry_id,))
-        return cursor.fetchone()
+        return self.db.get_entry(entry_id)
 
+    @profiled("update_dashboard")
     def update_dashboard(self):
         if not self.current_year_id:
             # Reset labels if no year is selected
-            self.solde_poste_label.configure(text="0.00 CHF")
-            self.solde_caisse_label.configure(text="0.00 CHF")
+            self.update_account_cards([dict(account, balance=0.0) for account in self.accounts])
             self.total_recettes_label.configure(text="0.00 CHF")
             self.total_depenses_label.configure(text="0.00 CHF")
             self.benefice_label.configure(text="0.00 CHF")
+            self.update_dashboard_charts()
             return
 
-        # Récupérer les soldes initiaux
-        year_info = self.accounting_years.get(self.year_selector_var.get())
-        initial_poste = year_info.get('initial_poste', 0.0) if year_info else 0.0
-        initial_caisse = year_info.get('initial_caisse', 0.0) if year_info else 0.0
-
-        entries = self.get_entries_for_selected_year()
-        
-        # Le solde final est le solde initial + la somme des mouvements de l'exercice
-        solde_poste = initial_poste + sum(e['amount'] for e in entries if e['journal'] == 'poste')
-        solde_caisse = initial_caisse + sum(e['amount'] for e in entries if e['journal'] == 'caisse')
-        
-        # Le résultat (bénéfice/perte) ne concerne que les mouvements de l'exercice
-        total_recettes = sum(e['amount'] for e in entries if e['type'] == 'recette')
-        total_depenses = sum(abs(e['amount']) for e in entries if e['type'] == 'depense')
-        benefice = total_recettes - total_depenses
-
-        self.solde_poste_label.configure(text=f"{solde_poste:.2f} CHF")
-        self.solde_caisse_label.configure(text=f"{solde_caisse:.2f} CHF")
-        self.total_recettes_label.configure(text=f"{total_recettes:.2f} CHF")
-        self.total_depenses_label.configure(text=f"{total_depenses:.2f} CHF")
-        self.benefice_label.configure(text=f"{benefice:.2f} CHF")
+        summary = load_dashboard_summary(self.current_snapshot())
+
+        self.update_account_cards(summary['accounts'])
+        self.total_recettes_label.configure(text=f"{summary['total_recettes']:.2f} CHF")
+        self.total_depenses_label.configure(text=f"{summary['total_depenses']:.2f} CHF")
+        self.benefice_label.configure(text=f"{summary['benefice']:.2f} CHF")
+        self.update_dashboard_charts()
+
+    def chart_years(self):
+        """Exercices tracés, dans l'ordre chronologique, jusqu'à l'exercice affiché."""
+        years = sorted(self.accounting_years.values(), key=lambda year: year['start'])
+        index = next((i for i, year in enumerate(years) if year['id'] == self.current_year_id), None)
+        if index is None:
+            return []
+        count = DASHBOARD_CHART_RANGES[self.chart_range_var.get()]
+        first = 0 if count is None else max(index + 1 - count, 0)
+        return [{'id': year['id'], 'start_date': year['start'], 'end_date': year['end']} for year in years[first:index + 1]]
+
+    @profiled("dashboard_charts")
+    def update_dashboard_charts(self):
+        """Trace les courbes depuis le cache ; les totaux manquants sont calculés sur le thread de travail."""
+        if not self.current_year_id:
+            self.chart_series = None
+            self.draw_dashboard_charts()
+            return
+        years = self.chart_years()
+        series = self.chart_cache.series(years)
+        if series is not None:
+            self.chart_series = series
+            self.draw_dashboard_charts()
+            return
+        if self.chart_task is not None and not self.chart_task.future.done():
+            return  # relancé à la fin du calcul en cours, avec l'exercice affiché à ce moment
 
+        def loaded(result, error):
+            self.chart_task = None
+            if error is not None:
+                print(f"Calcul des courbes impossible : {error}")
+                return
+            self.update_dashboard_charts()
+        year_ids = [year['id'] for year in years]
+        self.chart_task = self.tasks.submit(lambda db, task: self.chart_cache.load(db, year_ids),
+                                            label="Calcul des courbes...", on_done=loaded)
+
+    def draw_dashboard_charts(self):
+        series = self.chart_series
+        if series is None:
+            self.draw_line_chart(self.balance_chart, "Soldes", [], [], 1)
+            self.draw_line_chart(self.flow_chart, "Recettes / Dépenses", [], [], 1)
+            return
+        names = {account['code']: account['name'] for account in self.accounts}
+        balance_lines = [(names.get(code, code), values, CHART_ACCOUNT_COLORS[index % len(CHART_ACCOUNT_COLORS)])
+                         for index, (code, values) in enumerate(series['balances'].items())]
+        flow_lines = [("Recettes", series['recettes'], CHART_RECETTES_COLOR), ("Dépenses", series['depenses'], CHART_DEPENSES_COLOR)]
+        self.draw_line_chart(self.balance_chart, "Soldes", series['months'], balance_lines, series['step'])
+        self.draw_line_chart(self.flow_chart, "Recettes / Dépenses", series['months'], flow_lines, series['step'])
+
+    def draw_line_chart(self, canvas, title, months, lines, step):
+        """Dessine des courbes (nom, valeurs, couleur) : une polyligne par courbe, interrompue aux valeurs None."""
+        canvas.delete("all")
+        width, height = canvas.winfo_width(), canvas.winfo_height()
+        if width < 100 or height < 80:
+            return  # canevas pas encore affiché ; redessiné par <Configure>
+        left, right, top, bottom = 60, 10, 26, 22
+        canvas.create_text(left, 6, anchor="nw", text=title, fill="white", font=("Calibri", 11, "bold"))
+        values = [value for _, line_values, _ in lines for value in line_values if value is not None]
+        if not months or not values:
+            canvas.create_text(width / 2, height / 2, text="Aucune donnée", fill="gray")
+            return
+        low, high = min(values + [0.0]), max(values + [0.0])
+        if high == low:
+            high = low + 1.0
+        plot_width, plot_height = width - left - right, height - top - bottom
+
+        def x(i):
+            return left + plot_width * i / max(len(months) - 1, 1)
+
+        def y(value):
+            return top + plot_height * (high - value) / (high - low)
+
+        for k in range(DASHBOARD_CHART_GRIDLINES + 1):
+            value = low + (high - low) * k / DASHBOARD_CHART_GRIDLINES
+            canvas.create_line(left, y(value), width - right, y(value), fill="#565b5e" if value else "#888888")
+            canvas.create_text(left - 4, y(value), anchor="e", text=f"{value:.0f}", fill="gray", font=("Calibri", 8))
+        label_every = max(1, -(-len(months) // 8))
+        for i in range(0, len(months), label_every):
+            month = months[i]
+            label = month[:4] if step >= 12 else f"{month[5:7]}.{month[2:4]}"
+            canvas.create_text(x(i), height - bottom + 4, anchor="n", text=label, fill="gray", font=("Calibri", 8))
+        legend_x = width - right
+        for name, line_values, color in reversed(lines):
+            item = canvas.create_text(legend_x, 6, anchor="ne", text=name, fill=color, font=("Calibri", 9))
+            legend_x = canvas.bbox(item)[0] - 10
+            segment = []
+            for i, value in enumerate(line_values + [None]):
+                if value is not None:
+                    segment += (x(i), y(value))
+                elif len(segment) >= 4:
+                    canvas.create_line(*segment, fill=color, width=2)
+                    segment = []
+                elif segment:
+                    canvas.create_oval(segment[0] - 2, segment[1] - 2, segment[0] + 2, segment[1] + 2, fill=color, outline=color)
+                    segment = []
+
+    @profiled("refresh_journal")
     def refresh_journal_view(self, journal_type):
-        tree = getattr(self, f"{journal_type}_tree")
+        view = self.journal_views.get(journal_type)
+        if view is None:
+            return
+        if journal_type != self.current_view:
+            # Journal masqué : rafraîchi lorsqu'il sera de nouveau affiché
+            self.stale_journals.add(journal_type)
+            return
+        self.stale_journals.discard(journal_type)
+        tree = view['tree']
         for item in tree.get_children():
             tree.delete(item)
 
-        total_debit_label = getattr(self, f"{journal_type}_total_debit_label")
-        total_credit_label = getattr(self, f"{journal_type}_total_credit_label")
-        solde_final_label = getattr(self, f"{journal_type}_solde_final_label")
+        total_debit_label = view['total_debit_label']
+        total_credit_label = view['total_credit_label']
+        solde_final_label = view['solde_final_label']
 
         if not self.current_year_id:
             total_debit_label.configure(text="Total Débit: 0.00")
@@ -784,59 +6627,61 @@ class App(ctk.CTk):
             return
 
         # Récupérer le solde initial
-        year_info = self.accounting_years.get(self.year_selector_var.get())
-        initial_balance = 0.0
-        if year_info:
-            initial_balance = year_info['initial_poste'] if journal_type == 'poste' else year_info['initial_caisse']
+        snapshot = self.current_snapshot()
+        account = snapshot.account(journal_type)
+        initial_balance = account['opening_balance'] if account else 0.0
 
-        solde = initial_balance
-        
         # Ajouter la ligne de solde initial
         tree.insert("", 0, iid='initial_balance', values=(
             "", "", "Report à nouveau", "", "", "", f"{initial_balance:.2f}", ""
         ), tags=('initial_balance_row',))
-        
-        # Récupérer les écritures
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM entries WHERE journal = ? AND year_id = ? ORDER BY date ASC, id ASC", (journal_type, self.current_year_id))
-        entries = cursor.fetchall()
-
-        total_debit = 0
-        total_credit = 0
-        for entry in entries:
-            solde += entry['amount']
-            debit = f"{abs(entry['amount']):.2f}" if entry['amount'] < 0 else ""
-            credit = f"{entry['amount']:.2f}" if entry['amount'] >= 0 else ""
-            if entry['amount'] < 0: total_debit += abs(entry['amount'])
-            else: total_credit += entry['amount']
-
-            attachment_indicator = ""
-            if entry['attachment_path']:
-                attachment_indicator = "📄"
-            elif journal_type == 'caisse':
-                cursor.execute("SELECT 1 FROM cash_details WHERE entry_id = ?", (entry['id'],))
-                if cursor.fetchone():
-                    attachment_indicator = "💰"
 
-            tree.insert("", "end", values=(entry['id'], datetime.strptime(entry['date'], '%Y-%m-%d').strftime('%d/%m/%Y'), entry['libelle'], entry['category'], debit, credit, f"{solde:.2f}", attachment_indicator))
+        rows, total_debit, total_credit, solde = build_journal_rows(snapshot, journal_type, initial_balance)
+        for values in rows:
+            tree.insert("", "end", values=values)
 
         # Les totaux débit/crédit ne concernent que les mouvements de l'exercice
         total_debit_label.configure(text=f"Total Débit: {total_debit:.2f}")
         total_credit_label.configure(text=f"Total Crédit: {total_credit:.2f}")
         solde_final_label.configure(text=f"Solde Final: {solde:.2f}")
 
-        view_button = getattr(self, f"{journal_type}_view_attachment_button")
-        edit_button = getattr(self, f"{journal_type}_edit_button")
-        delete_button = getattr(self, f"{journal_type}_delete_button")
-        view_button.configure(state="disabled")
-        edit_button.configure(state="disabled")
-        delete_button.configure(state="disabled")
-    
+        view['view_attachment_button'].configure(state="disabled")
+        view['edit_button'].configure(state="disabled")
+        view['delete_button'].configure(state="disabled")
+        self.focus_pending_entry(journal_type)
+
+    def show_entry(self, year_name, journal_type, entry_id):
+        """Ouvre le journal d'une écriture et la sélectionne, une fois son exercice affiché."""
+        if year_name not in self.accounting_years or journal_type not in self.account_buttons:
+            return
+        self.pending_entry_focus = (self.accounting_years[year_name]['id'], journal_type, entry_id)
+        if self.year_selector_var.get() != year_name:
+            self.year_selector_var.set(year_name)
+            self.on_year_selected(year_name)
+        self.select_frame_by_name(journal_type)
+        self.focus_pending_entry(journal_type)
+
+    def focus_pending_entry(self, journal_type):
+        if self.pending_entry_focus is None:
+            return
+        year_id, pending_journal, entry_id = self.pending_entry_focus
+        if pending_journal != journal_type or year_id != self.current_year_id or journal_type != self.current_view:
+            return
+        if self.year_cache.peek(year_id) is None:
+            return  # exercice en cours de chargement : le journal sera rafraîchi ensuite
+        self.pending_entry_focus = None
+        tree = self.journal_views[journal_type]['tree']
+        for item in tree.get_children():
+            if str(tree.item(item, "values")[0]) == str(entry_id):
+                tree.selection_set(item)
+                tree.focus(item)
+                tree.see(item)
+                return
+
     def on_journal_select(self, event, journal_type):
-        tree = getattr(self, f"{journal_type}_tree")
-        view_button = getattr(self, f"{journal_type}_view_attachment_button")
-        edit_button = getattr(self, f"{journal_type}_edit_button")
-        delete_button = getattr(self, f"{journal_type}_delete_button")
+        view = self.journal_views[journal_type]
+        tree = view['tree']
+        view_button, edit_button, delete_button = view['view_attachment_button'], view['edit_button'], view['delete_button']
 
         selected_items = tree.selection()
         
@@ -847,8 +6692,10 @@ class App(ctk.CTk):
             delete_button.configure(state="disabled")
             return
 
-        edit_button.configure(state="normal")
-        delete_button.configure(state="normal")
+        year_info = self.accounting_years.get(self.year_selector_var.get())
+        state = "disabled" if year_info and year_info['archived'] else "normal"
+        edit_button.configure(state=state)
+        delete_button.configure(state=state)
         selected_item = selected_items[0]
         attachment_indicator = tree.item(selected_item, "values")[7]
 
@@ -861,11 +6708,13 @@ class App(ctk.CTk):
         if not self.current_year_id:
             messagebox.showerror("Erreur", "Veuillez d'abord sélectionner ou créer un exercice comptable.")
             return
+        if self.current_year_is_archived():
+            return
 
         entry_data = None
         entry_id = None
         if edit_mode:
-            tree = getattr(self, f"{journal_type}_tree")
+            tree = self.journal_views[journal_type]['tree']
             if not tree.focus():
                 messagebox.showwarning("Attention", "Veuillez sélectionner une écriture à modifier.")
                 return
@@ -892,32 +6741,10 @@ class App(ctk.CTk):
                 attachment_label.configure(text=os.path.basename(filepath))
 
         def open_cash_details():
-            details_win = ctk.CTkToplevel(win)
-            details_win.title("Détail de la monnaie"); details_win.transient(win)
-
-            entries = {}
-            for i, denom in enumerate(DENOMINATIONS):
-                ctk.CTkLabel(details_win, text=f"{denom:.2f} CHF").grid(row=i, column=0, padx=10, pady=5)
-                entry = ctk.CTkEntry(details_win)
-                entry.grid(row=i, column=1, padx=10, pady=5)
-                entries[denom] = entry
-
-            def calculate_total():
-                total = 0
-                cash_details_data.clear()
-                for denom, entry in entries.items():
-                    try:
-                        count = int(entry.get() or 0)
-                        if count > 0:
-                            cash_details_data[denom] = count
-                            total += denom * count
-                    except ValueError:
-                        pass
+            def set_amount(total):
                 amount_entry.delete(0, 'end')
                 amount_entry.insert(0, f"{total:.2f}")
-                details_win.destroy()
-
-            ctk.CTkButton(details_win, text="Valider", command=calculate_total).grid(row=len(DENOMINATIONS), column=0, columnspan=2, pady=10)
+            self.open_cash_details_dialog(win, cash_details_data, set_amount)
 
         ctk.CTkLabel(win, text="Date:").grid(row=0, column=0, padx=10, pady=5, sticky="w")
         date_entry = ctk.CTkEntry(win, placeholder_text="YYYY-MM-DD")
@@ -932,15 +6759,15 @@ class App(ctk.CTk):
         ctk.CTkLabel(win, text="Type:").grid(row=2, column=0, padx=10, pady=5, sticky="w")
         type_var = ctk.StringVar(value=entry_data['type'] if edit_mode else "depense")
         def update_cat_menu(selected_type):
-            cat_menu.configure(values=CATEGORIES[selected_type])
+            cat_menu.configure(values=self.categories.names(selected_type))
             if not edit_mode or (edit_mode and selected_type != entry_data['type']):
-                cat_var.set(CATEGORIES[selected_type][0])
+                cat_var.set(self.categories.names(selected_type)[0])
         type_menu = ctk.CTkOptionMenu(win, variable=type_var, values=["depense", "recette"], command=update_cat_menu)
         type_menu.grid(row=2, column=1, columnspan=2, padx=10, pady=5, sticky="ew")
 
         ctk.CTkLabel(win, text="Catégorie:").grid(row=3, column=0, padx=10, pady=5, sticky="w")
-        cat_var = ctk.StringVar(value=entry_data['category'] if edit_mode else CATEGORIES[type_var.get()][0])
-        cat_menu = ctk.CTkOptionMenu(win, variable=cat_var, values=CATEGORIES[type_var.get()])
+        cat_var = ctk.StringVar(value=entry_data['category'] if edit_mode else self.categories.names(type_var.get())[0])
+        cat_menu = ctk.CTkOptionMenu(win, variable=cat_var, values=self.categories.names(type_var.get()))
         cat_menu.grid(row=3, column=1, columnspan=2, padx=10, pady=5, sticky="ew")
 
         ctk.CTkLabel(win, text="Montant (CHF):").grid(row=4, column=0, padx=10, pady=5, sticky="w")
@@ -958,12 +6785,275 @@ class App(ctk.CTk):
         attachment_label.grid(row=7, column=1, columnspan=2, padx=10, pady=(0,10), sticky="ew")
 
         if edit_mode:
-            save_button = ctk.CTkButton(win, text="Sauvegarder", command=lambda: self.update_entry(win, entry_id, journal_type, date_entry.get(), libelle_entry.get(), type_var.get(), cat_var.get(), amount_entry.get(), new_attachment_path=attachment_path.get(), cash_details=cash_details_data, old_db_attachment_path=entry_data['attachment_path']))
+            save_button = ctk.CTkButton(win, text="Sauvegarder", command=lambda: self.update_entry(win, entry_id, journal_type, date_entry.get(), libelle_entry.get(), type_var.get(), cat_var.get(), amount_entry.get(), new_attachment_path=attachment_path.get(), cash_details=cash_details_data, old_db_attachment_path=entry_data['attachment_path'], expected_version=entry_data['version']))
         else:
             save_button = ctk.CTkButton(win, text="Sauvegarder", command=lambda: self.save_entry(win, journal_type, date_entry.get(), libelle_entry.get(), type_var.get(), cat_var.get(), amount_entry.get(), attachment_path.get(), cash_details_data))
         save_button.grid(row=8, column=0, columnspan=3, padx=10, pady=20)
 
-    def save_entry(self, win, journal_type, date_str, libelle, type_op, category, amount_str, source_attachment_path, cash_details):
+    def open_cash_details_dialog(self, parent, cash_details_data, on_total):
+        """Saisie du nombre de billets/pièces : remplit cash_details_data et transmet le total à on_total."""
+        details_win = ctk.CTkToplevel(parent)
+        details_win.title("Détail de la monnaie"); details_win.transient(parent)
+
+        entries = {}
+        for i, denom in enumerate(DENOMINATIONS):
+            ctk.CTkLabel(details_win, text=f"{denom:.2f} CHF").grid(row=i, column=0, padx=10, pady=5)
+            entry = ctk.CTkEntry(details_win)
+            entry.grid(row=i, column=1, padx=10, pady=5)
+            if cash_details_data.get(denom):
+                entry.insert(0, str(cash_details_data[denom]))
+            entries[denom] = entry
+
+        def calculate_total():
+            total = 0
+            cash_details_data.clear()
+            for denom, entry in entries.items():
+                try:
+                    count = int(entry.get() or 0)
+                    if count > 0:
+                        cash_details_data[denom] = count
+                        total += denom * count
+                except ValueError:
+                    pass
+            on_total(total)
+            details_win.destroy()
+
+        ctk.CTkButton(details_win, text="Valider", command=calculate_total).grid(row=len(DENOMINATIONS), column=0, columnspan=2, pady=10)
+        details_win.bind("<Return>", lambda event: calculate_total())
+        details_win.after(100, entries[DENOMINATIONS[0]].focus_set)
+
+    def open_batch_entry_window(self, journal_type):
+        """Saisie en lot façon tableur : navigation au clavier, complétion depuis l'historique,
+        validation ligne par ligne, puis enregistrement de tout le lot en une transaction."""
+        if not self.current_year_id:
+            messagebox.showerror("Erreur", "Veuillez d'abord sélectionner ou créer un exercice comptable.")
+            return
+        if self.current_year_is_archived():
+            return
+        year_info = self.accounting_years.get(self.year_selector_var.get())
+        year_id = self.current_year_id
+
+        win = ctk.CTkToplevel(self)
+        win.title(f"Saisie en lot - Journal de {self.account_named(journal_type)['name']}")
+        win.geometry("1050x600"); win.transient(self)
+
+        # Historique : libellé -> (catégorie, type) le plus récent
+        history = {}
+        for row in self.db.libelle_history(journal_type):
+            history.setdefault(row['libelle'], (row['category'], row['type']))
+        libelles = list(history)
+
+        columns = ["Date", "Libellé", "Type (d/r)", "Catégorie", "Montant"]
+        widths = [110, 320, 90, 220, 110]
+        grid_frame = ctk.CTkScrollableFrame(win)
+        grid_frame.pack(expand=True, fill="both", padx=10, pady=(10, 0))
+        for col, title in enumerate(columns + (["Monnaie"] if journal_type == 'caisse' else []) + [""]):
+            ctk.CTkLabel(grid_frame, text=title, font=ctk.CTkFont(weight="bold")).grid(row=0, column=col, padx=2, sticky="w")
+
+        rows = []   # une ligne = {'cells': [CTkEntry...], 'cash': {valeur: nombre}, 'status': CTkLabel}
+        default_border = None
+
+        def complete(entry, candidates, event):
+            """Complète le texte saisi avec le premier candidat ; la partie ajoutée reste sélectionnée."""
+            if len(event.char) != 1 or not event.char.isprintable():
+                return
+            typed = entry.get()[:entry.index("insert")]
+            if not typed:
+                return
+            match = next((c for c in candidates if c.lower().startswith(typed.lower()) and len(c) > len(typed)), None)
+            if match:
+                entry.delete(0, 'end')
+                entry.insert(0, typed + match[len(typed):])
+                entry.icursor(len(typed))
+                entry.select_range(len(typed), 'end')
+
+        def fill_from_history(row):
+            libelle_cell, type_cell, category_cell = row['cells'][1:4]
+            known = history.get(libelle_cell.get().strip())
+            if known and not category_cell.get():
+                category, type_op = known
+                type_cell.delete(0, 'end'); type_cell.insert(0, type_op)
+                category_cell.delete(0, 'end'); category_cell.insert(0, category)
+
+        def category_candidates(row):
+            type_key = row['cells'][2].get().strip().lower().replace('é', 'e')
+            type_op = next((t for t in ('depense', 'recette') if type_key and t.startswith(type_key)), None)
+            return self.categories.names(type_op)
+
+        def is_blank(row):
+            return not any(cell.get().strip() for cell in row['cells'][1:]) and not row['cash']
+
+        def validate_row(row):
+            """Retourne la ligne validée (tuple pour insert_entries), None si vide ; colore les erreurs."""
+            if is_blank(row):
+                row['status'].configure(text="")
+                return None
+            try:
+                values = parse_entry_fields(*(cell.get() for cell in row['cells']), year_info['start'], year_info['end'], self.categories)
+            except ValueError as e:
+                row['status'].configure(text=f"⚠ {e}", text_color="#D32F2F")
+                for cell in row['cells']:
+                    cell.configure(border_color="#D32F2F")
+                raise
+            for cell in row['cells']:
+                cell.configure(border_color=default_border)
+            row['status'].configure(text="✓", text_color="green")
+            iso_date, libelle, type_op, category, amount = values
+            return iso_date, libelle, category, type_op, amount, dict(row['cash']) if journal_type == 'caisse' else None
+
+        def check_row(row):
+            try:
+                validate_row(row)
+            except ValueError:
+                pass
+            update_summary()
+
+        def move(row_index, col_index):
+            if row_index >= len(rows):
+                add_row()
+            if 0 <= row_index < len(rows):
+                cell = rows[row_index]['cells'][col_index]
+                cell.focus_set()
+                cell.select_range(0, 'end')
+            return "break"
+
+        def open_cash(row):
+            def set_amount(total):
+                amount_cell = row['cells'][4]
+                amount_cell.delete(0, 'end')
+                amount_cell.insert(0, f"{total:.2f}")
+                row['cash_button'].configure(text=f"{sum(row['cash'].values())} pièces" if row['cash'] else "Détail...")
+                check_row(row)
+                amount_cell.focus_set()
+            self.open_cash_details_dialog(win, row['cash'], set_amount)
+            return "break"
+
+        def add_row():
+            nonlocal default_border
+            index = len(rows)
+            row = {'cells': [], 'cash': {}, 'status': ctk.CTkLabel(grid_frame, text="", anchor="w")}
+            for col, width in enumerate(widths):
+                cell = ctk.CTkEntry(grid_frame, width=width)
+                cell.grid(row=index + 1, column=col, padx=2, pady=1, sticky="w")
+                row['cells'].append(cell)
+                last_col = col == len(widths) - 1
+                cell.bind("<Return>", lambda event, r=index, c=col, last=last_col: move(r + 1, 0) if last else move(r, c + 1))
+                cell.bind("<Up>", lambda event, r=index, c=col: move(r - 1, c))
+                cell.bind("<Down>", lambda event, r=index, c=col: move(r + 1, c))
+                # Plus précis que <Return> : sans cela la cellule intercepterait Ctrl+Entrée
+                cell.bind("<Control-Return>", lambda event: save_batch())
+                # Une ligne est validée en quittant le montant, puis revalidée à chaque correction
+                cell.bind("<FocusOut>", lambda event, r=row, last=last_col: check_row(r) if last or r['status'].cget("text") else None)
+            if default_border is None:
+                default_border = row['cells'][0].cget("border_color")
+            libelle_cell, category_cell = row['cells'][1], row['cells'][3]
+            libelle_cell.bind("<KeyRelease>", lambda event: complete(libelle_cell, libelles, event))
+            libelle_cell.bind("<FocusOut>", lambda event, r=row: fill_from_history(r))
+            category_cell.bind("<KeyRelease>", lambda event, r=row: complete(category_cell, category_candidates(r), event))
+            next_col = len(widths)
+            if journal_type == 'caisse':
+                row['cash_button'] = ctk.CTkButton(grid_frame, text="Détail...", width=90, command=lambda r=row: open_cash(r))
+                row['cash_button'].grid(row=index + 1, column=next_col, padx=2, pady=1)
+                for cell in row['cells']:
+                    cell.bind("<Control-m>", lambda event, r=row: open_cash(r))
+                next_col += 1
+            row['status'].grid(row=index + 1, column=next_col, padx=5, sticky="w")
+            # La date reprend celle de la ligne précédente (ou aujourd'hui si elle tombe dans l'exercice)
+            if rows:
+                default_date = rows[-1]['cells'][0].get()
+            else:
+                today = date.today().isoformat()
+                default_date = today if year_info['start'] <= today <= year_info['end'] else year_info['start']
+            row['cells'][0].insert(0, default_date)
+            rows.append(row)
+            return row
+
+        def update_summary():
+            count, total = 0, 0.0
+            for row in rows:
+                if row['status'].cget("text") == "✓":
+                    count += 1
+                    try:
+                        amount = abs(float(row['cells'][4].get().strip().replace("'", "").replace(",", ".")))
+                    except ValueError:
+                        continue
+                    total += -amount if row['cells'][2].get().strip().lower().startswith('d') else amount
+            summary_label.configure(text=f"{count} ligne(s) valide(s) - mouvement net : {total:.2f} CHF")
+
+        def save_batch(allow_duplicate=False):
+            batch, numbers, errors = [], [], []
+            for number, row in enumerate(rows, start=1):
+                try:
+                    values = validate_row(row)
+                except ValueError as e:
+                    errors.append(f"Ligne {number} : {e}")
+                    continue
+                if values:
+                    batch.append(values)
+                    numbers.append(number)
+            update_summary()
+            if errors:
+                messagebox.showerror("Lignes invalides", "\n".join(errors[:15]), parent=win)
+                return "break"
+            if not batch:
+                messagebox.showinfo("Information", "Aucune ligne à enregistrer.", parent=win)
+                return "break"
+            if getattr(win, 'saving', False):
+                return "break"  # enregistrement déjà en cours
+            win.saving = True
+
+            def save(db, task):
+                if not allow_duplicate:
+                    duplicates = find_batch_duplicates(db, journal_type, batch)
+                    if duplicates:
+                        return duplicates  # rien n'est enregistré : l'utilisateur confirme d'abord
+                db.insert_entries(year_id, journal_type, batch)
+
+            def saved(duplicates, error):
+                win.saving = False
+                if error is not None:
+                    messagebox.showerror("Erreur", f"Le lot n'a pas pu être enregistré : {error}", parent=win)
+                    return
+                if duplicates:
+                    for index in duplicates:
+                        rows[numbers[index] - 1]['status'].configure(text="⚠ doublon probable", text_color="#F57C00")
+                    if self.confirm_batch_duplicates(win, numbers, duplicates):
+                        save_batch(allow_duplicate=True)
+                    return
+                self.after_db_write()
+                win.destroy()
+                messagebox.showinfo("Succès", f"{len(batch)} écriture(s) enregistrée(s) dans le journal de {self.account_named(journal_type)['name']}.")
+            self.tasks.submit(save, label="Enregistrement du lot...", on_done=saved, action="save_batch")
+            return "break"
+
+        def close():
+            if any(not is_blank(row) for row in rows) and \
+                    not messagebox.askyesno("Confirmation", "Abandonner les lignes non enregistrées ?", parent=win):
+                return
+            win.destroy()
+
+        bottom = ctk.CTkFrame(win, fg_color="transparent")
+        bottom.pack(fill="x", padx=10, pady=10)
+        summary_label = ctk.CTkLabel(bottom, text="", anchor="w")
+        summary_label.pack(side="left", padx=5)
+        ctk.CTkButton(bottom, text="Enregistrer le lot (Ctrl+Entrée)", command=save_batch).pack(side="right", padx=5)
+        ctk.CTkButton(bottom, text="Ajouter une ligne (Ctrl+N)", command=lambda: move(len(rows), 0)).pack(side="right", padx=5)
+        help_text = "Entrée : cellule suivante · ↑/↓ : ligne · Type : d/r · Date : JJ.MM accepté"
+        if journal_type == 'caisse':
+            help_text += " · Ctrl+M : détail de la monnaie"
+        ctk.CTkLabel(win, text=help_text, text_color="gray").pack(padx=10, pady=(0, 5), anchor="w")
+
+        win.bind("<Control-Return>", lambda event: save_batch())
+        win.bind("<Control-n>", lambda event: move(len(rows), 0))
+        win.bind("<Escape>", lambda event: close())
+        win.protocol("WM_DELETE_WINDOW", close)
+        for _ in range(5):
+            add_row()
+        update_summary()
+        win.after(100, lambda: move(0, 1))
+
+    def save_entry(self, win, journal_type, date_str, libelle, type_op, category, amount_str, source_attachment_path, cash_details,
+                   allow_duplicate=False):
         year_name = self.year_selector_var.get()
         year_info = self.accounting_years.get(year_name)
         try:
@@ -988,35 +7078,48 @@ class App(ctk.CTk):
             messagebox.showerror("Erreur", "Le libellé est requis.", parent=win)
             return
 
-        db_attachment_path = None
-        if source_attachment_path:
+        if getattr(win, 'saving', False):
+            return  # enregistrement déjà en cours (double clic)
+        win.saving = True
+        year_id = self.current_year_id
+
+        def save(db, task):
+            digest = _hash_file(source_attachment_path) if source_attachment_path else None
+            if not allow_duplicate:
+                duplicates = find_entry_duplicates(db, journal_type, date_str, libelle, amount, digest)
+                if duplicates:
+                    return duplicates  # rien n'est enregistré : l'utilisateur confirme d'abord
+            db_attachment_path = copy_attachment(source_attachment_path, year_id) if source_attachment_path else None
             try:
-                year_folder = os.path.join(ATTACHMENT_DIR, str(self.current_year_id))
-                os.makedirs(year_folder, exist_ok=True)
-                timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-                filename = f"{timestamp}_{os.path.basename(source_attachment_path)}"
-                dest_path = os.path.join(year_folder, filename)
-                shutil.copy(source_attachment_path, dest_path)
-                db_attachment_path = os.path.join(str(self.current_year_id), filename)
-            except Exception as e:
-                messagebox.showerror("Erreur Fichier", f"Impossible de copier le justificatif : {e}", parent=win)
+                with db.transaction():
+                    entry_id = db.insert_entry(year_id, date_str, journal_type, libelle, category, type_op, amount, db_attachment_path,
+                                               cash_details if journal_type == 'caisse' else None)
+                    if digest:
+                        db.set_attachment_hashes([(entry_id, digest)])
+            except BaseException:
+                if db_attachment_path:
+                    os.remove(os.path.join(ATTACHMENT_DIR, db_attachment_path))
+                raise
+
+        def saved(duplicates, error):
+            win.saving = False
+            if isinstance(error, OSError):
+                messagebox.showerror("Erreur Fichier", f"Impossible de copier le justificatif : {error}", parent=win)
                 return
+            if error is not None:
+                messagebox.showerror("Erreur", f"L'écriture n'a pas pu être enregistrée : {error}", parent=win)
+                return
+            if duplicates:
+                if self.confirm_duplicates(win, duplicates):
+                    self.save_entry(win, journal_type, date_str, libelle, type_op, category, amount_str, source_attachment_path,
+                                    cash_details, allow_duplicate=True)
+                return
+            self.after_db_write()
+            win.destroy()
+        self.tasks.submit(save, label="Enregistrement de l'écriture...", on_done=saved, action="save_entry")
 
-        cursor = self.conn.cursor()
-        cursor.execute("INSERT INTO entries (date, journal, libelle, category, type, amount, year_id, attachment_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                       (date_str, journal_type, libelle, category, type_op, amount, self.current_year_id, db_attachment_path))
-
-        if journal_type == 'caisse' and cash_details:
-            entry_id = cursor.lastrowid
-            cursor.execute("DELETE FROM cash_details WHERE entry_id = ?", (entry_id,))
-            for denom, count in cash_details.items():
-                cursor.execute("INSERT INTO cash_details (entry_id, denomination, count) VALUES (?, ?, ?)", (entry_id, denom, count))
-
-        self.conn.commit()
-        self.refresh_all_views()
-        win.destroy()
-
-    def update_entry(self, win, entry_id, journal_type, date_str, libelle, type_op, category, amount_str, new_attachment_path, cash_details, old_db_attachment_path):
+    def update_entry(self, win, entry_id, journal_type, date_str, libelle, type_op, category, amount_str, new_attachment_path, cash_details, old_db_attachment_path, expected_version=None,
+                     allow_duplicate=False):
         try:
             amount = float(amount_str)
             if type_op == 'depense': amount = -abs(amount)
@@ -1024,40 +7127,312 @@ class App(ctk.CTk):
             messagebox.showerror("Erreur", "Le montant doit être un nombre.", parent=win)
             return
 
-        db_attachment_path = old_db_attachment_path
-        if new_attachment_path and os.path.join(ATTACHMENT_DIR, str(old_db_attachment_path or '')) != new_attachment_path:
-            if old_db_attachment_path and os.path.exists(os.path.join(ATTACHMENT_DIR, old_db_attachment_path)):
-                os.remove(os.path.join(ATTACHMENT_DIR, old_db_attachment_path))
+        if getattr(win, 'saving', False):
+            return
+        win.saving = True
+        year_id = self.current_year_id
+        attachment_replaced = bool(new_attachment_path) and os.path.join(ATTACHMENT_DIR, str(old_db_attachment_path or '')) != new_attachment_path
+
+        def save(db, task):
+            digest = _hash_file(new_attachment_path) if attachment_replaced else None
+            if not allow_duplicate:
+                duplicates = find_entry_duplicates(db, journal_type, date_str, libelle, amount, digest, exclude_id=entry_id)
+                if duplicates:
+                    return duplicates
+            db_attachment_path = copy_attachment(new_attachment_path, year_id) if attachment_replaced else old_db_attachment_path
             try:
-                year_folder = os.path.join(ATTACHMENT_DIR, str(self.current_year_id))
-                os.makedirs(year_folder, exist_ok=True)
-                timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-                filename = f"{timestamp}_{os.path.basename(new_attachment_path)}"
-                dest_path = os.path.join(year_folder, filename)
-                shutil.copy(new_attachment_path, dest_path)
-                db_attachment_path = os.path.join(str(self.current_year_id), filename)
-            except Exception as e:
-                messagebox.showerror("Erreur Fichier", f"Impossible de copier le nouveau justificatif : {e}", parent=win)
-                return
-
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            UPDATE entries SET date = ?, libelle = ?, category = ?, type = ?, amount = ?, attachment_path = ?
-            WHERE id = ?
-        """, (date_str, libelle, category, type_op, amount, db_attachment_path, entry_id))
-
-        if journal_type == 'caisse':
-            cursor.execute("DELETE FROM cash_details WHERE entry_id = ?", (entry_id,))
-            if cash_details:
-                for denom, count in cash_details.items():
-                    cursor.execute("INSERT INTO cash_details (entry_id, denomination, count) VALUES (?, ?, ?)", (entry_id, denom, count))
+                with db.transaction():
+                    db.update_entry(entry_id, date_str, libelle, category, type_op, amount, db_attachment_path,
+                                    cash_details, replace_cash_details=(journal_type == 'caisse'), expected_version=expected_version)
+                    if digest:
+                        db.set_attachment_hashes([(entry_id, digest)])
+            except BaseException:
+                if attachment_replaced:
+                    os.remove(os.path.join(ATTACHMENT_DIR, db_attachment_path))
+                raise
+            # L'ancien justificatif n'est supprimé qu'une fois la modification enregistrée
+            if attachment_replaced and old_db_attachment_path and old_db_attachment_path != db_attachment_path \
+                    and os.path.exists(os.path.join(ATTACHMENT_DIR, old_db_attachment_path)):
+                os.remove(os.path.join(ATTACHMENT_DIR, old_db_attachment_path))
 
-        self.conn.commit()
-        self.refresh_all_views()
-        win.destroy()
+        def saved(duplicates, error):
+            win.saving = False
+            if isinstance(error, ConflictError):
+                messagebox.showerror("Conflit de modification", "Cette écriture a été modifiée ou supprimée sur un autre poste pendant votre saisie.\n"
+                                     "Les vues vont être rechargées ; veuillez refaire votre modification.", parent=win)
+                self.after_db_write()
+                win.destroy()
+                return
+            if isinstance(error, OSError):
+                messagebox.showerror("Erreur Fichier", f"Impossible de copier le nouveau justificatif : {error}", parent=win)
+                return
+            if error is not None:
+                messagebox.showerror("Erreur", f"La modification n'a pas pu être enregistrée : {error}", parent=win)
+                return
+            if duplicates:
+                if self.confirm_duplicates(win, duplicates):
+                    self.update_entry(win, entry_id, journal_type, date_str, libelle, type_op, category, amount_str, new_attachment_path,
+                                      cash_details, old_db_attachment_path, expected_version, allow_duplicate=True)
+                return
+            self.after_db_write()
+            win.destroy()
+        self.tasks.submit(save, label="Enregistrement de la modification...", on_done=saved, action="update_entry")
+
+    def confirm_duplicates(self, win, duplicates):
+        """Demande confirmation avant d'enregistrer une écriture qui ressemble à des écritures existantes."""
+        lines = []
+        for score, row, same_attachment in duplicates[:5]:
+            reason = "même justificatif" if same_attachment else f"similarité {score:.0%}"
+            lines.append(f"#{row['id']} du {row['date']} : {row['libelle']} ({row['amount']:.2f}) - {reason}")
+        if len(duplicates) > 5:
+            lines.append(f"... et {len(duplicates) - 5} autre(s)")
+        return messagebox.askyesno("Doublon probable", "Cette écriture ressemble à :\n\n" + "\n".join(lines) +
+                                   "\n\nL'enregistrer quand même ?", icon="warning", parent=win)
+
+    def confirm_batch_duplicates(self, win, numbers, duplicates):
+        """Comme confirm_duplicates, pour les lignes signalées d'un lot (numbers : numéro de ligne de chaque rang du lot)."""
+        lines = []
+        for index, found in sorted(duplicates.items())[:8]:
+            score, row, same_attachment = found[0]
+            other = f"la ligne {numbers[row['line']]}" if row['id'] is None else f"#{row['id']} du {row['date']}"
+            reason = "même justificatif" if same_attachment else f"similarité {score:.0%}"
+            lines.append(f"Ligne {numbers[index]} comme {other} : {row['libelle']} ({row['amount']:.2f}) - {reason}")
+        if len(duplicates) > 8:
+            lines.append(f"... et {len(duplicates) - 8} autre(s) ligne(s)")
+        return messagebox.askyesno("Doublons probables", "Des lignes du lot ressemblent à d'autres écritures :\n\n" + "\n".join(lines) +
+                                   "\n\nEnregistrer le lot quand même ?", icon="warning", parent=win)
+
+    def open_duplicates_window(self):
+        """Recherche complète des doublons de l'exercice affiché."""
+        if not self.current_year_id:
+            messagebox.showerror("Erreur", "Veuillez d'abord sélectionner ou créer un exercice comptable.")
+            return
+        year_id, year_name = self.current_year_id, self.year_selector_var.get()
 
+        def done(pairs, error):
+            if error is not None:
+                messagebox.showerror("Erreur", f"La recherche des doublons a échoué : {error}")
+                return
+            if not pairs:
+                messagebox.showinfo("Doublons", f"Aucun doublon probable dans l'exercice {year_name}.")
+                return
+            win = ctk.CTkToplevel(self)
+            win.title(f"Doublons probables - {year_name}")
+            win.geometry("1000x450")
+            win.transient(self)
+            tree = ttk.Treeview(win, columns=("Score", "Journal", "Montant", "Écriture", "Doublon", "Motif"), show="headings")
+            for col, width in (("Score", 60), ("Journal", 70), ("Montant", 90), ("Écriture", 320), ("Doublon", 320), ("Motif", 120)):
+                tree.heading(col, text=col)
+                tree.column(col, width=width, anchor="w" if col in ("Écriture", "Doublon") else "center")
+            tree.pack(expand=True, fill="both", padx=10, pady=10)
+            for score, row, other, same_attachment in pairs:
+                tree.insert("", "end", values=(f"{score:.0%}", row['journal'], f"{row['amount']:.2f}",
+                                               f"#{row['id']} {row['date']} {row['libelle']}", f"#{other['id']} {other['date']} {other['libelle']}",
+                                               "Même justificatif" if same_attachment else "Libellé proche"))
+            ctk.CTkLabel(win, text=f"{len(pairs)} paire(s) à vérifier dans les journaux.").pack(pady=(0, 10))
+        self.tasks.submit(lambda db, task: scan_year_duplicates(db, year_id), label="Recherche des doublons...", on_done=done)
+
+    def open_attachment_search_window(self):
+        """Recherche dans le texte des justificatifs PDF ; un double-clic ouvre l'écriture dans son journal."""
+        if PdfReader is None or not self.db.attachment_index_available():
+            messagebox.showinfo("Information", "La recherche dans les justificatifs nécessite pypdf et SQLite avec FTS5.")
+            return
+        self.start_attachment_indexing()
+        win = ctk.CTkToplevel(self)
+        win.title("Rechercher dans les justificatifs")
+        win.geometry("1100x500")
+        win.transient(self)
+
+        search_frame = ctk.CTkFrame(win, fg_color="transparent")
+        search_frame.pack(fill="x", padx=10, pady=(10, 0))
+        query_var = ctk.StringVar()
+        query_entry = ctk.CTkEntry(search_frame, textvariable=query_var, width=400, placeholder_text="ex. imprimerie facture")
+        query_entry.pack(side="left", padx=(0, 5))
+        ctk.CTkButton(search_frame, text="Rechercher", width=100, command=lambda: search()).pack(side="left")
+        status_label = ctk.CTkLabel(search_frame, text="")
+        status_label.pack(side="left", padx=10)
+
+        tree = ttk.Treeview(win, columns=("Exercice", "Journal", "Date", "Libellé", "Montant", "Extrait"), show="headings")
+        for col, width in (("Exercice", 90), ("Journal", 90), ("Date", 90), ("Libellé", 220), ("Montant", 90), ("Extrait", 480)):
+            tree.heading(col, text=col)
+            tree.column(col, width=width, anchor="w" if col in ("Libellé", "Extrait") else "center")
+        tree.pack(expand=True, fill="both", padx=10, pady=10)
+        results = {}
+
+        def show_status(status, found=None):
+            indexed, with_text, pending = status
+            text = f"{indexed} justificatif(s) indexé(s), dont {with_text} avec du texte"
+            if pending:
+                text += f", {pending} en attente"
+            status_label.configure(text=text if found is None else f"{found} résultat(s) - {text}")
+
+        def done(outcome, error):
+            if not win.winfo_exists():
+                return
+            if error is not None:
+                messagebox.showerror("Erreur", f"La recherche a échoué : {error}", parent=win)
+                return
+            rows, status = outcome
+            if rows is None:  # état de l'index seulement, à l'ouverture
+                show_status(status)
+                return
+            tree.delete(*tree.get_children())
+            results.clear()
+            for row in rows:
+                account = self.account_named(row['journal'])
+                item = tree.insert("", "end", values=(row['year_name'], account['name'] if account else row['journal'], row['date'],
+                                                      row['libelle'], f"{row['amount']:.2f}", row['excerpt']))
+                results[item] = row
+            show_status(status, len(rows))
+
+        def search(event=None):
+            match_query = fts_query(query_var.get())
+            self.tasks.submit(lambda db, task: (db.search_attachments(match_query) if match_query else [], db.attachment_index_status()),
+                              label="Recherche dans les justificatifs...", on_done=done)
+
+        def open_selected(event=None):
+            row = results.get(tree.focus())
+            if row is not None:
+                self.show_entry(row['year_name'], row['journal'], row['id'])
+
+        query_entry.bind("<Return>", search)
+        tree.bind("<Double-1>", open_selected)
+        self.tasks.submit(lambda db, task: (None, db.attachment_index_status()), on_done=done)
+        query_entry.focus_set()
+
+    def open_inbox_window(self):
+        """Attribution rapide des justificatifs reçus que la boîte de réception n'a pas su rattacher."""
+        year_id = self.current_year_id
+        win = ctk.CTkToplevel(self)
+        win.title(f"Justificatifs reçus - dossier {os.path.realpath(INBOX_DIR)}")
+        win.geometry("1200x520")
+        win.transient(self)
+        win.grid_columnconfigure((0, 1), weight=1)
+        win.grid_rowconfigure(1, weight=1)
+        ctk.CTkLabel(win, text="Justificatifs à attribuer", font=ctk.CTkFont(weight="bold")).grid(row=0, column=0, padx=10, pady=(10, 0), sticky="w")
+        ctk.CTkLabel(win, text=f"Écritures sans justificatif - {self.year_selector_var.get() if year_id else 'aucun exercice'}",
+                     font=ctk.CTkFont(weight="bold")).grid(row=0, column=1, padx=10, pady=(10, 0), sticky="w")
+
+        files_tree = ttk.Treeview(win, columns=("Fichier", "Date", "Montant", "Remarque"), show="headings", selectmode="browse")
+        for col, width in (("Fichier", 200), ("Date", 85), ("Montant", 80), ("Remarque", 220)):
+            files_tree.heading(col, text=col)
+            files_tree.column(col, width=width, anchor="w" if col in ("Fichier", "Remarque") else "center")
+        files_tree.grid(row=1, column=0, padx=10, pady=10, sticky="nsew")
+        entries_tree = ttk.Treeview(win, columns=("Date", "Journal", "Libellé", "Montant"), show="headings", selectmode="browse")
+        for col, width in (("Date", 85), ("Journal", 90), ("Libellé", 300), ("Montant", 90)):
+            entries_tree.heading(col, text=col)
+            entries_tree.column(col, width=width, anchor="w" if col == "Libellé" else "center")
+        entries_tree.grid(row=1, column=1, padx=10, pady=10, sticky="nsew")
+        state = {'pending': {}, 'entries': []}
+
+        def show_entries(event=None):
+            """Écritures du même montant d'abord, puis les plus proches de la date du fichier."""
+            pending = state['pending'].get(files_tree.focus())
+            rows = state['entries']
+            if pending is not None and pending['amount'] is not None:
+                target = date.fromisoformat(pending['file_date']) if pending['file_date'] else None
+                rows = sorted(rows, key=lambda row: (round(abs(row['amount']) - pending['amount'], 2) != 0,
+                                                     abs((date.fromisoformat(row['date']) - target).days) if target else 0))
+            entries_tree.delete(*entries_tree.get_children())
+            for row in rows:
+                account = self.account_named(row['journal'])
+                entries_tree.insert("", "end", iid=str(row['id']), values=(
+                    row['date'], account['name'] if account else row['journal'], row['libelle'], f"{row['amount']:.2f}"))
+
+        def loaded(result, error):
+            if not win.winfo_exists():
+                return
+            if error is not None:
+                messagebox.showerror("Erreur", f"Les justificatifs reçus n'ont pas pu être lus : {error}", parent=win)
+                return
+            pending_rows, state['entries'] = result
+            focus = files_tree.focus()
+            files_tree.delete(*files_tree.get_children())
+            state['pending'] = {}
+            for row in pending_rows:
+                iid = str(row['id'])
+                state['pending'][iid] = row
+                files_tree.insert("", "end", iid=iid, values=(row['original_name'], row['file_date'] or "",
+                                                              f"{row['amount']:.2f}" if row['amount'] is not None else "", row['note'] or ""))
+            if focus in state['pending']:
+                files_tree.focus(focus)
+                files_tree.selection_set(focus)
+            show_entries()
+            self.update_inbox_button()
+
+        def refresh():
+            self.tasks.submit(lambda db, task: (db.inbox_pending(), db.entries_without_attachment(year_id) if year_id else []),
+                              label="Lecture des justificatifs reçus...", on_done=loaded)
+
+        def selected_file():
+            pending = state['pending'].get(files_tree.focus())
+            if pending is None:
+                messagebox.showwarning("Sélection requise", "Veuillez sélectionner un justificatif.", parent=win)
+            return pending
+
+        def open_file():
+            pending = selected_file()
+            if pending is not None:
+                webbrowser.open(pathlib.Path(os.path.realpath(pending['path'])).as_uri())
+
+        def attach():
+            pending = selected_file()
+            if pending is None:
+                return
+            if not entries_tree.focus():
+                messagebox.showwarning("Sélection requise", "Veuillez sélectionner l'écriture à laquelle joindre le justificatif.", parent=win)
+                return
+            entry = {'id': int(entries_tree.focus()), 'year_id': year_id}
+
+            def attached(result, error):
+                if isinstance(error, ConflictError):
+                    messagebox.showwarning("Justificatif non joint", str(error), parent=win)
+                elif error is not None:
+                    messagebox.showerror("Erreur", f"Le justificatif n'a pas pu être joint : {error}", parent=win)
+                else:
+                    self.after_db_write()
+                if win.winfo_exists():
+                    refresh()
+            self.tasks.submit(lambda db, task: attach_inbox_file(db, pending['path'], entry, pending['sha256'], pending['id']),
+                              label="Enregistrement du justificatif...", on_done=attached)
+
+        def discard():
+            pending = selected_file()
+            if pending is None or not messagebox.askyesno(
+                    "Confirmation", f"Supprimer définitivement le fichier '{pending['original_name']}' ?", parent=win):
+                return
+            try:
+                if os.path.exists(pending['path']):
+                    os.remove(pending['path'])
+            except OSError as e:
+                messagebox.showerror("Erreur", f"Impossible de supprimer le fichier : {e}", parent=win)
+                return
+            self.db.delete_inbox_pending(pending['id'])
+            refresh()
+
+        def close():
+            self.inbox_window_refresh = None
+            win.destroy()
+
+        files_tree.bind("<<TreeviewSelect>>", show_entries)
+        files_tree.bind("<Double-1>", lambda event: open_file())
+        entries_tree.bind("<Double-1>", lambda event: attach())
+        button_frame = ctk.CTkFrame(win, fg_color="transparent")
+        button_frame.grid(row=2, column=0, columnspan=2, padx=10, pady=(0, 10), sticky="ew")
+        ctk.CTkLabel(button_frame, text=("Surveillance : inotify" if self.inbox.uses_inotify else f"Surveillance : toutes les {INBOX_POLL_S:.0f} s")
+                     + " · Nom reconnu : « E123 » (écriture 123) ou date et montant, ex. « 2025-03-14 imprimerie 120.50.pdf »",
+                     text_color="gray").pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Fermer", command=close).pack(side="right", padx=5)
+        ctk.CTkButton(button_frame, text="Supprimer le fichier", command=discard, fg_color="#D32F2F", hover_color="#B71C1C").pack(side="right", padx=5)
+        ctk.CTkButton(button_frame, text="Joindre à l'écriture", command=attach).pack(side="right", padx=5)
+        ctk.CTkButton(button_frame, text="Ouvrir", command=open_file).pack(side="right", padx=5)
+        win.protocol("WM_DELETE_WINDOW", close)
+        self.inbox_window_refresh = refresh
+        refresh()
+
+    @profiled("delete_entry")
     def delete_entry(self, journal_type):
-        tree = getattr(self, f"{journal_type}_tree")
+        tree = self.journal_views[journal_type]['tree']
         if not tree.focus():
             messagebox.showwarning("Attention", "Veuillez sélectionner une écriture à supprimer.")
             return
@@ -1068,6 +7443,13 @@ class App(ctk.CTk):
         attachment_path_str = entry_data['attachment_path'] if entry_data else None
 
         if messagebox.askyesno("Confirmation", f"Êtes-vous sûr de vouloir supprimer l'écriture ID {entry_id} ?"):
+            try:
+                self.db.delete_entry(entry_id, expected_version=entry_data['version'] if entry_data else None)
+            except ConflictError:
+                messagebox.showerror("Conflit de modification", "Cette écriture a été modifiée ou supprimée sur un autre poste.")
+                self.refresh_all_views()
+                return
+
             if attachment_path_str:
                 full_path = os.path.join(ATTACHMENT_DIR, attachment_path_str)
                 if os.path.exists(full_path):
@@ -1076,21 +7458,17 @@ class App(ctk.CTk):
                     except OSError as e:
                         messagebox.showerror("Erreur", f"Impossible de supprimer la pièce jointe: {e}")
 
-            self.conn.execute("DELETE FROM entries WHERE id = ?", (entry_id,))
-            self.conn.commit()
             self.refresh_all_views()
 
     def view_attachment(self, journal_type):
-        tree = getattr(self, f"{journal_type}_tree")
+        tree = self.journal_views[journal_type]['tree']
         if not tree.focus(): return
 
         entry_id = tree.item(tree.focus())['values'][0]
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT attachment_path FROM entries WHERE id = ?", (entry_id,))
-        result = cursor.fetchone()
+        result = self.db.get_entry(entry_id, self.current_year_id)
 
-        if result and result[0]:
-            file_path = os.path.join(ATTACHMENT_DIR, result[0])
+        if result and result['attachment_path']:
+            file_path = os.path.join(year_attachment_dir(self.db, self.current_year_id), result['attachment_path'])
             if os.path.exists(file_path):
                 try:
                     webbrowser.open(f'file://{os.path.realpath(file_path)}')
@@ -1099,8 +7477,7 @@ class App(ctk.CTk):
             else:
                 messagebox.showerror("Erreur", "Fichier non trouvé.")
         elif journal_type == 'caisse':
-            cursor.execute("SELECT denomination, count FROM cash_details WHERE entry_id = ? ORDER BY denomination DESC", (entry_id,))
-            details = cursor.fetchall()
+            details = self.db.cash_details(entry_id, self.current_year_id)
             if details:
                 details_win = ctk.CTkToplevel(self)
                 details_win.title(f"Détail Caisse - Écriture {entry_id}")
@@ -1113,6 +7490,231 @@ class App(ctk.CTk):
                 ctk.CTkLabel(details_win, text=f"Total: {total:.2f} CHF", font=ctk.CTkFont(weight="bold")).pack(pady=10)
             else:
                 messagebox.showinfo("Information", "Aucun détail pour cette écriture.")
+    def open_reconciliation_window(self, journal_type='poste'):
+        """Rapprochement d'un relevé bancaire (CSV PostFinance ou camt.053) avec le journal d'un compte."""
+        if not self.current_year_id:
+            messagebox.showerror("Erreur", "Veuillez d'abord sélectionner ou créer un exercice comptable.")
+            return
+        if self.current_year_is_archived():
+            return
+        filepath = filedialog.askopenfilename(title="Sélectionner le relevé bancaire",
+                                              filetypes=[("Relevés", "*.csv *.xml"), ("Tous les fichiers", "*.*")])
+        if not filepath:
+            return
+        year_id = self.current_year_id
+
+        def reconcile(db, task):
+            return reconcile_statement(parse_statement(filepath), db.reconciliation_entries(year_id, journal_type))
+
+        def done(result, error):
+            if isinstance(error, (StatementError, OSError, UnicodeDecodeError)):
+                messagebox.showerror("Relevé illisible", str(error))
+            elif error is not None:
+                messagebox.showerror("Erreur", f"Le rapprochement a échoué : {error}")
+            else:
+                self.show_reconciliation(os.path.basename(filepath), result)
+        self.tasks.submit(reconcile, label="Rapprochement du relevé...", on_done=done)
+
+    def show_reconciliation(self, statement_name, result):
+        win = ctk.CTkToplevel(self)
+        win.title(f"Rapprochement bancaire - {statement_name}")
+        win.geometry("1000x650")
+        win.transient(self)
+        win.grid_columnconfigure(0, weight=1)
+        win.grid_rowconfigure(1, weight=2)
+        win.grid_rowconfigure(3, weight=1)
+
+        # Indice de ligne du relevé -> (ligne, statut, écriture ou candidats)
+        state = {}
+        for line, entry in result['matched']:
+            state[line['line']] = (line, 'matched', entry)
+        for line, free in result['ambiguous']:
+            state[line['line']] = (line, 'ambiguous', free)
+        for line in result['unmatched_lines']:
+            state[line['line']] = (line, 'unmatched', None)
+        unmatched_entries = list(result['unmatched_entries'])
+
+        summary_label = ctk.CTkLabel(win, text="", anchor="w")
+        summary_label.grid(row=0, column=0, padx=10, pady=(10, 5), sticky="ew")
+
+        lines_tree = ttk.Treeview(win, columns=("Ligne", "Date", "Texte", "Montant", "Statut", "Écriture"), show="headings")
+        for col, width in (("Ligne", 50), ("Date", 90), ("Texte", 380), ("Montant", 90), ("Statut", 120), ("Écriture", 240)):
+            lines_tree.heading(col, text=col)
+            lines_tree.column(col, width=width, anchor="w" if col in ("Texte", "Écriture") else "center")
+        lines_tree.tag_configure('matched', foreground='#7fd17f')
+        lines_tree.tag_configure('ambiguous', foreground='orange')
+        lines_tree.tag_configure('unmatched', foreground='#ff7070')
+        lines_tree.grid(row=1, column=0, padx=10, sticky="nsew")
+
+        entries_label = ctk.CTkLabel(win, text="", anchor="w", font=ctk.CTkFont(weight="bold"))
+        entries_label.grid(row=2, column=0, padx=10, pady=(10, 2), sticky="ew")
+        entries_tree = ttk.Treeview(win, columns=("ID", "Date", "Libellé", "Montant"), show="headings", height=6)
+        for col, width in (("ID", 60), ("Date", 90), ("Libellé", 400), ("Montant", 90)):
+            entries_tree.heading(col, text=col)
+            entries_tree.column(col, width=width, anchor="w" if col == "Libellé" else "center")
+        entries_tree.grid(row=3, column=0, padx=10, sticky="nsew")
+
+        status_texts = {'matched': "Rapprochée", 'ambiguous': "Ambiguë", 'unmatched': "Sans écriture"}
+
+        def refresh():
+            lines_tree.delete(*lines_tree.get_children())
+            counts = Counter()
+            for number, (line, status, target) in sorted(state.items()):
+                counts[status] += 1
+                if status == 'matched':
+                    label = f"#{target['id']} {target['libelle']}"
+                    text = "Déjà pointée" if target['reconciled_on'] else status_texts[status]
+                elif status == 'ambiguous':
+                    label = " / ".join(f"#{entry['id']}" for entry in target)
+                    text = status_texts[status]
+                else:
+                    label, text = "", status_texts[status]
+                lines_tree.insert("", "end", iid=str(number), tags=(status,),
+                                  values=(number, line['date'], line['text'], f"{line['amount']:.2f}", text, label))
+            summary_label.configure(text=f"{len(state)} mouvement(s) : {counts['matched']} rapproché(s), {counts['ambiguous']} ambigu(s), "
+                                         f"{counts['unmatched']} sans écriture ; {len(unmatched_entries)} écriture(s) absente(s) du relevé.")
+            show_entries(None)
+
+        def show_entries(number):
+            entries_tree.delete(*entries_tree.get_children())
+            if number is not None and state[number][1] == 'ambiguous':
+                entries_label.configure(text="Écritures candidates (choisir puis « Associer »)")
+                shown = state[number][2]
+            else:
+                entries_label.configure(text="Écritures du journal absentes du relevé")
+                shown = unmatched_entries
+            for entry in shown:
+                entries_tree.insert("", "end", iid=str(entry['id']), values=(entry['id'], entry['date'], entry['libelle'], f"{entry['amount']:.2f}"))
+
+        def on_line_select(event):
+            selection = lines_tree.selection()
+            show_entries(int(selection[0]) if selection else None)
+
+        def associate():
+            line_selection, entry_selection = lines_tree.selection(), entries_tree.selection()
+            if not line_selection or not entry_selection:
+                messagebox.showwarning("Attention", "Sélectionnez un mouvement du relevé et une écriture.", parent=win)
+                return
+            number, entry_id = int(line_selection[0]), int(entry_selection[0])
+            line, status, target = state[number]
+            if status == 'matched':
+                messagebox.showwarning("Attention", "Ce mouvement est déjà rapproché.", parent=win)
+                return
+            candidates = target if status == 'ambiguous' else unmatched_entries
+            entry = next(entry for entry in candidates if entry['id'] == entry_id)
+            if round(entry['amount'] * 100) != round(line['amount'] * 100):
+                messagebox.showerror("Montants différents", "Le montant de l'écriture ne correspond pas à celui du relevé.", parent=win)
+                return
+            state[number] = (line, 'matched', entry)
+            if entry in unmatched_entries:
+                unmatched_entries.remove(entry)
+            # L'écriture n'est plus disponible pour les autres mouvements ambigus
+            for other, (other_line, other_status, other_target) in list(state.items()):
+                if other_status == 'ambiguous' and other != number:
+                    remaining = [candidate for candidate in other_target if candidate['id'] != entry_id]
+                    state[other] = (other_line, 'ambiguous' if remaining else 'unmatched', remaining or None)
+            refresh()
+
+        def save():
+            matches = [(target['id'], line['date']) for line, status, target in state.values()
+                       if status == 'matched' and target['reconciled_on'] != line['date']]
+            if not matches:
+                win.destroy()
+                return
+
+            def saved(result, error):
+                if error is not None:
+                    messagebox.showerror("Erreur", f"Le pointage n'a pas pu être enregistré : {error}", parent=win)
+                    return
+                self.db.has_external_changes()
+                messagebox.showinfo("Succès", f"{len(matches)} écriture(s) pointée(s).", parent=win)
+                win.destroy()
+            self.tasks.submit(lambda db, task: db.mark_reconciled(matches), label="Pointage des écritures...", on_done=saved)
+
+        lines_tree.bind("<<TreeviewSelect>>", on_line_select)
+        button_frame = ctk.CTkFrame(win, fg_color="transparent")
+        button_frame.grid(row=4, column=0, padx=10, pady=10, sticky="e")
+        ctk.CTkButton(button_frame, text="Associer", command=associate).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Pointer les écritures rapprochées", command=save).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Fermer", command=win.destroy).pack(side="left", padx=5)
+        refresh()
+
+    def open_cash_count_window(self):
+        """Rapprochement entre l'inventaire théorique de la caisse et un comptage physique."""
+        win = ctk.CTkToplevel(self)
+        win.title("Comptage de caisse")
+        win.transient(self)
+
+        ctk.CTkLabel(win, text="Date du comptage:").grid(row=0, column=0, padx=10, pady=5, sticky="w")
+        date_entry = ctk.CTkEntry(win, placeholder_text="YYYY-MM-DD")
+        date_entry.grid(row=0, column=1, columnspan=2, padx=10, pady=5, sticky="ew")
+        date_entry.insert(0, datetime.now().strftime('%Y-%m-%d'))
+
+        header_font = ctk.CTkFont(weight="bold")
+        for col, title in enumerate(("Valeur", "Théorique", "Compté", "Écart")):
+            ctk.CTkLabel(win, text=title, font=header_font).grid(row=1, column=col, padx=10, pady=(10, 2))
+
+        expected_labels, counted_entries, diff_labels = {}, {}, {}
+        for i, denom in enumerate(DENOMINATIONS, start=2):
+            ctk.CTkLabel(win, text=f"{denom:.2f} CHF").grid(row=i, column=0, padx=10, pady=2, sticky="e")
+            expected_labels[denom] = ctk.CTkLabel(win, text="0")
+            expected_labels[denom].grid(row=i, column=1, padx=10, pady=2)
+            counted_entries[denom] = ctk.CTkEntry(win, width=80)
+            counted_entries[denom].grid(row=i, column=2, padx=10, pady=2)
+            diff_labels[denom] = ctk.CTkLabel(win, text="")
+            diff_labels[denom].grid(row=i, column=3, padx=10, pady=2)
+
+        summary_label = ctk.CTkLabel(win, text="", justify="left", anchor="w")
+        summary_label.grid(row=len(DENOMINATIONS) + 2, column=0, columnspan=4, padx=10, pady=10, sticky="ew")
+        state = {}
+
+        def compute():
+            count_date = date_entry.get()
+            try:
+                datetime.strptime(count_date, '%Y-%m-%d')
+            except ValueError:
+                messagebox.showerror("Erreur de date", "Format de date invalide (YYYY-MM-DD).", parent=win)
+                return False
+            try:
+                counted = {denom: int(entry.get() or 0) for denom, entry in counted_entries.items()}
+            except ValueError:
+                messagebox.showerror("Erreur", "Les quantités comptées doivent être des nombres entiers.", parent=win)
+                return False
+            self.db.refresh_cash_snapshots()
+            inventory = self.db.cash_inventory(count_date)
+            year, book_balance = self.db.caisse_book_balance(count_date)
+            lines = {denom: (inventory[denom], counted[denom]) for denom in DENOMINATIONS}
+            for denom, (expected, counted_value) in lines.items():
+                expected_labels[denom].configure(text=str(expected))
+                diff = counted_value - expected
+                diff_labels[denom].configure(text=f"{diff:+d}" if diff else "", text_color="red" if diff else "gray")
+            total_expected = sum(denom * expected for denom, (expected, _) in lines.items())
+            total_counted = sum(denom * counted_value for denom, (_, counted_value) in lines.items())
+            summary = [f"Inventaire théorique : {total_expected:.2f} CHF", f"Comptage physique : {total_counted:.2f} CHF",
+                       f"Écart : {total_counted - total_expected:+.2f} CHF"]
+            if book_balance is not None:
+                summary.append(f"Solde comptable ({year['name']}) : {book_balance:.2f} CHF, écart {total_counted - book_balance:+.2f} CHF")
+            summary_label.configure(text="\n".join(summary))
+            state.update(count_date=count_date, lines=lines, year=year, book_balance=book_balance)
+            return True
+
+        def save():
+            if compute():
+                self.db.save_cash_count(state['count_date'], state['lines'], state['book_balance'])
+                messagebox.showinfo("Succès", "Comptage enregistré.", parent=win)
+
+        def export_pdf():
+            if compute():
+                year_name = state['year']['name'] if state['year'] else self.year_selector_var.get()
+                generate_pdf('cash_count', year_name, lines=state['lines'], count_date=state['count_date'], book_balance=state['book_balance'])
+
+        button_frame = ctk.CTkFrame(win, fg_color="transparent")
+        button_frame.grid(row=len(DENOMINATIONS) + 3, column=0, columnspan=4, pady=10)
+        ctk.CTkButton(button_frame, text="Calculer", command=compute).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Enregistrer le comptage", command=save).pack(side="left", padx=5)
+        ctk.CTkButton(button_frame, text="Générer PDF", command=export_pdf).pack(side="left", padx=5)
+        compute()
+
     def add_year(self):
         name = self.year_name_entry.get()
         start = self.start_date_entry.get()
@@ -1120,8 +7722,7 @@ class App(ctk.CTk):
         
         # Récupérer et valider les soldes initiaux
         try:
-            initial_poste = float(self.initial_poste_entry.get() or 0.0)
-            initial_caisse = float(self.initial_caisse_entry.get() or 0.0)
+            opening_balances = {code: float(entry.get() or 0.0) for code, entry in self.opening_balance_entries.items()}
         except ValueError:
             messagebox.showerror("Erreur", "Les soldes initiaux doivent être des nombres.")
             return
@@ -1135,17 +7736,13 @@ class App(ctk.CTk):
             messagebox.showerror("Erreur", "Format de date invalide. Utilisez YYYY-MM-DD.")
             return
         try:
-            cursor = self.conn.cursor()
-            cursor.execute("""
-                INSERT INTO accounting_years (name, start_date, end_date, initial_balance_poste, initial_balance_caisse) 
-                VALUES (?, ?, ?, ?, ?)
-            """, (name, start, end, initial_poste, initial_caisse))
-            self.conn.commit()
+            self.db.insert_year(name, start, end, opening_balances)
             self.refresh_years_view()
             self.update_year_selector()
             # Vider les champs
             self.year_name_entry.delete(0, 'end'); self.start_date_entry.delete(0, 'end'); self.end_date_entry.delete(0, 'end')
-            self.initial_poste_entry.delete(0, 'end'); self.initial_caisse_entry.delete(0, 'end')
+            for entry in self.opening_balance_entries.values():
+                entry.delete(0, 'end')
         except sqlite3.IntegrityError:
             messagebox.showerror("Erreur", "Un exercice avec ce nom existe déjà.")
 
@@ -1163,70 +7760,138 @@ class App(ctk.CTk):
                                   "ATTENTION : Toutes les écritures, budgets et pièces jointes associés seront définitivement supprimés."):
             return
 
-        try:
-            cursor = self.conn.cursor()
-            
+        def delete(db, task):
             # 1. Supprimer les pièces jointes associées
             attachment_folder = os.path.join(ATTACHMENT_DIR, str(year_id))
             if os.path.exists(attachment_folder):
                 shutil.rmtree(attachment_folder)
                 print(f"Dossier de pièces jointes '{attachment_folder}' supprimé.")
 
-            # 2. Supprimer les budgets
-            cursor.execute("DELETE FROM budgets WHERE year_id = ?", (year_id,))
-            
-            # 3. Supprimer les détails de caisse (via la suppression des écritures)
-            cursor.execute("DELETE FROM cash_details WHERE entry_id IN (SELECT id FROM entries WHERE year_id = ?)", (year_id,))
+            # 2. Supprimer budgets, détails de caisse, écritures et l'exercice en une transaction
+            archive_file = db.archive_file(year_id)
+            db.delete_year(year_id)
+            if archive_file:
+                db.detach_archives()
+            return archive_file
+
+        def deleted(archive_file, error):
+            if error is not None:
+                messagebox.showerror("Erreur de suppression", f"Une erreur est survenue : {error}")
+                return
+            self.db.has_external_changes()
+            if archive_file:
+                # La connexion de l'interface peut aussi avoir attaché l'archive
+                self.db.detach_archives()
+                remove_archive_files(archive_file)
 
-            # 4. Supprimer les écritures
-            cursor.execute("DELETE FROM entries WHERE year_id = ?", (year_id,))
-            
-            # 5. Supprimer l'exercice lui-même
-            cursor.execute("DELETE FROM accounting_years WHERE id = ?", (year_id,))
-            
-            self.conn.commit()
-            
             messagebox.showinfo("Succès", f"L'exercice '{year_name}' et toutes ses données ont été supprimés.")
-            
+
             # Rafraîchir toutes les vues
             self.update_year_selector()
             self.refresh_years_view()
-
-        except Exception as e:
-            self.conn.rollback()
-            messagebox.showerror("Erreur de suppression", f"Une erreur est survenue : {e}")
+        self.tasks.submit(delete, label="Suppression de l'exercice...", on_done=deleted, action="delete_year")
 
     def refresh_years_view(self):
         for item in self.years_tree.get_children(): self.years_tree.delete(item)
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM accounting_years ORDER BY start_date DESC")
-        for row in cursor.fetchall():
+        opening_balances = self.db.opening_balances()
+        for row in self.db.list_years():
             self.years_tree.insert("", "end", values=(
                 row['id'], 
                 row['name'], 
                 row['start_date'], 
                 row['end_date'],
-                f"{row['initial_balance_poste']:.2f}",
-                f"{row['initial_balance_caisse']:.2f}"
+                " · ".join(f"{name} {amount:.2f}" for code, name, amount in opening_balances[row['id']]),
+                "Archivé" if row['archive_file'] else ""
             ))
 
+    def selected_year_row(self, action):
+        if not self.years_tree.focus():
+            messagebox.showwarning("Sélection requise", f"Veuillez sélectionner un exercice à {action}.")
+            return None
+        values = self.years_tree.item(self.years_tree.focus())['values']
+        return values[0], str(values[1])
+
+    @profiled("archive_year")
+    def archive_selected_year(self):
+        selected = self.selected_year_row("archiver")
+        if selected is None:
+            return
+        year_id, year_name = selected
+        if not messagebox.askyesno("Archiver l'exercice",
+                                   f"Déplacer l'exercice '{year_name}' et ses pièces jointes dans le dossier '{ARCHIVE_DIR}' ?\n"
+                                   "Il restera consultable (tableau de bord, journaux, rapports) mais ne sera plus modifiable."):
+            return
+        try:
+            safety_copy = backup_database_file(self.db, prefix="avant_archivage")
+            self.configure(cursor="watch"); self.update_idletasks()
+            entries, files = archive_year(self.db, year_id)
+        except (ArchiveError, sqlite3.Error, OSError) as e:
+            messagebox.showerror("Archivage impossible", str(e))
+            return
+        finally:
+            self.configure(cursor="")
+        self.refresh_years_view()
+        self.update_year_selector(keep_selection=True)
+        messagebox.showinfo("Succès", f"Exercice '{year_name}' archivé : {entries} écriture(s), {files} pièce(s) jointe(s).\n"
+                            f"Copie de la base avant archivage : {safety_copy}")
+
+    def unarchive_selected_year(self):
+        selected = self.selected_year_row("désarchiver")
+        if selected is None:
+            return
+        year_id, year_name = selected
+        if not messagebox.askyesno("Désarchiver l'exercice", f"Réintégrer l'exercice '{year_name}' dans la base principale pour le modifier ?"):
+            return
+        try:
+            entries = unarchive_year(self.db, year_id)
+        except (ArchiveError, sqlite3.Error, OSError) as e:
+            messagebox.showerror("Désarchivage impossible", str(e))
+            return
+        self.refresh_years_view()
+        self.update_year_selector(keep_selection=True)
+        messagebox.showinfo("Succès", f"Exercice '{year_name}' réintégré : {entries} écriture(s).")
+
+    def export_selected_year_dossier(self):
+        selected = self.selected_year_row("exporter")
+        if selected is None:
+            return
+        year_id, year_name = selected
+        safe_name = year_name.replace('/', '-').replace('\\', '-')
+        dest_path = filedialog.asksaveasfilename(title="Enregistrer le dossier de clôture", defaultextension=".zip",
+                                                 initialfile=f"dossier_cloture_{safe_name}.zip", filetypes=[("Archive ZIP", "*.zip")])
+        if not dest_path:
+            return
+        merge_receipts = PdfWriter is not None and messagebox.askyesno(
+            "Dossier de clôture", "Joindre aussi chaque journal avec ses justificatifs en annexe (un seul PDF par journal) ?")
+
+        def done(result, error):
+            if isinstance(error, TaskCancelled):
+                messagebox.showinfo("Dossier de clôture", "Export annulé.")
+            elif error is not None:
+                messagebox.showerror("Erreur d'export", f"Le dossier de clôture n'a pas pu être créé : {error}")
+            else:
+                included, missing = result
+                details = f"\n{missing} justificatif(s) manquant(s), voir index.csv." if missing else ""
+                messagebox.showinfo("Succès", f"Dossier de clôture créé avec {included} justificatif(s) :\n{dest_path}{details}")
+        self.tasks.submit(lambda db, task: export_year_dossier(db, year_id, dest_path, merge_receipts, check=task.check),
+                          label="Export du dossier de clôture...", on_done=done, cancellable=True)
+
+    @profiled("save_budget")
     def save_budget(self):
         if not self.current_year_id:
             messagebox.showerror("Erreur", "Veuillez sélectionner un exercice.")
             return
-        cursor = self.conn.cursor()
+        if self.current_year_is_archived():
+            return
+        amounts = {}
         for category, entry_widget in self.budget_entries.items():
             amount_str = entry_widget.get()
             try:
-                amount = float(amount_str) if amount_str else 0.0
-                cursor.execute("""
-                    INSERT INTO budgets (year_id, category, amount) VALUES (?, ?, ?)
-                    ON CONFLICT(year_id, category) DO UPDATE SET amount = excluded.amount
-                """, (self.current_year_id, category, amount))
+                amounts[category] = float(amount_str) if amount_str else 0.0
             except ValueError:
                 messagebox.showerror("Erreur", f"Montant invalide pour la catégorie '{category}'.")
                 return
-        self.conn.commit()
+        self.db.save_budgets(self.current_year_id, amounts)
         messagebox.showinfo("Succès", "Budget sauvegardé.")
         self.update_budget_view()
 
@@ -1234,13 +7899,11 @@ class App(ctk.CTk):
         for entry in self.budget_entries.values():
             entry.delete(0, 'end')
         if not self.current_year_id: return
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT category, amount FROM budgets WHERE year_id = ?", (self.current_year_id,))
-        for row in cursor.fetchall():
-            category, amount = row['category'], row['amount']
+        for category, amount in self.current_snapshot().budgets.items():
             if category in self.budget_entries:
                 self.budget_entries[category].insert(0, f"{amount:.2f}")
 
+    @profiled("update_budget_view")
     def update_budget_view(self):
         for widget in self.budget_view_frame.winfo_children():
             widget.destroy()
@@ -1259,11 +7922,10 @@ class App(ctk.CTk):
         result_frame = ctk.CTkFrame(main_budget_frame)
         result_frame.grid(row=1, column=0, columnspan=2, padx=10, pady=10, sticky="nsew")
 
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT category, amount FROM budgets WHERE year_id = ?", (self.current_year_id,))
-        budget_data = {row['category']: row['amount'] for row in cursor.fetchall()}
-        cursor.execute("SELECT category, SUM(amount) FROM entries WHERE year_id = ? GROUP BY category", (self.current_year_id,))
-        actual_data = {row['category']: row[1] for row in cursor.fetchall()}
+        snapshot = self.current_snapshot()
+        # Totaux cumulés par id : une catégorie parente inclut ses sous-catégories
+        budget_data = snapshot.budget_rollup
+        actual_data = snapshot.category_rollup
 
         header_font = ctk.CTkFont(size=12, weight="bold")
 
@@ -1274,12 +7936,15 @@ class App(ctk.CTk):
 
         total_budget_recettes, total_actual_recettes = 0.0, 0.0
         row = 2
-        for cat in CATEGORIES["recette"]:
-            budget_amount = budget_data.get(cat, 0.0)
-            actual_amount = actual_data.get(cat, 0.0)
-            total_budget_recettes += budget_amount
-            total_actual_recettes += actual_amount
-            ctk.CTkLabel(revenu_frame, text=cat).grid(row=row, column=0, sticky="w")
+        for category in snapshot.categories:
+            if category['type'] != 'recette':
+                continue
+            budget_amount = budget_data.get(category['id'], 0.0)
+            actual_amount = actual_data.get(category['id'], 0.0)
+            if category['parent_id'] is None:
+                total_budget_recettes += budget_amount
+                total_actual_recettes += actual_amount
+            ctk.CTkLabel(revenu_frame, text=category_label(category)).grid(row=row, column=0, sticky="w")
             ctk.CTkLabel(revenu_frame, text=f"{budget_amount:.2f}").grid(row=row, column=1, sticky="e")
             ctk.CTkLabel(revenu_frame, text=f"{actual_amount:.2f}", text_color="green").grid(row=row, column=2, sticky="e")
             row += 1
@@ -1295,12 +7960,15 @@ class App(ctk.CTk):
 
         total_budget_depenses, total_actual_depenses = 0.0, 0.0
         row = 2
-        for cat in CATEGORIES["depense"]:
-            budget_amount = budget_data.get(cat, 0.0)
-            actual_amount = abs(actual_data.get(cat, 0.0))
-            total_budget_depenses += budget_amount
-            total_actual_depenses += actual_amount
-            ctk.CTkLabel(charges_frame, text=cat).grid(row=row, column=0, sticky="w")
+        for category in snapshot.categories:
+            if category['type'] != 'depense':
+                continue
+            budget_amount = budget_data.get(category['id'], 0.0)
+            actual_amount = abs(actual_data.get(category['id'], 0.0))
+            if category['parent_id'] is None:
+                total_budget_depenses += budget_amount
+                total_actual_depenses += actual_amount
+            ctk.CTkLabel(charges_frame, text=category_label(category)).grid(row=row, column=0, sticky="w")
             ctk.CTkLabel(charges_frame, text=f"{budget_amount:.2f}").grid(row=row, column=1, sticky="e")
             ctk.CTkLabel(charges_frame, text=f"{actual_amount:.2f}", text_color="red").grid(row=row, column=2, sticky="e")
             row += 1
@@ -1323,36 +7991,31 @@ class App(ctk.CTk):
         
         year_name = self.year_selector_var.get()
         
-        report_kwargs = {}
-        if report_type in ['caisse', 'poste', 'resultat', 'exploitation']:
-            report_kwargs['data'] = self.get_entries_for_selected_year()
-        elif report_type == 'budget':
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT category, amount FROM budgets WHERE year_id = ?", (self.current_year_id,))
-            report_kwargs['budget_data'] = {row['category']: row['amount'] for row in cursor.fetchall()}
-            cursor.execute("SELECT category, SUM(amount) FROM entries WHERE year_id = ? GROUP BY category", (self.current_year_id,))
-            report_kwargs['actual_data'] = {row['category']: row[1] for row in cursor.fetchall()}
-        elif report_type == 'monthly_summary':
-            selected_date = kwargs.get('selected_date')
-            if not selected_date:
-                messagebox.showerror("Erreur", "Aucun mois n'a été sélectionné pour le rapport.")
-                return
-
-            start_of_month = selected_date.replace(day=1)
-            end_of_month = selected_date.replace(day=calendar.monthrange(selected_date.year, selected_date.month)[1])
-            
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT * FROM entries WHERE year_id = ? AND date BETWEEN ? AND ?", 
-                           (self.current_year_id, start_of_month.strftime('%Y-%m-%d'), end_of_month.strftime('%Y-%m-%d')))
-            report_kwargs['monthly_entries'] = cursor.fetchall()
-            
-            cursor.execute("SELECT category, amount FROM budgets WHERE year_id = ?", (self.current_year_id,))
-            report_kwargs['budget_data'] = {row['category']: row['amount'] for row in cursor.fetchall()}
-            
-            report_kwargs['month_name'] = selected_date.strftime("%B")
-            report_kwargs['report_year'] = selected_date.year
+        selected_date = kwargs.get('selected_date')
+        if report_type == 'monthly_summary' and not selected_date:
+            messagebox.showerror("Erreur", "Aucun mois n'a été sélectionné pour le rapport.")
+            return
 
-        generate_pdf(report_type=report_type, year_name=year_name, **report_kwargs)
+        report_kwargs = load_report_data(self.current_snapshot(), report_type, selected_date)
+
+        def written(filepath, error):
+            if isinstance(error, TaskCancelled):
+                if filepath and os.path.exists(filepath):
+                    os.remove(filepath)
+                return
+            show_report_result(report_type, filepath, error)
+        # Rendu dans un processus séparé : la fenêtre reste réactive pendant les gros rapports
+        self.tasks.submit_process(write_report_pdf, report_type, year_name, report_kwargs,
+                                  label=f"Génération du rapport {self.report_label(report_type)}...", on_done=written, action="report")
+
+    def report_label(self, report_type):
+        account = self.account_named(report_type)
+        return f"Journal de {account['name']}" if account else REPORT_LABELS.get(report_type, report_type)
+
+    def generate_journal_report(self):
+        account = next((a for a in self.accounts if a['name'] == self.journal_report_var.get()), None)
+        if account is not None:
+            self.generate_report(account['code'])
     
     ### NOUVEAU ###
     def prompt_for_monthly_report(self):
@@ -1412,21 +8075,17 @@ class App(ctk.CTk):
         ctk.CTkButton(dialog, text="Générer", command=on_generate).pack(pady=10)
 
     def backup_database(self):
-        try:
-            self.conn.close()
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_filename = f"backup_{timestamp}.db"
-            backup_filepath = os.path.join(SAVE_DIR, backup_filename)
-            shutil.copyfile(DB_FILE, backup_filepath)
-            self.conn = db_connect()
-            messagebox.showinfo("Succès", f"Sauvegarde créée avec succès:\n{backup_filepath}")
-        except Exception as e:
-            messagebox.showerror("Erreur de sauvegarde", f"Une erreur est survenue: {e}")
-            self.conn = db_connect()
+        def done(backup_filepath, error):
+            if isinstance(error, TaskCancelled):
+                messagebox.showinfo("Sauvegarde", "Sauvegarde annulée.")
+            elif error is not None:
+                messagebox.showerror("Erreur de sauvegarde", f"Une erreur est survenue: {error}")
+            else:
+                messagebox.showinfo("Succès", f"Sauvegarde créée avec succès:\n{backup_filepath}")
+        self.tasks.submit(lambda db, task: backup_database_file(db, progress=lambda *_: task.check()),
+                          label="Sauvegarde de la base...", on_done=done, cancellable=True, action="backup")
 
     def restore_database(self):
-        if not messagebox.askyesno("Confirmation", "Êtes-vous sûr de vouloir charger une sauvegarde ?\nToutes les données non sauvegardées seront écrasées."):
-            return
         filepath = filedialog.askopenfilename(
             title="Sélectionner un fichier de sauvegarde",
             initialdir=SAVE_DIR,
@@ -1434,19 +8093,89 @@ class App(ctk.CTk):
         )
         if not filepath:
             return
-        try:
-            self.conn.close()
-            shutil.copyfile(filepath, DB_FILE)
-            self.conn = db_connect()
+        if os.path.abspath(filepath) == os.path.abspath(DB_FILE):
+            messagebox.showerror("Erreur de restauration", "Ce fichier est la base en cours d'utilisation.")
+            return
+
+        def validated(year_names, error):
+            if error is not None:
+                messagebox.showerror("Sauvegarde invalide", str(error))
+                return
+            self.open_restore_window(filepath, year_names)
+        # Le contrôle d'intégrité d'une grosse sauvegarde ne doit pas figer l'interface
+        self.tasks.submit(lambda db, task: validate_backup_file(filepath), label="Vérification de la sauvegarde...", on_done=validated)
+
+    def open_restore_window(self, filepath, year_names):
+        """Choix du mode de restauration : toute la base ou un seul exercice."""
+        win = ctk.CTkToplevel(self)
+        win.title("Charger une sauvegarde")
+        win.transient(self)
+        ctk.CTkLabel(win, text=f"Sauvegarde valide : {os.path.basename(filepath)}\n{len(year_names)} exercice(s)", justify="left").grid(
+            row=0, column=0, columnspan=2, padx=10, pady=10, sticky="w")
+
+        ctk.CTkButton(win, text="Restaurer toute la base", fg_color="#D32F2F", hover_color="#B71C1C",
+                      command=lambda: self.restore_full_backup(win, filepath)).grid(row=1, column=0, columnspan=2, padx=10, pady=5, sticky="ew")
+
+        year_var = ctk.StringVar(value=year_names[0] if year_names else "")
+        ctk.CTkOptionMenu(win, variable=year_var, values=year_names or [""]).grid(row=2, column=0, padx=10, pady=(15, 10), sticky="ew")
+        year_button = ctk.CTkButton(win, text="Restaurer uniquement cet exercice", command=lambda: self.restore_year_backup(win, filepath, year_var.get()))
+        year_button.grid(row=2, column=1, padx=10, pady=(15, 10), sticky="ew")
+        if not year_names:
+            year_button.configure(state="disabled")
+
+    def restore_full_backup(self, win, filepath):
+        if not messagebox.askyesno("Confirmation", "Remplacer toute la base par cette sauvegarde ?\n"
+                                   "Une copie de la base actuelle sera enregistrée auparavant.", parent=win):
+            return
+        win.destroy()
+
+        def restore(db, task):
+            safety_copy = backup_database_file(db, prefix="avant_restauration")
+            restore_database(db, filepath)
+            return safety_copy
+
+        def restored(safety_copy, error):
+            if error is not None:
+                messagebox.showerror("Erreur de restauration", f"Une erreur est survenue: {error}\nLa base actuelle n'a pas été modifiée.")
+                return
+            self.db.reconnect()
+            self.year_cache.invalidate()
+            self.chart_cache.invalidate()
             self.update_year_selector()
-            self.on_year_selected(self.year_selector_var.get())
             self.select_frame_by_name("dashboard")
-            messagebox.showinfo("Succès", "La sauvegarde a été chargée avec succès.")
-        except Exception as e:
-            messagebox.showerror("Erreur de restauration", f"Une erreur est survenue: {e}")
-            self.conn = db_connect()
+            messagebox.showinfo("Succès", f"La sauvegarde a été chargée avec succès.\nCopie de l'ancienne base : {safety_copy}")
+        self.tasks.submit(restore, label="Restauration de la sauvegarde...", on_done=restored, action="restore")
+
+    def restore_year_backup(self, win, filepath, year_name):
+        exists = year_name in self.accounting_years
+        question = (f"Remplacer l'exercice '{year_name}' par sa version dans la sauvegarde ?" if exists
+                    else f"Recréer l'exercice '{year_name}' à partir de la sauvegarde ?")
+        if not messagebox.askyesno("Confirmation", question + "\nLes autres exercices ne sont pas modifiés.", parent=win):
+            return
+
+        def restore(db, task):
+            safety_copy = backup_database_file(db, prefix="avant_restauration")
+            return safety_copy, db.restore_year_from(filepath, year_name)
+
+        def restored(result, error):
+            if error is not None:
+                messagebox.showerror("Erreur de restauration", f"Une erreur est survenue: {error}\nLa base actuelle n'a pas été modifiée.", parent=win)
+                return
+            safety_copy, (entries, budgets) = result
+            win.destroy()
+            self.db.has_external_changes()
+            self.refresh_years_view()
+            self.update_year_selector()
+            if year_name in self.accounting_years:
+                self.year_selector_var.set(year_name)
+                self.on_year_selected(year_name)
+            messagebox.showinfo("Succès", f"Exercice '{year_name}' restauré : {entries} écriture(s), {budgets} budget(s).\n"
+                                f"Copie de l'ancienne base : {safety_copy}")
+        self.tasks.submit(restore, label="Restauration de l'exercice...", on_done=restored, action="restore_year")
     
 if __name__ == "__main__":
+    # Requis pour les processus de rendu des rapports dans l'exécutable Windows
+    multiprocessing.freeze_support()
     # Définir la locale pour avoir les noms de mois en français
     try:
         # Tenter la locale Windows, puis Linux/macOS
@@ -1457,6 +8186,28 @@ if __name__ == "__main__":
         except locale.Error:
             print("Locale 'fr_FR' non trouvée, utilisation de la locale système.")
     
+    if os.environ.get(PROFILE_ENV_VAR) == "1" or "--profile" in sys.argv:
+        PROFILER.enable()
+
+    if "--check-integrity" in sys.argv:
+        # Contrôle complet sans interface ; --repair applique les corrections automatiques
+        integrity_report = check_integrity(rehash=True)
+        print(integrity_report.summary())
+        if "--repair" in sys.argv and not integrity_report.ok:
+            for action in repair_integrity(LedgerRepository(), integrity_report):
+                print(action)
+        sys.exit(0 if integrity_report.ok else 1)
+
+    if "--api-only" in sys.argv:
+        # API seule, sans interface (ex. pour l'écran du comité)
+        server = start_api_server()
+        print(f"API locale disponible sur http://{API_HOST}:{API_PORT}/api/balances (Ctrl+C pour arrêter)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+        sys.exit(0)
+
     ctk.set_appearance_mode("System")
     ctk.set_default_color_theme("blue")
     app = App()
@@ -0,0 +1,350 @@
+"""Banc de mesure des chemins critiques de l'application AETML Compta.
+
+Génère un grand livre synthétique reproductible (graine fixe), puis chronomètre sans
+interface graphique la logique utilisée par le tableau de bord, les journaux, les
+rapports PDF, la connexion et la sauvegarde. Les résultats sont écrits en JSON pour
+pouvoir comparer deux versions entre elles.
+
+Exemples :
+    python bench_compta.py --scales 1000 50000
+    python bench_compta.py --scales 1000 50000 500000 --output bench_1.1.1.json
+    python bench_compta.py --scales 1000 --compare bench_1.1.1.json
+    python bench_compta.py --scales 1000 --concurrency 2
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import app_compta_aetml as app
+
+# Répartition réaliste des catégories : (catégorie, type, poids, montant min, montant max, part en caisse)
+CATEGORY_MIX = [
+    ("Recettes babyfoot", "recette", 30, 5, 120, 0.9),
+    ("Dons", "recette", 4, 20, 500, 0.3),
+    ("Sponsoring", "recette", 2, 200, 3000, 0.0),
+    ("Cotisations", "recette", 10, 20, 50, 0.5),
+    ("Autre Recette", "recette", 3, 5, 300, 0.4),
+    ("Frais de production", "depense", 12, 10, 800, 0.3),
+    ("Frais de communication", "depense", 6, 10, 400, 0.2),
+    ("Frais de représentation", "depense", 5, 10, 250, 0.5),
+    ("Charges financières", "depense", 2, 1, 50, 0.0),
+    ("Taxe bancaire", "depense", 6, 1, 15, 0.0),
+    ("Prix et sponsoring", "depense", 3, 20, 500, 0.3),
+    ("Achats matériel", "depense", 8, 15, 1500, 0.2),
+    ("Autre Dépense", "depense", 9, 5, 300, 0.4),
+]
+LIBELLES = ["Soirée", "Tournoi", "Facture", "Achat", "Vente", "Versement", "Remboursement", "Commande", "Location", "Apéro"]
+ATTACHMENT_RATIO = 0.25
+CASH_DETAILS_RATIO = 0.8
+FAKE_PDF = b"%PDF-1.4\n1 0 obj<<>>endobj\ntrailer<<>>\n%%EOF\n"
+DEFAULT_OPERATIONS = ["db_connect", "year_snapshot", "dashboard", "dashboard_charts", "journal_poste", "journal_caisse",
+                      "report_poste", "report_caisse", "report_resultat", "report_budget",
+                      "report_monthly_summary", "backup"]
+
+
+def split_in_denominations(amount):
+    """Décompose un montant en pièces et billets (algorithme glouton sur DENOMINATIONS)."""
+    remaining = round(abs(amount) * 100)
+    details = {}
+    for denom in app.DENOMINATIONS:
+        cents = round(denom * 100)
+        count, remaining = divmod(remaining, cents)
+        if count:
+            details[denom] = count
+    return details
+
+
+def generate_synthetic_ledger(db_path, n_years, entries_per_year, seed=42, attachment_dir=None):
+    """Crée une base de n_years exercices contenant chacun entries_per_year écritures.
+
+    Les pièces jointes sont de petits fichiers PDF factices écrits dans attachment_dir
+    (sous-dossier par exercice, comme dans l'application). Retourne la liste des id d'exercice.
+    """
+    rng = random.Random(seed)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = app.db_connect(db_path)
+    cursor = conn.cursor()
+    weights = [c[2] for c in CATEGORY_MIX]
+    first_year = date.today().year - n_years
+    year_ids = []
+    for y in range(n_years):
+        start = date(first_year + y, 8, 1)
+        end = date(first_year + y + 1, 7, 31)
+        cursor.execute("INSERT INTO accounting_years (name, start_date, end_date, initial_balance_poste, initial_balance_caisse) VALUES (?, ?, ?, ?, ?)",
+                       (f"{start.year}-{end.year}", start.isoformat(), end.isoformat(), round(rng.uniform(1000, 20000), 2), round(rng.uniform(100, 2000), 2)))
+        year_id = cursor.lastrowid
+        year_ids.append(year_id)
+        span = (end - start).days
+        if attachment_dir:
+            os.makedirs(os.path.join(attachment_dir, str(year_id)), exist_ok=True)
+
+        entry_rows, cash_rows = [], []
+        next_id = (cursor.execute("SELECT COALESCE(MAX(id), 0) FROM entries").fetchone()[0]) + 1
+        for i in range(entries_per_year):
+            category, type_op, _, low, high, cash_share = rng.choices(CATEGORY_MIX, weights)[0]
+            journal = "caisse" if rng.random() < cash_share else "poste"
+            amount = round(rng.uniform(low, high), 1 if journal == "caisse" else 2)
+            if type_op == "depense":
+                amount = -amount
+            entry_date = (start + timedelta(days=rng.randrange(span + 1))).isoformat()
+            libelle = f"{rng.choice(LIBELLES)} {category.split()[0].lower()} #{i}"
+            attachment_path = None
+            if rng.random() < ATTACHMENT_RATIO:
+                filename = f"{entry_date.replace('-', '')}000000_piece_{next_id}.pdf"
+                attachment_path = os.path.join(str(year_id), filename)
+                if attachment_dir:
+                    with open(os.path.join(attachment_dir, attachment_path), "wb") as f:
+                        f.write(FAKE_PDF)
+            entry_rows.append((next_id, entry_date, journal, libelle, category, type_op, amount, year_id, attachment_path))
+            if journal == "caisse" and attachment_path is None and rng.random() < CASH_DETAILS_RATIO:
+                for denom, count in split_in_denominations(amount).items():
+                    cash_rows.append((next_id, denom, count))
+            next_id += 1
+
+        cursor.executemany("INSERT INTO entries (id, date, journal, libelle, category, type, amount, year_id, attachment_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", entry_rows)
+        cursor.executemany("INSERT INTO cash_details (entry_id, denomination, count) VALUES (?, ?, ?)", cash_rows)
+        budget_rows = [(year_id, c[0], round(rng.uniform(500, 5000), 0)) for c in CATEGORY_MIX]
+        cursor.executemany("INSERT INTO budgets (year_id, category, amount) VALUES (?, ?, ?)", budget_rows)
+        conn.commit()
+    conn.close()
+    return year_ids
+
+
+def time_operation(func, repeat):
+    """Exécute func `repeat` fois et retourne les statistiques de durée en millisecondes."""
+    durations = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - t0) * 1000)
+    return {
+        "runs": repeat,
+        "min_ms": round(min(durations), 3),
+        "median_ms": round(statistics.median(durations), 3),
+        "mean_ms": round(statistics.mean(durations), 3),
+    }
+
+
+def build_operations(db_path, save_dir):
+    """Retourne les opérations chronométrées, chacune travaillant sur l'exercice le plus récent."""
+    db = app.LedgerRepository(db_path)
+    year = db.list_years()[0]
+    year_id, year_name = year['id'], year['name']
+    first_month = datetime.strptime(year['start_date'], '%Y-%m-%d').date()
+    # Journaux et rapports travaillent sur l'instantané en cache ; "year_snapshot" et "dashboard" le rechargent à froid
+    snapshot = app.YearSnapshot.load(db, year_id)
+
+    def report(report_type, **kwargs):
+        def run():
+            data = app.load_report_data(snapshot, report_type, **kwargs)
+            pdf, _ = app.render_report(report_type, year_name, **data)
+            pdf.output()
+        return run
+
+    def connect():
+        app.db_connect(db_path).close()
+
+    # Courbes de tout l'historique à froid : totaux mensuels de chaque exercice puis échantillonnage
+    chart_years = [{'id': y['id'], 'start_date': y['start_date'], 'end_date': y['end_date']} for y in reversed(db.list_years())]
+
+    def dashboard():
+        # Ouverture à froid du tableau de bord : l'exercice n'est pas encore dans le cache
+        cache = app.YearSnapshotCache(db)
+        app.load_dashboard_summary(cache.get(year_id))
+
+    def dashboard_charts():
+        cache = app.DashboardSeriesCache()
+        cache.load(db, [y['id'] for y in chart_years])
+        cache.series(chart_years)
+
+    operations = {
+        "db_connect": connect,
+        "year_snapshot": lambda: app.YearSnapshot.load(db, year_id),
+        "dashboard": dashboard,
+        "dashboard_charts": dashboard_charts,
+        "journal_poste": lambda: app.build_journal_rows(snapshot, 'poste', year['initial_balance_poste']),
+        "journal_caisse": lambda: app.build_journal_rows(snapshot, 'caisse', year['initial_balance_caisse']),
+        "report_poste": report('poste'),
+        "report_caisse": report('caisse'),
+        "report_resultat": report('resultat'),
+        "report_budget": report('budget'),
+        "report_monthly_summary": report('monthly_summary', selected_date=first_month),
+        "backup": lambda: os.remove(app.backup_database_file(db, save_dir)),
+    }
+    return db, operations
+
+
+def run_benchmarks(scales, n_years, seed, repeat, operations, workdir):
+    results = {}
+    for scale in scales:
+        entries_per_year = max(1, scale // n_years)
+        scale_dir = os.path.join(workdir, f"scale_{scale}")
+        os.makedirs(scale_dir, exist_ok=True)
+        db_path = os.path.join(scale_dir, app.DB_FILE)
+        save_dir = os.path.join(scale_dir, app.SAVE_DIR)
+        os.makedirs(save_dir, exist_ok=True)
+
+        print(f"[{scale} écritures] génération ({n_years} exercices x {entries_per_year})...", flush=True)
+        t0 = time.perf_counter()
+        generate_synthetic_ledger(db_path, n_years, entries_per_year, seed, os.path.join(scale_dir, app.ATTACHMENT_DIR))
+        generation_ms = (time.perf_counter() - t0) * 1000
+
+        db, available = build_operations(db_path, save_dir)
+        scale_results = {"entries_per_year": entries_per_year, "generation_ms": round(generation_ms, 1),
+                         "db_size_bytes": os.path.getsize(db_path), "operations": {}}
+        for name in operations:
+            stats = time_operation(available[name], repeat)
+            scale_results["operations"][name] = stats
+            print(f"  {name:<24} médiane {stats['median_ms']:>10.2f} ms  (min {stats['min_ms']:.2f})", flush=True)
+        db.close()
+        results[str(scale)] = scale_results
+    return results
+
+
+def _stress_worker(db_path, counter_id, worker_index, operations):
+    """Processus concurrent : insère des écritures et incrémente une écriture partagée (verrouillage optimiste)."""
+    db = app.LedgerRepository(db_path)
+    year_id = db.list_years()[0]['id']
+    stats = {"inserts": 0, "increments": 0, "conflicts": 0, "locked_errors": 0}
+    for i in range(operations):
+        try:
+            db.insert_entry(year_id, date.today().isoformat(), "poste", f"Processus {worker_index} #{i}", "Dons", "recette", 1.0)
+            stats["inserts"] += 1
+            while True:
+                counter = db.get_entry(counter_id)
+                try:
+                    db.update_entry(counter_id, counter['date'], counter['libelle'], counter['category'], counter['type'],
+                                    counter['amount'] + 1, None, expected_version=counter['version'])
+                    stats["increments"] += 1
+                    break
+                except app.ConflictError:
+                    stats["conflicts"] += 1
+        except sqlite3.OperationalError as e:
+            if not app.is_locked_error(e):
+                raise
+            stats["locked_errors"] += 1
+    db.close()
+    return stats
+
+
+def run_concurrency_check(workdir, workers, operations):
+    """Fait travailler plusieurs processus sur le même fichier et vérifie qu'aucune écriture n'est perdue."""
+    db_path = os.path.join(workdir, "concurrency.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    db = app.LedgerRepository(db_path)
+    today = date.today()
+    year_id = db.insert_year("Concurrence", date(today.year, 1, 1).isoformat(), date(today.year, 12, 31).isoformat())
+    counter_id = db.insert_entry(year_id, today.isoformat(), "poste", "Compteur partagé", "Dons", "recette", 0.0)
+
+    print(f"[concurrence] {workers} processus x {operations} opérations...", flush=True)
+    t0 = time.perf_counter()
+    with multiprocessing.Pool(workers) as pool:
+        worker_stats = pool.starmap(_stress_worker, [(db_path, counter_id, i, operations) for i in range(workers)])
+    elapsed_ms = (time.perf_counter() - t0) * 1000
+
+    inserted = db.conn.execute("SELECT COUNT(*) FROM entries WHERE id != ?", (counter_id,)).fetchone()[0]
+    counter = db.get_entry(counter_id)
+    db.close()
+    expected_inserts = sum(w["inserts"] for w in worker_stats)
+    expected_increments = sum(w["increments"] for w in worker_stats)
+    result = {
+        "workers": workers,
+        "operations": operations,
+        "elapsed_ms": round(elapsed_ms, 1),
+        "conflicts_detected": sum(w["conflicts"] for w in worker_stats),
+        "locked_errors": sum(w["locked_errors"] for w in worker_stats),
+        "lost_inserts": expected_inserts - inserted,
+        "lost_updates": expected_increments - int(counter['amount']),
+    }
+    result["ok"] = result["lost_inserts"] == 0 and result["lost_updates"] == 0 and result["locked_errors"] == 0
+    print(f"  {elapsed_ms:.0f} ms, {result['conflicts_detected']} conflits détectés, {result['locked_errors']} erreurs de verrou, "
+          f"{result['lost_inserts']} insertions et {result['lost_updates']} mises à jour perdues -> {'OK' if result['ok'] else 'ÉCHEC'}", flush=True)
+    return result
+
+
+def compare_results(current, previous, threshold):
+    """Affiche l'écart avec un précédent fichier de résultats. Retourne le nombre de régressions."""
+    regressions = 0
+    print(f"\nComparaison avec la version {previous.get('app_version')} ({previous.get('timestamp')}) :")
+    for scale, scale_results in current["results"].items():
+        old_scale = previous.get("results", {}).get(scale)
+        if not old_scale:
+            continue
+        for name, stats in scale_results["operations"].items():
+            old = old_scale["operations"].get(name)
+            if not old or not old["median_ms"]:
+                continue
+            ratio = stats["median_ms"] / old["median_ms"]
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = "  <-- RÉGRESSION"
+                regressions += 1
+            print(f"  [{scale}] {name:<24} {old['median_ms']:>10.2f} -> {stats['median_ms']:>10.2f} ms  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Banc de mesure AETML Compta")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 50000, 500000], help="Nombres totaux d'écritures à générer")
+    parser.add_argument("--years", type=int, default=5, help="Nombre d'exercices générés")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=3, help="Nombre de mesures par opération")
+    parser.add_argument("--only", nargs="+", choices=DEFAULT_OPERATIONS, help="Limiter aux opérations listées")
+    parser.add_argument("--workdir", help="Dossier de travail (temporaire par défaut)")
+    parser.add_argument("--output", help="Fichier JSON de résultats (défaut: bench_<version>_<horodatage>.json)")
+    parser.add_argument("--compare", help="Fichier JSON d'une mesure précédente à comparer")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Tolérance avant de signaler une régression (0.10 = +10%%)")
+    parser.add_argument("--concurrency", type=int, metavar="PROCESSUS", help="Vérifier l'accès concurrent avec ce nombre de processus")
+    parser.add_argument("--concurrency-ops", type=int, default=300, help="Opérations par processus pour --concurrency")
+    args = parser.parse_args(argv)
+
+    operations = args.only or DEFAULT_OPERATIONS
+    with tempfile.TemporaryDirectory(prefix="aetml_bench_") as tmp:
+        workdir = os.path.abspath(args.workdir or tmp)
+        os.makedirs(workdir, exist_ok=True)
+        results = run_benchmarks(args.scales, args.years, args.seed, args.repeat, operations, workdir)
+        concurrency = run_concurrency_check(workdir, args.concurrency, args.concurrency_ops) if args.concurrency else None
+
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    report = {
+        "app_version": app.APP_VERSION,
+        "timestamp": timestamp,
+        "python": sys.version.split()[0],
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "years": args.years,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if concurrency:
+        report["concurrency"] = concurrency
+    output = args.output or f"bench_{app.APP_VERSION}_{timestamp}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nRésultats enregistrés dans {output}")
+
+    if concurrency and not concurrency["ok"]:
+        return 1
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+        if compare_results(report, previous, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
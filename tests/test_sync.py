@@ -0,0 +1,86 @@
+"""Synchronisation entre postes : scénarios de régression (python -m unittest discover tests)."""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_compta_aetml as app
+
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.attachments = {}
+        self.a = app.LedgerRepository(os.path.join(self.tmp, "a.db"))
+        self.b = app.LedgerRepository(os.path.join(self.tmp, "b.db"))
+        for db, name in ((self.a, "a"), (self.b, "b")):
+            self.attachments[db] = os.path.join(self.tmp, f"attachments_{name}")
+        self.a.insert_year("2025", "2025-01-01", "2025-12-31")
+        self.year_id = self.a.list_years()[0]['id']
+        self.packages = 0
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+        shutil.rmtree(self.tmp)
+
+    def add_entry(self, libelle):
+        self.a.insert_entry(self.year_id, "2025-03-01", "poste", libelle, None, "depense", -10.0)
+
+    def send(self, source, dest):
+        self.packages += 1
+        path = os.path.join(self.tmp, f"p{self.packages}{app.SYNC_PACKAGE_EXT}")
+        app.export_sync_package(source, path, attachment_dir=self.attachments[source])
+        return app.import_sync_package(dest, path, attachment_dir=self.attachments[dest])
+
+    def libelles(self, db):
+        return {row[0] for row in db.conn.execute("SELECT libelle FROM entries")}
+
+    def test_changes_after_full_restore_reach_peer(self):
+        self.add_entry("e1")
+        backup_path = os.path.join(self.tmp, "backup.db")
+        self.a.backup_to(backup_path)
+        self.add_entry("e2")
+        self.send(self.a, self.b)
+        self.send(self.b, self.a)
+
+        app.restore_database(self.a, backup_path)
+        self.add_entry("e3")
+        self.assertTrue(self.a.full_export_pending())
+        result = self.send(self.a, self.b)
+
+        self.assertFalse(result['already'])
+        self.assertIn("e3", self.libelles(self.b))
+        self.assertFalse(self.a.full_export_pending())
+
+    def write_attachment(self, db, path, content):
+        full_path = os.path.join(self.attachments[db], path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "wb") as f:
+            f.write(content)
+
+    def test_conflict_attachment_is_not_unreferenced(self):
+        self.write_attachment(self.a, "1/f1.pdf", b"f1")
+        entry_id = self.a.insert_entry(self.year_id, "2025-03-01", "poste", "e1", None, "depense", -10.0, "1/f1.pdf")
+        self.send(self.a, self.b)
+        self.send(self.b, self.a)
+
+        # Modifiée des deux côtés : l'import sur B signale un conflit et garde la pièce reçue
+        self.write_attachment(self.a, "1/f2.pdf", b"f2")
+        with self.a.transaction():
+            self.a.conn.execute("UPDATE entries SET libelle = 'A', attachment_path = '1/f2.pdf' WHERE id = ?", (entry_id,))
+        with self.b.transaction():
+            self.b.conn.execute("UPDATE entries SET libelle = 'B'")
+        result = self.send(self.a, self.b)
+        self.assertEqual(result['conflicts'], 1)
+        self.assertEqual(result['files'], 1)
+
+        report = app.check_integrity(self.b.db_file, self.attachments[self.b], cache_file=os.path.join(self.tmp, "hashes.json"))
+        self.assertEqual(report.unreferenced_files, [])
+
+
+if __name__ == "__main__":
+    unittest.main()